@@ -2,6 +2,7 @@
 from fastapi import APIRouter, HTTPException, Depends, Request, Header, Query, Form
 from typing import Optional, List
 from pydantic import BaseModel, Field, validator
+import asyncio
 import re
 
 from services.bankcard_service import BankcardService
@@ -83,7 +84,9 @@ async def bind_bankcard(
 ):
     """绑定银行卡（需先完成微信进件，自动同步微信数据，需短信验证码）"""
     try:
-        result = BankcardService.bind_bankcard(
+        # 同步查询微信结算账户（限流时可能排队等待），放到线程池执行，避免阻塞事件循环
+        result = await asyncio.to_thread(
+            BankcardService.bind_bankcard,
             user_id=current_user["id"],
             bank_name=request.account_bank,
             bank_account=request.account_number,
@@ -145,7 +148,7 @@ async def apply_modify_bankcard(
 ):
     """申请改绑银行卡（需验证微信数据，原卡自动解绑）"""
     try:
-        result = BankcardService.modify_bankcard(
+        result = await BankcardService.modify_bankcard(
             user_id=current_user["id"],
             new_bank_name=request.new_account_bank,
             new_bank_account=request.new_account_number,
@@ -168,7 +171,8 @@ async def get_modify_status(
 ):
     """查询改绑申请审核状态（自动同步微信最新状态）"""
     try:
-        result = BankcardService.poll_modify_status(
+        result = await asyncio.to_thread(
+            BankcardService.poll_modify_status,
             user_id=current_user["id"],
             application_no=application_no
         )
@@ -197,7 +201,7 @@ async def get_bind_status(
 ):
     """查询用户银行卡绑定状态（包含微信同步信息）"""
     try:
-        result = BankcardService.query_bind_status(user_id=current_user["id"])
+        result = await asyncio.to_thread(BankcardService.query_bind_status, user_id=current_user["id"])
         return {"code": 0, "message": "查询成功", "data": result}
     except Exception as e:
         logger.error(f"查询状态失败: {e}")
@@ -11,6 +11,7 @@ from core.logging import get_logger
 from core.table_access import build_dynamic_select
 from database_setup import DatabaseManager
 from services.finance_service import FinanceService
+from services.user_display_service import UserDisplayService
 from core.exceptions import FinanceException, OrderException, InsufficientBalanceException
 from core.config import (
     PLATFORM_MERCHANT_ID,
@@ -272,29 +273,13 @@ async def get_public_welfare_flow(
     try:
         flows = service.get_public_welfare_flow(limit)
 
-        def get_user_name(uid):
-            if not uid:
-                return "系统"
-            try:
-                with get_conn() as conn:
-                    with conn.cursor() as cur:
-                        select_sql = build_dynamic_select(
-                            cur,
-                            "users",
-                            where_clause="id = %s",
-                            select_fields=["name"]
-                        )
-                        cur.execute(select_sql, (uid,))
-                        row = cur.fetchone()
-                        return row["name"] if row else "未知用户"
-            except Exception as e:
-                return f"未知用户:{e}"
+        user_names = UserDisplayService.get_names(flow['related_user'] for flow in flows)
 
         data = {
             "flows": [{
                 "id": flow['id'],
                 "related_user": flow['related_user'],
-                "user_name": get_user_name(flow['related_user']),
+                "user_name": UserDisplayService.display_name(user_names, flow['related_user']),
                 "account_type": "public_welfare",  # 新增：明确资金池
                 "change_amount": str(flow['change_amount']),
                 "balance_after": str(flow['balance_after']) if flow['balance_after'] else None,
@@ -318,27 +303,11 @@ async def get_public_welfare_report(
     try:
         report_data = service.get_public_welfare_report(start_date, end_date)
 
-        def get_user_name(uid):
-            if not uid:
-                return "系统"
-            try:
-                with get_conn() as conn:
-                    with conn.cursor() as cur:
-                        select_sql = build_dynamic_select(
-                            cur,
-                            "users",
-                            where_clause="id = %s",
-                            select_fields=["name"]
-                        )
-                        cur.execute(select_sql, (uid,))
-                        row = cur.fetchone()
-                        return row["name"] if row else "未知用户"
-            except Exception as e:
-                return f"未知用户:{e}"
+        user_names = UserDisplayService.get_names(item['related_user'] for item in report_data['details'])
 
         details = [{
             **item,
-            "user_name": get_user_name(item['related_user']),
+            "user_name": UserDisplayService.display_name(user_names, item['related_user']),
             "change_amount": str(item['change_amount']),
             "balance_after": str(item['balance_after']) if item['balance_after'] else None,
             "created_at": item['created_at'].strftime("%Y-%m-%d %H:%M:%S") if isinstance(item['created_at'],
@@ -1237,6 +1206,7 @@ async def get_platform_flow_summary(
         include_detail: bool = Query(True, description="是否包含明细记录"),
         page: int = Query(1, ge=1, description="页码"),
         page_size: int = Query(50, ge=1, le=200, description="每页条数"),
+        cursor: Optional[str] = Query(None, description="分页游标（上一页返回的 next_cursor，传入后忽略 page）；总数仅首页返回"),
         service: FinanceService = Depends(get_finance_service)
 ):
     """
@@ -1256,15 +1226,18 @@ async def get_platform_flow_summary(
             user_id=user_id,
             include_detail=include_detail,
             page=page,
-            page_size=page_size
+            page_size=page_size,
+            cursor=cursor
         )
 
         total_pools = len(data['pools_summary'])
         total_records = data['pagination']['total']
+        # 总数只在首页返回
+        records_msg = f", {total_records}笔交易" if total_records is not None else ""
 
         return ResponseModel(
             success=True,
-            message=f"平台综合流水报表生成成功: {total_pools}个资金池, {total_records}笔交易",
+            message=f"平台综合流水报表生成成功: {total_pools}个资金池{records_msg}",
             data=data
         )
     except FinanceException as e:
@@ -18,6 +18,7 @@ from services.notify_service import handle_pay_notify
 from decimal import Decimal, ROUND_HALF_UP
 from services.finance_service import FinanceService
 from core.rate_limiter import pay_bridge_ip_limiter
+from core.event_bus import order_event_bus
 from services.wechat_api import (
     get_or_create_permanent_pay_openlink,
     get_or_create_permanent_pay_urllink,
@@ -515,8 +516,8 @@ async def unified_order(
 @router.post("/zhifu/notify", summary="微信回调")
 async def pay_notify(request: Request):
     raw_body = await request.body()
-    # 唯一变动：把原来 OfflineService.handle_notify 换成新的 handle_pay_notify
-    result = await handle_pay_notify(raw_body)
+    # 验签需要 Wechatpay-* 请求头；结算由支付回调收件箱异步完成
+    result = await handle_pay_notify(raw_body, request.headers)
     return Response(content=result, media_type="application/xml")
 
 
@@ -585,6 +586,26 @@ async def qrcode_status(
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@router.get("/shoukuanma/zhuangtai/wait", summary="收款码状态（长轮询）")
+async def qrcode_status_wait(
+    order_no: str = Query(...),
+    timeout: int = Query(25, ge=1, le=30, description="最长等待秒数"),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    收款码仍为 valid 时挂起等待支付回调事件，到达后回查一次；超时返回当前状态，客户端重新发起即可
+    """
+    try:
+        async with order_event_bus.subscribe(order_no) as queue:
+            result = await OfflineService.qrcode_status(order_no=order_no, merchant_id=current_user["id"])
+            if result["status"] == "valid" and await order_event_bus.wait(queue, timeout) is not None:
+                result = await OfflineService.qrcode_status(order_no=order_no, merchant_id=current_user["id"])
+        return {"code": 0, "message": "查询成功", "data": result}
+    except Exception as e:
+        logger.error(f"收款码状态查询失败: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 # ------------------ 9. 注册函数 ------------------
 def register_offline_routes(app) -> None:
     shared = {
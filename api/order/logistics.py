@@ -1,9 +1,11 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import Optional, Dict, Any
-import requests
+import httpx
 import json
 
+from core.http_client import sync_request
+
 router = APIRouter()
 
 class LogisticsManager:
@@ -26,10 +28,10 @@ class LogisticsManager:
             "param": json.dumps(param)
         }
         try:
-            resp = requests.post(url, data=payload, timeout=10)
+            resp = sync_request("POST", url, endpoint="kuaidi100.query", idempotent=True, data=payload)
             resp.raise_for_status()
             return resp.json()
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             raise HTTPException(status_code=500, detail=f"物流查询失败: {str(e)}")
 
 class LogisticsQuery(BaseModel):
@@ -7,6 +7,7 @@ from services.finance_service import get_balance, withdraw
 from decimal import Decimal
 from .refund import RefundManager
 from core.logging import get_logger
+from services.order_detail_cache import OrderDetailCache
 
 router = APIRouter()
 logger = get_logger(__name__)
@@ -117,8 +118,6 @@ class MerchantManager:
                     "WHERE order_number=%s AND status='pending_ship'",
                     (actual_tracking, order_number)
                 )
-                conn.commit()
-
                 updated = cur.rowcount > 0
                 result["local_updated"] = updated
 
@@ -126,78 +125,40 @@ class MerchantManager:
                     result["message"] = "更新订单状态失败"
                     return result
 
+                # ===== 发货信息录入微信：同一事务入队，由 ShippingSyncService 批量异步上传 =====
+                transaction_id = order_info.get("transaction_id")
+                if transaction_id:
+                    from services.shipping_sync_service import ShippingSyncService
+                    from services.wechat_shipping_v2_service import LOGISTICS_TYPE_MAP
+
+                    # 物流类型映射
+                    wx_logistics_type = LOGISTICS_TYPE_MAP.get(delivery_way, 1)
+
+                    # 快递公司编码映射（常见中文名称）
+                    express_mapping = {
+                        "圆通": "YTO", "韵达": "YUNDA", "中通": "ZTO", "申通": "STO",
+                        "顺丰": "SF", "京东": "JD", "邮政": "EMS", "极兔": "JTSD"
+                    }
+                    company = express_company or "YTO"
+                    if company in express_mapping:
+                        company = express_mapping[company]
+                    company = company.upper()
+
+                    ShippingSyncService.enqueue(
+                        cur, order_info["id"], order_number, transaction_id, wx_logistics_type,
+                        tracking_no=actual_tracking if wx_logistics_type in (1, 2) else None,
+                        express_company=company if wx_logistics_type in (1, 2) else None,
+                    )
+                else:
+                    logger.warning(f"订单 {order_number} 缺少 transaction_id，无法同步微信发货")
+                conn.commit()
+                # ===================================
+
+                OrderDetailCache.invalidate(order_number)
                 result["ok"] = True
                 result["message"] = "发货成功"
-
-                # ===== 同步发货信息到微信 =====
-                try:
-                    transaction_id = order_info.get("transaction_id")
-                    openid = order_info.get("openid")
-                    if transaction_id and openid:
-                        from services.wechat_shipping_v2_service import WechatShippingService, LOGISTICS_TYPE_MAP
-                        wx_service = WechatShippingService()
-
-                        # 查询订单商品名称，构造 item_desc
-                        with get_conn() as inner_conn:  # 独立连接，不影响外层事务
-                            with inner_conn.cursor() as inner_cur:
-                                inner_cur.execute("""
-                                    SELECT p.name
-                                    FROM order_items oi
-                                    JOIN products p ON oi.product_id = p.id
-                                    WHERE oi.order_id = %s
-                                """, (order_info['id'],))
-                                products = inner_cur.fetchall()
-
-                        logger.info(f"订单 {order_number} 商品名称: {[p['name'] for p in products]}")
-
-                        # 清理特殊字符并拼接商品名
-                        import re
-                        clean_names = [re.sub(r'[\r\n\t]', '', p['name']) for p in products]
-                        joined = '、'.join(clean_names)
-                        if len(joined) > 120:
-                            item_desc = joined[:117] + "…"
-                        else:
-                            item_desc = joined
-                        if not item_desc:
-                            item_desc = "商品"
-                        # 确保UTF8编码
-                        item_desc = item_desc.encode('utf-8').decode('utf-8')
-
-                        # 物流类型映射
-                        wx_logistics_type = LOGISTICS_TYPE_MAP.get(delivery_way, 1)
-
-                        # 快递公司编码映射（常见中文名称）
-                        express_mapping = {
-                            "圆通": "YTO", "韵达": "YUNDA", "中通": "ZTO", "申通": "STO",
-                            "顺丰": "SF", "京东": "JD", "邮政": "EMS", "极兔": "JTSD"
-                        }
-                        company = express_company or "YTO"
-                        if company in express_mapping:
-                            company = express_mapping[company]
-                        company = company.upper()
-
-                        shipping_list = [{"item_desc": item_desc}]
-                        if wx_logistics_type in [1, 2]:  # 快递或同城配送需填写物流单号
-                            shipping_list[0]["tracking_no"] = actual_tracking
-                            shipping_list[0]["express_company"] = company
-
-                        wx_result = wx_service.upload_shipping_info(
-                            transaction_id=transaction_id,
-                            openid=openid,
-                            logistics_type=wx_logistics_type,
-                            shipping_list=shipping_list,
-                            delivery_mode=1
-                        )
-
-                        if wx_result.get("errcode") == 0:
-                            logger.info(f"订单 {order_number} 发货信息同步微信成功")
-                        else:
-                            logger.error(f"订单 {order_number} 发货信息同步微信失败: {wx_result}")
-                    else:
-                        logger.warning(f"订单 {order_number} 缺少 transaction_id 或 openid，无法同步微信发货")
-                except Exception as e:
-                    logger.error(f"订单 {order_number} 调用微信发货接口异常: {e}", exc_info=True)
-                # ===================================
+                if transaction_id:
+                    ShippingSyncService.kick()
 
                 return result
 
@@ -4,18 +4,21 @@ from services.finance_service import (
     max_coupon_total_yuan,
     parse_pending_coupon_ids,
 )
-from fastapi import APIRouter, HTTPException, Query, Request, Depends
+from fastapi import APIRouter, HTTPException, Query, Request, Response, Depends
 from pydantic import BaseModel, Field, ConfigDict, AliasChoices, model_validator
 from typing import Optional, List, Dict, Any, cast
 from core.config import Settings, settings
 from core.database import get_conn
+from core.db_adapter import build_date_range, build_in_placeholders
 from services.finance_service import split_order_funds
+from services.flow_ref_service import FlowRefService
 from core.config import VALID_PAY_WAYS, POINTS_DISCOUNT_RATE
 from core.table_access import build_dynamic_select, get_table_structure, _quote_identifier
 from decimal import Decimal, ROUND_DOWN
 import uuid
 from datetime import datetime, timedelta
 from enum import Enum
+import asyncio
 import json
 import threading
 import time
@@ -27,39 +30,24 @@ from io import BytesIO
 from typing import List, Dict, Any
 from fastapi.responses import StreamingResponse
 
-# ==================== 新增：导入 Redis 用于分布式锁 ====================
-import redis
-import redis.exceptions
+# 幂等键/下单锁：Redis 优先，不可用时自动落到 MySQL（见 core/idempotency.py）
+from core.idempotency import idempotency_store
+from services.order_detail_cache import OrderDetailCache, etag_matches
+from core.event_bus import order_event_bus
 
 logger = get_logger(__name__)
 router = APIRouter()
 
+# 下单防重锁持有时间（秒）与幂等键保留时间（秒）
+ORDER_CREATE_LOCK_TTL = 5
+ORDER_IDEMPOTENCY_TTL = 86400
 
-# ==================== 新增：Redis 客户端初始化（带容错） ====================
-def _get_redis_client():
-    """获取 Redis 客户端，如果未配置则返回 None"""
-    try:
-        redis_host = getattr(settings, 'REDIS_HOST', 'localhost')
-        redis_port = getattr(settings, 'REDIS_PORT', 6379)
-        redis_db = getattr(settings, 'REDIS_DB', 0)
-
-        client = redis.Redis(
-            host=redis_host,
-            port=redis_port,
-            db=redis_db,
-            decode_responses=True,
-            socket_connect_timeout=2,
-            socket_timeout=2
-        )
-        client.ping()
-        return client
-    except Exception as e:
-        logger.warning(f"Redis 连接失败（将使用数据库兜底）: {e}")
-        return None
+# 支付状态 SSE 单连接最长保持时间与心跳间隔（秒）
+PAY_STATUS_SSE_MAX_SECONDS = 120
+PAY_STATUS_SSE_HEARTBEAT_SECONDS = 15
 
-
-# 全局 Redis 客户端
-redis_client = _get_redis_client()
+# 导出时单次 IN 查询的订单/用户数量
+EXPORT_LOOKUP_CHUNK = 500
 
 
 def _cancel_expire_orders():
@@ -76,7 +64,8 @@ def _cancel_expire_orders():
                           AND expire_at IS NOT NULL
                           AND expire_at <= %s
                     """, (now,))
-                    for o in cur.fetchall():
+                    expired = cur.fetchall()
+                    for o in expired:
                         oid, ono = o["id"], o["order_number"]
 
                         # 删除该订单的待发放奖励记录
@@ -110,6 +99,9 @@ def _cancel_expire_orders():
                         )
                         print(f"[expire] 订单 {ono} 已自动取消")
                     conn.commit()
+                    OrderDetailCache.invalidate_many(o["order_number"] for o in expired)
+                    for o in expired:
+                        order_event_bus.publish(o["order_number"], {"event": "cancelled"})
         except Exception as e:
             print(f"[expire] error: {e}")
         time.sleep(60)
@@ -150,23 +142,37 @@ class OrderManager:
             merchant_id: Optional[int] = None
     ) -> Optional[str]:
         """创建订单（已增加幂等性校验，防止重复创建，支持多商家订单）"""
-        lock_key = f"order:create:{user_id}"
-        lock_acquired = False
+        used_key = f"order:idempotency:{idempotency_key}" if idempotency_key else None
 
-        if redis_client:
+        def _existing_order() -> Optional[Dict[str, Any]]:
+            existing_order = idempotency_store.get_result(used_key) if used_key else None
+            if not existing_order:
+                return None
+            logger.info(f"幂等 Key 重复，返回已存在订单: {existing_order}")
             try:
-                lock_acquired = redis_client.set(lock_key, idempotency_key or "1", nx=True, ex=5)
-                if not lock_acquired:
-                    logger.warning(f"用户 {user_id} 重复提交订单，Redis 锁拦截")
-                    raise HTTPException(
-                        status_code=429,
-                        detail="订单创建中，请勿重复提交，或等待 5 秒后重试"
-                    )
-            except redis.exceptions.RedisError as e:
-                logger.error(f"Redis 锁操作失败: {e}，将降级为数据库锁")
-                lock_acquired = False
+                return json.loads(existing_order)
+            except ValueError:
+                return {"order_number": existing_order, "need_pay": True}
+
+        existing = _existing_order()
+        if existing:
+            return existing
+
+        lock_key = f"order:create:{user_id}"
+        lock_token = idempotency_store.acquire_lock(lock_key, ttl=ORDER_CREATE_LOCK_TTL)
+        if not lock_token:
+            logger.warning(f"用户 {user_id} 重复提交订单，下单锁拦截")
+            raise HTTPException(
+                status_code=429,
+                detail="订单创建中，请勿重复提交，或等待 5 秒后重试"
+            )
 
         try:
+            # 持锁后再查一次：首个请求写入结果后才释放锁，紧随其后的重试在这里拿到已创建的订单
+            existing = _existing_order()
+            if existing:
+                return existing
+
             with get_conn() as conn:
                 with conn.cursor() as cur:
 
@@ -189,13 +195,6 @@ class OrderManager:
                                 detail=f"您刚刚已创建订单 {recent_order['order_number']}，请勿重复提交"
                             )
 
-                    if idempotency_key and redis_client:
-                        used_key = f"order:idempotency:{idempotency_key}"
-                        if redis_client.exists(used_key):
-                            existing_order = redis_client.get(used_key)
-                            logger.info(f"幂等 Key 重复，返回已存在订单: {existing_order}")
-                            return existing_order
-
                     # ---------- 1. 组装订单明细 ----------
                     if buy_now:
                         if not buy_now_items:
@@ -461,24 +460,23 @@ class OrderManager:
                             external_conn=conn
                         )
 
-                    if idempotency_key and redis_client:
-                        used_key = f"order:idempotency:{idempotency_key}"
-                        redis_client.setex(used_key, 86400, order_number)
-
                     conn.commit()
                     logger.info(f"订单创建成功: {order_number}, 用户: {user_id}, 商家: {merchant_id}")
 
-                    return {
+                    result = {
                         "order_number": order_number,
                         "need_pay": not is_zero_order
                     }
+                    if used_key:
+                        try:
+                            idempotency_store.save_result(used_key, json.dumps(result), ttl=ORDER_IDEMPOTENCY_TTL)
+                        except Exception as e:
+                            logger.error(f"写入下单幂等键失败: {e}")
+
+                    return result
 
         finally:
-            if lock_acquired and redis_client:
-                try:
-                    redis_client.delete(lock_key)
-                except Exception as e:
-                    logger.error(f"释放 Redis 锁失败: {e}")
+            idempotency_store.release_lock(lock_key, lock_token)
 
     @staticmethod
     def list_by_user(user_id: int, status: Optional[str] = None):
@@ -531,13 +529,10 @@ class OrderManager:
                     where_conditions.append("status = %s")
                     params.append(status)
 
-                if start_date:
-                    where_conditions.append("DATE(created_at) >= %s")
-                    params.append(start_date)
-
-                if end_date:
-                    where_conditions.append("DATE(created_at) <= %s")
-                    params.append(end_date)
+                date_sql, date_params = build_date_range("created_at", start_date, end_date)
+                if date_sql:
+                    where_conditions.append(date_sql)
+                    params.extend(date_params)
 
                 where_clause = " AND ".join(where_conditions)
 
@@ -694,6 +689,15 @@ class OrderManager:
                     "coupon_discount": float(order.get("coupon_discount") or 0),
                 }
 
+    @staticmethod
+    def get_status(order_number: str) -> Optional[str]:
+        """仅查询订单状态（长轮询/SSE 用）"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT status FROM orders WHERE order_number=%s LIMIT 1", (order_number,))
+                row = cur.fetchone()
+                return row["status"] if row else None
+
     @staticmethod
     def update_status(order_number: str, new_status: str, reason: Optional[str] = None,
                       external_conn=None) -> bool:
@@ -725,17 +729,21 @@ class OrderManager:
             return cur.rowcount > 0
 
         if external_conn:
+            # 由调用方提交事务；提前失效最多让旧详情多保留一个缓存 TTL
             cur = external_conn.cursor()
             try:
-                return _apply_update(cur)
+                updated = _apply_update(cur)
             finally:
                 cur.close()
+            OrderDetailCache.invalidate(order_number)
+            return updated
         else:
             with get_conn() as conn:
                 with conn.cursor() as cur:
                     updated = _apply_update(cur)
                     conn.commit()
-                    return updated
+            OrderDetailCache.invalidate(order_number)
+            return updated
 
     @staticmethod
     def confirm_receive(order_number: str, user_id: Optional[int] = None) -> Dict[str, Any]:
@@ -765,12 +773,94 @@ class OrderManager:
                     (order['id'],)
                 )
                 conn.commit()
+        OrderDetailCache.invalidate(order_number)
 
         logger.info(f"用户 {user_id or order['user_id']} 确认收货成功，订单号：{order_number}")
 
         # 不再主动调用微信接口，微信侧订单状态将由用户通过官方确认收货组件触发的回调更新
         return {"ok": True, "message": "确认收货成功"}
 
+    @staticmethod
+    def _fetch_in(cur, sql: str, values: List[Any]) -> List[dict]:
+        """按 EXPORT_LOOKUP_CHUNK 分批执行 `... IN ({placeholders})` 查询并合并结果"""
+        rows: List[dict] = []
+        values = list(dict.fromkeys(v for v in values if v))
+        for i in range(0, len(values), EXPORT_LOOKUP_CHUNK):
+            placeholders, params = build_in_placeholders(values[i:i + EXPORT_LOOKUP_CHUNK])
+            cur.execute(sql.format(placeholders=placeholders), tuple(params.values()))
+            rows.extend(cur.fetchall())
+        return rows
+
+    @staticmethod
+    def _load_export_orders(cur, order_numbers: List[str]) -> Dict[str, dict]:
+        """导出用：在调用方游标（只读从库）上批量加载订单、商品明细、用户、商家与资金流水
+
+        返回 {order_number: {"order_info", "user", "merchant", "address", "items", "specifications", "flows"}}；
+        flows 仅在 account_flow 已有 related_order_id 时批量加载，否则为 None（由调用方按备注回查）
+        """
+        fetch_in = OrderManager._fetch_in
+        select_fields = OrderManager._build_orders_select(cur)
+        orders = fetch_in(cur, f"SELECT {select_fields} FROM orders WHERE order_number IN ({{placeholders}})",
+                          order_numbers)
+        if not orders:
+            return {}
+
+        items_by_order: Dict[Any, List[dict]] = {}
+        for item in fetch_in(
+                cur,
+                """SELECT oi.*, p.name AS product_name, p.is_member_product, p.cover AS product_cover, p.cash_only
+                   FROM order_items oi
+                   LEFT JOIN products p ON oi.product_id = p.id
+                   WHERE oi.order_id IN ({placeholders})""",
+                [o["id"] for o in orders]):
+            items_by_order.setdefault(item["order_id"], []).append(item)
+
+        users = {u["id"]: u for u in fetch_in(
+            cur,
+            "SELECT id, name, mobile, avatar, member_level, member_points FROM users WHERE id IN ({placeholders})",
+            [o.get("user_id") for o in orders])}
+        merchants = {m["id"]: m for m in fetch_in(
+            cur,
+            """SELECT u.id, u.name, u.mobile, u.avatar, u.wechat_sub_mchid,
+                      ms.store_name, ms.store_logo_image_id, ms.store_address
+               FROM users u
+               LEFT JOIN merchant_stores ms ON ms.user_id = u.id
+               WHERE u.id IN ({placeholders}) AND u.is_merchant = 1""",
+            [o.get("merchant_id") for o in orders if (o.get("merchant_id") or 0) > 0])}
+
+        flows_by_order: Optional[Dict[Any, List[dict]]] = None
+        if FlowRefService.refs_ready():
+            flows_by_order = {o["id"]: [] for o in orders}
+            for flow in fetch_in(
+                    cur,
+                    """SELECT related_order_id, account_type, change_amount, balance_after,
+                              flow_type, remark, created_at
+                       FROM account_flow
+                       WHERE related_order_id IN ({placeholders})
+                       ORDER BY created_at ASC, id ASC""",
+                    [o["id"] for o in orders]):
+                flows_by_order[flow["related_order_id"]].append(flow)
+
+        result: Dict[str, dict] = {}
+        for o in orders:
+            result[o["order_number"]] = {
+                "order_info": o,
+                "user": users.get(o.get("user_id")),
+                "merchant": merchants.get(o.get("merchant_id")),
+                "address": {
+                    "consignee_name": o.get("consignee_name"),
+                    "consignee_phone": o.get("consignee_phone"),
+                    "province": o.get("province"),
+                    "city": o.get("city"),
+                    "district": o.get("district"),
+                    "detail": o.get("shipping_address"),
+                },
+                "items": items_by_order.get(o["id"], []),
+                "specifications": o.get("refund_reason"),
+                "flows": flows_by_order.get(o["id"], []) if flows_by_order is not None else None,
+            }
+        return result
+
     @staticmethod
     def export_to_excel(order_numbers: List[str]) -> bytes:
         """
@@ -838,15 +928,17 @@ class OrderManager:
         row_idx1 = 2
         row_idx2 = 2
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
+                # 订单/明细/用户/商家/流水在只读连接上分批 IN 查询，不再逐单调用 detail()（走主库、每单多次查询）
+                export_orders = OrderManager._load_export_orders(cur, order_numbers)
                 for order_number in order_numbers:
-                    order_data = OrderManager.detail(order_number)
+                    order_data = export_orders.get(order_number)
                     if not order_data:
                         continue
 
                     order_info = order_data["order_info"]
-                    user_info = order_data["user"]
+                    user_info = order_data["user"] or {}
                     merchant_info = order_data.get("merchant")
                     address = order_data["address"] or {}
                     items = order_data["items"]
@@ -907,15 +999,17 @@ class OrderManager:
 
                     row_idx1 += 1
 
-                    cur.execute("""
-                        SELECT account_type, change_amount, balance_after, 
-                               flow_type, remark, created_at
-                        FROM account_flow 
-                        WHERE remark LIKE %s
-                        ORDER BY created_at ASC
-                    """, (f"%{order_number}%",))
-
-                    flows = cur.fetchall()
+                    flows = order_data["flows"]
+                    if flows is None:
+                        # 流水尚未回填 related_order_id：按备注中的订单号回查
+                        cur.execute("""
+                            SELECT account_type, change_amount, balance_after, 
+                                   flow_type, remark, created_at
+                            FROM account_flow 
+                            WHERE remark LIKE %s
+                            ORDER BY created_at ASC
+                        """, (f"%{order_number}%",))
+                        flows = cur.fetchall()
 
                     platform_fee = float(actual_pay) * 0.2
 
@@ -1216,13 +1310,78 @@ def list_orders(user_id: int, status: Optional[str] = None):
 
 
 @router.get("/detail/{order_number}", summary="查询订单详情")
-def order_detail(order_number: str):
-    d = OrderManager.detail(order_number)
+def order_detail(order_number: str, request: Request, response: Response):
+    """支持 ETag / If-None-Match：详情未变化时返回 304，供支付/发货状态轮询使用"""
+    d, etag = OrderDetailCache.load(order_number, OrderManager.detail)
     if not d:
         raise HTTPException(status_code=404, detail="订单不存在")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
     return d
 
 
+@router.get("/pay-status/{order_number}/wait", summary="长轮询等待订单状态变化")
+async def wait_pay_status(
+        order_number: str,
+        since: str = Query("pending_pay", description="客户端当前已知的订单状态"),
+        timeout: int = Query(25, ge=1, le=30, description="最长等待秒数"),
+):
+    """
+    状态与 since 不同时立即返回；否则挂起等待支付回调事件，超时返回当前已知状态（changed=False），
+    客户端随即重新发起即可。每次请求最多两次状态查询，替代每秒轮询订单详情。
+    """
+    async with order_event_bus.subscribe(order_number) as queue:
+        status = await asyncio.to_thread(OrderManager.get_status, order_number)
+        if status is None:
+            raise HTTPException(status_code=404, detail="订单不存在")
+        if status != since:
+            return {"order_number": order_number, "status": status, "changed": True}
+        event = await order_event_bus.wait(queue, timeout)
+
+    if event is not None:
+        status = await asyncio.to_thread(OrderManager.get_status, order_number)
+    return {"order_number": order_number, "status": status, "changed": status != since}
+
+
+@router.get("/pay-status/{order_number}/events", summary="订单支付状态事件流（SSE）")
+async def pay_status_events(order_number: str, request: Request):
+    """
+    Server-Sent Events：连接建立后先推送一次当前状态，之后仅在支付回调事件到达时回查并推送；
+    订单离开 pending_pay 或超过 PAY_STATUS_SSE_MAX_SECONDS 后关闭，空闲期间发送心跳注释。
+    """
+    if await asyncio.to_thread(OrderManager.get_status, order_number) is None:
+        raise HTTPException(status_code=404, detail="订单不存在")
+
+    def _sse(status: Optional[str]) -> str:
+        data = json.dumps({"order_number": order_number, "status": status}, ensure_ascii=False)
+        return f"event: status\ndata: {data}\n\n"
+
+    async def _stream():
+        async with order_event_bus.subscribe(order_number) as queue:
+            status = await asyncio.to_thread(OrderManager.get_status, order_number)
+            yield _sse(status)
+            deadline = time.monotonic() + PAY_STATUS_SSE_MAX_SECONDS
+            while status == "pending_pay" and time.monotonic() < deadline:
+                if await request.is_disconnected():
+                    break
+                event = await order_event_bus.wait(queue, PAY_STATUS_SSE_HEARTBEAT_SECONDS)
+                if event is None:
+                    yield ": ping\n\n"
+                    continue
+                new_status = await asyncio.to_thread(OrderManager.get_status, order_number)
+                if new_status != status:
+                    status = new_status
+                    yield _sse(status)
+
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/status", summary="更新订单状态")
 def update_status(body: StatusUpdate):
     return {"ok": OrderManager.update_status(body.order_number, body.new_status, body.reason)}
@@ -1289,6 +1448,7 @@ def auto_receive_task(db_cfg: dict = None):
                                 (order_id,)
                             )
                             conn.commit()
+                            OrderDetailCache.invalidate(order_number)
                             logger.debug(f"[auto_receive] 订单 {order_number} 已自动完成。")
             except Exception as e:
                 logger.error(f"[auto_receive] 异常: {e}")
@@ -1353,7 +1513,7 @@ def export_orders_by_time(body: OrderExportByTimeRequest):
             status_code=422,
             detail="时间范围不能超过31天"
         )
-    with get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         with conn.cursor() as cur:
             if body.status:
                 sql = """
@@ -4,12 +4,11 @@ from typing import Optional, Dict, Any
 from datetime import datetime, timedelta
 from core.database import get_conn
 from core.table_access import build_dynamic_select
-from services.finance_service import reverse_split_on_refund
-from core.wx_pay_client import wxpay_client
-from core.config import settings
 from core.logging import get_logger
-from decimal import Decimal
-from services.finance_service import FinanceService, reverse_split_on_refund
+from services.finance_service import reverse_split_on_refund
+from services.flow_ref_service import FlowRefService
+from services.refund_service import RefundService
+from services.order_detail_cache import OrderDetailCache
 
 logger = get_logger(__name__)
 
@@ -140,6 +139,7 @@ class RefundManager:
                             )
 
                             conn.commit()
+                            OrderDetailCache.invalidate(order_number)
                             logger.info(f"【退款审核】零元订单事务已提交")
 
                             # 调用积分/优惠券回退（独立事务，不影响已提交的退款事务）
@@ -184,32 +184,23 @@ class RefundManager:
                         raise HTTPException(status_code=400, detail="订单金额无效，无法退款")
 
                     sub_mchid = order_info.get('wechat_sub_mchid')
-                    out_refund_no = f"REF{order_number}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-                    logger.info(f"【退款审核】退款单号: {out_refund_no}, 金额: {refund_fee}分")
-
-                    # 调用微信退款
-                    try:
-                        refund_result = wxpay_client.refund(
-                            transaction_id=transaction_id,
-                            out_refund_no=out_refund_no,
-                            total_fee=total_fee,
-                            refund_fee=refund_fee,
-                            notify_url=f"{settings.public_base_url}/api/wechat-pay/refund-notify",
-                            sub_mchid=sub_mchid
-                        )
-                        logger.info(f"【退款审核】微信退款受理成功: {refund_result}")
-                    except Exception as e:
-                        logger.error(f"【退款审核】微信退款调用失败: {e}", exc_info=True)
-                        raise HTTPException(status_code=500, detail=f"微信退款调用失败: {str(e)}")
 
-                    cur.execute(
-                        "UPDATE orders SET refund_no=%s WHERE order_number=%s",
-                        (out_refund_no, order_number)
+                    # 只登记退款任务，微信退款接口由 RefundService worker 在事务外调用（含限流与重试），
+                    # 受理成功后再执行分账回冲
+                    out_refund_no = RefundService.enqueue(
+                        cur,
+                        order_number=order_number,
+                        transaction_id=transaction_id,
+                        total_fee=total_fee,
+                        refund_fee=refund_fee,
+                        sub_mchid=sub_mchid,
+                        prev_order_status=current_status,
                     )
-                    reverse_split_on_refund(order_number)
+                    logger.info(f"【退款审核】退款任务已入队: {out_refund_no}, 金额: {refund_fee}分")
+
                     cur.execute(
-                        "UPDATE orders SET status='refunding' WHERE order_number=%s",
-                        (order_number,)
+                        "UPDATE orders SET refund_no=%s, status='refunding' WHERE order_number=%s",
+                        (out_refund_no, order_number)
                     )
                     # 更新退款申请状态为“卖家同意”
                     cur.execute(
@@ -220,6 +211,8 @@ class RefundManager:
                         (merchant_address, order_number)
                     )
                     conn.commit()
+                    OrderDetailCache.invalidate(order_number)
+                    RefundService.kick()
                     logger.info(f"【退款审核】处理完成: {order_number}")
                     return True
 
@@ -244,6 +237,7 @@ class RefundManager:
                         (new_status, order_number)
                     )
                     conn.commit()
+                    OrderDetailCache.invalidate(order_number)
                     logger.info(f"【退款审核】处理完成: {order_number}")
                     return True
 
@@ -323,13 +317,22 @@ def query_refund_status(order_number: str):
                 raise HTTPException(status_code=404, detail="订单不存在")
             
             # 查询资金回冲流水
-            cur.execute(
-                """SELECT id, account_type, change_amount, flow_type, remark, created_at 
-                   FROM account_flow 
-                   WHERE remark LIKE %s 
-                   ORDER BY created_at DESC""",
-                (f"%{order_number}%",)
-            )
+            if FlowRefService.refs_ready():
+                cur.execute(
+                    """SELECT id, account_type, change_amount, flow_type, remark, created_at
+                       FROM account_flow
+                       WHERE related_order_id = %s
+                       ORDER BY created_at DESC""",
+                    (order['id'],)
+                )
+            else:
+                cur.execute(
+                    """SELECT id, account_type, change_amount, flow_type, remark, created_at 
+                       FROM account_flow 
+                       WHERE remark LIKE %s 
+                       ORDER BY created_at DESC""",
+                    (f"%{order_number}%",)
+                )
             flows = cur.fetchall()
             
             # 查询退款申请表
@@ -388,12 +391,15 @@ def sync_refund_status(order_number: str):
             refund_no = row['refund_no']
             if not refund_no:
                 raise HTTPException(status_code=400, detail="未找到退款单号")
-    
-    # 这里可以添加调用微信查询接口的逻辑
-    # 暂时返回提示
+
+    try:
+        result = RefundService.sync_order(order_number)
+    except Exception as e:
+        logger.error(f"同步退款状态失败 {order_number}: {e}", exc_info=True)
+        raise HTTPException(status_code=502, detail=f"查询微信退款状态失败: {str(e)}")
+
     return {
         "order_number": order_number,
         "refund_no": refund_no,
-        "message": "请确认微信商户平台退款状态后，如需更新可联系管理员手动更新",
-        "manual_update_sql": f"UPDATE orders SET status='refunded' WHERE order_number='{order_number}';"
-    }
\ No newline at end of file
+        **(result or {}),
+    }
@@ -10,6 +10,7 @@ from core.table_access import build_dynamic_select, get_table_structure
 from pypinyin import lazy_pinyin, Style
 from core.auth import get_current_user
 from core.logging import get_logger  # ✅ 新增：日志
+from services.cart_service import CartService
 
 logger = get_logger(__name__)  # ✅ 新增：模块级 logger
 
@@ -764,6 +765,7 @@ def update_product(
                         """, (id, a_name, a_value))
 
                 conn.commit()
+                CartService.invalidate_products([id])
 
                 # 查询更新后的商品
                 select_sql = build_dynamic_select(cur, "products", where_clause="id = %s")
@@ -857,6 +859,7 @@ def delete_product(
                     raise HTTPException(status_code=404, detail="商品删除失败或已被删除")
 
                 conn.commit()
+                CartService.invalidate_products([id])
 
                 # 异步删除物理文件
                 if image_urls_to_delete:
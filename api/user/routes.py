@@ -1,7 +1,6 @@
 from fastapi import HTTPException, APIRouter, Request,File, UploadFile,Path, Depends
 import uuid
 import datetime
-import requests
 from models.schemas.user import (
     SetStatusReq, AuthReq, AuthResp, UpdateProfileReq, SelfDeleteReq,
     FreezeReq, ResetPwdReq, AdminResetPwdReq, SetLevelReq, AddressReq,
@@ -11,6 +10,7 @@ from models.schemas.user import (
     ReferralQRResponse,DecryptPhoneReq, DecryptPhoneResp,GetPhoneReq, GetPhoneResp
 )
 from core.config import WECHAT_APP_ID, WECHAT_APP_SECRET
+from core.wechat_token import get_access_token_sync
 from core.database import get_conn
 from core.logging import get_logger
 from core.table_access import build_dynamic_select, get_table_structure, _quote_identifier
@@ -21,6 +21,7 @@ from services.points_service import add_points
 from services.reward_service import TeamRewardService
 from services.director_service import DirectorService
 from services.wechat_service import WechatService
+from services.user_display_service import UserDisplayService
 from core.table_access import build_select_list
 from typing import List
 
@@ -206,6 +207,10 @@ def update_profile(body: UpdateProfileReq):
             sql = f"UPDATE {_quote_identifier('users')} SET {set_clause} WHERE id=%s"
             cur.execute(sql, tuple(updates.values()) + (user_id,))
             conn.commit()
+            if "name" in updates:
+                UserDisplayService.invalidate(user_id)
+            if "avatar_path" in updates:
+                UserService.invalidate_avatar_codes(user_id)
             return {"msg": "ok"}
 
 @router.post("/user/self-delete", summary="用户自助注销（动态字段/兼容老库）")
@@ -1278,7 +1283,9 @@ async def wechat_login(request: Request):
 
     try:
         # 调用微信接口，通过 code 换取 openid（及服务端用的 session_key，可选 unionid）
-        result = WechatService.get_openid_by_code(code)
+        # 同步 HTTP 调用放到线程池，避免阻塞事件循环
+        import anyio
+        result = await anyio.to_thread.run_sync(WechatService.get_openid_by_code, code)
         # session_key 仅用于服务端解密等场景，禁止写入响应或日志（微信安全规范）
         if isinstance(result, (list, tuple)):
             if len(result) >= 2:
@@ -1663,7 +1670,7 @@ def refresh_referral_qr(user_id: int):
     强制刷新用户的推荐码小程序码（重新生成）
     """
     try:
-        qr_url = UserService.generate_referral_qr(user_id)
+        qr_url = UserService.generate_referral_qr(user_id, force=True)
         if not qr_url:
             raise HTTPException(status_code=500, detail="生成二维码失败")
 
@@ -1722,6 +1729,7 @@ def clear_avatar(user_id: int):
                 )
                 conn.commit()
 
+        UserService.invalidate_avatar_codes(user_id)
         logger.info(f"✅ 用户 {user_id} 清空头像成功")
         return {"message": "头像已清空", "success": True}
 
@@ -1766,11 +1774,8 @@ def get_phone(req: GetPhoneReq):
 
 
 def get_wx_access_token() -> str:
-    """获取微信 access_token（缓存）"""
-    # 实现 access_token 缓存逻辑
-    url = f"https://api.weixin.qq.com/cgi-bin/token?grant_type=client_credential&appid={WECHAT_APP_ID}&secret={WECHAT_APP_SECRET}"
-    resp = requests.get(url, timeout=10).json()
-    return resp.get("access_token")
+    """获取微信 access_token（core.wechat_token 统一缓存）"""
+    return get_access_token_sync()
 
 
 def get_current_user_id() -> int:
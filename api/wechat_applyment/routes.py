@@ -126,7 +126,7 @@ async def resubmit_applyment(
     """根据驳回原因修改后重新提交"""
     try:
         service = WechatApplymentService()
-        result = service.resubmit_applyment(current_user["id"], applyment_id)
+        result = await service.resubmit_applyment(current_user["id"], applyment_id)
         return success_response(data=result, message="进件已重新提交")
     except Exception as e:
         return error_response(message=str(e))
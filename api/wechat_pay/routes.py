@@ -1,31 +1,38 @@
 # api/wechat_pay/routes.py
-from fastapi import APIRouter, Request, HTTPException, Response
-from core.wx_pay_client import WeChatPayClient
-from core.config import ENVIRONMENT, WECHAT_PAY_API_V3_KEY, POINTS_DISCOUNT_RATE
+from fastapi import APIRouter, Depends, Request, HTTPException, Query, Response
+from core.wx_pay_client import WeChatPayClient, AsyncWeChatPayClient
+from core.wx_pay_notify import open_notify, NotifyVerifyError
+from core.config import ENVIRONMENT, POINTS_DISCOUNT_RATE
 from core.response import success_response
 from core.database import get_conn
+from core.idempotency import idempotency_store, REFUND_NOTIFY_NAMESPACE
 from services.finance_service import (
-    FinanceService,
     parse_pending_coupon_ids,
-    parse_offline_coupon_ids,
     max_coupon_total_yuan,
 )
 from decimal import Decimal
 from services.wechat_applyment_service import WechatApplymentService
-from datetime import datetime
+from services.applyment_poller import ApplymentPoller
+from services.refund_service import RefundService
+from services.pay_notify_inbox import PayNotifyInbox
+from services.wechat_reconcile_service import WechatReconcileService, ReconcileBusy
+from services.order_detail_cache import OrderDetailCache
+from datetime import date, datetime
+import asyncio
+from typing import Optional
 import time
 import uuid
+import os
 import json
 import logging
-import base64
 from core.config import settings
 import xml.etree.ElementTree as ET  # 用于生成XML响应
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 router = APIRouter(prefix="/wechat-pay", tags=["微信支付"])
 
 logger = logging.getLogger(__name__)
 pay_client = WeChatPayClient()
+async_pay_client = AsyncWeChatPayClient(pay_client)
 
 
 @router.post("/create-order", summary="创建JSAPI订单并返回前端支付参数")
@@ -169,6 +176,7 @@ async def create_jsapi_order(request: Request):
                 if payable_cents <= 0:
                     _sync_order_pay_fields(max(new_total, Decimal('0')))
                     conn.commit()
+                    OrderDetailCache.invalidate(out_trade_no)
                     logger.info(
                         f"零元订单 {out_trade_no} 无需支付 (原始金额¥{order_row.get('original_amount')})"
                     )
@@ -205,12 +213,13 @@ async def create_jsapi_order(request: Request):
                     _sync_order_pay_fields(charge_yuan)
 
                 conn.commit()
+                OrderDetailCache.invalidate(out_trade_no)
                 total_fee = final_cents
 
         # 到这里无需持有连接，调用微信接口
         # 1) 调用微信下单，获取 prepay_id
         try:
-            resp = pay_client.create_jsapi_order(
+            resp = await async_pay_client.create_jsapi_order(
                 out_trade_no=str(out_trade_no),
                 total_fee=int(total_fee),
                 openid=str(openid),
@@ -252,7 +261,7 @@ async def create_jsapi_order(request: Request):
             raise HTTPException(status_code=500, detail="wechat create order failed")
 
         # 2) 生成前端支付参数（含 paySign）
-        pay_params = pay_client.generate_jsapi_pay_params(prepay_id)
+        pay_params = await async_pay_client.generate_jsapi_pay_params(prepay_id)
 
         return {
             "prepay_id": prepay_id,
@@ -271,157 +280,35 @@ async def create_jsapi_order(request: Request):
 async def wechat_pay_notify(request: Request):
     """
     处理微信支付异步通知
-    1. 验证签名
-    2. 解密回调数据
-    3. 更新订单/进件状态
-    4. 返回成功响应
+    1. 验签 + 解密（core.wx_pay_notify，微信支付线程池内完成）
+    2. 支付成功：写入回调收件箱后立即应答，结算在后台异步执行
+    3. 进件/发货管理等其它事件：直接处理后应答
     """
     try:
         body = await request.body()
-
-        # 提前定义 headers（关键修复）
-        headers = request.headers
-
-        # 调试日志（现在 headers 已存在，不会报错了）
-        try:
-            logger.debug(f"收到原始请求体 ({len(body)} bytes): {body!r}")
-            logger.debug(f"请求头 Content-Type: {headers.get('content-type', '未知')}")
-        except Exception:
-            logger.debug("无法记录原始请求体（调试日志）")
-
-        # 检查请求体是否为空（防止JSONDecodeError）
-        if not body or len(body.strip()) == 0:
-            logger.warning("收到空请求体，返回错误响应")
-            return _xml_response("FAIL", "Empty request body")
-
         headers = request.headers
 
-        # 验证签名头
-        signature = headers.get("Wechatpay-Signature")
-        timestamp = headers.get("Wechatpay-Timestamp")
-        nonce = headers.get("Wechatpay-Nonce")
-        serial = headers.get("Wechatpay-Serial")
-
         # 开发绕过：允许在非 production 环境下通过自定义头跳过签名校验（仅用于本地/测试）
         bypass_header = headers.get("X-DEV-BYPASS-VERIFY") or headers.get("X-DEV-BYPASS")
         # 支持基于共享测试令牌的绕过（在 systemd/.env 中设置 TEST_NOTIFY_TOKEN）
         test_token_header = headers.get("X-DEV-TEST-TOKEN")
-        test_token_env = None
-        try:
-            import os
-
-            test_token_env = os.getenv("TEST_NOTIFY_TOKEN")
-        except Exception:
-            test_token_env = None
-
-        if (bypass_header and ENVIRONMENT != "production") or (
-            test_token_header and test_token_env and test_token_header == test_token_env
-        ):
+        test_token_env = os.getenv("TEST_NOTIFY_TOKEN")
+        skip_verify = bool(
+            (bypass_header and ENVIRONMENT != "production")
+            or (test_token_header and test_token_env and test_token_header == test_token_env)
+        )
+        if skip_verify:
             logger.warning("开发模式：绕过回调签名校验（开发头或测试令牌触发）")
-        else:
-            if not all([signature, timestamp, nonce, serial]):
-                logger.error("缺少必要的回调头信息")
-                return _xml_response("FAIL", "Missing callback headers")
-
-            try:
-                if not pay_client.verify_signature(signature, timestamp, nonce, body.decode()):
-                    logger.error("签名验证失败")
-                    return _xml_response("FAIL", "Signature verification failed")
-            except Exception as e:
-                logger.error(f"签名验证异常: {str(e)}")
-                return _xml_response("FAIL", f"Signature error: {str(e)}")
-
-        # 支持开发调试绕过签名验证（兼容性备用头）
-        if headers.get("X-Bypass-Signature", "").lower() == "true" and ENVIRONMENT != "production":
-            logger.warning("开发模式：跳过签名验证 (X-Bypass-Signature)")
-
-        # 解析回调数据（真实微信通知是JSON，部分测试可能使用XML包装）
-        content_type = headers.get("content-type", "")
-        if "xml" in content_type:
-            import xmltodict  # 需要安装: pip install xmltodict
-
-            data_dict = xmltodict.parse(body)
-            data = data_dict.get("xml", {})
-            if "resource" in data:
-                resource = data["resource"]
-                if isinstance(resource, str):
-                    data = json.loads(resource)
-                else:
-                    data = {"resource": resource}
-            else:
-                data = {"resource": data}
-        else:
-            data = json.loads(body)
-
-        # 解密回调数据
-        resource = data.get("resource", {})
-        if not resource:
-            logger.error("回调数据中缺少resource字段")
-            return _xml_response("FAIL", "Missing resource")
 
         # 开发绕过：若请求头包含 X-DEV-PLAIN-BODY，则认为 resource 已是明文 JSON（跳过 decrypt）
         plain_header = headers.get("X-DEV-PLAIN-BODY") or headers.get("X-DEV-PLAIN")
+        skip_decrypt = bool(plain_header and ENVIRONMENT != "production")
 
-        # 检查 resource 是否具备解密所需字段
-        required_fields = ("ciphertext", "nonce", "associated_data")
-        missing_fields = [f for f in required_fields if f not in resource]
-        if missing_fields and not (plain_header and ENVIRONMENT != "production"):
-            logger.error(f"回调 resource 缺少必要字段 {missing_fields}; content={resource}")
-            return _xml_response("FAIL", f"Missing resource fields: {','.join(missing_fields)}")
-
-        # 记录 resource 关键字段长度以便排查解密失败
         try:
-            logger.info(
-                "回调 resource 明细: keys=%s, ciphertext_len=%s, nonce_len=%s, ad_len=%s",
-                list(resource.keys()),
-                len(resource.get("ciphertext", "")) if isinstance(resource.get("ciphertext"), str) else None,
-                len(resource.get("nonce", "")) if isinstance(resource.get("nonce"), str) else None,
-                len(resource.get("associated_data", "")) if isinstance(resource.get("associated_data"), str) else None,
-            )
-        except Exception:
-            logger.debug("记录 resource 明细失败", exc_info=True)
-
-        if plain_header and ENVIRONMENT != "production":
-            logger.info("开发模式：跳过回调解密，直接使用明文 resource（X-DEV-PLAIN-BODY detected）")
-            decrypted_data = resource
-        else:
-            # 按官方示例执行 AESGCM 解密
-            try:
-                key_bytes = WECHAT_PAY_API_V3_KEY.encode("utf-8")
-                if len(key_bytes) not in (16, 24, 32):
-                    logger.error("API v3 key 长度无效: %s", len(key_bytes))
-                    return _xml_response("FAIL", "Invalid APIv3 key length")
-
-                nonce_bytes = str(resource.get("nonce", "")).encode("utf-8")
-                ad_str = resource.get("associated_data", "") or ""
-                ad_bytes = ad_str.encode("utf-8") if ad_str else None
-                cipher_b64 = resource.get("ciphertext", "")
-
-                # 记录首尾片段便于对比是否被篡改
-                try:
-                    preview = cipher_b64 if len(cipher_b64) <= 80 else f"{cipher_b64[:30]}...{cipher_b64[-30:]}"
-                    logger.info(
-                        "解密准备: key_len=%s, nonce_len=%s, ad_len=%s, ct_len=%s, ct_preview=%s",
-                        len(key_bytes), len(nonce_bytes), len(ad_bytes) if ad_bytes else 0,
-                        len(cipher_b64), preview
-                    )
-                except Exception:
-                    logger.debug("记录解密准备信息失败", exc_info=True)
-
-                cipher_bytes = base64.b64decode(cipher_b64)
-                aesgcm = AESGCM(key_bytes)
-                plaintext = aesgcm.decrypt(nonce_bytes, cipher_bytes, ad_bytes)
-                decrypted_data = json.loads(plaintext.decode("utf-8"))
-            except Exception as e:
-                logger.error(
-                    "回调解密异常(官方示例逻辑): %s; key_len=%s; nonce_len=%s; ad_len=%s; ct_len=%s",
-                    str(e),
-                    len(WECHAT_PAY_API_V3_KEY.encode("utf-8")) if WECHAT_PAY_API_V3_KEY else None,
-                    len(resource.get("nonce", "")) if isinstance(resource.get("nonce", ""), str) else None,
-                    len(resource.get("associated_data", "")) if isinstance(resource.get("associated_data", ""), str) else None,
-                    len(resource.get("ciphertext", "")) if isinstance(resource.get("ciphertext", ""), str) else None,
-                )
-                return _xml_response("FAIL", "Decrypt failed")
+            data, decrypted_data = await open_notify(headers, body, verify=not skip_verify, decrypt=not skip_decrypt)
+        except NotifyVerifyError as e:
+            logger.error(f"支付回调校验失败: {e}")
+            return _xml_response("FAIL", str(e))
 
         # 根据事件类型处理（优先外层 event_type，其次解密后字段，兼容交易通知仅在外层提供 event_type）
         event_type = data.get("event_type") or decrypted_data.get("event_type")
@@ -429,22 +316,19 @@ async def wechat_pay_notify(request: Request):
         # 兼容交易通知：若无 event_type，但 trade_state=SUCCESS，则视为 TRANSACTION.SUCCESS
         if not event_type and decrypted_data.get("trade_state") == "SUCCESS":
             event_type = "TRANSACTION.SUCCESS"
-        try:
-            logger.info(
-                "解密后 payload 概览: event_type=%s, keys=%s, out_trade_no=%s, transaction_id=%s",
-                event_type,
-                list(decrypted_data.keys()),
-                decrypted_data.get("out_trade_no"),
-                decrypted_data.get("transaction_id"),
-            )
-        except Exception:
-            logger.debug("记录解密后 payload 概览失败", exc_info=True)
+        logger.info(
+            "支付回调: event_type=%s, out_trade_no=%s, transaction_id=%s",
+            event_type,
+            decrypted_data.get("out_trade_no"),
+            decrypted_data.get("transaction_id"),
+        )
 
         if event_type == "APPLYMENT_STATE_CHANGE":
             await handle_applyment_state_change(decrypted_data)
             return _xml_response("SUCCESS", "OK")
         elif event_type == "TRANSACTION.SUCCESS":
-            await handle_transaction_success(decrypted_data)
+            # 落库即应答；同一 transaction_id 重推只命中已有记录
+            await PayNotifyInbox.accept(decrypted_data, event_type)
             return _xml_response("SUCCESS", "OK")
         # ===== 新增：处理微信发货管理相关事件 =====
         elif event_type == "trade_manage_remind_shipping":
@@ -473,9 +357,6 @@ async def wechat_pay_notify(request: Request):
             logger.warning(f"未知的事件类型: {event_type}; payload={decrypted_data}")
             return _xml_response("FAIL", f"Unknown event_type: {event_type}")
 
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON解析失败: {str(e)}")
-        return _xml_response("FAIL", "Invalid JSON format")
     except Exception as e:
         logger.error(f"微信支付回调处理失败: {str(e)}", exc_info=True)
         return _xml_response("FAIL", str(e))
@@ -488,39 +369,12 @@ async def wechat_refund_notify(request: Request):
     """
     try:
         body = await request.body()
-        headers = request.headers
-        
-        logger.info(f"【退款回调】收到通知，headers: {dict(headers)}")
-
-        # 1. 验签（可选但推荐）
-        signature = headers.get("Wechatpay-Signature")
-        timestamp = headers.get("Wechatpay-Timestamp")
-        nonce = headers.get("Wechatpay-Nonce")
-        serial = headers.get("Wechatpay-Serial")
-        if not all([signature, timestamp, nonce, serial]):
-            logger.warning("【退款回调】缺少必要的签名头")
-            return Response(content="", status_code=200)
 
-        if not pay_client.verify_signature(signature, timestamp, nonce, body.decode()):
-            logger.warning("【退款回调】签名验证失败")
-            return Response(content="", status_code=200)
-
-        # 2. 解析 JSON
+        # 1-3. 验签、解析、解密
         try:
-            data = json.loads(body)
-        except json.JSONDecodeError as e:
-            logger.error(f"【退款回调】JSON 解析失败: {e}")
-            return Response(content="", status_code=200)
-            
-        resource = data.get("resource", {})
-        if not resource:
-            logger.warning("【退款回调】缺少 resource 字段")
-            return Response(content="", status_code=200)
-
-        # 3. 解密 resource
-        decrypted = pay_client.decrypt_callback_data(resource)
-        if not decrypted:
-            logger.warning("【退款回调】解密失败")
+            _, decrypted = await open_notify(request.headers, body)
+        except NotifyVerifyError as e:
+            logger.warning(f"【退款回调】校验失败: {e}")
             return Response(content="", status_code=200)
 
         # 4. 提取关键信息
@@ -532,58 +386,18 @@ async def wechat_refund_notify(request: Request):
 
         logger.info(f"【退款回调】解密数据: out_refund_no={out_refund_no}, status={refund_status}, refund_id={refund_id}, amount={amount}")
 
+        # 幂等：同一退款单的终态通知重复送达时只做一次键查询
+        refund_notify_ident = f"{out_refund_no}:{refund_status}"
+        if refund_status in ('SUCCESS', 'REFUNDCLOSE') and idempotency_store.is_done(
+                REFUND_NOTIFY_NAMESPACE, refund_notify_ident):
+            logger.info(f"【退款回调】重复通知，已处理过: out_refund_no={out_refund_no}, status={refund_status}")
+            return Response(content="", status_code=200)
+
         # 🔥 新增：处理不同状态
         if refund_status == 'SUCCESS':
-            order_number_to_revoke = None
-            with get_conn() as conn:
-                with conn.cursor() as cur:
-                    # 先通过 refund_no 更新
-                    cur.execute(
-                        "UPDATE orders SET status='refunded', updated_at=NOW() WHERE refund_no=%s AND status='refunding'",
-                        (out_refund_no,)
-                    )
-                    updated_rows = cur.rowcount
-                    
-                    if updated_rows == 0:
-                        # 尝试通过解析 out_refund_no 获取 order_number
-                        try:
-                            parts = out_refund_no.split('_')
-                            if len(parts) >= 2 and parts[0].startswith('REF'):
-                                order_number = parts[0][3:]
-                                cur.execute(
-                                    "UPDATE orders SET status='refunded', updated_at=NOW() WHERE order_number=%s AND status='refunding'",
-                                    (order_number,)
-                                )
-                                updated_rows = cur.rowcount
-                                logger.info(f"【退款回调】通过解析 order_number 更新: {order_number}, 影响行数: {updated_rows}")
-                                if updated_rows > 0:
-                                    order_number_to_revoke = order_number
-                        except Exception as e:
-                            logger.error(f"【退款回调】解析 order_number 失败: {e}")
-                    else:
-                        # 获取被更新的订单号，用于后续回退
-                        cur.execute("SELECT order_number FROM orders WHERE refund_no=%s", (out_refund_no,))
-                        row = cur.fetchone()
-                        if row:
-                            order_number_to_revoke = row['order_number']
-                    
-                    if updated_rows > 0 and order_number_to_revoke:
-                        # ✅ 在同一个事务中调用回退方法（复用当前游标）
-                        try:
-                            from services.finance_service import FinanceService
-                            FinanceService.revoke_order_discounts(order_number_to_revoke, external_cur=cur)
-                            logger.info(f"【退款回调】积分/优惠券回退成功: {order_number_to_revoke}")
-                        except Exception as e:
-                            logger.error(f"【退款回调】回退积分/优惠券失败，事务将回滚: {e}", exc_info=True)
-                            # 抛出异常，导致外层事务回滚，订单状态保持 refunding
-                            raise
-                    
-                    if updated_rows > 0:
-                        conn.commit()
-                        logger.info(f"【退款回调】✅ 退款成功并完成积分/优惠券回退: out_refund_no={out_refund_no}")
-                    else:
-                        logger.warning(f"【退款回调】⚠️ 未找到匹配的退款中订单: out_refund_no={out_refund_no}")
-                        
+            # 与退款队列批量同步共用终态处理（同一事务内更新订单并回退积分/优惠券，失败回滚保持 refunding）
+            RefundService.apply_refund_success(out_refund_no)
+
         elif refund_status == 'PROCESSING':
             logger.info(f"【退款回调】退款处理中: out_refund_no={out_refund_no}")
             # 保持 refunding 状态，等待下一次回调
@@ -594,14 +408,8 @@ async def wechat_refund_notify(request: Request):
             
         elif refund_status == 'REFUNDCLOSE':
             logger.warning(f"【退款回调】退款关闭: out_refund_no={out_refund_no}")
-            # 更新订单状态回退到之前状态（如 completed）
-            with get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE orders SET status='completed', updated_at=NOW() WHERE refund_no=%s AND status='refunding'",
-                        (out_refund_no,)
-                    )
-                    conn.commit()
+            # 订单恢复到发起退款前的状态
+            RefundService.apply_refund_closed(out_refund_no)
         else:
             logger.warning(f"【退款回调】未知状态: {refund_status} - {decrypted}")
 
@@ -648,292 +456,64 @@ async def handle_applyment_state_change(data: dict):
             },
         )
         logger.info(f"进件状态更新成功: {applyment_id} -> {state}")
+        # 立即向微信核实一次，补齐回调中没有的签约链接/驳回详情
+        ApplymentPoller.schedule_now(applyment_id)
     except Exception as e:
         logger.error(f"进件状态处理失败: {str(e)}", exc_info=True)
 
 
-# api/wechat_pay/routes.py （从 handle_transaction_success 开始）
+# ==================== 支付回调收件箱（管理端） ====================
 
-async def handle_transaction_success(data: dict):
-    out_trade_no = data.get("out_trade_no")
-    transaction_id = data.get("transaction_id")
-    amount = data.get("amount", {}).get("total")
+def _require_admin(admin_key: str = Query(..., description="后台口令")) -> None:
+    """管理端接口口令校验（与 user 模块管理接口一致）"""
+    if admin_key != "admin2025":
+        raise HTTPException(status_code=403, detail="后台口令错误")
 
-    if not out_trade_no:
-        logger.error("支付回调缺少 out_trade_no")
-        return
 
-    # 与小程序「发货管理」列表对齐：须与公众平台绑定的 appid、mchid 一致（便于排查搜不到单）
-    logger.info(
-        "支付成功: 订单号=%s, 微信流水号=%s, 金额=%s, appid=%s, mchid=%s, sub_mchid=%s",
-        out_trade_no,
-        transaction_id,
-        amount,
-        data.get("appid"),
-        data.get("mchid"),
-        data.get("sub_mchid"),
-    )
+@router.get("/admin/notify-events/stuck", summary="查询未完成的支付回调事件（管理员）",
+            dependencies=[Depends(_require_admin)])
+def list_stuck_notify_events(stale_minutes: int = 10, limit: int = 100):
+    """结算失败、等待重试或超过 stale_minutes 仍未完成的支付事件，附各步骤状态"""
+    return success_response(PayNotifyInbox.stuck_events(stale_minutes=stale_minutes, limit=min(limit, 500)))
 
-    try:
-        if out_trade_no.startswith("OFF"):
-            await _handle_offline_pay_success(out_trade_no, transaction_id, amount, data)
-        else:
-            await _handle_online_pay_success(out_trade_no, transaction_id, amount, data)
-    except ValueError as e:
-        # 业务错误：订单不存在、金额不一致等，记录但返回成功（避免微信重试）
-        logger.error(f"支付成功处理失败（业务错误）: {e}", exc_info=True)
-        # 可选：将异常记录到专门的表供人工对账
-    except Exception as e:
-        # 临时性错误：数据库连接、微信API调用失败等，继续抛出让微信重试
-        logger.error(f"支付成功处理发生未知异常: {e}", exc_info=True)
-        raise
 
+@router.post("/admin/notify-events/{event_id}/retry", summary="重试支付回调事件（管理员）",
+             dependencies=[Depends(_require_admin)])
+async def retry_notify_event(event_id: int):
+    """失败步骤重置重试次数并立即重新入队"""
+    if not await asyncio.to_thread(PayNotifyInbox.retry, event_id):
+        raise HTTPException(status_code=400, detail="事件不存在或已完成")
+    PayNotifyInbox.kick(event_id)
+    return success_response({"event_id": event_id}, message="已重新入队")
 
-async def _handle_offline_pay_success(order_no: str, transaction_id: str, amount: int, data: dict):
-    from decimal import Decimal
-    from services.offline_service import OfflineService
-    from services.finance_service import FinanceService
-    from core.database import get_conn
-    import pymysql
 
-    try:
-        with get_conn() as conn:
-            with conn.cursor(pymysql.cursors.DictCursor) as cur:
-                # 查询并锁定订单
-                cur.execute(
-                    "SELECT id, user_id, amount, paid_amount, status, coupon_id, coupon_ids, coupon_discount, merchant_id, store_name "
-                    "FROM offline_order WHERE order_no = %s FOR UPDATE",
-                    (order_no,)
-                )
-                order = cur.fetchone()
+# ==================== 微信支付对账（管理端） ====================
 
-                if not order:
-                    logger.error(f"[offline-pay] 订单不存在: {order_no}")
-                    raise ValueError(f"订单不存在: {order_no}")
-
-                if order["status"] != 1:
-                    logger.info(f"[offline-pay] 订单已处理: {order_no}, 状态={order['status']}")
-                    return
-
-                # 金额核对（增强版）
-                db_total = order.get("paid_amount")
-                if db_total is None or db_total == 0:
-                    logger.warning(f"[offline-pay] 订单 {order_no} paid_amount 为0或None，尝试从优惠券重新计算")
-                    coupon_discount = int(order.get("coupon_discount") or 0)
-                    if coupon_discount <= 0:
-                        coupon_discount = 0
-                        cids = parse_offline_coupon_ids(order)
-                        if cids:
-                            ph = ",".join(["%s"] * len(cids))
-                            cur.execute(
-                                f"SELECT id, amount FROM coupons WHERE id IN ({ph})",
-                                tuple(cids),
-                            )
-                            rows = cur.fetchall() or []
-                            by_id = {int(r["id"]): r for r in rows}
-                            for cid in cids:
-                                r = by_id.get(int(cid))
-                                if not r:
-                                    continue
-                                coupon_discount += int(Decimal(r["amount"]) * 100)
-                    expected_paid = order["amount"] - coupon_discount
-                    if expected_paid < 0:
-                        expected_paid = 0
-                    if amount != expected_paid:
-                        logger.error(f"[offline-pay] 重新计算后金额仍不一致: 微信{amount}≠预期{expected_paid}")
-                        raise ValueError(f"金额不一致")
-                    db_total = expected_paid
-                    # 更新订单的 paid_amount 为正确值
-                    cur.execute("UPDATE offline_order SET paid_amount = %s WHERE id = %s", (db_total, order["id"]))
-                    logger.info(f"[offline-pay] 已修复订单 {order_no} paid_amount 为 {db_total}")
-                else:
-                    if amount != db_total:
-                        logger.error(f"[offline-pay] 金额不一致: 微信{amount}≠系统{db_total}")
-                        raise ValueError(f"金额不一致: 微信{amount}≠系统{db_total}")
+@router.get("/admin/reconcile/runs", summary="查询微信支付对账批次（管理员）",
+            dependencies=[Depends(_require_admin)])
+def list_reconcile_runs(limit: int = 30):
+    """按账单日期倒序，含账单笔数/金额、一致数、已修复与待处理差异数"""
+    return success_response(WechatReconcileService.list_runs(limit=min(limit, 200)))
 
-                # 核销优惠券（如果有）
-                offline_cids = parse_offline_coupon_ids(order)
-                if offline_cids:
-                    try:
-                        fs = FinanceService()
-                        for cid in offline_cids:
-                            fs.use_coupon(
-                                coupon_id=int(cid),
-                                user_id=order["user_id"],
-                                order_type="normal"
-                            )
-                        logger.info(f"[offline-pay] 优惠券核销成功: 订单={order_no}, 优惠券={offline_cids}")
-                    except Exception as e:
-                        logger.error(f"[offline-pay] 优惠券核销失败（需人工处理）: 订单={order_no}, 错误={e}")
-
-                # 更新订单状态
-                cur.execute(
-                    """
-                    UPDATE offline_order
-                    SET status = 2,
-                        pay_time = NOW(),
-                        transaction_id = %s,
-                        updated_at = NOW()
-                    WHERE id = %s
-                    """,
-                    (transaction_id, order["id"])
-                )
 
-                # 资金分账
-                tw = await OfflineService.on_paid(
-                    order_no=order_no,
-                    amount=Decimal(db_total) / 100,
-                    coupon_discount=Decimal(order["amount"] - db_total) / 100 if offline_cids else Decimal(0),
-                    transaction_id=transaction_id,
-                )
-                if tw:
-                    logger.warning(f"[offline-pay] 商家转账未成功（已分账） order={order_no}: {tw}")
+@router.get("/admin/reconcile/items", summary="查询微信支付对账差异明细（管理员）",
+            dependencies=[Depends(_require_admin)])
+def list_reconcile_items(bill_date: date, kind: Optional[str] = None, action: Optional[str] = None,
+                         limit: int = 200):
+    """kind: missing_local/unpaid_local/tx_mismatch/amount_mismatch/local_only；action: fixed/flagged"""
+    return success_response(WechatReconcileService.list_items(bill_date, kind=kind, action=action,
+                                                              limit=min(limit, 1000)))
 
-                conn.commit()
-                logger.info(f"[offline-pay] 线下订单支付成功: {order_no}")
 
-    except Exception as e:
-        logger.error(f"[offline-pay] 处理失败: {e}", exc_info=True)
-        raise
-
-
-async def _handle_online_pay_success(order_no: str, transaction_id: str, amount: int, data: dict):
-    """处理线上订单支付成功"""
+@router.post("/admin/reconcile/run", summary="重新对账指定日期（管理员）",
+             dependencies=[Depends(_require_admin)])
+def rerun_reconcile(bill_date: date):
+    """下载该日账单重新比对，覆盖该日上一次的差异明细"""
     try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                # 查询订单信息
-                cur.execute(
-                    "SELECT id, user_id, total_amount, status, delivery_way, "
-                    "pending_points, pending_coupon_id, pending_coupon_ids, original_amount, "
-                    "coupon_discount, points_discount "
-                    "FROM orders WHERE order_number=%s FOR UPDATE",
-                    (order_no,),
-                )
-                order = cur.fetchone()
-                if not order:
-                    raise ValueError("订单号不存在")
-                if order.get('status') != 'pending_pay':
-                    logger.info(f"订单 {order_no} 状态为 {order.get('status')}，已处理，忽略")
-                    return
-
-                db_total = int((Decimal(str(order['total_amount'] or 0)) * 100).quantize(Decimal('1')))
-
-                coupon_amt = Decimal('0')
-                coupon_id_list = parse_pending_coupon_ids(order)
-                if coupon_id_list:
-                    for cid in coupon_id_list:
-                        cur.execute(
-                            """SELECT id, amount, status, valid_to, user_id 
-                               FROM coupons 
-                               WHERE id = %s 
-                               FOR UPDATE""",
-                            (cid,),
-                        )
-                        coupon_row = cur.fetchone()
-                        if not coupon_row or coupon_row['status'] != 'unused' or coupon_row[
-                            'valid_to'] < datetime.now().date():
-                            if order.get('status') == 'pending_pay':
-                                logger.error(
-                                    f"订单 {order_no} 优惠券 {cid} 状态异常 "
-                                    f"(status={coupon_row['status'] if coupon_row else 'not found'})，需人工介入"
-                                )
-                            return
-                        if coupon_row['user_id'] != order['user_id']:
-                            logger.error(f"订单 {order_no} 优惠券 {cid} 用户不匹配")
-                            return
-                        coupon_amt += Decimal(str(coupon_row['amount']))
-
-                    orig = Decimal(str(order.get('original_amount') or 0))
-                    pp = Decimal(str(order.get('pending_points') or 0))
-                    pd = pp * POINTS_DISCOUNT_RATE
-                    if pd > orig:
-                        pd = orig
-                    max_c = max_coupon_total_yuan(orig, pd)
-                    if coupon_amt > max_c:
-                        raise ValueError(f"优惠券叠加超过上限{max_c}")
-
-                    for cid in coupon_id_list:
-                        cur.execute(
-                            "UPDATE coupons SET status='used', used_at=NOW() WHERE id=%s AND status='unused'",
-                            (cid,),
-                        )
-                        if cur.rowcount == 0:
-                            logger.warning(f"订单 {order_no} 优惠券 {cid} 核销影响行数为0")
-                            if order.get('status') == 'pending_pay':
-                                logger.error(f"订单 {order_no} 优惠券核销失败，需人工介入")
-                            return
-                else:
-                    coupon_amt = Decimal(str(order.get("coupon_discount") or 0))
-                    if coupon_amt > 0:
-                        logger.warning(
-                            "订单 %s 无 pending_coupon_ids 但存在 coupon_discount=%s，跳过核销，按落库券额结算",
-                            order_no,
-                            coupon_amt,
-                        )
-
-                # 微信支付金额与系统应付金额核对
-                if amount != db_total:
-                    raise ValueError(f"金额不一致 微信{amount}≠系统{db_total}")
-
-                # 记录优惠券抵扣金额到订单表
-                # 记录优惠券抵扣金额和交易流水号到订单表
-                cur.execute("""
-                    UPDATE orders 
-                    SET coupon_discount = %s,
-                        original_amount = COALESCE(%s, total_amount),
-                        transaction_id = %s
-                    WHERE id = %s
-                """, (
-                    coupon_amt,
-                    order.get('original_amount') or order['total_amount'],
-                    transaction_id,
-                    order['id']
-                ))
-
-                # 资金结算（积分抵扣在 settle_order 内部处理）
-                from services.finance_service import FinanceService
-                fs = FinanceService()
-                fs.settle_order(
-                    order_no=order_no,
-                    user_id=order['user_id'],
-                    order_id=order['id'],
-                    points_to_use=order.get('pending_points') or 0,
-                    coupon_discount=coupon_amt,
-                    external_conn=conn
-                )
-
-                # 更新订单状态
-                next_status = "pending_recv" if order.get('delivery_way') == 'pickup' else "pending_ship"
-                from api.order.order import OrderManager
-                OrderManager.update_status(order_no, next_status, external_conn=conn)
-
-                conn.commit()
-        logger.info(f"线上订单支付成功: {order_no}")
-        if order.get("delivery_way") == "pickup":
-            import asyncio
-
-            from services.wechat_shipping_v2_service import upload_pickup_shipping_to_wechat
-
-            async def _pickup_upload_bg():
-                try:
-                    await asyncio.to_thread(upload_pickup_shipping_to_wechat, order_no, transaction_id)
-                except Exception as ex:
-                    logger.error(
-                        "自提微信发货后台任务异常 order=%s: %s",
-                        order_no,
-                        ex,
-                        exc_info=True,
-                    )
-
-            try:
-                asyncio.create_task(_pickup_upload_bg())
-            except RuntimeError:
-                upload_pickup_shipping_to_wechat(order_no, transaction_id)
-
-    except Exception as e:
-        logger.error(f"线上订单支付成功处理失败: {e}", exc_info=True)
-        # 异常已由上层捕获，订单状态保持 pending_pay，不会错误更新
+        summary = WechatReconcileService.run(bill_date)
+    except ReconcileBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return success_response(summary, message="对账完成")
 
 @router.post("/refund", summary="申请订单退款")
 async def create_refund(request: Request):
@@ -993,7 +573,7 @@ async def create_refund(request: Request):
                 
                 # 调用微信退款
                 logger.info(f"[Refund] 发起退款: order={order_number}, tx={transaction_id}, refund_fee={refund_fee}")
-                result = pay_client.refund(
+                result = await async_pay_client.refund(
                     transaction_id=transaction_id,
                     out_refund_no=out_refund_no,
                     total_fee=total_fee,
@@ -1009,6 +589,7 @@ async def create_refund(request: Request):
                     (out_refund_no, order["id"])
                 )
                 conn.commit()
+                OrderDetailCache.invalidate(order["order_number"])
                 
                 return {
                     "success": True,
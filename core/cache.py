@@ -0,0 +1,106 @@
+# core/cache.py
+"""
+进程内缓存工具（线程安全的 TTL + LRU）
+
+用于缓存读多写少、允许短暂不一致的数据（商品快照、配置等）。
+多 worker 部署下每个进程各自一份，写路径需主动调用 delete/clear 失效本进程缓存，
+跨进程一致性由各业务模块自行处理（版本号、Redis 等）。
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """带过期时间的 LRU 缓存
+
+    使用示例:
+        cache = TTLCache(maxsize=1000, ttl=60, name="product_snapshot")
+        cache.set(1, {...})
+        hit = cache.get(1)
+        found = cache.get_many([1, 2, 3])   # 只返回命中的键
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0, name: str = ""):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _get_locked(self, key: Hashable, now: float) -> Any:
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            self._misses += 1
+            return _MISSING
+        value, expire_ts = item
+        if expire_ts <= now:
+            del self._data[key]
+            self._misses += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        self._hits += 1
+        return value
+
+    def _set_locked(self, key: Hashable, value: Any, ttl: Optional[float], now: float) -> None:
+        self._data[key] = (value, now + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._get_locked(key, time.time())
+        return default if value is _MISSING else value
+
+    def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, Any]:
+        result = {}
+        with self._lock:
+            now = time.time()
+            for key in keys:
+                value = self._get_locked(key, now)
+                if value is not _MISSING:
+                    result[key] = value
+        return result
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._set_locked(key, value, ttl, time.time())
+
+    def set_many(self, mapping: Dict[Hashable, Any], ttl: Optional[float] = None) -> None:
+        with self._lock:
+            now = time.time()
+            for key, value in mapping.items():
+                self._set_locked(key, value, ttl, now)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_many(self, keys: Iterable[Hashable]) -> None:
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "name": self.name,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 4) if total else None,
+            }
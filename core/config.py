@@ -46,6 +46,24 @@ class Settings(BaseSettings):
     MYSQL_USER: str
     MYSQL_PASSWORD: str
     MYSQL_DATABASE: str
+    # 只读从库（报表/导出用；MYSQL_REPLICA_HOST 留空表示不使用从库，账号/库名留空沿用主库）
+    MYSQL_REPLICA_HOST: str = ""
+    MYSQL_REPLICA_PORT: int = 3306
+    MYSQL_REPLICA_USER: str = ""
+    MYSQL_REPLICA_PASSWORD: str = ""
+    MYSQL_REPLICA_DATABASE: str = ""
+    # 从库复制延迟超过该秒数时只读查询回落主库
+    MYSQL_REPLICA_MAX_LAG_SECONDS: int = 30
+
+    # Redis（分布式锁、幂等键等；REDIS_HOST 留空表示不使用 Redis）
+    REDIS_HOST: str = "localhost"
+    REDIS_PORT: int = 6379
+    REDIS_DB: int = 0
+    REDIS_PASSWORD: str = ""
+    # 幂等/锁存储后端：auto（Redis 可用用 Redis，否则 MySQL）/ redis / mysql / memory
+    IDEMPOTENCY_BACKEND: str = "auto"
+    # 微信接口限流令牌桶存储：auto（优先 Redis，暂时不可用时 MySQL；未配置 Redis 时进程内）/ redis / mysql / memory
+    RATE_LIMIT_BACKEND: str = "auto"
 
     # 微信/支付相关
     WECHAT_APP_ID: str = ""
@@ -144,6 +162,21 @@ def get_db_config():
         raise RuntimeError(f"缺少必要的数据库环境变量: {', '.join(missing)}\n")
     return cfg
 
+
+def get_replica_db_config():
+    """获取只读从库配置字典；未配置从库时返回 None"""
+    if not settings.MYSQL_REPLICA_HOST:
+        return None
+    primary = get_db_config()
+    return {
+        'host': settings.MYSQL_REPLICA_HOST,
+        'port': int(settings.MYSQL_REPLICA_PORT),
+        'user': settings.MYSQL_REPLICA_USER or primary['user'],
+        'password': settings.MYSQL_REPLICA_PASSWORD or primary['password'],
+        'database': settings.MYSQL_REPLICA_DATABASE or primary['database'],
+        'charset': 'utf8mb4',
+    }
+
 # ==================== 平台常量 ====================
 PLATFORM_MERCHANT_ID: Final[int] = 0
 MEMBER_PRODUCT_PRICE: Final[Decimal] = Decimal('1980.00')
@@ -259,6 +292,8 @@ WECHAT_APP_SECRET: Final[str] = settings.WECHAT_APP_SECRET
 # 挂载静态文件目录（/pic -> pic_data）
 # 将 `PIC_PATH` 指向存放商品图片的 `pic_data` 目录，保证 `/pic/<分类>/...` 能正确映射到磁盘文件
 PIC_PATH: Final[Path] = Path(__file__).resolve().parent.parent / "pic_data"
+# 小程序码/二维码缓存（按内容 sha256 存放，经 /pic/wxacode 静态访问，见 services/wxacode_cache.py）
+WXACODE_CACHE_DIR: Final[Path] = PIC_PATH / "wxacode"
 
 # 向后兼容：Wechat_ID 字典
 Wechat_ID: Final[dict] = {
@@ -2,13 +2,28 @@
 统一的数据库连接管理模块
 使用 pymysql 作为统一的数据库连接方式
 """
+import threading
+import time
 import pymysql
 from contextlib import contextmanager
 from typing import Optional
-from core.config import get_db_config
+from core.config import get_db_config, get_replica_db_config, settings
+from core.logging import get_logger
+
+logger = get_logger(__name__)
 
 # 全局连接配置缓存
 _db_config = None
+_replica_config = None
+_replica_config_loaded = False
+
+# 从库健康状态（进程内）：延迟检查结果缓存 REPLICA_CHECK_INTERVAL_SECONDS 秒，
+# 连接失败或延迟超限后 REPLICA_COOLDOWN_SECONDS 秒内只读查询直接走主库
+REPLICA_CHECK_INTERVAL_SECONDS = 5
+REPLICA_COOLDOWN_SECONDS = 30
+_replica_lock = threading.Lock()
+_replica_checked_at = 0.0
+_replica_down_until = 0.0
 
 
 def get_db_config_cached():
@@ -19,28 +34,109 @@ def get_db_config_cached():
     return _db_config
 
 
+def get_replica_config_cached():
+    """获取缓存的从库配置（未配置返回 None）"""
+    global _replica_config, _replica_config_loaded
+    if not _replica_config_loaded:
+        _replica_config = get_replica_db_config()
+        _replica_config_loaded = True
+    return _replica_config
+
+
+def _connect(cfg: dict):
+    return pymysql.connect(
+        host=cfg['host'],
+        port=cfg['port'],
+        user=cfg['user'],
+        password=cfg['password'],
+        database=cfg['database'],
+        charset=cfg['charset'],
+        cursorclass=pymysql.cursors.DictCursor,
+        autocommit=False  # 统一使用事务管理
+    )
+
+
+def _replica_lag_seconds(conn) -> Optional[float]:
+    """读取从库复制延迟；复制线程停止时返回 None，非从库（无复制状态）视为 0"""
+    with conn.cursor() as cur:
+        try:
+            cur.execute("SHOW REPLICA STATUS")
+        except pymysql.MySQLError:
+            cur.execute("SHOW SLAVE STATUS")  # MySQL 8.0.22 之前
+        row = cur.fetchone()
+    if not row:
+        return 0.0
+    lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+    return float(lag) if lag is not None else None
+
+
+def _mark_replica_down(reason: str) -> None:
+    global _replica_down_until
+    with _replica_lock:
+        _replica_down_until = time.time() + REPLICA_COOLDOWN_SECONDS
+    logger.warning(f"只读从库不可用，{REPLICA_COOLDOWN_SECONDS}秒内只读查询回落主库: {reason}")
+
+
+def _open_replica():
+    """打开从库连接；未配置、冷却中、连接失败或延迟超限时返回 None（调用方回落主库）"""
+    global _replica_checked_at
+    cfg = get_replica_config_cached()
+    if cfg is None:
+        return None
+    now = time.time()
+    if now < _replica_down_until:
+        return None
+
+    try:
+        conn = _connect(cfg)
+    except pymysql.MySQLError as e:
+        _mark_replica_down(f"连接失败 {e}")
+        return None
+
+    if now - _replica_checked_at >= REPLICA_CHECK_INTERVAL_SECONDS:
+        try:
+            lag = _replica_lag_seconds(conn)
+        except pymysql.MySQLError as e:
+            # 账号缺少 REPLICATION CLIENT 权限等：无法判断延迟时信任配置继续使用从库
+            logger.debug(f"读取从库复制状态失败，跳过延迟检查: {e}")
+            lag = 0.0
+        if lag is None or lag > settings.MYSQL_REPLICA_MAX_LAG_SECONDS:
+            conn.close()
+            _mark_replica_down(f"复制延迟 {lag if lag is not None else '未知（复制已停止）'}秒")
+            return None
+        with _replica_lock:
+            _replica_checked_at = now
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET SESSION TRANSACTION READ ONLY")
+    except pymysql.MySQLError as e:
+        logger.debug(f"设置从库会话只读失败（已忽略）: {e}")
+    return conn
+
+
 @contextmanager
-def get_conn():
+def get_conn(readonly: bool = False):
     """
     获取数据库连接的上下文管理器（统一入口）
+
+    Args:
+        readonly: True 时优先使用只读从库（报表、导出等允许秒级延迟的查询）；
+                  未配置从库、从库不可用或复制延迟超过 MYSQL_REPLICA_MAX_LAG_SECONDS 时自动回落主库。
+                  只读连接上不得执行写操作。
     
     使用示例:
         with get_conn() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
                 result = cur.fetchone()
+
+        with get_conn(readonly=True) as conn:
+            ...
     """
-    cfg = get_db_config_cached()
-    conn = pymysql.connect(
-        host=cfg['host'],
-        port=cfg['port'],
-        user=cfg['user'],
-        password=cfg['password'],
-        database=cfg['database'],
-        charset=cfg['charset'],
-        cursorclass=pymysql.cursors.DictCursor,
-        autocommit=False  # 统一使用事务管理
-    )
+    conn = _open_replica() if readonly else None
+    if conn is None:
+        conn = _connect(get_db_config_cached())
     try:
         yield conn
     except Exception:
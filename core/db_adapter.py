@@ -3,8 +3,9 @@
 提供统一的数据库操作接口，支持命名参数和便捷的结果访问
 """
 from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 import logging
-from typing import Optional, Any, Dict, List
+from typing import Optional, Any, Dict, List, Union
 from core.database import get_conn
 import pymysql
 from typing import Iterable, Tuple
@@ -263,6 +264,40 @@ def build_in_placeholders(values: Iterable) -> Tuple[str, dict]:
     return placeholders, params
 
 
+def _to_day_start(value: Union[str, date, datetime]) -> datetime:
+    if isinstance(value, datetime):
+        return datetime.combine(value.date(), datetime.min.time())
+    if isinstance(value, date):
+        return datetime.combine(value, datetime.min.time())
+    try:
+        return datetime.strptime(str(value).strip()[:10], "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"日期格式错误，请使用 yyyy-MM-dd: {value}")
+
+
+def build_date_range(column: str,
+                     start_date: Optional[Union[str, date, datetime]] = None,
+                     end_date: Optional[Union[str, date, datetime]] = None) -> Tuple[str, List[Any]]:
+    """把按日期（含首尾两天）的过滤转换为半开区间谓词，替代 `DATE(col) BETWEEN %s AND %s`。
+
+    DATE(col) 会让 MySQL 放弃 col 上的索引；改写为 `col >= start AND col < end + 1天` 后，
+    单列或 (type, created_at) 之类的复合索引都能做范围扫描。
+
+    返回 (predicate, params)，两端都为空时返回 ("", [])。例如:
+        build_date_range("af.created_at", "2025-01-01", "2025-01-31")
+        -> ("af.created_at >= %s AND af.created_at < %s", [datetime(2025,1,1), datetime(2025,2,1)])
+    """
+    conditions: List[str] = []
+    params: List[Any] = []
+    if start_date:
+        conditions.append(f"{column} >= %s")
+        params.append(_to_day_start(start_date))
+    if end_date:
+        conditions.append(f"{column} < %s")
+        params.append(_to_day_start(end_date) + timedelta(days=1))
+    return " AND ".join(conditions), params
+
+
 class ResultProxy:
     """数据库查询结果代理类，封装查询结果并提供便捷的访问方法"""
     
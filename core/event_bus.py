@@ -0,0 +1,170 @@
+# core/event_bus.py
+"""
+按键订阅的轻量事件总线（长轮询 / SSE 用）
+
+- 进程内：key -> asyncio.Queue 集合，publish 可在任意线程调用（call_soon_threadsafe 投递到订阅者事件循环）
+- 多 worker：Redis 可用时同时 PUBLISH 到频道，每个进程一个后台线程 SUBSCRIBE 后转发给本进程订阅者；
+  消息带进程标识，本进程发出的消息不重复投递。Redis 不可用时退化为仅进程内，订阅方应以超时后回查兜底
+
+使用示例:
+    from core.event_bus import order_event_bus
+
+    async with order_event_bus.subscribe(order_number) as queue:
+        ...  # 先订阅再查当前状态，避免漏掉查询与订阅之间的事件
+        event = await order_event_bus.wait(queue, timeout=25)
+
+    order_event_bus.publish(order_number, {"event": "paid"})
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Set, Tuple
+
+from core.logging import get_logger
+from core.redis_client import (
+    get_redis_client,
+    mark_redis_failure,
+    is_redis_error,
+    RECONNECT_INTERVAL_SECONDS,
+)
+
+logger = get_logger(__name__)
+
+# 单个订阅队列的最大积压，慢消费者丢弃多余事件（订阅方收到任一事件都会回查最新状态）
+_QUEUE_MAXSIZE = 16
+# 订阅轮询间隔（须小于客户端 socket_timeout），订阅中断后的重连等待
+_POLL_SECONDS = 1.0
+_RESUBSCRIBE_DELAY_SECONDS = 5
+
+
+class EventBus:
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self._origin = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._subscribers: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self._lock = threading.Lock()
+        self._listener: Optional[threading.Thread] = None
+
+    # ---------- 订阅 ----------
+    @asynccontextmanager
+    async def subscribe(self, key: str) -> AsyncIterator[asyncio.Queue]:
+        self._ensure_listener()
+        entry = (asyncio.get_running_loop(), asyncio.Queue(maxsize=_QUEUE_MAXSIZE))
+        with self._lock:
+            self._subscribers.setdefault(key, set()).add(entry)
+        try:
+            yield entry[1]
+        finally:
+            with self._lock:
+                subs = self._subscribers.get(key)
+                if subs is not None:
+                    subs.discard(entry)
+                    if not subs:
+                        self._subscribers.pop(key, None)
+
+    @staticmethod
+    async def wait(queue: asyncio.Queue, timeout: float) -> Optional[Dict[str, Any]]:
+        """等待下一条事件，超时返回 None"""
+        try:
+            return await asyncio.wait_for(queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    # ---------- 发布 ----------
+    def publish(self, key: str, payload: Optional[Dict[str, Any]] = None) -> None:
+        """发布事件；失败只记日志，不影响调用方（通常是支付回调）"""
+        if not key:
+            return
+        payload = dict(payload or {})
+        payload.setdefault("ts", int(time.time()))
+        self._dispatch_local(key, payload)
+
+        client = get_redis_client()
+        if client is None:
+            return
+        try:
+            client.publish(self.channel, json.dumps(
+                {"origin": self._origin, "key": key, "payload": payload},
+                ensure_ascii=False, default=str,
+            ))
+        except Exception as e:
+            if is_redis_error(e):
+                mark_redis_failure(e)
+            logger.warning(f"事件发布到 Redis 失败 {self.channel}/{key}: {e}")
+
+    def _dispatch_local(self, key: str, payload: Dict[str, Any]) -> None:
+        with self._lock:
+            subs = list(self._subscribers.get(key, ()))
+        for loop, queue in subs:
+            try:
+                loop.call_soon_threadsafe(self._put_nowait, queue, payload)
+            except RuntimeError:
+                # 订阅者事件循环已关闭
+                pass
+
+    @staticmethod
+    def _put_nowait(queue: asyncio.Queue, payload: Dict[str, Any]) -> None:
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            pass
+
+    # ---------- Redis 监听 ----------
+    def _ensure_listener(self) -> None:
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(
+                target=self._listen_forever, daemon=True, name=f"event-bus:{self.channel}"
+            )
+            self._listener.start()
+
+    def _listen_forever(self) -> None:
+        """订阅连接独立于共享客户端的健康状态：频道空闲时 get_message 按 _POLL_SECONDS 返回 None，
+        不会触发共享客户端的 socket_timeout；订阅中断只重建订阅，不调用 mark_redis_failure
+        （否则空闲一次就让幂等、缓存版本、限流等全部切到兜底）"""
+        while True:
+            client = get_redis_client()
+            if client is None:
+                time.sleep(RECONNECT_INTERVAL_SECONDS)
+                continue
+            pubsub = None
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                logger.info(f"事件总线已订阅 Redis 频道: {self.channel}")
+                while True:
+                    message = pubsub.get_message(timeout=_POLL_SECONDS)
+                    if message is not None:
+                        self._on_redis_message(message)
+            except Exception as e:
+                logger.warning(f"事件总线 Redis 订阅中断 {self.channel}，稍后重连: {e}")
+                time.sleep(_RESUBSCRIBE_DELAY_SECONDS)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+    def _on_redis_message(self, message: Dict[str, Any]) -> None:
+        if message.get("type") != "message":
+            return
+        try:
+            data = json.loads(message["data"])
+        except (TypeError, ValueError):
+            return
+        if data.get("origin") == self._origin or not data.get("key"):
+            return
+        self._dispatch_local(data["key"], data.get("payload") or {})
+
+
+# 订单支付/状态事件（线上订单按 order_number，线下收款码按 order_no）
+order_event_bus = EventBus("order:events")
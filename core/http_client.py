@@ -0,0 +1,194 @@
+# core/http_client.py
+"""
+出站 HTTP 客户端（微信开放接口、快递100 等第三方调用统一入口）
+
+原先每次调用都新建 httpx.AsyncClient 或直接 requests.get/post，每次都要重新建连接、做 TLS 握手，
+部分 async 函数里还直接调用同步 requests，把事件循环堵住。现在：
+
+- 异步：应用生命周期内共享一个 httpx.AsyncClient（keep-alive 连接池；安装了 h2 时启用 HTTP/2），
+  startup 时创建、shutdown 时关闭；非应用事件循环（定时任务里 run_until_complete 等）使用临时客户端
+- 同步：线程池/定时任务/同步路由共享一个 httpx.Client（线程安全，连接池复用）
+- 超时：按接口名配置（ENDPOINT_TIMEOUTS），未配置时用 DEFAULT_TIMEOUT_SECONDS
+- 重试：连接类错误（请求未发出）自动重试；读超时/5xx 仅在 idempotent=True 时重试，指数退避
+  （jscode2session 等一次性 code 换取接口不能标 idempotent：首个请求可能已被微信消费，重放只会得到 code 已使用）
+- 指标：按接口名累计调用次数、失败次数、重试次数与耗时，http_stats() 查看；超过 SLOW_REQUEST_MS 记警告
+
+使用示例:
+    resp = await async_request("POST", url, endpoint="wxa.getwxacodeunlimit", json=payload)
+    resp = sync_request("POST", url, endpoint="kuaidi100.query", idempotent=True, data=payload)
+    resp.raise_for_status()
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+from core.logging import get_logger
+
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:  # pragma: no cover - 未安装 h2 时使用 HTTP/1.1 keep-alive
+    HTTP2_ENABLED = False
+
+logger = get_logger(__name__)
+
+DEFAULT_TIMEOUT_SECONDS = 10.0
+CONNECT_TIMEOUT_SECONDS = 5.0
+MAX_RETRIES = 2
+RETRY_BACKOFF_SECONDS = 0.2
+SLOW_REQUEST_MS = 3000
+
+# 按接口名的读超时（秒）
+ENDPOINT_TIMEOUTS: Dict[str, float] = {
+    "cgi-bin.stable_token": 15,
+    "wxa.getwxacode": 10,
+    "wxa.getwxacodeunlimit": 10,
+    "wxa.generate_urllink": 15,
+    "wxa.generatescheme": 15,
+    "wxa.getuserphonenumber": 10,
+    "sns.jscode2session": 10,
+    "wxa.sec.order": 15,
+    "message.send": 10,
+    "kuaidi100.query": 10,
+}
+
+_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+
+_async_client: Optional[httpx.AsyncClient] = None
+_async_loop: Optional[asyncio.AbstractEventLoop] = None
+_sync_client: Optional[httpx.Client] = None
+_client_lock = threading.Lock()
+
+_stats: Dict[str, Dict[str, Any]] = {}
+_stats_lock = threading.Lock()
+
+
+def _timeout(endpoint: str, timeout: Optional[float]) -> httpx.Timeout:
+    read = timeout if timeout is not None else ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT_SECONDS)
+    return httpx.Timeout(read, connect=min(CONNECT_TIMEOUT_SECONDS, read))
+
+
+def _new_async_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(http2=HTTP2_ENABLED, limits=_LIMITS, timeout=DEFAULT_TIMEOUT_SECONDS)
+
+
+def get_sync_client() -> httpx.Client:
+    """进程共享的同步客户端（惰性创建）"""
+    global _sync_client
+    if _sync_client is None:
+        with _client_lock:
+            if _sync_client is None:
+                _sync_client = httpx.Client(http2=HTTP2_ENABLED, limits=_LIMITS, timeout=DEFAULT_TIMEOUT_SECONDS)
+    return _sync_client
+
+
+async def start_http_clients() -> None:
+    """应用 startup：在应用事件循环上创建共享异步客户端"""
+    global _async_client, _async_loop
+    if _async_client is None:
+        _async_client = _new_async_client()
+        _async_loop = asyncio.get_running_loop()
+        logger.info(f"出站 HTTP 客户端已创建（HTTP/2: {HTTP2_ENABLED}）")
+
+
+async def close_http_clients() -> None:
+    """应用 shutdown：关闭共享客户端，释放连接"""
+    global _async_client, _async_loop, _sync_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+        _async_loop = None
+    with _client_lock:
+        if _sync_client is not None:
+            _sync_client.close()
+            _sync_client = None
+
+
+def _record(endpoint: str, elapsed_ms: float, ok: bool, retries: int) -> None:
+    with _stats_lock:
+        s = _stats.setdefault(endpoint, {"calls": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0})
+        s["calls"] += 1
+        s["retries"] += retries
+        s["total_ms"] += elapsed_ms
+        s["max_ms"] = max(s["max_ms"], elapsed_ms)
+        if not ok:
+            s["errors"] += 1
+    if elapsed_ms > SLOW_REQUEST_MS:
+        logger.warning(f"出站请求耗时过长: {endpoint} {elapsed_ms:.0f}ms")
+
+
+def http_stats() -> Dict[str, Dict[str, Any]]:
+    """按接口名的调用统计（本进程）"""
+    with _stats_lock:
+        return {
+            name: {**s, "avg_ms": round(s["total_ms"] / s["calls"], 1) if s["calls"] else None}
+            for name, s in _stats.items()
+        }
+
+
+def _should_retry(error: Optional[Exception], resp: Optional[httpx.Response], idempotent: bool) -> bool:
+    # 连接没建立起来，请求一定没发出，任何方法都可以重试
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if not idempotent:
+        return False
+    if isinstance(error, (httpx.ReadTimeout, httpx.RemoteProtocolError)):
+        return True
+    return resp is not None and resp.status_code >= 500
+
+
+async def async_request(method: str, url: str, *, endpoint: str, timeout: Optional[float] = None,
+                        idempotent: bool = False, **kwargs) -> httpx.Response:
+    """异步发起请求；非 2xx 不抛异常，由调用方 raise_for_status 或按业务判断"""
+    client = _async_client
+    temporary = None
+    if client is None or _async_loop is not asyncio.get_running_loop():
+        temporary = client = _new_async_client()
+
+    started = time.perf_counter()
+    retries = 0
+    try:
+        while True:
+            resp, error = None, None
+            try:
+                resp = await client.request(method, url, timeout=_timeout(endpoint, timeout), **kwargs)
+            except httpx.TransportError as e:
+                error = e
+            if retries < MAX_RETRIES and _should_retry(error, resp, idempotent):
+                retries += 1
+                logger.warning(f"出站请求重试 {endpoint} 第{retries}次: {error or resp.status_code}")
+                await asyncio.sleep(RETRY_BACKOFF_SECONDS * (2 ** (retries - 1)))
+                continue
+            _record(endpoint, (time.perf_counter() - started) * 1000, error is None and resp.status_code < 500, retries)
+            if error is not None:
+                raise error
+            return resp
+    finally:
+        if temporary is not None:
+            await temporary.aclose()
+
+
+def sync_request(method: str, url: str, *, endpoint: str, timeout: Optional[float] = None,
+                 idempotent: bool = False, **kwargs) -> httpx.Response:
+    """同步发起请求（共享连接池）；语义同 async_request"""
+    client = get_sync_client()
+    started = time.perf_counter()
+    retries = 0
+    while True:
+        resp, error = None, None
+        try:
+            resp = client.request(method, url, timeout=_timeout(endpoint, timeout), **kwargs)
+        except httpx.TransportError as e:
+            error = e
+        if retries < MAX_RETRIES and _should_retry(error, resp, idempotent):
+            retries += 1
+            logger.warning(f"出站请求重试 {endpoint} 第{retries}次: {error or resp.status_code}")
+            time.sleep(RETRY_BACKOFF_SECONDS * (2 ** (retries - 1)))
+            continue
+        _record(endpoint, (time.perf_counter() - started) * 1000, error is None and resp.status_code < 500, retries)
+        if error is not None:
+            raise error
+        return resp
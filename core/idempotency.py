@@ -0,0 +1,279 @@
+# core/idempotency.py
+"""
+幂等键 / 分布式锁统一存储
+
+后端：
+- RedisIdempotencyBackend：SET NX EX，多进程/多机共享
+- MySQLIdempotencyBackend：idempotency_keys 表，单机或无 Redis 时的持久兜底
+- MemoryIdempotencyBackend：进程内字典，仅用于单进程部署与测试
+
+IDEMPOTENCY_BACKEND=auto 时每次调用优先使用 Redis，Redis 不可用（含运行中断线）时自动落到 MySQL，
+Redis 恢复后自动切回，不再依赖 import 时的一次性连接结果。
+
+使用示例:
+    from core.idempotency import idempotency_store
+
+    with idempotency_store.lock(f"order:create:{user_id}", ttl=5) as acquired:
+        if not acquired:
+            raise HTTPException(status_code=429, detail="请勿重复提交")
+        ...
+
+    if idempotency_store.is_done("pay:notify", transaction_id):
+        return SUCCESS
+"""
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, Optional, Tuple
+
+from core.config import settings
+from core.database import get_conn
+from core.logging import get_logger
+from core.redis_client import get_redis_client, mark_redis_failure, is_redis_error
+
+logger = get_logger(__name__)
+
+# 回调幂等命名空间：支付回调（/api/wechat-pay/notify 与线下 /zhifu/notify 共用，按 transaction_id）、退款回调
+PAY_NOTIFY_NAMESPACE = "pay:notify"
+REFUND_NOTIFY_NAMESPACE = "refund:notify"
+
+# 回调类幂等标记默认保留 3 天（覆盖微信支付/退款通知的重试周期）
+NOTIFY_DONE_TTL_SECONDS = 3 * 86400
+
+# 释放锁时仅删除自己持有的锁，避免误删他人在锁过期后重新获取的锁
+_REDIS_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+else
+    return 0
+end
+"""
+
+
+class IdempotencyBackend(ABC):
+    """幂等存储后端接口"""
+
+    name = "base"
+
+    @abstractmethod
+    def set_nx(self, key: str, value: str, ttl: int) -> bool:
+        """键不存在（或已过期）时写入并返回 True，否则返回 False"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: str, ttl: int) -> None:
+        ...
+
+    @abstractmethod
+    def delete_if_equals(self, key: str, value: str) -> bool:
+        ...
+
+
+class RedisIdempotencyBackend(IdempotencyBackend):
+    name = "redis"
+
+    def __init__(self, client):
+        self.client = client
+
+    def set_nx(self, key: str, value: str, ttl: int) -> bool:
+        return bool(self.client.set(key, value, nx=True, ex=ttl))
+
+    def get(self, key: str) -> Optional[str]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        self.client.setex(key, ttl, value)
+
+    def delete_if_equals(self, key: str, value: str) -> bool:
+        return bool(self.client.eval(_REDIS_RELEASE_SCRIPT, 1, key, value))
+
+
+class MySQLIdempotencyBackend(IdempotencyBackend):
+    """基于 idempotency_keys 表（见 database_setup.py），过期行在写入前惰性清理"""
+
+    name = "mysql"
+
+    def set_nx(self, key: str, value: str, ttl: int) -> bool:
+        expire_at = datetime.now() + timedelta(seconds=ttl)
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM idempotency_keys WHERE idem_key=%s AND expire_at <= NOW()",
+                    (key,)
+                )
+                cur.execute(
+                    "INSERT IGNORE INTO idempotency_keys (idem_key, idem_value, expire_at) VALUES (%s, %s, %s)",
+                    (key, value, expire_at)
+                )
+                inserted = cur.rowcount == 1
+                conn.commit()
+                return inserted
+
+    def get(self, key: str) -> Optional[str]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT idem_value FROM idempotency_keys WHERE idem_key=%s AND expire_at > NOW()",
+                    (key,)
+                )
+                row = cur.fetchone()
+                return row["idem_value"] if row else None
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        expire_at = datetime.now() + timedelta(seconds=ttl)
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """INSERT INTO idempotency_keys (idem_key, idem_value, expire_at) VALUES (%s, %s, %s)
+                       ON DUPLICATE KEY UPDATE idem_value=VALUES(idem_value), expire_at=VALUES(expire_at)""",
+                    (key, value, expire_at)
+                )
+                conn.commit()
+
+    def delete_if_equals(self, key: str, value: str) -> bool:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM idempotency_keys WHERE idem_key=%s AND idem_value=%s",
+                    (key, value)
+                )
+                deleted = cur.rowcount > 0
+                conn.commit()
+                return deleted
+
+
+class MemoryIdempotencyBackend(IdempotencyBackend):
+    """进程内实现（单进程部署/测试用），多 worker 下各自独立"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def _alive(self, key: str, now: float) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expire_ts = item
+        if expire_ts <= now:
+            self._data.pop(key, None)
+            return None
+        return value
+
+    def set_nx(self, key: str, value: str, ttl: int) -> bool:
+        with self._lock:
+            now = time.time()
+            if self._alive(key, now) is not None:
+                return False
+            self._data[key] = (value, now + ttl)
+            return True
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._alive(key, time.time())
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl)
+
+    def delete_if_equals(self, key: str, value: str) -> bool:
+        with self._lock:
+            if self._alive(key, time.time()) == value:
+                self._data.pop(key, None)
+                return True
+            return False
+
+
+class IdempotencyStore:
+    """幂等/锁门面：按配置选择后端，auto 模式下 Redis 故障时逐次降级到 MySQL"""
+
+    def __init__(self, backend: str = "auto"):
+        self.mode = (backend or "auto").lower()
+        self._mysql = MySQLIdempotencyBackend()
+        self._memory = MemoryIdempotencyBackend() if self.mode == "memory" else None
+
+    def _fallback(self) -> IdempotencyBackend:
+        return self._memory if self._memory is not None else self._mysql
+
+    def _backend(self) -> IdempotencyBackend:
+        if self.mode == "memory":
+            return self._memory
+        if self.mode == "mysql":
+            return self._mysql
+        client = get_redis_client()
+        if client is not None:
+            return RedisIdempotencyBackend(client)
+        if self.mode == "redis":
+            logger.warning("IDEMPOTENCY_BACKEND=redis 但 Redis 不可用，临时使用 MySQL 兜底")
+        return self._mysql
+
+    def _call(self, method: str, *args):
+        backend = self._backend()
+        try:
+            return getattr(backend, method)(*args)
+        except Exception as e:
+            if backend.name == "redis" and is_redis_error(e):
+                mark_redis_failure(e)
+                return getattr(self._fallback(), method)(*args)
+            raise
+
+    # ---------- 锁 ----------
+    def acquire_lock(self, key: str, ttl: int = 5, token: Optional[str] = None) -> Optional[str]:
+        """获取锁，成功返回持有令牌（释放时需要），失败返回 None"""
+        token = token or uuid.uuid4().hex
+        return token if self._call("set_nx", key, token, ttl) else None
+
+    def release_lock(self, key: str, token: Optional[str]) -> None:
+        if not token:
+            return
+        try:
+            self._call("delete_if_equals", key, token)
+        except Exception as e:
+            logger.error(f"释放锁失败 {key}: {e}")
+
+    @contextmanager
+    def lock(self, key: str, ttl: int = 5) -> Iterator[bool]:
+        """锁上下文：yield 是否获取成功，退出时仅释放自己持有的锁"""
+        token = self.acquire_lock(key, ttl)
+        try:
+            yield token is not None
+        finally:
+            if token is not None:
+                self.release_lock(key, token)
+
+    # ---------- 结果缓存 ----------
+    def get_result(self, key: str) -> Optional[str]:
+        return self._call("get", key)
+
+    def save_result(self, key: str, value: str, ttl: int = 86400) -> None:
+        self._call("set", key, value, ttl)
+
+    # ---------- 回调去重 ----------
+    def is_done(self, namespace: str, ident: str) -> bool:
+        """回调是否已处理完成（一次键查询，不读业务行）"""
+        if not ident:
+            return False
+        try:
+            return self._call("get", f"{namespace}:{ident}") is not None
+        except Exception as e:
+            logger.warning(f"幂等标记查询失败 {namespace}:{ident}，按未处理继续: {e}")
+            return False
+
+    def mark_done(self, namespace: str, ident: str, ttl: int = NOTIFY_DONE_TTL_SECONDS) -> None:
+        if not ident:
+            return
+        try:
+            self._call("set", f"{namespace}:{ident}", "1", ttl)
+        except Exception as e:
+            logger.warning(f"幂等标记写入失败 {namespace}:{ident}: {e}")
+
+
+# 全局实例
+idempotency_store = IdempotencyStore(settings.IDEMPOTENCY_BACKEND)
@@ -3,12 +3,12 @@
 微信模板消息推送服务
 用于状态变更实时通知
 """
-import requests
 import json
 import datetime
 import logging
 from typing import Dict, Any, Optional
-from core.config import WECHAT_APP_ID, WECHAT_APP_SECRET
+from core.http_client import async_request
+from core.wechat_token import get_access_token as get_shared_access_token, is_stale_token_error
 
 logger = logging.getLogger(__name__)
 
@@ -17,32 +17,12 @@ class PushService:
     """推送服务类"""
 
     def __init__(self):
-        self.access_token_url = "https://api.weixin.qq.com/cgi-bin/token"
         self.message_send_url = "https://api.weixin.qq.com/cgi-bin/message/subscribe/send"
-        self._access_token = None
-        self._token_expires_at = 0
-
-    async def get_access_token(self) -> str:
-        """获取小程序access_token"""
-        import time
-        if self._access_token and time.time() < self._token_expires_at:
-            return self._access_token
 
+    async def get_access_token(self, stale_token: Optional[str] = None) -> str:
+        """获取小程序access_token（core.wechat_token 统一缓存），失败返回空串"""
         try:
-            response = requests.get(
-                self.access_token_url,
-                params={
-                    "grant_type": "client_credential",
-                    "appid": WECHAT_APP_ID,
-                    "secret": WECHAT_APP_SECRET
-                },
-                timeout=10
-            )
-            data = response.json()
-            self._access_token = data.get("access_token")
-            expires_in = data.get("expires_in", 7200)
-            self._token_expires_at = time.time() + expires_in - 300  # 提前5分钟刷新
-            return self._access_token
+            return await get_shared_access_token(stale_token=stale_token)
         except Exception as e:
             logger.error(f"获取access_token失败: {str(e)}")
             return ""
@@ -61,24 +41,30 @@ class PushService:
                         return False
                     openid = result['openid']
 
-            # 发送消息
-            access_token = await self.get_access_token()
-            if not access_token:
-                return False
-
+            # 发送消息（token 失效时刷新后重试一次）
             message_data = {
                 "touser": openid,
                 "template_id": template_id,
                 "data": data
             }
 
-            response = requests.post(
-                f"{self.message_send_url}?access_token={access_token}",
-                json=message_data,
-                timeout=10
-            )
+            access_token = None
+            for attempt in range(2):
+                access_token = await self.get_access_token(stale_token=access_token)
+                if not access_token:
+                    return False
+
+                response = await async_request(
+                    "POST",
+                    f"{self.message_send_url}?access_token={access_token}",
+                    endpoint="message.send",
+                    json=message_data,
+                )
+                result = response.json()
+                if attempt == 0 and is_stale_token_error(result.get("errcode"), result.get("errmsg")):
+                    continue
+                break
 
-            result = response.json()
             if result.get("errcode") == 0:
                 logger.info(f"推送成功: 用户 {user_id}")
                 return True
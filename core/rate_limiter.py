@@ -1,37 +1,269 @@
 # core/rate_limiter.py
-import time
-import threading
+"""
+微信支付 V3 接口限流（令牌桶，多 worker 共享配额）
+
+原实现每个进程各自维护 deque + 全局 threading.Lock（异步装饰器里也持有该锁），
+等待后仍超限直接抛异常，且 N 个 uvicorn worker 各算各的，实际速率是配置的 N 倍。现在：
+
+1. 令牌桶：每个 key 容量 max_calls，按 max_calls/period 匀速补充；取令牌采用"预约"方式——
+   令牌不足时仍扣减（可为负），返回需要等待的秒数，调用方睡眠后直接放行，先到先得、无需重试
+2. 共享后端：RATE_LIMIT_BACKEND=auto 时优先 Redis（Lua 脚本原子计算，时钟取 Redis TIME），
+   已配置 Redis 但暂时不可用（含运行中断线）逐次降级到 MySQL rate_limit_buckets 表（SELECT ... FOR UPDATE），
+   MySQL 也失败时退回进程内桶并记录告警，限流器本身不阻断业务；
+   未配置 Redis（REDIS_HOST 为空 / 未安装 redis）时直接用进程内桶，不为每次微信调用加一次行锁，
+   多 worker 需共享配额时显式设置 RATE_LIMIT_BACKEND=mysql
+3. 异步装饰器：取令牌放到线程池执行，等待使用 asyncio.sleep，不再在事件循环里持有线程锁
+4. 排队上限：预计等待超过 max_wait 秒才抛 RateLimitExceeded（不扣令牌），正常突发只排队不报错
+5. 指标：get_stats() 返回每个 key 的放行/排队/拒绝次数与等待时长（本进程统计）
+6. 装饰器计数键：按参数名取 sub_mchid（或 rate_key），每个子商户一个桶；
+   函数没有这类参数或传空值时（进件提交/查询、图片上传等服务商级接口）整个接口共用一个桶，
+   不会把 applyment_id 等其它第二参数误当作子商户
+
+使用示例:
+    @settlement_rate_limiter
+    def modify_settlement_account(self, sub_mchid, ...): ...   # 按 sub_mchid 计数
+
+    @settlement_rate_limiter
+    def submit_applyment(self, applyment_data, ...): ...       # 无 sub_mchid，接口共用一个桶
+
+    await query_rate_limiter.acquire_async(f"query_order_{sub_mchid}")   # 非装饰器用法
+"""
 import asyncio
+import inspect
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
 from functools import wraps
-from collections import defaultdict, deque
-from typing import Callable, Any, Optional, Union, DefaultDict
-import os
+from typing import Any, Callable, Dict, Optional, Tuple
 
+from core.config import settings
+from core.database import get_conn
 from core.logging import get_logger
+from core.redis_client import get_redis_client, is_redis_configured, is_redis_error, mark_redis_failure
 
 logger = get_logger(__name__)
 
+KEY_PREFIX = "ratelimit"
+
+# 装饰器按这些参数名取计数键（sub_mchid：子商户；rate_key：调用方显式给出的计数键）
+KEY_PARAMS = ("sub_mchid", "rate_key")
+
+# KEYS[1]=桶键；ARGV: rate(个/秒), capacity, max_wait(秒)
+# 返回 {是否放行, 等待秒数(字符串，Lua 数字返回会被截断为整数)}
+_REDIS_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+if wait > max_wait then
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    return {0, tostring(wait)}
+end
+tokens = tokens - 1
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return {1, tostring(wait)}
+"""
+
+
+class RateLimitExceeded(Exception):
+    """预计排队时间超过 max_wait（令牌未扣减，调用方可稍后重试）"""
+
+
+def _take(tokens: float, ts: float, now: float, rate: float, capacity: float,
+          max_wait: float) -> Tuple[bool, float, float]:
+    """令牌桶计算（与 Lua 脚本一致），返回 (是否放行, 等待秒数, 剩余令牌)"""
+    tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+    wait = (1 - tokens) / rate if tokens < 1 else 0.0
+    if wait > max_wait:
+        return False, wait, tokens
+    return True, wait, tokens - 1
+
+
+class RedisBucketBackend:
+    name = "redis"
+
+    def __init__(self, client):
+        self.client = client
+
+    def take(self, key: str, rate: float, capacity: float, max_wait: float) -> Tuple[bool, float]:
+        granted, wait = self.client.eval(_REDIS_TAKE_SCRIPT, 1, key, rate, capacity, max_wait)
+        return bool(int(granted)), float(wait)
+
+
+class MySQLBucketBackend:
+    """基于 rate_limit_buckets 表（见 database_setup.py），时钟取数据库 NOW(6)"""
+
+    name = "mysql"
+
+    def take(self, key: str, rate: float, capacity: float, max_wait: float) -> Tuple[bool, float]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT IGNORE INTO rate_limit_buckets (bucket_key, tokens, refreshed_at) "
+                    "VALUES (%s, %s, UNIX_TIMESTAMP(NOW(6)))",
+                    (key, capacity)
+                )
+                cur.execute(
+                    "SELECT tokens, refreshed_at, UNIX_TIMESTAMP(NOW(6)) AS now_ts "
+                    "FROM rate_limit_buckets WHERE bucket_key=%s FOR UPDATE",
+                    (key,)
+                )
+                row = cur.fetchone()
+                now = float(row["now_ts"])
+                granted, wait, tokens = _take(
+                    float(row["tokens"]), float(row["refreshed_at"]), now, rate, capacity, max_wait
+                )
+                cur.execute(
+                    "UPDATE rate_limit_buckets SET tokens=%s, refreshed_at=%s WHERE bucket_key=%s",
+                    (tokens, now, key)
+                )
+                conn.commit()
+                return granted, wait
+
+
+class MemoryBucketBackend:
+    """进程内令牌桶：单进程部署、测试，以及共享后端全部不可用时的兜底"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, capacity: float, max_wait: float) -> Tuple[bool, float]:
+        with self._lock:
+            now = time.monotonic()
+            tokens, ts = self._buckets.get(key, (capacity, now))
+            granted, wait, tokens = _take(tokens, ts, now, rate, capacity, max_wait)
+            self._buckets[key] = (tokens, now)
+            return granted, wait
+
+    def reset(self, key: Optional[str] = None) -> None:
+        with self._lock:
+            if key:
+                self._buckets.pop(key, None)
+            else:
+                self._buckets.clear()
+
 
 class RateLimiter:
-    """微信支付V3 API专用限流器（线程安全，支持异步）
+    """微信支付V3 API专用限流器（令牌桶，多进程共享，支持同步/异步）
 
-    限制策略：每个sub_mchid独立计数，默认1秒5次请求
+    限制策略：每个sub_mchid独立计数，默认1秒5次请求（允许 max_calls 次突发）
     参考微信文档：QPS ≥ 10，但结算账户类接口建议更保守
     """
 
-    def __init__(self, max_calls: int = 5, period: int = 1):
+    def __init__(self, max_calls: int = 5, period: int = 1, name: str = "default",
+                 max_wait: float = 30.0, backend: Optional[str] = None):
         """
-        :param max_calls: 时间窗口内最大调用次数
+        :param max_calls: 时间窗口内最大调用次数（同时也是桶容量）
         :param period: 时间窗口（秒）
+        :param name: 限流器名称，作为共享存储键前缀的一部分
+        :param max_wait: 单次调用最长排队时间（秒），超过则抛 RateLimitExceeded
+        :param backend: auto / redis / mysql / memory，默认取 RATE_LIMIT_BACKEND
         """
         self.max_calls = max_calls
         self.period = period
-        # 存储结构：{key: deque([timestamp, ...])}
-        self.calls = defaultdict(deque)
-        self.lock = threading.Lock()
-
-        logger.info(f"RateLimiter初始化: max_calls={max_calls}, period={period}s")
-
+        self.name = name
+        self.max_wait = max_wait
+        self.rate = max_calls / float(period)
+        self.mode = (backend or settings.RATE_LIMIT_BACKEND or "auto").lower()
+        self._mysql = MySQLBucketBackend()
+        self._memory = MemoryBucketBackend()
+        # 本进程统计：{key: {...}}
+        self._stats: Dict[str, Dict[str, Any]] = defaultdict(self._new_stats)
+        self._stats_lock = threading.Lock()
+
+        logger.info(f"RateLimiter初始化: name={name}, max_calls={max_calls}, period={period}s, backend={self.mode}")
+
+    # ---------- 后端 ----------
+    def _backend(self):
+        if self.mode == "memory":
+            return self._memory
+        if self.mode == "mysql":
+            return self._mysql
+        if self.mode == "auto" and not is_redis_configured():
+            return self._memory
+        client = get_redis_client()
+        if client is not None:
+            return RedisBucketBackend(client)
+        return self._mysql
+
+    def _take(self, key: str) -> Tuple[bool, float, str]:
+        bucket_key = f"{KEY_PREFIX}:{self.name}:{key}"
+        backend = self._backend()
+        try:
+            granted, wait = backend.take(bucket_key, self.rate, self.max_calls, self.max_wait)
+            return granted, wait, backend.name
+        except Exception as e:
+            if backend.name == "redis" and is_redis_error(e):
+                mark_redis_failure(e)
+                backend = self._mysql
+                try:
+                    granted, wait = backend.take(bucket_key, self.rate, self.max_calls, self.max_wait)
+                    return granted, wait, backend.name
+                except Exception as e2:
+                    e = e2
+            if backend.name == "memory":
+                raise
+            logger.warning(f"限流共享存储不可用（{backend.name}），本次使用进程内令牌桶 {bucket_key}: {e}")
+            granted, wait = self._memory.take(bucket_key, self.rate, self.max_calls, self.max_wait)
+            return granted, wait, self._memory.name
+
+    # ---------- 统计 ----------
+    @staticmethod
+    def _new_stats() -> Dict[str, Any]:
+        return {"granted": 0, "delayed": 0, "rejected": 0, "wait_seconds_total": 0.0,
+                "wait_seconds_max": 0.0, "backend": None, "last_at": None}
+
+    def _record(self, key: str, granted: bool, wait: float, backend: str) -> None:
+        with self._stats_lock:
+            s = self._stats[key]
+            s["backend"] = backend
+            s["last_at"] = time.time()
+            if not granted:
+                s["rejected"] += 1
+                return
+            s["granted"] += 1
+            if wait > 0:
+                s["delayed"] += 1
+                s["wait_seconds_total"] += wait
+                s["wait_seconds_max"] = max(s["wait_seconds_max"], wait)
+
+    def _reserve(self, key: str) -> float:
+        granted, wait, backend = self._take(key)
+        self._record(key, granted, wait, backend)
+        if not granted:
+            logger.warning(f"微信接口限流拒绝: {self.name}/{key} 预计需排队{wait:.2f}秒，超过上限{self.max_wait}秒")
+            raise RateLimitExceeded(f"请求过于频繁，请{int(wait) + 1}秒后重试")
+        if wait > 0:
+            logger.info(f"微信接口限流排队: {self.name}/{key} 等待{wait:.2f}秒")
+        return wait
+
+    # ---------- 取令牌 ----------
+    def acquire(self, key: str) -> None:
+        """同步取令牌：不足时阻塞等待（调用方应处于线程池/后台线程中）"""
+        wait = self._reserve(key)
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, key: str) -> None:
+        """异步取令牌：存储访问在线程池执行，等待不占用事件循环"""
+        wait = await asyncio.to_thread(self._reserve, key)
+        if wait:
+            await asyncio.sleep(wait)
+
+    # ---------- 装饰器 ----------
     def __call__(self, func: Callable) -> Callable:
         """装饰器模式：自动识别同步/异步函数"""
         if asyncio.iscoroutinefunction(func):
@@ -39,42 +271,24 @@ class RateLimiter:
         else:
             return self._sync_decorator(func)
 
+    @staticmethod
+    def _extract_key(func: Callable, args: tuple, kwargs: dict) -> str:
+        """按 KEY_PARAMS 参数名取子商户计数键，取不到时按接口整体计数"""
+        try:
+            bound = inspect.signature(func).bind_partial(*args, **kwargs).arguments
+        except TypeError:
+            bound = kwargs
+        for param in KEY_PARAMS:
+            value = bound.get(param)
+            if isinstance(value, (str, int)) and not isinstance(value, bool) and value:
+                return f"{func.__name__}_{value}"
+        return func.__name__
+
     def _sync_decorator(self, func: Callable) -> Callable:
         """同步函数装饰器"""
         @wraps(func)
         def wrapper(*args: Any, **kwargs: Any) -> Any:
-            # 从参数中提取sub_mchid
-            sub_mchid = args[1] if len(args) > 1 else None
-            if not sub_mchid:
-                logger.warning(f"无法提取sub_mchid，限流器跳过: {func.__name__}")
-                return func(*args, **kwargs)
-
-            key = f"{func.__name__}_{sub_mchid}"
-
-            with self.lock:
-                now = time.time()
-                call_queue = self.calls[key]
-                # 清理过期记录
-                self._cleanup_expired(call_queue, now)
-
-                # 检查限流
-                sleep_time = self._check_limit(call_queue, now)
-
-                # 记录本次调用
-                call_queue.append(now)
-
-            # 在锁外等待
-            if sleep_time:
-                time.sleep(sleep_time)
-                # 等待后重新检查
-                with self.lock:
-                    now = time.time()
-                    call_queue = self.calls[key]
-                    self._cleanup_expired(call_queue, now)
-                    # 重新检查是否仍超限
-                    if len(call_queue) >= self.max_calls:
-                        raise Exception("限流异常：等待后仍超限，请求过于频繁")
-
+            self.acquire(self._extract_key(func, args, kwargs))
             return func(*args, **kwargs)
 
         return wrapper
@@ -83,112 +297,65 @@ class RateLimiter:
         """异步函数装饰器"""
         @wraps(func)
         async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
-            # 从参数中提取sub_mchid
-            sub_mchid = args[1] if len(args) > 1 else None
-            if not sub_mchid:
-                logger.warning(f"无法提取sub_mchid，限流器跳过: {func.__name__}")
-                return await func(*args, **kwargs)
-
-            key = f"{func.__name__}_{sub_mchid}"
-
-            with self.lock:
-                now = time.time()
-                call_queue = self.calls[key]
-                # 清理过期记录
-                self._cleanup_expired(call_queue, now)
-
-                # 检查限流
-                sleep_time = self._check_limit(call_queue, now)
-
-                # 记录本次调用
-                call_queue.append(now)
-
-            # 在锁外等待
-            if sleep_time:
-                await asyncio.sleep(sleep_time)
-                # 等待后重新检查
-                with self.lock:
-                    now = time.time()
-                    call_queue = self.calls[key]
-                    self._cleanup_expired(call_queue, now)
-                    # 重新检查是否仍超限
-                    if len(call_queue) >= self.max_calls:
-                        raise Exception("限流异常：等待后仍超限，请求过于频繁")
-
+            await self.acquire_async(self._extract_key(func, args, kwargs))
             return await func(*args, **kwargs)
 
         return async_wrapper
 
-    def _cleanup_expired(self, queue: deque, now: float):
-        """清理过期记录"""
-        while queue and now - queue[0] > self.period:
-            queue.popleft()
-
-    def _check_limit(self, queue: deque, now: float) -> Optional[float]:
-        """检查是否超限，返回等待时间"""
-        if len(queue) >= self.max_calls:
-            wait_time = self.period - (now - queue[0])
-            logger.warning(
-                f"微信接口限流触发: 当前{len(queue)}次/{self.period}秒, "
-                f"需等待{wait_time:.2f}秒"
-            )
-            return max(0, wait_time)
-        return None
-
     def get_stats(self, key: Optional[str] = None) -> dict:
-        """获取限流统计（清理后）"""
-        with self.lock:
-            now = time.time()
+        """获取本进程限流统计（桶状态在共享存储中，此处为各 key 的放行/排队/拒绝计数）"""
+        with self._stats_lock:
             if key:
-                queue = self.calls.get(key, deque())
-                self._cleanup_expired(queue, now)
-                return {
-                    "key": key,
-                    "current_calls": len(queue),
-                    "window_seconds": self.period,
-                    "max_calls": self.max_calls
-                }
-            else:
-                stats = {}
-                for k, q in self.calls.items():
-                    self._cleanup_expired(q, now)
-                    stats[k] = {
-                        "current_calls": len(q),
-                        "oldest_call_age": now - q[0] if q else None
-                    }
-                return stats
+                s = dict(self._stats.get(key) or self._new_stats())
+                return {"key": key, "name": self.name, "max_calls": self.max_calls,
+                        "window_seconds": self.period, **s}
+            return {k: dict(v) for k, v in self._stats.items()}
 
     def reset(self, key: Optional[str] = None):
-        """重置限流计数（用于测试）"""
-        with self.lock:
+        """重置本进程统计与进程内桶（用于测试；共享存储中的桶按 TTL 自然恢复）"""
+        with self._stats_lock:
             if key:
-                if key in self.calls:
-                    del self.calls[key]
+                self._stats.pop(key, None)
                 logger.info(f"限流计数已重置: {key}")
             else:
-                self.calls.clear()
+                self._stats.clear()
                 logger.info("限流计数已全局重置")
+        self._memory.reset(f"{KEY_PREFIX}:{self.name}:{key}" if key else None)
 
 
 # 全局限流器实例
 # 建议：结算账户类接口更严格（5次/秒），查询类可放宽（10次/秒）
-settlement_rate_limiter = RateLimiter(max_calls=5, period=1)
-query_rate_limiter = RateLimiter(max_calls=10, period=1)
+settlement_rate_limiter = RateLimiter(max_calls=5, period=1, name="settlement")
+query_rate_limiter = RateLimiter(max_calls=10, period=1, name="query")
+# 退款队列 worker 调用退款申请/查询接口（按子商户计数）
+refund_rate_limiter = RateLimiter(max_calls=5, period=1, name="refund")
+# 后台轮询进件状态的独立预算，与用户发起的进件/结算账户请求互不挤占
+applyment_poll_rate_limiter = RateLimiter(max_calls=2, period=1, name="applyment_poll")
 
 
 class SimpleWindowIPRateLimiter:
-    """按客户端 IP 的滑动窗口计数；超过阈值则拒绝（用于公开 H5 落地页）。"""
+    """按客户端 IP 的滑动窗口计数；超过阈值则拒绝（用于公开 H5 落地页）。
 
-    def __init__(self, max_calls: int, period_seconds: float):
+    IP 表按 LRU 保留最多 max_ips 个，最久未访问的 IP 先淘汰，避免被大量来源 IP 撑爆内存。
+    """
+
+    def __init__(self, max_calls: int, period_seconds: float, max_ips: int = 10000):
         self.max_calls = max_calls
         self.period_seconds = period_seconds
-        self._by_ip: DefaultDict[str, deque] = defaultdict(deque)
+        self.max_ips = max_ips
+        self._by_ip: "OrderedDict[str, deque]" = OrderedDict()
         self._lock = threading.Lock()
 
     def allow(self, ip: str) -> bool:
         with self._lock:
             now = time.time()
-            q = self._by_ip[ip]
+            q = self._by_ip.get(ip)
+            if q is None:
+                q = self._by_ip[ip] = deque()
+                while len(self._by_ip) > self.max_ips:
+                    self._by_ip.popitem(last=False)
+            else:
+                self._by_ip.move_to_end(ip)
             while q and now - q[0] > self.period_seconds:
                 q.popleft()
             if len(q) >= self.max_calls:
@@ -198,4 +365,4 @@ class SimpleWindowIPRateLimiter:
 
 
 # 永久收款 H5 中转 /offline（及兼容 /pay-bridge）：默认每 IP 每分钟 60 次
-pay_bridge_ip_limiter = SimpleWindowIPRateLimiter(max_calls=60, period_seconds=60.0)
\ No newline at end of file
+pay_bridge_ip_limiter = SimpleWindowIPRateLimiter(max_calls=60, period_seconds=60.0)
@@ -0,0 +1,93 @@
+# core/redis_client.py
+"""
+统一的 Redis 客户端管理模块
+
+- 惰性连接：首次使用时才连接，不再在 import 时一次性探测
+- 断线重连：连接失败后进入冷却期，冷却结束后自动重试，而不是整个进程生命周期都降级
+- 未安装 redis 或未配置 REDIS_HOST 时返回 None，由调用方走本地/数据库兜底
+"""
+import threading
+import time
+from typing import Optional
+
+from core.config import settings
+from core.logging import get_logger
+
+try:
+    import redis
+    import redis.exceptions
+except ImportError:  # pragma: no cover - 依赖缺失时降级
+    redis = None
+
+logger = get_logger(__name__)
+
+# 连接失败后的重试冷却时间（秒）
+RECONNECT_INTERVAL_SECONDS = 30
+
+_client = None
+_last_failure_at = 0.0
+_lock = threading.Lock()
+
+
+def _connect():
+    client = redis.Redis(
+        host=settings.REDIS_HOST,
+        port=int(settings.REDIS_PORT),
+        db=int(settings.REDIS_DB),
+        password=settings.REDIS_PASSWORD or None,
+        decode_responses=True,
+        socket_connect_timeout=2,
+        socket_timeout=2,
+        health_check_interval=30,
+    )
+    client.ping()
+    return client
+
+
+def is_redis_configured() -> bool:
+    """已安装 redis 且配置了 REDIS_HOST（不代表当前可连通）"""
+    return redis is not None and bool(settings.REDIS_HOST)
+
+
+def get_redis_client() -> Optional["redis.Redis"]:
+    """获取 Redis 客户端；不可用时返回 None（冷却期内不重复探测）"""
+    global _client, _last_failure_at
+    if not is_redis_configured():
+        return None
+    if _client is not None:
+        return _client
+    if time.time() - _last_failure_at < RECONNECT_INTERVAL_SECONDS:
+        return None
+
+    with _lock:
+        if _client is not None:
+            return _client
+        if time.time() - _last_failure_at < RECONNECT_INTERVAL_SECONDS:
+            return None
+        try:
+            _client = _connect()
+            logger.info(f"Redis 已连接: {settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB}")
+        except Exception as e:
+            _client = None
+            _last_failure_at = time.time()
+            logger.warning(f"Redis 连接失败（{RECONNECT_INTERVAL_SECONDS}s 后重试，期间走兜底）: {e}")
+    return _client
+
+
+def mark_redis_failure(error: Exception) -> None:
+    """调用方遇到 RedisError 时调用：丢弃当前客户端并进入冷却期"""
+    global _client, _last_failure_at
+    with _lock:
+        if _client is not None:
+            logger.warning(f"Redis 操作失败，暂时切换为兜底实现: {error}")
+            try:
+                _client.close()
+            except Exception:
+                pass
+        _client = None
+        _last_failure_at = time.time()
+
+
+def is_redis_error(error: Exception) -> bool:
+    """判断异常是否为 Redis 连接/命令错误"""
+    return redis is not None and isinstance(error, redis.exceptions.RedisError)
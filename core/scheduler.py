@@ -54,12 +54,14 @@ class TaskScheduler:
         )
         # ===========================================
 
-        # 每10分钟轮询审核中的进件状态
+        # 每分钟查询到期的进行中进件（各单按状态时长退避排期，回调后即时唤醒）
         self.scheduler.add_job(
             self.poll_applyment_status,
-            CronTrigger(minute="*/10"),
+            CronTrigger(minute="*"),
             id="poll_applyment_status",
-            replace_existing=True
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
         )
 
         # 每天9点检查审核超时（超过2个工作日）
@@ -107,6 +109,124 @@ class TaskScheduler:
             replace_existing=True
         )
 
+        # 每小时清理过期幂等键（MySQL 兜底存储）
+        self.scheduler.add_job(
+            self.clean_expired_idempotency_keys,
+            CronTrigger(hour="*", minute=40),
+            id="clean_expired_idempotency_keys",
+            replace_existing=True
+        )
+
+        # 每分钟提交退款队列中的待处理退款（审核后也会即时唤醒）
+        self.scheduler.add_job(
+            self.process_refund_tasks,
+            CronTrigger(minute="*"),
+            id="process_refund_tasks",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
+        # 每5分钟批量同步退款中订单的微信退款状态（回调丢失兜底）
+        self.scheduler.add_job(
+            self.sync_refund_status,
+            CronTrigger(minute="*/5"),
+            id="sync_refund_status",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
+        # 每日凌晨重算最近几天的财务日汇总（迟到数据修正）
+        self.scheduler.add_job(
+            self.compact_finance_rollups,
+            CronTrigger(hour=0, minute=30),
+            id="compact_finance_rollups",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
+        # 每小时回填 account_flow 订单关联（related_order_id / ref_type），回填完成后为空跑
+        self.scheduler.add_job(
+            self.backfill_account_flow_refs,
+            CronTrigger(minute=15),
+            id="backfill_account_flow_refs",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
+        # 每小时补算缺失的财务日汇总（历史数据首次上线），补齐后为空跑
+        self.scheduler.add_job(
+            self.backfill_finance_rollups,
+            CronTrigger(minute=45),
+            id="backfill_finance_rollups",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
+        # 每5分钟检查小程序 access_token，临近过期时提前刷新
+        self.scheduler.add_job(
+            self.refresh_wechat_access_token,
+            CronTrigger(minute="*/5"),
+            id="refresh_wechat_access_token",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
+        # 每分钟处理支付回调收件箱中到期/中断的事件（回调后即时处理的兜底）
+        self.scheduler.add_job(
+            self.process_pay_notify_inbox,
+            CronTrigger(minute="*"),
+            id="process_pay_notify_inbox",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
+        # 每分钟上传到期的微信发货录入任务（入队后即时唤醒的兜底）
+        self.scheduler.add_job(
+            self.process_shipping_queue,
+            CronTrigger(minute="*"),
+            id="process_shipping_queue",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
+        # 每小时第50分与微信订单列表对账，修正微信侧已发货的未完成任务
+        self.scheduler.add_job(
+            self.reconcile_shipping_queue,
+            CronTrigger(minute=50),
+            id="reconcile_shipping_queue",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
+        # 每天凌晨4点20分清理不再被引用的小程序码缓存文件
+        self.scheduler.add_job(
+            self.purge_wxacode_files,
+            CronTrigger(hour=4, minute=20),
+            id="purge_wxacode_files",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
+        # 每天10点30分下载前一日微信交易账单对账（微信次日10点后出账单）
+        self.scheduler.add_job(
+            self.reconcile_wechat_payments,
+            CronTrigger(hour=10, minute=30),
+            id="reconcile_wechat_payments",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+
         self.scheduler.start()
         logger.info("定时任务管理器已启动（当前进程持有锁）")
 
@@ -190,6 +310,125 @@ class TaskScheduler:
         except Exception as e:
             logger.error(f"[定时任务] 清理过期验证码失败: {e}")
 
+    def clean_expired_idempotency_keys(self):
+        """清理 idempotency_keys 表中的过期幂等键/锁"""
+        try:
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM idempotency_keys WHERE expire_at <= NOW() LIMIT 5000")
+                    deleted = cur.rowcount
+                    conn.commit()
+                    logger.info(f"[定时任务] 清理过期幂等键: {deleted}条")
+        except Exception as e:
+            logger.error(f"[定时任务] 清理过期幂等键失败: {e}")
+
+    def process_refund_tasks(self):
+        """提交 refund_tasks 中到期的待处理退款"""
+        try:
+            from services.refund_service import RefundService
+            accepted = RefundService.process_pending()
+            if accepted:
+                logger.info(f"[定时任务] 退款队列受理成功: {accepted}笔")
+        except Exception as e:
+            logger.error(f"[定时任务] 退款队列处理失败: {e}")
+
+    def sync_refund_status(self):
+        """批量查询退款中任务的微信状态并落终态"""
+        try:
+            from services.refund_service import RefundService
+            stats = RefundService.sync_in_flight()
+            if stats:
+                logger.info(f"[定时任务] 退款状态同步: {stats}")
+        except Exception as e:
+            logger.error(f"[定时任务] 退款状态同步失败: {e}")
+
+    def compact_finance_rollups(self):
+        """重算最近几天的 daily_order_stats / daily_points_stats / daily_pool_flow_stats"""
+        try:
+            from services.finance_rollup_service import FinanceRollupService
+            days = FinanceRollupService.compact()
+            logger.info(f"[定时任务] 财务日汇总完成: {days}天")
+        except Exception as e:
+            logger.error(f"[定时任务] 财务日汇总失败: {e}")
+
+    def backfill_finance_rollups(self):
+        """补算尚无汇总行的历史日期（按批推进，避免报表请求中现算写表）"""
+        try:
+            from services.finance_rollup_service import FinanceRollupService
+            days = FinanceRollupService.backfill_missing()
+            if days:
+                logger.info(f"[定时任务] 财务日汇总补齐: {days}天")
+        except Exception as e:
+            logger.error(f"[定时任务] 财务日汇总补齐失败: {e}")
+
+    def backfill_account_flow_refs(self):
+        """解析历史流水 remark，回填 account_flow.related_order_id / ref_type"""
+        try:
+            from services.flow_ref_service import FlowRefService
+            rows = FlowRefService.backfill()
+            if rows:
+                logger.info(f"[定时任务] 流水订单关联回填完成: {rows}行")
+        except Exception as e:
+            logger.error(f"[定时任务] 流水订单关联回填失败: {e}")
+
+    def refresh_wechat_access_token(self):
+        """小程序 access_token 提前刷新（core.wechat_token 共享缓存）"""
+        try:
+            from core.wechat_token import refresh_if_due
+            refresh_if_due()
+        except Exception as e:
+            logger.error(f"[定时任务] access_token 提前刷新失败: {e}")
+
+    def process_pay_notify_inbox(self):
+        """处理 pay_notify_inbox 中到期的支付成功事件"""
+        try:
+            from services.pay_notify_inbox import PayNotifyInbox
+            settled = asyncio.run(PayNotifyInbox.process_pending())
+            if settled:
+                logger.info(f"[定时任务] 支付回调收件箱处理完成: {settled}笔")
+        except Exception as e:
+            logger.error(f"[定时任务] 支付回调收件箱处理失败: {e}")
+
+    def process_shipping_queue(self):
+        """上传 wechat_shipping_queue 中到期的发货录入任务"""
+        try:
+            from services.shipping_sync_service import ShippingSyncService
+            uploaded = ShippingSyncService.process_pending()
+            if uploaded:
+                logger.info(f"[定时任务] 微信发货录入完成: {uploaded}单")
+        except Exception as e:
+            logger.error(f"[定时任务] 微信发货录入队列处理失败: {e}")
+
+    def reconcile_shipping_queue(self):
+        """按微信订单列表批量修正发货录入任务状态"""
+        try:
+            from services.shipping_sync_service import ShippingSyncService
+            fixed = ShippingSyncService.reconcile()
+            if fixed:
+                logger.info(f"[定时任务] 微信发货对账修正: {fixed}单")
+        except Exception as e:
+            logger.error(f"[定时任务] 微信发货对账失败: {e}")
+
+    def purge_wxacode_files(self):
+        """删除 pic_data/wxacode 中不再被 wxa_code_cache 引用的图片"""
+        try:
+            from services.wxacode_cache import WxaCodeCache
+            removed = WxaCodeCache.purge_orphan_files()
+            if removed:
+                logger.info(f"[定时任务] 清理小程序码缓存文件: {removed}个")
+        except Exception as e:
+            logger.error(f"[定时任务] 清理小程序码缓存文件失败: {e}")
+
+    def reconcile_wechat_payments(self):
+        """前一日微信支付账单与本地订单对账，差异写入 wechat_reconcile_items"""
+        try:
+            from services.wechat_reconcile_service import WechatReconcileService
+            summary = WechatReconcileService.run()
+            if summary.get("flagged_count"):
+                logger.warning(f"[定时任务] 微信支付对账存在待处理差异: {summary}")
+        except Exception as e:
+            logger.error(f"[定时任务] 微信支付对账失败: {e}")
+
     def clean_expired_drafts(self):
         """清理过期草稿"""
         try:
@@ -207,86 +446,14 @@ class TaskScheduler:
             logger.error(f"清理过期草稿失败: {str(e)}", exc_info=True)
 
     def poll_applyment_status(self):
-        """轮询审核中的进件状态"""
+        """查询到期的进行中进件（按单排期，见 services/applyment_poller.py）"""
         try:
-            with get_conn() as conn:
-                with conn.cursor() as cur:
-                    # 获取所有审核中的进件
-                    cur.execute("""
-                        SELECT applyment_id, user_id 
-                        FROM wx_applyment 
-                        WHERE applyment_state = 'APPLYMENT_STATE_AUDITING'
-                    """)
-                    applyments = cur.fetchall()
-
-                    for row in applyments:
-                        try:
-                            # 调用微信支付API查询状态
-                            status_info = self.pay_client.query_applyment_status(row['applyment_id'])
-                            new_state = status_info.get("applyment_state")
-
-                            # 如果状态有变化，直接更新数据库并推送
-                            if new_state and new_state != 'APPLYMENT_STATE_AUDITING':
-                                # 更新状态
-                                cur.execute("""
-                                    UPDATE wx_applyment 
-                                    SET applyment_state = %s, 
-                                        applyment_state_msg = %s,
-                                        sub_mchid = %s,
-                                        finished_at = CASE WHEN %s = 'APPLYMENT_STATE_FINISHED' THEN NOW() ELSE finished_at END
-                                    WHERE applyment_id = %s
-                                """, (
-                                    new_state,
-                                    status_info.get("state_msg"),
-                                    status_info.get("sub_mchid"),
-                                    new_state,
-                                    row['applyment_id']
-                                ))
-
-                                # 如果审核通过，绑定商户号并同步结算账户
-                                if new_state == "APPLYMENT_STATE_FINISHED":
-                                    sub_mchid = status_info.get("sub_mchid")
-
-                                    # 1. 绑定商户号
-                                    cur.execute("""
-                                        UPDATE users u
-                                        JOIN wx_applyment wa ON u.id = wa.user_id
-                                        SET u.wechat_sub_mchid = %s
-                                        WHERE wa.applyment_id = %s
-                                    """, (sub_mchid, row['applyment_id']))
-
-                                    # 2. 同步结算账户信息（复用service中的方法）
-                                    from services.wechat_applyment_service import WechatApplymentService
-                                    # 在循环外实例化服务类，避免重复创建
-                                    service = WechatApplymentService()
-                                    service._sync_settlement_account(cur, row['applyment_id'], row['user_id'],
-                                                                     sub_mchid)
-
-                                    # 关键修复：在推送前提交数据库事务
-                                    conn.commit()
-
-                                # 推送通知（使用同步方法）
-                                from core.push_service import push_service
-                                push_service.send_applyment_status_notification_sync(
-                                    row['user_id'],
-                                    new_state,
-                                    status_info.get("state_msg", "")
-                                )
-                            else:
-                                # 更新轮询时间
-                                cur.execute("""
-                                    UPDATE wx_applyment 
-                                    SET applyment_state_msg = %s,
-                                        updated_at = NOW()
-                                    WHERE applyment_id = %s
-                                """, (status_info.get("state_msg"), row['applyment_id']))
-                                conn.commit()
-
-                        except Exception as e:
-                            logger.error(f"轮询进件 {row['applyment_id']} 状态失败: {str(e)}")
-
+            from services.applyment_poller import ApplymentPoller
+            changed = ApplymentPoller.process_due()
+            if changed:
+                logger.info(f"[定时任务] 进件状态变更: {changed}个")
         except Exception as e:
-            logger.error(f"轮询进件状态失败: {str(e)}", exc_info=True)
+            logger.error(f"[定时任务] 轮询进件状态失败: {e}", exc_info=True)
 
     def check_audit_timeout(self):
         """检查审核超时（超过2个工作日）"""
@@ -331,6 +498,7 @@ class TaskScheduler:
         try:
             from services.wechat_shipping_v2_service import WechatShippingService
             from core.database import get_conn
+            from core.db_adapter import build_in_placeholders
             from api.order.order import OrderManager
             import time
             from datetime import datetime, timedelta
@@ -358,43 +526,47 @@ class TaskScheduler:
                 if not wx_orders:
                     break
 
-                with get_conn() as conn:
-                    with conn.cursor() as cur:
-                        for wx_order in wx_orders:
-                            transaction_id = wx_order.get("transaction_id")
-                            wx_state = wx_order.get("order_state")  # 1待发货 2已发货 3确认收货 ...
-                            merchant_trade_no = wx_order.get("merchant_trade_no")
-                            if not transaction_id:
-                                continue
-
-                            cur.execute("SELECT id, order_number, status FROM orders WHERE transaction_id=%s",
-                                        (transaction_id,))
-                            local_order = cur.fetchone()
-                            if not local_order:
-                                continue
-
-                            # 微信 order_state：1待发货 2已发货 3确认收货 4交易完成 …
-                            st = local_order["status"]
-                            if wx_state in (3, 4) and st != "completed":
-                                logger.info(
-                                    "微信订单已确认收货/交易完成，同步本地 completed: tx=%s local=%s",
-                                    transaction_id,
-                                    st,
-                                )
-                                OrderManager.update_status(
-                                    local_order["order_number"], "completed", external_conn=conn
-                                )
-                            elif wx_state == 2 and st == "pending_ship":
-                                logger.info(
-                                    "微信侧已发货，本地仍为待发货，同步为待收货: tx=%s",
-                                    transaction_id,
-                                )
-                                OrderManager.update_status(
-                                    local_order["order_number"], "pending_recv", external_conn=conn
-                                )
-                    # ==================== 新增：提交事务 ====================
-                    conn.commit()
-                    # =======================================================
+                # 每页一次 IN 查询（idx_trans），只对状态落后的订单发起更新
+                tx_ids = [o["transaction_id"] for o in wx_orders if o.get("transaction_id")]
+                if tx_ids:
+                    with get_conn() as conn:
+                        with conn.cursor() as cur:
+                            placeholders, params = build_in_placeholders(tx_ids)
+                            cur.execute(
+                                f"SELECT order_number, status, transaction_id FROM orders "
+                                f"WHERE transaction_id IN ({placeholders})",
+                                tuple(params.values()),
+                            )
+                            local_orders = {r["transaction_id"]: r for r in cur.fetchall()}
+                            for wx_order in wx_orders:
+                                transaction_id = wx_order.get("transaction_id")
+                                wx_state = wx_order.get("order_state")  # 1待发货 2已发货 3确认收货 ...
+                                local_order = local_orders.get(transaction_id)
+                                if not local_order:
+                                    continue
+
+                                # 微信 order_state：1待发货 2已发货 3确认收货 4交易完成 …
+                                st = local_order["status"]
+                                if wx_state in (3, 4) and st != "completed":
+                                    logger.info(
+                                        "微信订单已确认收货/交易完成，同步本地 completed: tx=%s local=%s",
+                                        transaction_id,
+                                        st,
+                                    )
+                                    OrderManager.update_status(
+                                        local_order["order_number"], "completed", external_conn=conn
+                                    )
+                                elif wx_state == 2 and st == "pending_ship":
+                                    logger.info(
+                                        "微信侧已发货，本地仍为待发货，同步为待收货: tx=%s",
+                                        transaction_id,
+                                    )
+                                    OrderManager.update_status(
+                                        local_order["order_number"], "pending_recv", external_conn=conn
+                                    )
+                        # ==================== 新增：提交事务 ====================
+                        conn.commit()
+                        # =======================================================
 
                 if not result.get("has_more"):
                     break
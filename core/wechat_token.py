@@ -0,0 +1,286 @@
+# core/wechat_token.py
+"""
+小程序 access_token 统一管理
+
+原先 wechat_api / WechatService / PushService / WechatShippingService / 用户模块各自拉 token，
+多数走普通 cgi-bin/token 且不缓存，多 worker 之间互相把对方的 token 刷掉（40001 not latest）。
+现在所有调用方都从这里取：
+
+- 共享缓存：wechat_access_tokens 表一行一个 appid，各进程另有本地缓存，到 refresh_after 前不查库
+- 单飞刷新：进程内线程锁 + 表内租约（lease_owner / lease_until），同一时刻只有一个 worker 调微信
+- 提前刷新：距过期 TOKEN_REFRESH_AHEAD_SECONDS 内即由拿到租约的 worker 后台换新，其余 worker 继续用旧 token；
+  定时任务 refresh_if_due() 兜底
+- 失效重试：调用方遇到 40001/42001 等错误时带上 stale_token 重取；共享缓存里已是新 token 则直接返回，
+  否则先普通模式拉取 stable_token，仍是同一个才 force_refresh
+
+使用示例:
+    token = get_access_token_sync()
+    ...
+    if is_stale_token_error(data.get("errcode")):
+        token = get_access_token_sync(stale_token=token)
+
+    token = await get_access_token()
+"""
+import functools
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from core.config import settings
+from core.database import get_conn
+from core.http_client import sync_request
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+STABLE_TOKEN_URL = "https://api.weixin.qq.com/cgi-bin/stable_token"
+
+# 距过期多久开始提前刷新；刷新租约时长；未拿到租约时等待他人刷新的最长时间
+TOKEN_REFRESH_AHEAD_SECONDS = 600
+TOKEN_EXPIRE_MARGIN_SECONDS = 60
+TOKEN_LEASE_SECONDS = 30
+TOKEN_WAIT_SECONDS = 8
+TOKEN_WAIT_INTERVAL_SECONDS = 0.3
+
+# 微信返回这些错误码说明 token 已失效（invalid credential / 已过期 / 不合法）
+STALE_TOKEN_ERRCODES = frozenset({40001, 40014, 42001})
+
+_OWNER = uuid.uuid4().hex[:12]
+_local: Dict[str, Any] = {"token": None, "expires_at": None, "refresh_after": None}
+_lock = threading.Lock()
+
+
+def is_stale_token_error(errcode: Any = None, errmsg: Optional[str] = None) -> bool:
+    """微信接口错误是否由 access_token 失效引起"""
+    try:
+        if errcode is not None and int(errcode) in STALE_TOKEN_ERRCODES:
+            return True
+    except (TypeError, ValueError):
+        pass
+    text = (errmsg or "").lower()
+    return "invalid credential" in text or "not latest" in text or "access_token expired" in text
+
+
+def _appid() -> str:
+    return settings.WECHAT_APP_ID
+
+
+def _usable(entry: Dict[str, Any], now: datetime, stale_token: Optional[str]) -> bool:
+    return bool(
+        entry.get("token")
+        and entry.get("expires_at")
+        and now < entry["expires_at"]
+        and entry["token"] != stale_token
+    )
+
+
+def _fresh(entry: Dict[str, Any], now: datetime) -> bool:
+    """未到提前刷新时间"""
+    return bool(entry.get("refresh_after") and now < entry["refresh_after"])
+
+
+def _read_row(cur) -> Dict[str, Any]:
+    cur.execute(
+        """SELECT access_token, expires_at, refresh_after, lease_owner, lease_until
+           FROM wechat_access_tokens WHERE appid = %s""",
+        (_appid(),)
+    )
+    row = cur.fetchone() or {}
+    return {
+        "token": row.get("access_token") or None,
+        "expires_at": row.get("expires_at"),
+        "refresh_after": row.get("refresh_after"),
+    }
+
+
+def _try_lease(now: datetime) -> bool:
+    """抢占刷新租约（过期租约可被接管）"""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("INSERT IGNORE INTO wechat_access_tokens (appid) VALUES (%s)", (_appid(),))
+            cur.execute(
+                """UPDATE wechat_access_tokens
+                   SET lease_owner = %s, lease_until = %s
+                   WHERE appid = %s AND (lease_until IS NULL OR lease_until < %s OR lease_owner = %s)""",
+                (_OWNER, now + timedelta(seconds=TOKEN_LEASE_SECONDS), _appid(), now, _OWNER)
+            )
+            acquired = cur.rowcount == 1
+            conn.commit()
+            return acquired
+
+
+def _release_lease() -> None:
+    try:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """UPDATE wechat_access_tokens SET lease_owner = NULL, lease_until = NULL
+                       WHERE appid = %s AND lease_owner = %s""",
+                    (_appid(), _OWNER)
+                )
+                conn.commit()
+    except Exception as e:
+        logger.warning(f"释放 access_token 刷新租约失败（{TOKEN_LEASE_SECONDS}s 后自动过期）: {e}")
+
+
+def _load_shared() -> Dict[str, Any]:
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            return _read_row(cur)
+
+
+def _store_shared(entry: Dict[str, Any]) -> None:
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO wechat_access_tokens (appid, access_token, expires_at, refresh_after)
+                   VALUES (%s, %s, %s, %s)
+                   ON DUPLICATE KEY UPDATE access_token = VALUES(access_token),
+                                           expires_at = VALUES(expires_at),
+                                           refresh_after = VALUES(refresh_after),
+                                           lease_owner = NULL, lease_until = NULL""",
+                (_appid(), entry["token"], entry["expires_at"], entry["refresh_after"])
+            )
+            conn.commit()
+
+
+def _fetch_stable_token(force_refresh: bool) -> Dict[str, Any]:
+    """调用 stable_token 接口；返回 {token, expires_at, refresh_after}"""
+    # 普通模式可安全重试；强制刷新只在请求未发出时重试
+    resp = sync_request(
+        "POST",
+        STABLE_TOKEN_URL,
+        endpoint="cgi-bin.stable_token",
+        idempotent=not force_refresh,
+        json={
+            "grant_type": "client_credential",
+            "appid": settings.WECHAT_APP_ID,
+            "secret": settings.WECHAT_APP_SECRET,
+            "force_refresh": bool(force_refresh),
+        },
+    )
+    resp.raise_for_status()
+    data = resp.json()
+    if data.get("errcode"):
+        logger.error("stable_token 失败: %s", data)
+        raise ValueError(data.get("errmsg") or str(data))
+
+    now = datetime.now()
+    expires_in = int(data.get("expires_in") or 7200)
+    # 普通模式下若微信返回的仍是即将过期的 token，1 分钟后再试，避免反复调用
+    refresh_in = max(60, expires_in - TOKEN_REFRESH_AHEAD_SECONDS)
+    return {
+        "token": data["access_token"],
+        "expires_at": now + timedelta(seconds=max(1, expires_in - TOKEN_EXPIRE_MARGIN_SECONDS)),
+        "refresh_after": now + timedelta(seconds=refresh_in),
+    }
+
+
+def _refresh(force_refresh: bool, stale_token: Optional[str]) -> Dict[str, Any]:
+    """拉取新 token 并写入共享缓存；stale_token 场景先走普通模式，拿到的仍是旧 token 才强制刷新"""
+    entry = _fetch_stable_token(force_refresh=force_refresh)
+    if stale_token and not force_refresh and entry["token"] == stale_token:
+        logger.warning("stable_token 普通模式返回的仍是已失效 token，强制刷新")
+        entry = _fetch_stable_token(force_refresh=True)
+    try:
+        _store_shared(entry)
+    except Exception as e:
+        logger.error(f"写入 access_token 共享缓存失败（仅本进程生效）: {e}")
+    logger.info(f"access_token 已刷新，有效至 {entry['expires_at']:%Y-%m-%d %H:%M:%S}")
+    return entry
+
+
+def _wait_for_peer(stale_token: Optional[str]) -> Optional[Dict[str, Any]]:
+    """其它 worker 持有租约时，轮询共享缓存等待其刷新结果"""
+    deadline = time.monotonic() + TOKEN_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        time.sleep(TOKEN_WAIT_INTERVAL_SECONDS)
+        shared = _load_shared()
+        if _usable(shared, datetime.now(), stale_token):
+            return shared
+    return None
+
+
+def get_access_token_sync(*, force_refresh: bool = False, stale_token: Optional[str] = None) -> str:
+    """
+    获取小程序 access_token（同步版，供线程内/同步代码调用）
+
+    force_refresh: 强制换新（会使其它 worker 手里的 token 失效，仅管理/排障用）
+    stale_token: 调用方刚被微信判定失效的 token，保证不再返回它
+    """
+    now = datetime.now()
+    if not force_refresh and _usable(_local, now, stale_token) and _fresh(_local, now):
+        return _local["token"]
+
+    with _lock:
+        now = datetime.now()
+        if not force_refresh and _usable(_local, now, stale_token) and _fresh(_local, now):
+            return _local["token"]
+
+        try:
+            shared = _load_shared()
+        except Exception as e:
+            logger.warning(f"读取 access_token 共享缓存失败，退回本进程缓存: {e}")
+            if not force_refresh and _usable(_local, now, stale_token):
+                return _local["token"]
+            _local.update(_refresh(force_refresh, stale_token))
+            return _local["token"]
+
+        if not force_refresh and _usable(shared, now, stale_token):
+            _local.update(shared)
+            if _fresh(shared, now):
+                return shared["token"]
+            # 临近过期：拿到租约的进程负责换新，其余进程继续使用当前 token
+            if not _try_lease(now):
+                return shared["token"]
+            try:
+                _local.update(_refresh(False, None))
+            except Exception as e:
+                logger.warning(f"提前刷新 access_token 失败，继续使用当前 token: {e}")
+                _release_lease()
+            return _local["token"]
+
+        leased = _try_lease(now)
+        if not leased:
+            peer = _wait_for_peer(stale_token)
+            if peer is not None:
+                _local.update(peer)
+                return peer["token"]
+            logger.warning(f"等待其它进程刷新 access_token 超时（{TOKEN_WAIT_SECONDS}s），本进程自行获取")
+        elif not force_refresh:
+            # 拿到租约前可能已有人刷新完成
+            shared = _load_shared()
+            if _usable(shared, datetime.now(), stale_token):
+                _release_lease()
+                _local.update(shared)
+                return shared["token"]
+
+        try:
+            entry = _refresh(force_refresh, stale_token)
+        except Exception:
+            if leased:
+                _release_lease()
+            raise
+        _local.update(entry)
+        return entry["token"]
+
+
+async def get_access_token(*, force_refresh: bool = False, stale_token: Optional[str] = None) -> str:
+    """获取小程序 access_token（异步版）：本地缓存命中直接返回，否则在线程池中查库/刷新"""
+    now = datetime.now()
+    if not force_refresh and _usable(_local, now, stale_token) and _fresh(_local, now):
+        return _local["token"]
+
+    import anyio
+    return await anyio.to_thread.run_sync(
+        functools.partial(get_access_token_sync, force_refresh=force_refresh, stale_token=stale_token)
+    )
+
+
+def refresh_if_due() -> None:
+    """定时任务：临近过期时提前刷新（未配置小程序时跳过）"""
+    if not settings.WECHAT_APP_ID or not settings.WECHAT_APP_SECRET:
+        return
+    get_access_token_sync()
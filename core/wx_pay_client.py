@@ -1,7 +1,10 @@
 # core/wx_pay_client.py
 # 微信支付V3 API客户端（生产级，本地公钥ID模式）
+import asyncio
+import functools
 import os
 import hashlib
+import threading
 import time
 import uuid
 import base64
@@ -9,6 +12,7 @@ import json
 import datetime
 from typing import Dict, Any, Optional
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
@@ -636,6 +640,10 @@ class WeChatPayClient:
     @query_rate_limiter
     def query_applyment_status(self, applyment_id: int) -> Dict[str, Any]:
         """查询进件状态"""
+        return self.fetch_applyment_status(applyment_id)
+
+    def fetch_applyment_status(self, applyment_id: int) -> Dict[str, Any]:
+        """查询进件状态（不经过共享查询限流，供自带限流预算的后台轮询调用）"""
         if self.mock_mode:
             logger.info(f"【MOCK】查询进件状态: {applyment_id}")
             return self._get_mock_application_status(f"MOCK_{applyment_id}")
@@ -1115,9 +1123,92 @@ class WeChatPayClient:
                 logger.error(f"【微信退款】微信错误详情: {error_data}")
             except:
                 logger.error(f"【微信退款】无法解析错误响应为JSON")
-            
+
             raise
 
+    def query_refund(self, out_refund_no: str, sub_mchid: Optional[str] = None) -> Dict[str, Any]:
+        """
+        查询单笔退款（按商户退款单号）
+        :return: 微信返回 JSON，status 为 SUCCESS / CLOSED / PROCESSING / ABNORMAL
+        """
+        if self.mock_mode:
+            logger.info(f"【MOCK】查询退款: {out_refund_no}")
+            return {"out_refund_no": out_refund_no, "status": "SUCCESS", "refund_id": f"MOCK_{out_refund_no}"}
+
+        url_path = f"/v3/refund/domestic/refunds/{out_refund_no}"
+        if sub_mchid:
+            url_path = f"{url_path}?sub_mchid={sub_mchid}"
+        full_url = f"{self.BASE_URL}{url_path}"
+
+        headers = {
+            'Authorization': self._build_auth_header('GET', url_path),
+            'Accept': 'application/json'
+        }
+
+        response = self.session.get(full_url, headers=headers, timeout=15)
+        response.raise_for_status()
+        return response.json()
+
+    # ==================== 对账相关API ====================
+
+    def query_transaction_by_out_trade_no(self, out_trade_no: str) -> Dict[str, Any]:
+        """
+        按商户订单号查询支付订单（对账核实用）
+        :return: 微信返回 JSON，trade_state 为 SUCCESS / NOTPAY / CLOSED / REFUND / ...
+        """
+        if self.mock_mode:
+            logger.info(f"【MOCK】查询支付订单: {out_trade_no}")
+            return {"out_trade_no": out_trade_no, "trade_state": "SUCCESS",
+                    "transaction_id": f"MOCK_{out_trade_no}"}
+
+        # 共用查询预算但不按订单号分桶：对账核实是批量调用，按接口计数
+        query_rate_limiter.acquire("query_transaction")
+        url_path = f"/v3/pay/transactions/out-trade-no/{out_trade_no}?mchid={self.mchid}"
+        headers = {
+            'Authorization': self._build_auth_header('GET', url_path),
+            'Accept': 'application/json'
+        }
+        response = self.session.get(f"{self.BASE_URL}{url_path}", headers=headers, timeout=15)
+        if response.status_code == 404:
+            return {"out_trade_no": out_trade_no, "trade_state": "NOT_EXIST"}
+        response.raise_for_status()
+        return response.json()
+
+    def download_trade_bill(self, bill_date: str, bill_type: str = "SUCCESS") -> str:
+        """
+        下载交易账单（bill_date 格式 YYYY-MM-DD，次日 10 点后可下载）
+        1. 申请账单获取 download_url 与摘要
+        2. 下载账单文件（同样需要签名）并校验 SHA1
+        :return: 账单 CSV 文本；当日无交易返回空字符串
+        """
+        if self.mock_mode:
+            logger.info(f"【MOCK】下载交易账单: {bill_date}")
+            return ""
+
+        query_rate_limiter.acquire("trade_bill")
+        url_path = f"/v3/bill/tradebill?bill_date={bill_date}&bill_type={bill_type}"
+        headers = {
+            'Authorization': self._build_auth_header('GET', url_path),
+            'Accept': 'application/json'
+        }
+        response = self.session.get(f"{self.BASE_URL}{url_path}", headers=headers, timeout=15)
+        if response.status_code == 400 and "NO_STATEMENT_EXIST" in response.text:
+            return ""
+        response.raise_for_status()
+        meta = response.json()
+
+        download_url = meta["download_url"]
+        download_path = download_url[len(self.BASE_URL):] if download_url.startswith(self.BASE_URL) else download_url
+        headers = {'Authorization': self._build_auth_header('GET', download_path)}
+        response = self.session.get(download_url, headers=headers, timeout=60)
+        response.raise_for_status()
+
+        content = response.content
+        if meta.get("hash_type", "SHA1").upper() == "SHA1" and meta.get("hash_value"):
+            if hashlib.sha1(content).hexdigest().lower() != meta["hash_value"].lower():
+                raise ValueError(f"交易账单摘要校验失败: {bill_date}")
+        return content.decode("utf-8-sig")
+
 
     # ==================== 本地加密解密工具 ====================
 
@@ -1155,5 +1246,101 @@ class WeChatPayClient:
         return self._decrypt_local(encrypted_data, key)
 
 
+# ==================== 异步包装 ====================
+
+# 微信支付调用专用线程池：同步客户端（requests、RSA 签名、限流器 sleep）在这里执行，不占用事件循环，
+# 也不与 FastAPI 默认线程池里的同步路由争抢线程
+WX_PAY_EXECUTOR_WORKERS = 16
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=WX_PAY_EXECUTOR_WORKERS, thread_name_prefix="wxpay")
+    return _executor
+
+
+async def run_in_wxpay_executor(func, *args, **kwargs):
+    """在微信支付专用线程池中执行同步函数（验签、解密、同步 SDK 调用）"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown_wxpay_executor() -> None:
+    """应用 shutdown 时调用：不再接收新任务，已提交的调用继续完成"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+class AsyncWeChatPayClient:
+    """WeChatPayClient 的异步包装：所有公开方法在专用线程池中执行，供 async 路由/服务 await 调用
+
+    使用示例:
+        resp = await async_wxpay_client.create_jsapi_order(out_trade_no=..., total_fee=..., openid=...)
+        result = await async_wxpay_client.refund(transaction_id=..., out_refund_no=..., ...)
+    其它属性（mock_mode、apiv3_key 等）透传给同步客户端。
+    """
+
+    def __init__(self, client: WeChatPayClient):
+        self.sync = client
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.sync, name)
+
+    async def _run(self, func, *args, **kwargs):
+        return await run_in_wxpay_executor(func, *args, **kwargs)
+
+    async def create_jsapi_order(self, *args, **kwargs) -> Dict[str, Any]:
+        return await self._run(self.sync.create_jsapi_order, *args, **kwargs)
+
+    async def generate_jsapi_pay_params(self, prepay_id: str) -> Dict[str, str]:
+        return await self._run(self.sync.generate_jsapi_pay_params, prepay_id)
+
+    async def refund(self, *args, **kwargs) -> Dict[str, Any]:
+        return await self._run(self.sync.refund, *args, **kwargs)
+
+    async def query_refund(self, *args, **kwargs) -> Dict[str, Any]:
+        return await self._run(self.sync.query_refund, *args, **kwargs)
+
+    async def query_transaction_by_out_trade_no(self, out_trade_no: str) -> Dict[str, Any]:
+        return await self._run(self.sync.query_transaction_by_out_trade_no, out_trade_no)
+
+    async def download_trade_bill(self, *args, **kwargs) -> str:
+        return await self._run(self.sync.download_trade_bill, *args, **kwargs)
+
+    async def submit_applyment(self, *args, **kwargs) -> Dict[str, Any]:
+        return await self._run(self.sync.submit_applyment, *args, **kwargs)
+
+    async def query_applyment_status(self, applyment_id: int) -> Dict[str, Any]:
+        return await self._run(self.sync.query_applyment_status, applyment_id)
+
+    async def upload_image(self, image_content: bytes, content_type: str) -> str:
+        return await self._run(self.sync.upload_image, image_content, content_type)
+
+    async def query_settlement_account(self, sub_mchid: str) -> Dict[str, Any]:
+        return await self._run(self.sync.query_settlement_account, sub_mchid)
+
+    async def modify_settlement_account(self, sub_mchid: str, account_info: Dict[str, Any]) -> Dict[str, Any]:
+        return await self._run(self.sync.modify_settlement_account, sub_mchid, account_info)
+
+    async def query_application_status(self, sub_mchid: str, application_no: str) -> Dict[str, Any]:
+        return await self._run(self.sync.query_application_status, sub_mchid, application_no)
+
+    async def verify_signature(self, signature: str, timestamp: str, nonce: str, body: str) -> bool:
+        return await self._run(self.sync.verify_signature, signature, timestamp, nonce, body)
+
+    async def decrypt_callback_data(self, resource: dict) -> dict:
+        return await self._run(self.sync.decrypt_callback_data, resource)
+
+
 # 全局客户端实例
-wxpay_client = WeChatPayClient()
\ No newline at end of file
+wxpay_client = WeChatPayClient()
+async_wxpay_client = AsyncWeChatPayClient(wxpay_client)
\ No newline at end of file
@@ -0,0 +1,234 @@
+# core/wx_pay_notify.py
+"""
+微信支付 V3 回调验签 / 解密
+
+原先 /api/wechat-pay/notify、/refund-notify 与 services.notify_service 各自加载平台公钥/证书：
+WeChatPayClient.verify_signature 公钥为空时重新读文件、签名解码层层兜底，notify_service 另建一个 wxpay 对象。
+现在所有回调入口都走这里：
+
+- 验签公钥：进程内按 Wechatpay-Serial 缓存（公钥ID模式 PUB_KEY_ID_xxx / 平台证书序列号），启动后首次使用时加载
+- 轮换：收到未知序列号时重新扫描公钥/证书文件（间隔不少于 KEY_RELOAD_MIN_INTERVAL_SECONDS），
+  新公钥以 <PUB_KEY_ID>.pem 放在 WECHAT_PAY_PUBLIC_KEY_PATH 同目录即可，平台证书路径可以是目录（新旧证书并存）
+- 时间戳：与本机时间相差超过 NOTIFY_TIMESTAMP_TOLERANCE_SECONDS 的回调拒绝（防重放）
+- 解密：AESGCM 实例按 APIv3 key 复用
+- open_notify() 在微信支付专用线程池中一次完成解析、验签、解密，不占用事件循环
+
+使用示例:
+    try:
+        data, resource = await open_notify(request.headers, body)
+    except NotifyVerifyError as e:
+        return fail(str(e))
+"""
+import base64
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from core.config import (
+    ENVIRONMENT, WECHAT_PAY_API_V3_KEY, WECHAT_PAY_PLATFORM_CERT_PATH,
+    WECHAT_PAY_PUBLIC_KEY_PATH, WECHAT_PAY_PUB_KEY_ID, settings,
+)
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+NOTIFY_TIMESTAMP_TOLERANCE_SECONDS = 300
+KEY_RELOAD_MIN_INTERVAL_SECONDS = 60
+
+_keys: Dict[str, Any] = {}
+_state = {"loaded_at": 0.0}
+_key_lock = threading.Lock()
+_aesgcm: Dict[bytes, AESGCM] = {}
+
+
+class NotifyVerifyError(Exception):
+    """回调验签/解密失败（应答 FAIL，由微信重试）"""
+
+
+def _pem_files(path: str) -> Iterable[Path]:
+    if not path:
+        return []
+    p = Path(path)
+    if p.is_dir():
+        return sorted(p.glob("*.pem"))
+    return [p] if p.exists() else []
+
+
+def _load_keys() -> Dict[str, Any]:
+    """扫描公钥/平台证书文件，返回 {序列号(大写): 公钥}"""
+    keys: Dict[str, Any] = {}
+
+    # 公钥ID模式：配置的公钥 + 同目录下以 PUB_KEY_ID_ 命名的轮换公钥
+    if WECHAT_PAY_PUBLIC_KEY_PATH and Path(WECHAT_PAY_PUBLIC_KEY_PATH).is_file():
+        key_path = Path(WECHAT_PAY_PUBLIC_KEY_PATH)
+        candidates = [(WECHAT_PAY_PUB_KEY_ID, key_path)] if WECHAT_PAY_PUB_KEY_ID else []
+        candidates += [(f.stem, f) for f in sorted(key_path.parent.glob("PUB_KEY_ID_*.pem"))]
+        for key_id, f in candidates:
+            try:
+                keys[key_id.upper()] = serialization.load_pem_public_key(f.read_bytes(), backend=default_backend())
+            except Exception as e:
+                logger.warning(f"加载微信支付公钥失败 {f}: {e}")
+
+    # 平台证书模式（兼容老商户）：按证书序列号登记
+    for f in _pem_files(WECHAT_PAY_PLATFORM_CERT_PATH):
+        try:
+            cert = x509.load_pem_x509_certificate(f.read_bytes(), backend=default_backend())
+        except Exception as e:
+            logger.warning(f"加载微信支付平台证书失败 {f}: {e}")
+            continue
+        keys[format(cert.serial_number, "x").upper()] = cert.public_key()
+
+    return keys
+
+
+def _reload_keys(force: bool = False) -> None:
+    with _key_lock:
+        now = time.monotonic()
+        if not force and _state["loaded_at"] and now - _state["loaded_at"] < KEY_RELOAD_MIN_INTERVAL_SECONDS:
+            return
+        _state["loaded_at"] = now
+        keys = _load_keys()
+        added = sorted(set(keys) - set(_keys))
+        _keys.clear()
+        _keys.update(keys)
+    if added:
+        logger.info(f"微信支付验签公钥已加载: {', '.join(added)}")
+
+
+def get_verify_key(serial: str) -> Optional[Any]:
+    """按 Wechatpay-Serial 取验签公钥；未命中时重新扫描文件一次（支持公钥/证书轮换）"""
+    serial = (serial or "").strip().upper()
+    key = _keys.get(serial)
+    if key is None:
+        _reload_keys()
+        key = _keys.get(serial)
+    return key
+
+
+def _lower_headers(headers: Mapping[str, str]) -> Dict[str, str]:
+    return {k.lower(): v for k, v in headers.items()}
+
+
+def verify_notify(headers: Mapping[str, str], body: bytes) -> None:
+    """校验回调签名头与签名，失败抛出 NotifyVerifyError"""
+    if settings.wx_mock_mode_bool:
+        return
+
+    headers = _lower_headers(headers)
+    signature = headers.get("wechatpay-signature")
+    timestamp = headers.get("wechatpay-timestamp")
+    nonce = headers.get("wechatpay-nonce")
+    serial = headers.get("wechatpay-serial")
+    if not all([signature, timestamp, nonce, serial]):
+        raise NotifyVerifyError("Missing callback headers")
+
+    # 测试回调的伪造签名仅在非生产环境放行
+    if signature.upper().startswith("MOCK") and ENVIRONMENT != "production":
+        logger.warning("检测到测试签名，跳过验签")
+        return
+
+    try:
+        skew = abs(time.time() - int(timestamp))
+    except ValueError:
+        raise NotifyVerifyError("Invalid timestamp")
+    if skew > NOTIFY_TIMESTAMP_TOLERANCE_SECONDS:
+        raise NotifyVerifyError(f"Timestamp out of range: {int(skew)}s")
+
+    key = get_verify_key(serial)
+    if key is None:
+        logger.error(f"未知的 Wechatpay-Serial: {serial}，已加载: {sorted(_keys)}")
+        raise NotifyVerifyError(f"Unknown Wechatpay-Serial: {serial}")
+
+    try:
+        signature_bytes = base64.b64decode(signature.strip(), validate=True)
+    except Exception:
+        raise NotifyVerifyError("Invalid signature encoding")
+
+    message = b"%s\n%s\n%s\n" % (timestamp.encode(), nonce.encode(), body)
+    try:
+        key.verify(signature_bytes, message, padding.PKCS1v15(), hashes.SHA256())
+    except InvalidSignature:
+        raise NotifyVerifyError("Signature verification failed")
+
+
+def _get_aesgcm() -> AESGCM:
+    key = (WECHAT_PAY_API_V3_KEY or "").encode("utf-8")
+    aesgcm = _aesgcm.get(key)
+    if aesgcm is None:
+        if len(key) not in (16, 24, 32):
+            raise NotifyVerifyError("Invalid APIv3 key length")
+        aesgcm = _aesgcm.setdefault(key, AESGCM(key))
+    return aesgcm
+
+
+def decrypt_resource(resource: Dict[str, Any]) -> Dict[str, Any]:
+    """解密回调 resource（AEAD_AES_256_GCM），失败抛出 NotifyVerifyError"""
+    missing = [f for f in ("ciphertext", "nonce") if not resource.get(f)]
+    if missing:
+        raise NotifyVerifyError(f"Missing resource fields: {','.join(missing)}")
+    ad = resource.get("associated_data") or ""
+    try:
+        plaintext = _get_aesgcm().decrypt(
+            str(resource["nonce"]).encode("utf-8"),
+            base64.b64decode(resource["ciphertext"]),
+            ad.encode("utf-8") if ad else None,
+        )
+        return json.loads(plaintext.decode("utf-8"))
+    except NotifyVerifyError:
+        raise
+    except Exception as e:
+        logger.error(
+            "回调解密失败: %s; ct_len=%s, nonce_len=%s, ad_len=%s",
+            e, len(str(resource.get("ciphertext", ""))), len(str(resource.get("nonce", ""))), len(ad),
+        )
+        raise NotifyVerifyError("Decrypt failed")
+
+
+def _parse_body(body: bytes, content_type: str) -> Dict[str, Any]:
+    # 真实微信通知是 JSON，部分测试工具使用 XML 包装
+    if "xml" in (content_type or ""):
+        import xmltodict
+
+        data = xmltodict.parse(body).get("xml", {})
+        if "resource" not in data:
+            return {"resource": data}
+        resource = data["resource"]
+        return json.loads(resource) if isinstance(resource, str) else {"resource": resource}
+    return json.loads(body)
+
+
+def open_notify_sync(headers: Mapping[str, str], body: bytes, *, verify: bool = True,
+                     decrypt: bool = True) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """解析 + 验签 + 解密，返回 (外层报文, resource 明文)
+
+    verify/decrypt 仅供开发绕过使用（调用方负责限制在非生产环境）
+    """
+    if not body or not body.strip():
+        raise NotifyVerifyError("Empty request body")
+    if verify:
+        verify_notify(headers, body)
+    try:
+        data = _parse_body(body, _lower_headers(headers).get("content-type", ""))
+    except Exception:
+        raise NotifyVerifyError("Invalid request body")
+    resource = data.get("resource") or {}
+    if not resource:
+        raise NotifyVerifyError("Missing resource")
+    return data, (decrypt_resource(resource) if decrypt else resource)
+
+
+async def open_notify(headers: Mapping[str, str], body: bytes, *, verify: bool = True,
+                      decrypt: bool = True) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """open_notify_sync 的异步版：在微信支付专用线程池中执行（RSA 验签不占用事件循环）"""
+    from core.wx_pay_client import run_in_wxpay_executor
+
+    return await run_in_wxpay_executor(open_notify_sync, _lower_headers(headers), body, verify=verify, decrypt=decrypt)
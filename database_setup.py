@@ -59,6 +59,33 @@ class DatabaseManager:
             # 如果表不存在，会在创建表时处理
             logger.debug(f"表 {table_name} 可能不存在，将在创建表时处理: {e}")
 
+    def _ensure_table_indexes(self, cursor, table_name: str, required_indexes: dict):
+        """
+        确保表的必需索引存在，如果不存在则添加（按索引名判断）
+
+        Args:
+            cursor: 数据库游标
+            table_name: 表名
+            required_indexes: 必需索引字典，格式为 {索引名: 列定义}，如 {'idx_type_created': '(type, created_at)'}
+        """
+        try:
+            cursor.execute("""
+                SELECT DISTINCT INDEX_NAME
+                FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+            """, (table_name,))
+            existing_indexes = {row['INDEX_NAME'] for row in cursor.fetchall()}
+
+            for index_name, columns in required_indexes.items():
+                if index_name not in existing_indexes:
+                    try:
+                        cursor.execute(f"ALTER TABLE {table_name} ADD INDEX {index_name} {columns}")
+                        logger.info(f"✅ 已添加索引 {table_name}.{index_name} {columns}")
+                    except Exception as e:
+                        logger.warning(f"⚠️ 添加索引 {table_name}.{index_name} 失败: {e}")
+        except Exception as e:
+            logger.debug(f"表 {table_name} 索引检查失败: {e}")
+
     def init_all_tables(self, cursor):
         logger.info("初始化数据库表结构")
 
@@ -217,6 +244,29 @@ class DatabaseManager:
                     INDEX idx_created_at (created_at)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             """,
+            # 微信发货信息录入队列（见 services/shipping_sync_service.py）
+            'wechat_shipping_queue': """
+                CREATE TABLE IF NOT EXISTS wechat_shipping_queue (
+                    id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+                    order_id BIGINT UNSIGNED NOT NULL COMMENT '关联订单ID',
+                    order_number VARCHAR(50) NOT NULL COMMENT '商户订单号',
+                    transaction_id VARCHAR(64) NULL COMMENT '微信支付单号',
+                    logistics_type TINYINT NOT NULL COMMENT '物流类型：1快递/2同城/3虚拟/4自提',
+                    tracking_no VARCHAR(128) NULL COMMENT '运单号',
+                    express_company VARCHAR(50) NULL COMMENT '物流公司编码',
+                    status ENUM('pending', 'uploading', 'done', 'failed') NOT NULL DEFAULT 'pending',
+                    attempts INT NOT NULL DEFAULT 0 COMMENT '已尝试次数（明细见 wechat_shipping_logs）',
+                    next_run_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '下次上传时间',
+                    claim_token CHAR(32) NULL COMMENT '认领批次令牌',
+                    last_error VARCHAR(500) NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    UNIQUE KEY uk_order_id (order_id),
+                    INDEX idx_transaction_id (transaction_id),
+                    INDEX idx_claim_token (claim_token),
+                    INDEX idx_status_next_run (status, next_run_at)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='微信发货信息录入队列'
+            """,
             'offline_order': """
                 CREATE TABLE IF NOT EXISTS offline_order (
                     id                  BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
@@ -294,6 +344,8 @@ class DatabaseManager:
                     balance_after DECIMAL(14,4),
                     flow_type VARCHAR(50),
                     remark VARCHAR(255),
+                    related_order_id BIGINT UNSIGNED NULL COMMENT '关联订单ID（orders.id）',
+                    ref_type VARCHAR(20) NULL COMMENT '关联类型：order_split/refund_reversal/order_alloc/order_reward/none',
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                     INDEX idx_account (account_id),
                     INDEX idx_related_user (related_user),
@@ -615,6 +667,9 @@ class DatabaseManager:
                     submitted_at DATETIME NULL COMMENT '正式提交时间',
                     is_timeout_alerted TINYINT(1) NOT NULL DEFAULT 0 COMMENT '审核超时提醒是否已发送',
                     finished_at DATETIME NULL COMMENT '完成时间',
+                    state_changed_at DATETIME NULL COMMENT '进入当前状态的时间（轮询退避依据）',
+                    next_check_at DATETIME NULL COMMENT '下次轮询微信状态的时间（NULL 表示尽快）',
+                    poll_token VARCHAR(32) NULL COMMENT '轮询认领标记',
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                     updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
                     UNIQUE KEY uk_business_code (business_code),
@@ -622,7 +677,8 @@ class DatabaseManager:
                     INDEX idx_applyment_id (applyment_id),
                     INDEX idx_sub_mchid (sub_mchid),
                     INDEX idx_parent_mchid (parent_mchid),
-                    INDEX idx_applyment_state (applyment_state)
+                    INDEX idx_applyment_state (applyment_state),
+                    INDEX idx_state_next_check (applyment_state, next_check_at)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             """,
             'wx_applyment_log': """
@@ -815,6 +871,28 @@ class DatabaseManager:
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
         """,
 
+            # 小程序码/二维码/URL Link 缓存索引（图片按内容存 pic_data/wxacode，见 services/wxacode_cache.py）
+            'wxa_code_cache': """
+            CREATE TABLE IF NOT EXISTS wxa_code_cache (
+                cache_key CHAR(64) NOT NULL PRIMARY KEY COMMENT 'sha256(kind|scene|page|width|env|avatar_hash|extra)',
+                kind VARCHAR(20) NOT NULL COMMENT 'wxacode/qrcode/urllink/openlink',
+                owner_id BIGINT UNSIGNED NULL COMMENT '所属用户/商户ID（头像变更时按此失效）',
+                scene VARCHAR(255) NOT NULL DEFAULT '' COMMENT '场景值/二维码内容/链接 query',
+                page VARCHAR(255) NOT NULL DEFAULT '' COMMENT '小程序页面路径',
+                width INT NOT NULL DEFAULT 0,
+                env_version VARCHAR(10) NOT NULL DEFAULT '' COMMENT 'release/trial/develop',
+                avatar_hash VARCHAR(64) NOT NULL DEFAULT '' COMMENT '叠加头像的指纹，空表示未叠加',
+                content_hash CHAR(64) NULL COMMENT '图片内容 sha256',
+                file_path VARCHAR(100) NULL COMMENT '相对 pic_data/wxacode 的路径',
+                link VARCHAR(512) NULL COMMENT 'URL Link / URL Scheme',
+                expires_at DATETIME NULL COMMENT '链接过期时间（图片为空）',
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                INDEX idx_owner_id (owner_id),
+                INDEX idx_file_path (file_path)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+        """,
+
             'store_logos': """
             CREATE TABLE IF NOT EXISTS store_logos (
                 id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY COMMENT 'LOGO ID',
@@ -828,6 +906,180 @@ class DatabaseManager:
                 CONSTRAINT fk_store_logos_user FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
         """,
+
+            # 幂等键/锁（Redis 不可用时的兜底存储，见 core/idempotency.py）
+            'idempotency_keys': """
+                CREATE TABLE IF NOT EXISTS idempotency_keys (
+                    idem_key VARCHAR(191) NOT NULL PRIMARY KEY COMMENT '幂等键/锁键',
+                    idem_value VARCHAR(255) NOT NULL COMMENT '持有令牌或处理结果（如订单号）',
+                    expire_at DATETIME NOT NULL COMMENT '过期时间',
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    INDEX idx_expire_at (expire_at)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            """,
+            # 微信接口限流令牌桶（Redis 不可用时的共享存储，见 core/rate_limiter.py）
+            'rate_limit_buckets': """
+                CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                    bucket_key VARCHAR(191) NOT NULL PRIMARY KEY COMMENT '限流器名:接口_子商户号',
+                    tokens DOUBLE NOT NULL COMMENT '剩余令牌（排队预约时可为负）',
+                    refreshed_at DOUBLE NOT NULL COMMENT '上次计算时间（UNIX 秒，数据库时钟）',
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            """,
+            'refund_tasks': """
+                CREATE TABLE IF NOT EXISTS refund_tasks (
+                    id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+                    order_number VARCHAR(50) NOT NULL COMMENT '订单号',
+                    out_refund_no VARCHAR(64) NOT NULL COMMENT '商户退款单号',
+                    transaction_id VARCHAR(64) NOT NULL COMMENT '微信支付订单号',
+                    total_fee INT NOT NULL COMMENT '原订单金额（分）',
+                    refund_fee INT NOT NULL COMMENT '退款金额（分）',
+                    sub_mchid VARCHAR(32) NULL COMMENT '子商户号',
+                    prev_order_status VARCHAR(30) NULL COMMENT '发起退款前的订单状态（退款失败/关闭时恢复）',
+                    status VARCHAR(20) NOT NULL DEFAULT 'pending' COMMENT 'pending/submitting/processing/success/closed/abnormal/failed',
+                    attempts INT NOT NULL DEFAULT 0 COMMENT '提交重试次数',
+                    next_run_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '下次提交/查询时间',
+                    wx_refund_id VARCHAR(64) NULL COMMENT '微信退款单号',
+                    split_reversed TINYINT(1) NOT NULL DEFAULT 0 COMMENT '分账是否已回冲',
+                    last_error VARCHAR(500) NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    UNIQUE KEY uk_out_refund_no (out_refund_no),
+                    INDEX idx_order_number (order_number),
+                    INDEX idx_status_next_run (status, next_run_at)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='微信退款任务队列'
+            """,
+
+            # 财务日汇总（见 services/finance_rollup_service.py）
+            'daily_order_stats': """
+                CREATE TABLE IF NOT EXISTS daily_order_stats (
+                    stat_date DATE NOT NULL PRIMARY KEY COMMENT '统计日期',
+                    total_orders INT NOT NULL DEFAULT 0 COMMENT '订单数',
+                    completed_orders INT NOT NULL DEFAULT 0 COMMENT '已完成订单数',
+                    total_original DECIMAL(14,2) NOT NULL DEFAULT 0.00 COMMENT '订单原价合计',
+                    total_actual DECIMAL(14,2) NOT NULL DEFAULT 0.00 COMMENT '实付合计',
+                    total_points_discount DECIMAL(14,6) NOT NULL DEFAULT 0.000000 COMMENT '积分抵扣合计',
+                    total_coupon_discount DECIMAL(14,2) NOT NULL DEFAULT 0.00 COMMENT '优惠券抵扣合计',
+                    coupon_used_count INT NOT NULL DEFAULT 0 COMMENT '当日核销优惠券数',
+                    coupon_used_amount DECIMAL(14,2) NOT NULL DEFAULT 0.00 COMMENT '当日核销优惠券金额',
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='每日订单汇总'
+            """,
+            'daily_points_stats': """
+                CREATE TABLE IF NOT EXISTS daily_points_stats (
+                    stat_date DATE NOT NULL COMMENT '统计日期',
+                    points_type VARCHAR(20) NOT NULL COMMENT 'member/merchant/company',
+                    income DECIMAL(16,6) NOT NULL DEFAULT 0.000000 COMMENT '收入合计',
+                    expense DECIMAL(16,6) NOT NULL DEFAULT 0.000000 COMMENT '支出合计（正数）',
+                    net_change DECIMAL(16,6) NOT NULL DEFAULT 0.000000 COMMENT '净变动',
+                    log_count INT NOT NULL DEFAULT 0 COMMENT '流水条数',
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    PRIMARY KEY (stat_date, points_type)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='每日积分流水汇总'
+            """,
+            'daily_pool_flow_stats': """
+                CREATE TABLE IF NOT EXISTS daily_pool_flow_stats (
+                    stat_date DATE NOT NULL COMMENT '统计日期',
+                    account_type VARCHAR(50) NOT NULL COMMENT '资金池类型',
+                    income DECIMAL(16,4) NOT NULL DEFAULT 0.0000 COMMENT '收入合计',
+                    expense DECIMAL(16,4) NOT NULL DEFAULT 0.0000 COMMENT '支出合计（正数）',
+                    net_change DECIMAL(16,4) NOT NULL DEFAULT 0.0000 COMMENT '净变动',
+                    flow_count INT NOT NULL DEFAULT 0 COMMENT '流水条数',
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    PRIMARY KEY (stat_date, account_type)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='每日资金池流水汇总'
+            """,
+
+            # 小程序 access_token 共享缓存与刷新租约（见 core/wechat_token.py）
+            'wechat_access_tokens': """
+                CREATE TABLE IF NOT EXISTS wechat_access_tokens (
+                    appid VARCHAR(64) NOT NULL PRIMARY KEY COMMENT '小程序 AppID',
+                    access_token VARCHAR(1024) NOT NULL DEFAULT '' COMMENT '当前 access_token',
+                    expires_at DATETIME NULL COMMENT '过期时间（已预留余量）',
+                    refresh_after DATETIME NULL COMMENT '到此时间后提前刷新',
+                    lease_owner VARCHAR(32) NULL COMMENT '刷新租约持有进程',
+                    lease_until DATETIME NULL COMMENT '刷新租约到期时间',
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='小程序 access_token 共享缓存'
+            """,
+
+            # 支付成功回调收件箱（见 services/pay_notify_inbox.py）
+            'pay_notify_inbox': """
+                CREATE TABLE IF NOT EXISTS pay_notify_inbox (
+                    id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+                    transaction_id VARCHAR(64) NOT NULL COMMENT '微信支付订单号（去重键）',
+                    out_trade_no VARCHAR(64) NOT NULL COMMENT '商户订单号',
+                    event_type VARCHAR(64) NOT NULL DEFAULT 'TRANSACTION.SUCCESS',
+                    amount_total INT NULL COMMENT '支付金额（分）',
+                    payload TEXT NOT NULL COMMENT '解密后的回调 resource',
+                    status VARCHAR(20) NOT NULL DEFAULT 'pending' COMMENT 'pending/processing/done/failed',
+                    attempts INT NOT NULL DEFAULT 0 COMMENT '处理次数',
+                    next_run_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '下次处理时间',
+                    last_error VARCHAR(500) NULL,
+                    processed_at DATETIME NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    UNIQUE KEY uk_transaction_id (transaction_id),
+                    INDEX idx_out_trade_no (out_trade_no),
+                    INDEX idx_status_next_run (status, next_run_at)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='支付成功回调收件箱'
+            """,
+            'pay_notify_steps': """
+                CREATE TABLE IF NOT EXISTS pay_notify_steps (
+                    id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+                    event_id BIGINT UNSIGNED NOT NULL COMMENT 'pay_notify_inbox.id',
+                    step VARCHAR(32) NOT NULL COMMENT 'settle/pickup_shipping/merchant_transfer/merchant_notice',
+                    seq INT NOT NULL DEFAULT 0 COMMENT '执行顺序',
+                    params TEXT NULL COMMENT '步骤参数（JSON）',
+                    status VARCHAR(20) NOT NULL DEFAULT 'pending' COMMENT 'pending/done/failed',
+                    attempts INT NOT NULL DEFAULT 0 COMMENT '执行次数',
+                    next_run_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '下次执行时间',
+                    last_error VARCHAR(500) NULL,
+                    finished_at DATETIME NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    UNIQUE KEY uk_event_step (event_id, step)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='支付事件结算步骤'
+            """,
+
+            # 微信支付每日对账（见 services/wechat_reconcile_service.py）
+            'wechat_reconcile_runs': """
+                CREATE TABLE IF NOT EXISTS wechat_reconcile_runs (
+                    id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+                    bill_date DATE NOT NULL COMMENT '账单日期',
+                    status VARCHAR(20) NOT NULL DEFAULT 'running' COMMENT 'running/done/failed',
+                    bill_count INT NOT NULL DEFAULT 0 COMMENT '账单成功笔数',
+                    bill_amount BIGINT NOT NULL DEFAULT 0 COMMENT '账单订单金额合计（分）',
+                    matched_count INT NOT NULL DEFAULT 0 COMMENT '一致笔数',
+                    fixed_count INT NOT NULL DEFAULT 0 COMMENT '已修复差异数',
+                    flagged_count INT NOT NULL DEFAULT 0 COMMENT '待人工处理差异数',
+                    verified_count INT NOT NULL DEFAULT 0 COMMENT '向微信核实的单数',
+                    error VARCHAR(500) NULL,
+                    started_at DATETIME NULL,
+                    finished_at DATETIME NULL,
+                    UNIQUE KEY uk_bill_date (bill_date)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='微信支付对账批次'
+            """,
+            'wechat_reconcile_items': """
+                CREATE TABLE IF NOT EXISTS wechat_reconcile_items (
+                    id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+                    run_id BIGINT UNSIGNED NOT NULL COMMENT 'wechat_reconcile_runs.id',
+                    bill_date DATE NOT NULL,
+                    kind VARCHAR(32) NOT NULL COMMENT 'missing_local/unpaid_local/tx_mismatch/amount_mismatch/local_only',
+                    action VARCHAR(16) NOT NULL COMMENT 'fixed/flagged',
+                    order_source VARCHAR(16) NOT NULL DEFAULT 'online' COMMENT 'online/offline',
+                    order_no VARCHAR(64) NOT NULL DEFAULT '',
+                    transaction_id VARCHAR(64) NOT NULL DEFAULT '',
+                    wechat_amount BIGINT NULL COMMENT '账单金额（分）',
+                    local_amount BIGINT NULL COMMENT '本地金额（分）',
+                    local_status VARCHAR(30) NULL,
+                    detail VARCHAR(500) NOT NULL DEFAULT '',
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    INDEX idx_run (run_id),
+                    INDEX idx_date_kind (bill_date, kind),
+                    INDEX idx_order_no (order_no)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='微信支付对账差异明细'
+            """,
         }
 
         # 定义必需字段（用于检查和更新已存在的表）
@@ -909,6 +1161,10 @@ class DatabaseManager:
                 'parent_mchid': "parent_mchid VARCHAR(32) NULL COMMENT '父级服务商商户号（二级商户必填）'",
                 'merchant_type': "merchant_type ENUM('service_provider', 'sub_merchant') DEFAULT 'sub_merchant' COMMENT '商户类型：服务商/二级子商户'",
                 'platform_appid': "platform_appid VARCHAR(32) NULL COMMENT '平台APPID（二级商户必填，服务商绑定）'",
+                # 进件状态轮询排期（services/applyment_poller.py）
+                'state_changed_at': "state_changed_at DATETIME NULL COMMENT '进入当前状态的时间（轮询退避依据）'",
+                'next_check_at': "next_check_at DATETIME NULL COMMENT '下次轮询微信状态的时间（NULL 表示尽快）'",
+                'poll_token': "poll_token VARCHAR(32) NULL COMMENT '轮询认领标记'",
             },
             'offline_order': {
                 'coupon_id': "coupon_id INT NULL COMMENT '使用的优惠券ID'",
@@ -925,6 +1181,57 @@ class DatabaseManager:
                 'refresh_count': "refresh_count TINYINT NOT NULL DEFAULT 0 COMMENT '已刷新次数'",
                 'qrcode_expire': "qrcode_expire DATETIME DEFAULT NULL COMMENT '码过期时间'",
             },
+            'account_flow': {
+                # 结构化订单关联，替代按 remark LIKE 扫描；历史数据由 FlowRefService.backfill 回填
+                'related_order_id': "related_order_id BIGINT UNSIGNED NULL COMMENT '关联订单ID（orders.id）'",
+                'ref_type': "ref_type VARCHAR(20) NULL COMMENT '关联类型：order_split/refund_reversal/order_alloc/order_reward/none'",
+            },
+            'refund_tasks': {
+                'split_reversed': "split_reversed TINYINT(1) NOT NULL DEFAULT 0 COMMENT '分账是否已回冲'",
+            },
+        }
+
+        # 定义必需索引（与报表查询路径匹配，配合 core.db_adapter.build_date_range 的半开区间过滤；
+        # 校验脚本见 scripts/explain_report_queries.py）
+        required_indexes = {
+            'account_flow': {
+                # 资金池流水报表 / 平台流水汇总：account_type = ? AND created_at 范围，按 created_at, id 排序分页
+                'idx_type_created_id': '(account_type, created_at, id)',
+                # 订单交易链路 / 奖励防重 / 退款回冲：related_order_id = ? [AND ref_type = ?]
+                'idx_related_order': '(related_order_id, ref_type)',
+                # 回填任务：ref_type IS NULL 按 id 续扫
+                'idx_ref_type': '(ref_type)',
+            },
+            'points_log': {
+                # 积分周/月报表、日汇总：type = ? AND created_at 范围
+                'idx_type_created': '(type, created_at)',
+                'idx_created_at': '(created_at)',
+            },
+            'orders': {
+                # 商家订单列表：merchant_id = ? AND created_at 范围
+                'idx_merchant_created': '(merchant_id, created_at)',
+                # 联创分红活跃用户：EXISTS (user_id = ? AND created_at 本月范围)
+                'idx_user_created': '(user_id, created_at)',
+                # 微信对账：本地当天已支付订单 paid_at 范围
+                'idx_paid_at': '(paid_at)',
+                # 财务日汇总变更检测：updated_at >= 上次 compact 水位
+                'idx_updated_at': '(updated_at)',
+            },
+            'wx_applyment': {
+                # 进件轮询：applyment_state IN (...) AND next_check_at 到期
+                'idx_state_next_check': '(applyment_state, next_check_at)',
+            },
+            'offline_order': {
+                # 微信对账：本地当天已支付订单 pay_time 范围
+                'idx_pay_time': '(pay_time)',
+            },
+            'withdrawals': {
+                'idx_created_at': '(created_at)',
+            },
+            'coupons': {
+                # 优惠券核销统计：status = 'used' AND used_at 范围
+                'idx_status_used_at': '(status, used_at)',
+            },
         }
 
         for table_name, sql in tables.items():
@@ -935,6 +1242,10 @@ class DatabaseManager:
             if table_name in required_columns:
                 self._ensure_table_columns(cursor, table_name, required_columns[table_name])
 
+            # 检查并添加缺失的索引
+            if table_name in required_indexes:
+                self._ensure_table_indexes(cursor, table_name, required_indexes[table_name])
+
         # 在表创建后添加外键约束（避免类型不匹配问题）
         self._add_cart_foreign_keys(cursor)
         self._add_refunds_foreign_keys(cursor)
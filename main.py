@@ -104,6 +104,21 @@ def on_startup():
     except Exception as e:
         logger.warning(f"刷新快递公司列表缓存失败: {e}")'''
 
+
+# 出站 HTTP 连接池：在应用事件循环上创建，关闭时释放连接；同时关闭微信支付线程池
+@app.on_event("startup")
+async def start_outbound_http():
+    from core.http_client import start_http_clients
+    await start_http_clients()
+
+
+@app.on_event("shutdown")
+async def close_outbound_http():
+    from core.http_client import close_http_clients
+    from core.wx_pay_client import shutdown_wxpay_executor
+    await close_http_clients()
+    shutdown_wxpay_executor()
+
 # ... 原有代码保持不变 ...
 
 tags_metadata = [
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+scripts/explain_report_queries.py
+
+报表查询的 EXPLAIN 回归检查：对资金池流水、积分周/月报表、商家订单列表等典型查询执行 EXPLAIN，
+确认账本表走的是 database_setup.py 中 required_indexes 定义的索引，而不是全表扫描。
+
+检查规则（任一条命中即视为失败，退出码 1）：
+- 被检查的表 type = ALL（全表扫描）
+- 被检查的表未使用任何索引（key 为空）
+- 指定了期望索引时，实际使用的索引不在期望列表内
+
+用法示例:
+  uv run scripts/explain_report_queries.py
+  uv run scripts/explain_report_queries.py --start 2025-01-01 --end 2025-01-31 -v
+
+注意：数据量很小时优化器可能选择全表扫描，请在有代表性数据的库上运行。
+"""
+import argparse
+import sys
+from pathlib import Path
+
+# Ensure project root is on sys.path so `from core import ...` works
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from core.database import get_conn  # noqa: E402
+from core.db_adapter import build_date_range  # noqa: E402
+
+
+def build_cases(start_date: str, end_date: str):
+    """返回 [(名称, SQL, 参数, 检查的表别名, 期望索引列表)]"""
+    af_sql, af_params = build_date_range("af.created_at", start_date, end_date)
+    pl_sql, pl_params = build_date_range("pl.created_at", start_date, end_date)
+    o_sql, o_params = build_date_range("o.created_at", start_date, end_date)
+    w_sql, w_params = build_date_range("w.created_at", start_date, end_date)
+    c_sql, c_params = build_date_range("c.used_at", start_date, end_date)
+
+    return [
+        (
+            "资金池流水报表",
+            f"SELECT af.id FROM account_flow af WHERE af.account_type = %s AND {af_sql} "
+            f"ORDER BY af.created_at DESC, af.id DESC LIMIT 20",
+            ["subsidy_pool", *af_params], "af", ["idx_type_created_id"],
+        ),
+        (
+            "平台流水按资金池汇总",
+            f"SELECT af.account_type, SUM(af.change_amount) FROM account_flow af "
+            f"WHERE af.account_type IN (%s, %s) AND {af_sql} GROUP BY af.account_type",
+            ["subsidy_pool", "public_welfare", *af_params], "af", ["idx_type_created_id"],
+        ),
+        (
+            "订单交易链路 / 退款回冲",
+            "SELECT af.account_type, SUM(af.change_amount) FROM account_flow af "
+            "WHERE af.related_order_id = %s AND af.ref_type = %s GROUP BY af.account_type",
+            [1, "order_split"], "af", ["idx_related_order"],
+        ),
+        (
+            "会员积分周/月报表",
+            f"SELECT pl.id FROM points_log pl WHERE pl.type = 'member' AND {pl_sql}",
+            list(pl_params), "pl", ["idx_type_created"],
+        ),
+        (
+            "积分日汇总",
+            f"SELECT pl.type, SUM(pl.change_amount) FROM points_log pl WHERE {pl_sql} GROUP BY pl.type",
+            list(pl_params), "pl", ["idx_created_at", "idx_type_created"],
+        ),
+        (
+            "商家订单列表",
+            f"SELECT o.id FROM orders o WHERE o.merchant_id = %s AND {o_sql} ORDER BY o.created_at DESC LIMIT 20",
+            [1, *o_params], "o", ["idx_merchant_created"],
+        ),
+        (
+            "订单日汇总",
+            f"SELECT COUNT(*) FROM orders o WHERE {o_sql}",
+            list(o_params), "o", ["idx_created_at", "idx_merchant_created"],
+        ),
+        (
+            "提现报表",
+            f"SELECT w.id FROM withdrawals w WHERE {w_sql}",
+            list(w_params), "w", ["idx_created_at"],
+        ),
+        (
+            "优惠券核销统计",
+            f"SELECT COUNT(*) FROM coupons c WHERE c.status = 'used' AND {c_sql}",
+            list(c_params), "c", ["idx_status_used_at"],
+        ),
+    ]
+
+
+def check_case(cur, name, sql, params, alias, expected_keys, verbose=False):
+    cur.execute("EXPLAIN " + sql, tuple(params))
+    rows = cur.fetchall()
+    if verbose:
+        for row in rows:
+            print(f"    {row}")
+
+    target = [r for r in rows if r.get("table") == alias]
+    if not target:
+        return [f"{name}: EXPLAIN 结果中未找到表 {alias}"]
+
+    problems = []
+    for row in target:
+        access_type = (row.get("type") or "").upper()
+        key = row.get("key")
+        if access_type == "ALL":
+            problems.append(f"{name}: {alias} 全表扫描 (type=ALL, rows={row.get('rows')})")
+        elif not key:
+            problems.append(f"{name}: {alias} 未使用索引 (type={access_type})")
+        elif expected_keys and key not in expected_keys:
+            problems.append(f"{name}: {alias} 使用了 {key}，期望 {'/'.join(expected_keys)}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="报表查询 EXPLAIN 回归检查")
+    parser.add_argument("--start", default="2025-01-01", help="开始日期 yyyy-MM-dd")
+    parser.add_argument("--end", default="2025-01-31", help="结束日期 yyyy-MM-dd")
+    parser.add_argument("-v", "--verbose", action="store_true", help="打印完整 EXPLAIN 结果")
+    args = parser.parse_args()
+
+    failures = []
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            for name, sql, params, alias, expected_keys in build_cases(args.start, args.end):
+                problems = check_case(cur, name, sql, params, alias, expected_keys, args.verbose)
+                print(f"[{'FAIL' if problems else ' OK '}] {name}")
+                for p in problems:
+                    print(f"    {p}")
+                failures.extend(problems)
+
+    if failures:
+        print(f"\n{len(failures)} 项检查未通过")
+        sys.exit(1)
+    print("\n所有报表查询均命中索引")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+# services/applyment_poller.py
+"""
+进件状态轮询
+
+原先 poll_applyment_status 每 10 分钟把所有审核中的申请单逐个同步查询，用的是与用户请求共用的
+query_rate_limiter，审核单一多就和商家查进件/改结算账户抢配额。现在：
+
+1. 按单排期：wx_applyment.next_check_at 记录下次查询时间（NULL 表示尽快），state_changed_at 记录进入
+   当前状态的时间；间隔按状态持续时长指数退避——刚提交 2 分钟查一次，之后约为状态时长的 1/4，
+   最长 MAX_INTERVAL（审核通常需要 1~3 个工作日，靠回调及时感知，轮询只是兜底）
+2. 回调后立即核实：进件回调处理完调用 schedule_now()，把该单 next_check_at 置为当前并唤醒 worker，
+   拉取回调里没有的签约链接/驳回详情
+3. 独立预算：查询走 applyment_poll_rate_limiter（与交互请求的限流桶分开），最多 POLL_CONCURRENCY 个并发
+4. 批量落库：一轮结果在一个事务里写入——状态未变的单 executemany 推迟 next_check_at，状态变化的单更新状态
+   并 executemany 写 wx_applyment_log；审核通过的绑定商户号、同步结算账户在同一事务内完成，提交后推送通知
+"""
+import json
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.database import get_conn
+from core.db_adapter import build_in_placeholders
+from core.logging import get_logger
+from core.rate_limiter import RateLimitExceeded, applyment_poll_rate_limiter
+
+logger = get_logger(__name__)
+
+# 需要轮询的进行中状态（驳回/完成/取消为终态，编辑中尚未提交）
+POLL_STATES = (
+    "APPLYMENT_STATE_AUDITING",
+    "APPLYMENT_STATE_TO_BE_CONFIRMED",
+    "APPLYMENT_STATE_TO_BE_SIGNED",
+    "APPLYMENT_STATE_SIGNING",
+)
+# 单轮认领数量与并发查询数
+BATCH_SIZE = 50
+POLL_CONCURRENCY = 4
+# 查询间隔：状态时长的 1/AGE_DIVISOR，夹在 [MIN_INTERVAL, MAX_INTERVAL] 之间；查询失败至少 ERROR_INTERVAL 后再试
+MIN_INTERVAL = timedelta(minutes=2)
+MAX_INTERVAL = timedelta(hours=2)
+AGE_DIVISOR = 4
+ERROR_INTERVAL = timedelta(minutes=5)
+# 认领租期：worker 中断后租期到了自然重新到期
+CLAIM_LEASE_MINUTES = 5
+
+_worker_lock = threading.Lock()
+
+
+def next_check_time(state_since: Optional[datetime], now: datetime, failed: bool = False) -> datetime:
+    """按状态时长计算下次查询时间"""
+    age = now - state_since if state_since else timedelta(0)
+    interval = min(MAX_INTERVAL, max(MIN_INTERVAL, age / AGE_DIVISOR))
+    if failed:
+        interval = max(interval, ERROR_INTERVAL)
+    return now + interval
+
+
+class ApplymentPoller:
+
+    @staticmethod
+    def schedule_now(applyment_id: int) -> None:
+        """回调到达后立即核实该单状态"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE wx_applyment SET next_check_at = NOW() WHERE applyment_id = %s",
+                    (applyment_id,),
+                )
+                conn.commit()
+        ApplymentPoller.kick()
+
+    @staticmethod
+    def kick() -> None:
+        """唤醒 worker，不必等下一次定时任务"""
+        if _worker_lock.locked():
+            return
+        threading.Thread(target=ApplymentPoller.process_due, daemon=True, name="applyment-poller").start()
+
+    # ------------- 认领 -------------
+    @staticmethod
+    def _claim(limit: int) -> List[Dict[str, Any]]:
+        token = uuid.uuid4().hex
+        state_ph, state_params = build_in_placeholders(list(POLL_STATES))
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""SELECT id FROM wx_applyment
+                        WHERE applyment_state IN ({state_ph}) AND applyment_id IS NOT NULL
+                          AND (next_check_at IS NULL OR next_check_at <= NOW())
+                        ORDER BY next_check_at LIMIT %s""",
+                    (*state_params.values(), limit),
+                )
+                ids = [r["id"] for r in cur.fetchall()]
+                if not ids:
+                    return []
+                placeholders, params = build_in_placeholders(ids)
+                # 租期内其它进程/线程不会再认领；条件复查避免与并发认领重复
+                cur.execute(
+                    f"""UPDATE wx_applyment
+                        SET next_check_at = NOW() + INTERVAL {CLAIM_LEASE_MINUTES} MINUTE, poll_token = %s
+                        WHERE id IN ({placeholders}) AND (next_check_at IS NULL OR next_check_at <= NOW())""",
+                    (token, *params.values()),
+                )
+                cur.execute(
+                    """SELECT id, applyment_id, user_id, business_code, applyment_state,
+                              COALESCE(state_changed_at, submitted_at) AS state_since
+                       FROM wx_applyment WHERE poll_token = %s""",
+                    (token,),
+                )
+                rows = cur.fetchall()
+                conn.commit()
+                return rows
+
+    # ------------- 查询 -------------
+    @staticmethod
+    def _query(row: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """返回 (微信返回, 错误信息)"""
+        from core.wx_pay_client import wxpay_client
+
+        try:
+            applyment_poll_rate_limiter.acquire("query_applyment")
+            return wxpay_client.fetch_applyment_status(row["applyment_id"]), None
+        except RateLimitExceeded as e:
+            return None, f"限流: {e}"
+        except Exception as e:
+            return None, str(e)
+
+    # ------------- 落库 -------------
+    @staticmethod
+    def _record(results: List[Tuple[Dict[str, Any], Optional[Dict[str, Any]], Optional[str]]]) -> List[Dict[str, Any]]:
+        """一轮结果一个事务写入，返回状态发生变化的单（用于提交后推送）"""
+        from services.wechat_applyment_service import WechatApplymentService
+
+        now = datetime.now()
+        unchanged: List[tuple] = []
+        failed: List[tuple] = []
+        changed: List[Dict[str, Any]] = []
+        for row, info, error in results:
+            if error is not None:
+                logger.error(f"轮询进件 {row['applyment_id']} 状态失败: {error}")
+                failed.append((next_check_time(row["state_since"], now, failed=True), row["id"]))
+                continue
+            new_state = info.get("applyment_state")
+            msg = info.get("applyment_state_msg") or info.get("state_msg")
+            if not new_state or new_state == row["applyment_state"]:
+                unchanged.append((msg, info.get("sign_url"), next_check_time(row["state_since"], now), row["id"]))
+            else:
+                changed.append({**row, "new_state": new_state, "msg": msg, "info": info})
+
+        applied: List[Dict[str, Any]] = []
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                if unchanged:
+                    cur.executemany(
+                        """UPDATE wx_applyment
+                           SET applyment_state_msg = COALESCE(%s, applyment_state_msg),
+                               sign_url = COALESCE(%s, sign_url), next_check_at = %s, poll_token = NULL,
+                               state_changed_at = COALESCE(state_changed_at, submitted_at, NOW())
+                           WHERE id = %s""",
+                        unchanged,
+                    )
+                if failed:
+                    cur.executemany(
+                        "UPDATE wx_applyment SET next_check_at = %s, poll_token = NULL WHERE id = %s",
+                        failed,
+                    )
+                service = None
+                for c in changed:
+                    info = c["info"]
+                    audit_detail = info.get("audit_detail")
+                    # 以认领时的状态为条件：期间回调已推进状态的单不覆盖
+                    cur.execute(
+                        """UPDATE wx_applyment
+                           SET applyment_state = %s, applyment_state_msg = %s,
+                               sub_mchid = COALESCE(%s, sub_mchid), sign_url = COALESCE(%s, sign_url),
+                               audit_detail = COALESCE(%s, audit_detail),
+                               finished_at = CASE WHEN %s = 'APPLYMENT_STATE_FINISHED' THEN NOW() ELSE finished_at END,
+                               state_changed_at = NOW(), next_check_at = %s, poll_token = NULL
+                           WHERE id = %s AND applyment_state = %s""",
+                        (c["new_state"], c["msg"], info.get("sub_mchid"), info.get("sign_url"),
+                         json.dumps(audit_detail, ensure_ascii=False) if audit_detail else None,
+                         c["new_state"], now + MIN_INTERVAL if c["new_state"] in POLL_STATES else None,
+                         c["id"], c["applyment_state"]),
+                    )
+                    if cur.rowcount == 0:
+                        continue
+                    applied.append(c)
+                    if c["new_state"] == "APPLYMENT_STATE_FINISHED" and info.get("sub_mchid"):
+                        cur.execute(
+                            "UPDATE users SET wechat_sub_mchid = %s WHERE id = %s",
+                            (info["sub_mchid"], c["user_id"]),
+                        )
+                        service = service or WechatApplymentService()
+                        service._sync_settlement_account(cur, c["applyment_id"], c["user_id"], info["sub_mchid"])
+                if applied:
+                    cur.executemany(
+                        """INSERT INTO wx_applyment_log
+                           (applyment_id, business_code, old_state, new_state, state_msg, reject_detail, operator)
+                           VALUES (%s, %s, %s, %s, %s, %s, 'SYSTEM')""",
+                        [(c["applyment_id"], c["business_code"], c["applyment_state"], c["new_state"], c["msg"],
+                          json.dumps(c["info"]["audit_detail"], ensure_ascii=False)
+                          if c["info"].get("audit_detail") else None)
+                         for c in applied],
+                    )
+                conn.commit()
+        return applied
+
+    @staticmethod
+    def _notify(applied: List[Dict[str, Any]]) -> None:
+        from core.push_service import push_service
+
+        for c in applied:
+            try:
+                push_service.send_applyment_status_notification_sync(c["user_id"], c["new_state"], c["msg"] or "")
+            except Exception as e:
+                logger.error(f"进件 {c['applyment_id']} 状态推送失败: {e}")
+
+    @staticmethod
+    def process_due(limit: int = BATCH_SIZE) -> int:
+        """查询到期的进件（一直处理到没有到期单），返回状态发生变化的数量"""
+        if not _worker_lock.acquire(blocking=False):
+            return 0
+        changed = 0
+        try:
+            while True:
+                rows = ApplymentPoller._claim(limit)
+                if not rows:
+                    break
+                with ThreadPoolExecutor(max_workers=POLL_CONCURRENCY, thread_name_prefix="applyment-poll") as pool:
+                    outcomes = list(pool.map(ApplymentPoller._query, rows))
+                applied = ApplymentPoller._record([(r, info, err) for r, (info, err) in zip(rows, outcomes)])
+                ApplymentPoller._notify(applied)
+                changed += len(applied)
+                for c in applied:
+                    logger.info(f"进件状态变更: {c['applyment_id']} {c['applyment_state']} -> {c['new_state']}")
+                if len(rows) < limit:
+                    break
+        finally:
+            _worker_lock.release()
+        return changed
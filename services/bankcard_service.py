@@ -17,7 +17,7 @@ from fastapi import HTTPException
 
 from core.database import get_conn
 from core.logging import get_logger
-from core.wx_pay_client import wxpay_client
+from core.wx_pay_client import wxpay_client, async_wxpay_client
 
 logger = get_logger(__name__)
 
@@ -616,7 +616,7 @@ class BankcardService:
                         import time
                         start_time = time.time()
                         while time.time() - start_time < 30:
-                            wx_status = wxpay_client.query_application_status(
+                            wx_status = await async_wxpay_client.query_application_status(
                                 old['sub_mchid'], old['modify_application_no']
                             )
                             wx_state = wx_status.get('applyment_state')
@@ -688,7 +688,7 @@ class BankcardService:
         sub_mchid = old["sub_mchid"]
         logger.info(f"调用微信改绑接口: sub_mchid={sub_mchid}")
 
-        wx_resp = wxpay_client.modify_settlement_account(sub_mchid, {
+        wx_resp = await async_wxpay_client.modify_settlement_account(sub_mchid, {
             "account_type": old["account_type"],
             "account_bank": new_bank_name[:128],
             "bank_name": new_bank_name[:128],
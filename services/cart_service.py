@@ -0,0 +1,262 @@
+# services/cart_service.py
+"""
+购物车服务
+
+- 写路径：批量新增走一条多行 INSERT ... ON DUPLICATE KEY UPDATE（唯一键 uk_user_product_sku），
+  批量修改/删除各一条 SQL，不再逐条查用户/商品/SKU/购物车行
+- 读路径：一次查询购物车行，商品名称/价格等取自进程内商品快照缓存，缓存未命中时一次 JOIN 批量回填
+- 商品/SKU 变更后由商品接口调用 CartService.invalidate_products 失效快照；
+  下单时价格仍以 product_skus 实时数据为准，快照仅用于购物车展示
+"""
+import json
+from typing import Any, Dict, Iterable, List, Optional
+
+import pymysql
+from fastapi import HTTPException
+
+from core.cache import TTLCache
+from core.database import get_conn
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+# 商品快照：product_id -> {name, cash_only, ..., default_sku_id, skus: {sku_id: price}}
+_product_snapshots = TTLCache(maxsize=5000, ttl=300, name="cart_product_snapshot")
+# 已确认存在的用户，避免每次加购都查 users 表
+_known_users = TTLCache(maxsize=20000, ttl=600, name="cart_known_user")
+
+# MySQL 外键约束失败（cart_ibfk_1 / cart_ibfk_2）
+_ER_NO_REFERENCED_ROW = 1452
+
+
+def _dump_spec(specifications: Optional[Dict[str, Any]]) -> Optional[str]:
+    return json.dumps(specifications, ensure_ascii=False) if specifications else None
+
+
+def _to_float(value) -> float:
+    return float(value) if value is not None else 0.0
+
+
+class CartService:
+
+    # ------------- 商品快照 -------------
+    @staticmethod
+    def _load_snapshots(cur, product_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        """批量获取商品快照：先读缓存，未命中的一次 JOIN 查询回填"""
+        ids = {int(pid) for pid in product_ids}
+        if not ids:
+            return {}
+        snapshots = _product_snapshots.get_many(ids)
+        missing = [pid for pid in ids if pid not in snapshots]
+        if missing:
+            placeholders = ",".join(["%s"] * len(missing))
+            cur.execute(
+                f"""
+                SELECT p.id AS product_id, p.name, p.cash_only, p.is_member_product, p.status,
+                       s.id AS sku_id, s.price
+                FROM products p
+                LEFT JOIN product_skus s ON s.product_id = p.id
+                WHERE p.id IN ({placeholders})
+                ORDER BY p.id, s.id
+                """,
+                tuple(missing),
+            )
+            loaded: Dict[int, Dict[str, Any]] = {}
+            for r in cur.fetchall():
+                snap = loaded.get(r["product_id"])
+                if snap is None:
+                    snap = loaded[r["product_id"]] = {
+                        "name": r["name"],
+                        "cash_only": r["cash_only"],
+                        "is_member_product": r["is_member_product"],
+                        "status": r["status"],
+                        "default_sku_id": None,
+                        "skus": {},
+                    }
+                if r["sku_id"] is not None:
+                    snap["skus"][r["sku_id"]] = _to_float(r["price"])
+                    if snap["default_sku_id"] is None:
+                        snap["default_sku_id"] = r["sku_id"]
+            _product_snapshots.set_many(loaded)
+            snapshots.update(loaded)
+        return snapshots
+
+    @staticmethod
+    def invalidate_products(product_ids: Iterable[int]) -> None:
+        """商品/SKU 更新或删除后调用，失效本进程的商品快照"""
+        _product_snapshots.delete_many(int(pid) for pid in product_ids)
+
+    @staticmethod
+    def _ensure_user(cur, user_id: int) -> None:
+        if _known_users.get(user_id):
+            return
+        cur.execute("SELECT 1 FROM users WHERE id = %s", (user_id,))
+        if not cur.fetchone():
+            raise HTTPException(status_code=404, detail=f"users 表中不存在 id={user_id}")
+        _known_users.set(user_id, True)
+
+    # ------------- 批量加购 -------------
+    @staticmethod
+    def bulk_add(user_id: int, items: List[Dict[str, Any]]) -> int:
+        """批量加入购物车，已存在的 (user_id, product_id, sku_id) 累加数量并覆盖规格
+
+        items: [{"product_id", "quantity", "sku_id"(可选，默认取商品第一个 SKU), "specifications"(可选)}]
+        返回写入的行数（去重合并后）
+        """
+        if not items:
+            return 0
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                CartService._ensure_user(cur, user_id)
+                snapshots = CartService._load_snapshots(cur, [it["product_id"] for it in items])
+
+                # 同一请求内重复的商品/SKU 先在内存合并，保证一条 SQL 内键唯一
+                merged: Dict[tuple, List[Any]] = {}
+                for it in items:
+                    product_id = int(it["product_id"])
+                    snap = snapshots.get(product_id)
+                    if not snap:
+                        raise HTTPException(status_code=404, detail=f"products 表中不存在 id={product_id}")
+                    sku_id = it.get("sku_id") or snap["default_sku_id"]
+                    if not sku_id or sku_id not in snap["skus"]:
+                        raise HTTPException(status_code=404, detail=f"product_skus 里找不到 product_id={product_id} 的记录")
+                    key = (product_id, sku_id)
+                    quantity = int(it.get("quantity") or 1)
+                    spec_str = _dump_spec(it.get("specifications"))
+                    if key in merged:
+                        merged[key][0] += quantity
+                        merged[key][1] = spec_str
+                    else:
+                        merged[key] = [quantity, spec_str]
+
+                values = []
+                params: List[Any] = []
+                for (product_id, sku_id), (quantity, spec_str) in merged.items():
+                    values.append("(%s, %s, %s, %s, %s)")
+                    params.extend([user_id, product_id, sku_id, quantity, spec_str])
+
+                try:
+                    cur.execute(
+                        f"""
+                        INSERT INTO cart (user_id, product_id, sku_id, quantity, specifications)
+                        VALUES {", ".join(values)}
+                        ON DUPLICATE KEY UPDATE
+                            quantity = quantity + VALUES(quantity),
+                            specifications = VALUES(specifications)
+                        """,
+                        tuple(params),
+                    )
+                except pymysql.err.IntegrityError as e:
+                    conn.rollback()
+                    if e.args and e.args[0] == _ER_NO_REFERENCED_ROW:
+                        # 缓存的用户/商品已被删除
+                        _known_users.delete(user_id)
+                        CartService.invalidate_products(pid for pid, _ in merged)
+                        raise HTTPException(status_code=404, detail="用户或商品不存在")
+                    raise
+                conn.commit()
+                return len(merged)
+
+    # ------------- 批量修改 -------------
+    @staticmethod
+    def bulk_update(user_id: int, items: List[Dict[str, Any]]) -> int:
+        """批量设置数量/选中状态；quantity <= 0 视为删除
+
+        items: [{"product_id", "quantity"(可选), "selected"(可选)}]
+        返回受影响的行数
+        """
+        qty_map: Dict[int, int] = {}
+        selected_map: Dict[int, int] = {}
+        to_delete: List[int] = []
+        for it in items:
+            product_id = int(it["product_id"])
+            if it.get("quantity") is not None:
+                if int(it["quantity"]) <= 0:
+                    to_delete.append(product_id)
+                    continue
+                qty_map[product_id] = int(it["quantity"])
+            if it.get("selected") is not None:
+                selected_map[product_id] = 1 if it["selected"] else 0
+        for product_id in to_delete:
+            qty_map.pop(product_id, None)
+            selected_map.pop(product_id, None)
+
+        affected = 0
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                if to_delete:
+                    placeholders = ",".join(["%s"] * len(to_delete))
+                    cur.execute(
+                        f"DELETE FROM cart WHERE user_id = %s AND product_id IN ({placeholders})",
+                        (user_id, *to_delete),
+                    )
+                    affected += cur.rowcount
+
+                update_ids = sorted(set(qty_map) | set(selected_map))
+                if update_ids:
+                    sets: List[str] = []
+                    params: List[Any] = []
+                    for column, mapping in (("quantity", qty_map), ("selected", selected_map)):
+                        if not mapping:
+                            continue
+                        cases = " ".join(["WHEN %s THEN %s"] * len(mapping))
+                        sets.append(f"{column} = CASE product_id {cases} ELSE {column} END")
+                        for product_id, value in mapping.items():
+                            params.extend([product_id, value])
+                    placeholders = ",".join(["%s"] * len(update_ids))
+                    params.append(user_id)
+                    params.extend(update_ids)
+                    cur.execute(
+                        f"UPDATE cart SET {', '.join(sets)} "
+                        f"WHERE user_id = %s AND product_id IN ({placeholders})",
+                        tuple(params),
+                    )
+                    affected += cur.rowcount
+                conn.commit()
+        return affected
+
+    # ------------- 批量删除 -------------
+    @staticmethod
+    def bulk_remove(user_id: int, product_ids: List[int]) -> int:
+        ids = sorted({int(pid) for pid in product_ids})
+        if not ids:
+            return 0
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                placeholders = ",".join(["%s"] * len(ids))
+                cur.execute(
+                    f"DELETE FROM cart WHERE user_id = %s AND product_id IN ({placeholders})",
+                    (user_id, *ids),
+                )
+                removed = cur.rowcount
+                conn.commit()
+                return removed
+
+    # ------------- 购物车列表 -------------
+    @staticmethod
+    def list_items(user_id: int) -> List[Dict[str, Any]]:
+        """购物车视图：一次查询购物车行 + 商品快照；商品或 SKU 已不存在的行不返回（与原 JOIN 语义一致）"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT * FROM cart WHERE user_id = %s ORDER BY added_at DESC",
+                    (user_id,),
+                )
+                rows = cur.fetchall()
+                if not rows:
+                    return []
+                snapshots = CartService._load_snapshots(cur, [r["product_id"] for r in rows])
+
+        result = []
+        for r in rows:
+            snap = snapshots.get(r["product_id"])
+            if not snap or r["sku_id"] not in snap["skus"]:
+                continue
+            unit_price = snap["skus"][r["sku_id"]]
+            r["product_name"] = snap["name"]
+            r["unit_price"] = unit_price
+            r["total_price"] = round(unit_price * r["quantity"], 2)
+            r["cash_only"] = snap["cash_only"]
+            r["specifications"] = json.loads(r["specifications"]) if r["specifications"] else None
+            result.append(r)
+        return result
@@ -89,7 +89,7 @@ class DirectorService:
                 cur.execute("""
                     SELECT SUM(total_amount) AS s
                     FROM orders
-                    WHERE DATE(created_at) BETWEEN %s AND DATE_ADD(%s, INTERVAL 6 DAY)
+                    WHERE created_at >= %s AND created_at < DATE_ADD(%s, INTERVAL 7 DAY)
                       AND status IN ('paid','completed')
                 """, (period, period))
                 new_sales = cur.fetchone()['s'] or 0
@@ -0,0 +1,130 @@
+# services/finance_config_cache.py
+"""
+财务参数缓存（资金池分配比例、日补贴比例、积分值/联创分红手动调整、system_config）
+
+这些参数每次支付、每次补贴计算都会读，但只有管理端偶尔修改。读取走进程内缓存，
+写入方（set_pool_allocations / set_daily_subsidy_ratio / adjust_subsidy_points_value /
+adjust_unilevel_dividend_amount）提交后调用 FinanceConfigCache.bump() 递增版本号。
+
+跨进程失效：
+- 版本号同时写入 Redis（finance_config:version）和 system_config（finance_config_version）
+- 各进程每 CONFIG_VERSION_CHECK_SECONDS 秒读取一次版本号（优先 Redis，不可用时读 MySQL），
+  与本地记录的版本不一致即清空本地缓存
+- 本地缓存另有 CONFIG_CACHE_TTL_SECONDS 兜底过期，版本号读取失败时最多延迟这么久
+
+使用示例:
+    allocs = FinanceConfigCache.get("pool_allocations", self._load_pool_allocations)
+    ...
+    conn.commit()
+    FinanceConfigCache.bump()
+"""
+import copy
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from core.cache import TTLCache
+from core.database import get_conn
+from core.logging import get_logger
+from core.redis_client import get_redis_client, is_redis_error, mark_redis_failure
+
+logger = get_logger(__name__)
+
+CONFIG_CACHE_TTL_SECONDS = 300
+CONFIG_VERSION_CHECK_SECONDS = 5
+
+CONFIG_VERSION_REDIS_KEY = "finance_config:version"
+CONFIG_VERSION_DB_KEY = "finance_config_version"
+
+_MISSING = object()
+
+_values = TTLCache(maxsize=256, ttl=CONFIG_CACHE_TTL_SECONDS, name="finance_config")
+_state = {"version": None, "checked_at": 0.0}
+_lock = threading.Lock()
+
+
+def _read_version() -> Optional[str]:
+    client = get_redis_client()
+    if client is not None:
+        try:
+            value = client.get(CONFIG_VERSION_REDIS_KEY)
+            if value is not None:
+                return f"r{value}"
+        except Exception as e:
+            if not is_redis_error(e):
+                raise
+            mark_redis_failure(e)
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT config_value FROM system_config WHERE config_key = %s", (CONFIG_VERSION_DB_KEY,))
+            row = cur.fetchone()
+            return f"m{row['config_value']}" if row else "m0"
+
+
+class FinanceConfigCache:
+
+    @staticmethod
+    def _sync_version() -> None:
+        """按间隔检查全局版本号，变化时清空本地缓存"""
+        now = time.monotonic()
+        if now - _state["checked_at"] < CONFIG_VERSION_CHECK_SECONDS:
+            return
+        with _lock:
+            if now - _state["checked_at"] < CONFIG_VERSION_CHECK_SECONDS:
+                return
+            _state["checked_at"] = now
+            try:
+                version = _read_version()
+            except Exception as e:
+                logger.warning(f"读取财务配置版本号失败，沿用本地缓存: {e}")
+                return
+            if version != _state["version"]:
+                if _state["version"] is not None:
+                    logger.info(f"财务配置版本变化 {_state['version']} -> {version}，清空本地缓存")
+                _values.clear()
+                _state["version"] = version
+
+    @staticmethod
+    def get(name: str, loader: Callable[[], Any]) -> Any:
+        """读取缓存的配置项，未命中时调用 loader 加载；loader 抛出的异常不缓存，直接向上抛出
+
+        返回值为副本，调用方修改不会污染缓存
+        """
+        FinanceConfigCache._sync_version()
+        value = _values.get(name, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            _values.set(name, value)
+        return copy.copy(value)
+
+    @staticmethod
+    def bump() -> None:
+        """配置写入并提交后调用：清空本进程缓存并递增全局版本号"""
+        _values.clear()
+
+        client = get_redis_client()
+        if client is not None:
+            try:
+                client.incr(CONFIG_VERSION_REDIS_KEY)
+            except Exception as e:
+                if not is_redis_error(e):
+                    raise
+                mark_redis_failure(e)
+
+        try:
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """INSERT INTO system_config (config_key, config_value, description)
+                           VALUES (%s, '1', '财务参数缓存版本号')
+                           ON DUPLICATE KEY UPDATE config_value = CAST(config_value AS UNSIGNED) + 1""",
+                        (CONFIG_VERSION_DB_KEY,)
+                    )
+                    conn.commit()
+        except Exception as e:
+            logger.error(f"递增财务配置版本号失败（其它进程最多延迟 {CONFIG_CACHE_TTL_SECONDS}s 生效）: {e}")
+
+        # 下次读取时立即重新同步版本号
+        with _lock:
+            _state["checked_at"] = 0.0
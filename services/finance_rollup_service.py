@@ -0,0 +1,289 @@
+# services/finance_rollup_service.py
+"""
+财务日汇总（rollup）
+
+汇总表（见 database_setup.py）：
+- daily_order_stats：每日订单数/金额/抵扣及优惠券核销，每个已汇总日期必有一行（兼作“已汇总”标记）
+- daily_points_stats：每日 points_log 按积分类型（member/merchant/company）的收入/支出/净变动/条数
+- daily_pool_flow_stats：每日 account_flow 按 account_type 的收入/支出/净变动/条数
+
+维护方式：
+- 每日凌晨 compact() 重算最近 ROLLUP_CORRECTION_DAYS 天（跨零点提交、补录等迟到数据），
+  以及更早的、自上次 compact 以来有订单被更新过的日期（迟到的完成/退款/取消会改变下单当天的完成数与金额；
+  orders.updated_at 随任何状态变更刷新，按 idx_updated_at 只扫描上次运行后的变更）
+- 历史日期的首次汇总由定时任务 backfill_missing() 分批补齐（每轮最多 ROLLUP_BACKFILL_DAYS_PER_RUN 天，
+  从近到远），不在请求中写表；报表读取时尚未汇总的已结束日期直接按原始表现算（只读），当天同样实时统计
+- 所有原始表查询均使用 [day, day+1) 半开区间，可走 created_at 索引
+"""
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional
+
+from core.database import get_conn
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+# 每日汇总时回溯重算的天数（含昨天）
+ROLLUP_CORRECTION_DAYS = 3
+# 历史补齐：每轮最多补算的天数
+ROLLUP_BACKFILL_DAYS_PER_RUN = 60
+# 变更检测：上次 compact 开始时间存于 system_config，回退 ROLLUP_DIRTY_OVERLAP 覆盖运行期间提交的更新
+ROLLUP_WATERMARK_KEY = "finance_rollup_dirty_since"
+ROLLUP_DIRTY_OVERLAP = timedelta(hours=1)
+
+
+def _day_range(day: date):
+    start = datetime.combine(day, datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+def _iter_days(start: date, end: date) -> Iterable[date]:
+    current = start
+    while current <= end:
+        yield current
+        current += timedelta(days=1)
+
+
+_ORDER_STATS_SQL = """
+    SELECT
+        COUNT(*) AS total_orders,
+        COALESCE(SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END), 0) AS completed_orders,
+        COALESCE(SUM(original_amount), 0) AS total_original,
+        COALESCE(SUM(total_amount), 0) AS total_actual,
+        COALESCE(SUM(points_discount), 0) AS total_points_discount,
+        COALESCE(SUM(coupon_discount), 0) AS total_coupon_discount
+    FROM orders
+    WHERE created_at >= %s AND created_at < %s
+"""
+
+_COUPON_STATS_SQL = """
+    SELECT COUNT(*) AS coupon_used_count, COALESCE(SUM(amount), 0) AS coupon_used_amount
+    FROM coupons
+    WHERE used_at >= %s AND used_at < %s AND status = 'used'
+"""
+
+_POINTS_STATS_SQL = """
+    SELECT type AS points_type,
+           COALESCE(SUM(CASE WHEN change_amount > 0 THEN change_amount ELSE 0 END), 0) AS income,
+           COALESCE(SUM(CASE WHEN change_amount < 0 THEN -change_amount ELSE 0 END), 0) AS expense,
+           COALESCE(SUM(change_amount), 0) AS net_change,
+           COUNT(*) AS log_count
+    FROM points_log
+    WHERE created_at >= %s AND created_at < %s
+    GROUP BY type
+"""
+
+_POOL_STATS_SQL = """
+    SELECT account_type,
+           COALESCE(SUM(CASE WHEN change_amount > 0 THEN change_amount ELSE 0 END), 0) AS income,
+           COALESCE(SUM(CASE WHEN change_amount < 0 THEN -change_amount ELSE 0 END), 0) AS expense,
+           COALESCE(SUM(change_amount), 0) AS net_change,
+           COUNT(*) AS flow_count
+    FROM account_flow
+    WHERE created_at >= %s AND created_at < %s AND account_type IS NOT NULL
+    GROUP BY account_type
+"""
+
+
+class FinanceRollupService:
+
+    # ------------- 汇总计算 -------------
+    @staticmethod
+    def _compute_day(cur, day: date) -> Dict[str, Any]:
+        start, end = _day_range(day)
+        cur.execute(_ORDER_STATS_SQL, (start, end))
+        order_stat = dict(cur.fetchone() or {})
+        cur.execute(_COUPON_STATS_SQL, (start, end))
+        order_stat.update(cur.fetchone() or {})
+        cur.execute(_POINTS_STATS_SQL, (start, end))
+        points = {r["points_type"]: r for r in cur.fetchall()}
+        cur.execute(_POOL_STATS_SQL, (start, end))
+        pools = {r["account_type"]: r for r in cur.fetchall()}
+        return {"order": order_stat, "points": points, "pools": pools}
+
+    @staticmethod
+    def _store_day(cur, day: date, stats: Dict[str, Any]) -> None:
+        o = stats["order"]
+        cur.execute(
+            """
+            INSERT INTO daily_order_stats
+                (stat_date, total_orders, completed_orders, total_original, total_actual,
+                 total_points_discount, total_coupon_discount, coupon_used_count, coupon_used_amount)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                total_orders=VALUES(total_orders), completed_orders=VALUES(completed_orders),
+                total_original=VALUES(total_original), total_actual=VALUES(total_actual),
+                total_points_discount=VALUES(total_points_discount),
+                total_coupon_discount=VALUES(total_coupon_discount),
+                coupon_used_count=VALUES(coupon_used_count), coupon_used_amount=VALUES(coupon_used_amount)
+            """,
+            (day, o.get("total_orders") or 0, o.get("completed_orders") or 0,
+             o.get("total_original") or 0, o.get("total_actual") or 0,
+             o.get("total_points_discount") or 0, o.get("total_coupon_discount") or 0,
+             o.get("coupon_used_count") or 0, o.get("coupon_used_amount") or 0),
+        )
+
+        # 维度行先删后插，当天已不存在的类型/资金池不会残留旧值
+        cur.execute("DELETE FROM daily_points_stats WHERE stat_date=%s", (day,))
+        if stats["points"]:
+            cur.executemany(
+                """INSERT INTO daily_points_stats
+                   (stat_date, points_type, income, expense, net_change, log_count)
+                   VALUES (%s, %s, %s, %s, %s, %s)""",
+                [(day, t, r["income"], r["expense"], r["net_change"], r["log_count"])
+                 for t, r in stats["points"].items()],
+            )
+        cur.execute("DELETE FROM daily_pool_flow_stats WHERE stat_date=%s", (day,))
+        if stats["pools"]:
+            cur.executemany(
+                """INSERT INTO daily_pool_flow_stats
+                   (stat_date, account_type, income, expense, net_change, flow_count)
+                   VALUES (%s, %s, %s, %s, %s, %s)""",
+                [(day, t, r["income"], r["expense"], r["net_change"], r["flow_count"])
+                 for t, r in stats["pools"].items()],
+            )
+
+    @staticmethod
+    def rebuild_range(start: date, end: date) -> int:
+        """重算 [start, end] 内已结束的日期（不含今天），返回重算天数"""
+        end = min(end, date.today() - timedelta(days=1))
+        return FinanceRollupService.rebuild_days(_iter_days(start, end))
+
+    @staticmethod
+    def rebuild_days(days: Iterable[date]) -> int:
+        """重算指定日期（每天一个事务），返回重算天数"""
+        days = sorted(set(days))
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                for day in days:
+                    FinanceRollupService._store_day(cur, day, FinanceRollupService._compute_day(cur, day))
+                    conn.commit()
+        return len(days)
+
+    @staticmethod
+    def _dirty_days(cur, since: Optional[datetime], before: date) -> List[date]:
+        """since 之后有订单更新、且下单日早于 before 的已汇总日期（完成数/金额可能已变化）"""
+        if since is None:
+            return []
+        cur.execute(
+            """SELECT DISTINCT DATE(o.created_at) AS stat_date
+               FROM orders o
+               JOIN daily_order_stats s ON s.stat_date = DATE(o.created_at)
+               WHERE o.updated_at >= %s AND o.created_at < %s""",
+            (since - ROLLUP_DIRTY_OVERLAP, datetime.combine(before, datetime.min.time())),
+        )
+        return [r["stat_date"] for r in cur.fetchall()]
+
+    @staticmethod
+    def compact(days_back: int = ROLLUP_CORRECTION_DAYS) -> int:
+        """每日汇总任务：重算最近 days_back 天，以及更早但自上次运行以来有订单变更的日期"""
+        yesterday = date.today() - timedelta(days=1)
+        window_start = yesterday - timedelta(days=days_back - 1)
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT NOW() AS now")
+                started_at = cur.fetchone()["now"]
+                cur.execute("SELECT config_value FROM system_config WHERE config_key = %s",
+                            (ROLLUP_WATERMARK_KEY,))
+                row = cur.fetchone()
+                since = datetime.fromisoformat(row["config_value"]) if row else None
+                dirty = FinanceRollupService._dirty_days(cur, since, window_start)
+        if dirty:
+            logger.info(f"财务日汇总：{len(dirty)} 个历史日期有订单变更，重算")
+        rebuilt = FinanceRollupService.rebuild_days([*_iter_days(window_start, yesterday), *dirty])
+
+        # 全部重算成功后才推进水位，失败时下次从旧水位重新检测
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """INSERT INTO system_config (config_key, config_value, description)
+                       VALUES (%s, %s, '财务日汇总变更检测水位')
+                       ON DUPLICATE KEY UPDATE config_value = VALUES(config_value)""",
+                    (ROLLUP_WATERMARK_KEY, started_at.isoformat(sep=" ")),
+                )
+                conn.commit()
+        return rebuilt
+
+    @staticmethod
+    def backfill_missing(max_days: int = ROLLUP_BACKFILL_DAYS_PER_RUN) -> int:
+        """定时任务：补算尚无汇总行的历史日期（从近到远，每轮最多 max_days 天），补齐后为空跑"""
+        yesterday = date.today() - timedelta(days=1)
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT MIN(created_at) AS first_at FROM orders")
+                row = cur.fetchone() or {}
+                if not row.get("first_at"):
+                    return 0
+                first_day = row["first_at"].date()
+                cur.execute(
+                    "SELECT stat_date FROM daily_order_stats WHERE stat_date BETWEEN %s AND %s",
+                    (first_day, yesterday),
+                )
+                done = {r["stat_date"] for r in cur.fetchall()}
+        missing = [d for d in _iter_days(first_day, yesterday) if d not in done][-max_days:]
+        if missing:
+            FinanceRollupService.rebuild_days(missing)
+            logger.info(f"财务日汇总补齐 {len(missing)} 天: {missing[0]} ~ {missing[-1]}")
+        return len(missing)
+
+    # ------------- 读取 -------------
+
+    @staticmethod
+    def get_daily_stats(start: date, end: date) -> Dict[date, Dict[str, Any]]:
+        """按日返回 {date: {"order": {...}, "points": {type: {...}}, "pools": {account_type: {...}}}}
+
+        已结束的日期读汇总表，今天及尚未补齐汇总的日期按原始表现算（只读，不在请求中写表）；
+        单个只读连接完成，汇总齐全时查询次数与天数无关
+        """
+        today = date.today()
+        result: Dict[date, Dict[str, Any]] = {
+            d: {"order": {}, "points": {}, "pools": {}} for d in _iter_days(start, end)
+        }
+        with get_conn(readonly=True) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT * FROM daily_order_stats WHERE stat_date BETWEEN %s AND %s", (start, end))
+                for r in cur.fetchall():
+                    if r["stat_date"] in result:
+                        result[r["stat_date"]]["order"] = r
+                cur.execute("SELECT * FROM daily_points_stats WHERE stat_date BETWEEN %s AND %s", (start, end))
+                for r in cur.fetchall():
+                    if r["stat_date"] in result:
+                        result[r["stat_date"]]["points"][r["points_type"]] = r
+                cur.execute("SELECT * FROM daily_pool_flow_stats WHERE stat_date BETWEEN %s AND %s", (start, end))
+                for r in cur.fetchall():
+                    if r["stat_date"] in result:
+                        result[r["stat_date"]]["pools"][r["account_type"]] = r
+
+                pending = [d for d, stats in result.items() if not stats["order"] and d < today]
+                if pending:
+                    logger.info(f"财务日汇总尚未补齐 {len(pending)} 天，本次按原始表统计: {pending[0]} ~ {pending[-1]}")
+                for day in pending:
+                    result[day] = FinanceRollupService._compute_day(cur, day)
+                if start <= today <= end:
+                    result[today] = FinanceRollupService._compute_day(cur, today)
+        return result
+
+    @staticmethod
+    def get_points_summary(points_type: str, start: date, end: date) -> Dict[str, Any]:
+        """区间内某积分类型的收入/支出/净变动/流水条数合计"""
+        totals = {"income": Decimal("0"), "expense": Decimal("0"), "net_change": Decimal("0"), "log_count": 0}
+        for stats in FinanceRollupService.get_daily_stats(start, end).values():
+            row = stats["points"].get(points_type)
+            if not row:
+                continue
+            totals["income"] += Decimal(str(row["income"] or 0))
+            totals["expense"] += Decimal(str(row["expense"] or 0))
+            totals["net_change"] += Decimal(str(row["net_change"] or 0))
+            totals["log_count"] += int(row["log_count"] or 0)
+        return totals
+
+    @staticmethod
+    def get_pool_net_changes(pool_types: List[str], start: date, end: date,
+                             daily: Optional[Dict[date, Dict[str, Any]]] = None) -> Dict[date, Dict[str, float]]:
+        """按日返回各资金池净变动（未发生变动的资金池为 0）"""
+        daily = daily if daily is not None else FinanceRollupService.get_daily_stats(start, end)
+        return {
+            d: {p: float((stats["pools"].get(p) or {}).get("net_change") or 0) for p in pool_types}
+            for d, stats in daily.items()
+        }
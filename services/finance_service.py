@@ -4,6 +4,7 @@
 # 2. 所有积分字段类型为DECIMAL(12,4)，需使用Decimal类型处理，禁止int()转换
 # 3. merchant_points同步支持小数精度处理
 
+import copy
 import logging
 import json
 from decimal import Decimal, ROUND_DOWN, ROUND_CEILING
@@ -18,16 +19,43 @@ from core.config import (
     PLATFORM_MERCHANT_ID, MAX_PURCHASE_PER_DAY, MAX_TEAM_LAYER,
     LOG_FILE, CouponStatus,
 )
+from core.cache import TTLCache
 from core.database import get_conn
 from core.db_adapter import PyMySQLAdapter
 from core.exceptions import FinanceException, OrderException, InsufficientBalanceException
 from core.logging import get_logger
+from services.finance_config_cache import FinanceConfigCache
+from services.finance_rollup_service import FinanceRollupService
+from services.pool_ledger import PoolLedger
+from services.flow_ref_service import (
+    FlowRefService, REF_MEMBER_REWARD, REF_ORDER_ALLOC, REF_ORDER_REWARD, REF_ORDER_SPLIT, REF_REFUND_REVERSAL,
+)
+from services.user_display_service import UserDisplayService
 from core.table_access import build_dynamic_select, get_table_structure, _quote_identifier
 from core.table_access import build_dynamic_select, get_table_structure, _quote_identifier, build_select_list
-from core.db_adapter import build_in_placeholders
+from core.db_adapter import build_in_placeholders, build_date_range
 
 logger = get_logger(__name__)
 
+# 联创星级分红：单个用户单次上限、发放批量、预览缓存
+UNILEVEL_MAX_PER_USER = Decimal('10000')
+UNILEVEL_PAYOUT_CHUNK = 500
+_unilevel_preview_cache = TTLCache(maxsize=8, ttl=120, name="unilevel_preview")
+
+# 优惠券批量发放/过期结算：每个事务处理的用户数、单条 INSERT 的优惠券行数、每批结算的券数
+COUPON_BULK_USER_CHUNK = 500
+COUPON_BULK_INSERT_CHUNK = 1000
+COUPON_SETTLE_CHUNK = 500
+
+
+def _coupon_ids_label(ids: List[int]) -> str:
+    """流水/积分日志里的优惠券描述：单张“优惠券#ID”，多张“优惠券#首ID等N张”"""
+    if not ids:
+        return "优惠券"
+    if len(ids) == 1:
+        return f"优惠券#{ids[0]}"
+    return f"优惠券#{ids[0]}等{len(ids)}张"
+
 
 def max_coupon_total_yuan(merchandise_total: Decimal, points_discount: Decimal) -> Decimal:
     """优惠券叠加面额上限：ceil(商品售卖价 − 积分抵扣金额)，金额向上取整到元。"""
@@ -177,7 +205,8 @@ class FinanceService:
             logger.error(f"查询用户余额失败: {e}")
             return Decimal('0')
 
-    def _grant_referral_points(self, cur, referrer_id: int, amount: Decimal, order_no: str):
+    def _grant_referral_points(self, cur, referrer_id: int, amount: Decimal, order_no: str,
+                               order_id: Optional[int] = None):
         """
         向推荐人发放推荐奖励点数（referral_points 和 true_total_points）
         """
@@ -205,10 +234,10 @@ class FinanceService:
         # 记录 account_flow
         cur.execute(
             """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after,
-               flow_type, remark, created_at)
-               VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
+               flow_type, remark, related_order_id, ref_type, created_at)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
             ('referral_points', referrer_id, amount, new_balance, 'income',
-             f"普通商品推荐奖励 - 订单{order_no}")
+             f"普通商品推荐奖励 - 订单{order_no}", order_id, REF_ORDER_REWARD)
         )
 
         logger.info(f"普通商品推荐奖励发放: 用户{referrer_id} +{amount:.4f}点数（订单{order_no}）")
@@ -490,9 +519,12 @@ class FinanceService:
                 f"（原价¥{total_amount:.2f}，积分抵扣¥{points_discount:.2f}，优惠券¥{coupon_discount:.2f}，实付¥{final_amount:.2f}）"
             )
 
+            # 本订单的资金池变动统一登记，最后一次加锁批量落账
+            ledger = PoolLedger(related_order_id=order_id, ref_type=REF_ORDER_SPLIT)
+
             # 平台收入池记入 100% 实付现金
-            self._add_pool_balance(
-                cur, 'platform_revenue_pool', final_amount,
+            ledger.add(
+                'platform_revenue_pool', final_amount,
                 f"订单分账: {order_no} 实付现金¥{final_amount:.2f}（原价¥{total_amount:.2f}）",
                 user_id
             )
@@ -528,8 +560,8 @@ class FinanceService:
                 if atype == 'merchant_balance':
                     continue
                 alloc_amount = (distribution_base * ratio).quantize(Decimal('0.000001'))
-                self._add_pool_balance(
-                    cur, 'platform_revenue_pool', -alloc_amount,
+                ledger.add(
+                    'platform_revenue_pool', -alloc_amount,
                     f"订单分账: {order_no} → {atype} ({ratio * 100:.0f}%)",
                     user_id
                 )
@@ -537,37 +569,31 @@ class FinanceService:
                     # 计算应给推荐人的金额（基于普通商品部分）
                     referral_amount = (normal_paid * ratio).quantize(Decimal('0.000001'))
                     # 发放给推荐人点数
-                    self._grant_referral_points(cur, referrer_id, referral_amount, order_no)
+                    self._grant_referral_points(cur, referrer_id, referral_amount, order_no, order_id)
                     # 剩余部分进入事业发展基金
                     fund_pool_amount = alloc_amount - referral_amount
                     if fund_pool_amount > 0:
-                        self._add_pool_balance(
-                            cur, atype, fund_pool_amount,
+                        ledger.add(
+                            atype, fund_pool_amount,
                             f"订单#{order_no} {atype.replace('_', ' ')}+{int(ratio * 100)}% (剩余部分)",
-                            user_id
+                            user_id, ref_type=REF_ORDER_ALLOC
                         )
                 else:
-                    self._add_pool_balance(
-                        cur, atype, alloc_amount,
+                    ledger.add(
+                        atype, alloc_amount,
                         f"订单#{order_no} {atype.replace('_', ' ')}+{int(ratio * 100)}%",
-                        user_id
+                        user_id, ref_type=REF_ORDER_ALLOC
                     )
 
             # 公司积分池独立增加（基于实付金额的20%）
             company_points_amount = (distribution_base * Decimal('0.20')).quantize(Decimal('0.000001'))
-            cur.execute(
-                "UPDATE finance_accounts SET balance = balance + %s WHERE account_type = 'company_points'",
-                (company_points_amount,)
-            )
-            cur.execute("SELECT balance FROM finance_accounts WHERE account_type = 'company_points'")
-            cp_new_balance = Decimal(str(cur.fetchone()['balance'] or 0))
-            cur.execute(
-                """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after, 
-                   flow_type, remark, created_at)
-                   VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
-                ('company_points', PLATFORM_MERCHANT_ID, company_points_amount, cp_new_balance, 'income',
-                 f"订单#{order_no} 公司积分池+20% ¥{company_points_amount:.4f}")
+            ledger.add(
+                'company_points', company_points_amount,
+                f"订单#{order_no} 公司积分池+20% ¥{company_points_amount:.4f}",
+                PLATFORM_MERCHANT_ID, ref_type=REF_ORDER_ALLOC
             )
+            pool_balances = ledger.commit(cur)
+            cp_new_balance = pool_balances['company_points']
             try:
                 cur.execute(
                     "INSERT INTO points_log (user_id, change_amount, balance_after, type, reason, related_order, created_at) VALUES (%s, %s, %s, 'company', %s, %s, NOW())",
@@ -578,19 +604,20 @@ class FinanceService:
                 logger.debug(f"写入 points_log（公司积分池）失败: {e}")
 
             # 记录平台收入池流水
-            cur.execute("SELECT balance FROM finance_accounts WHERE account_type = 'platform_revenue_pool'")
-            new_balance = Decimal(str(cur.fetchone()['balance'] or 0))
+            new_balance = pool_balances['platform_revenue_pool']
             cur.execute(
                 """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after, 
-                   flow_type, remark, created_at)
-                   VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
+                   flow_type, remark, related_order_id, ref_type, created_at)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
                 (
                     'platform_revenue_pool',
                     PLATFORM_MERCHANT_ID,
                     distribution_base,
                     new_balance,
                     'income',
-                    f"订单分账: {order_no} 平台收入¥{distribution_base:.2f}"
+                    f"订单分账: {order_no} 平台收入¥{distribution_base:.2f}",
+                    order_id,
+                    REF_ORDER_SPLIT
                 )
             )
 
@@ -618,10 +645,10 @@ class FinanceService:
                     new_true_total = cur.fetchone()['true_total_points']
                     cur.execute(
                         """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after,
-                           flow_type, remark, created_at)
-                           VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
+                           flow_type, remark, related_order_id, ref_type, created_at)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
                         ('true_total_points', user_id, total_rain, new_true_total, 'income',
-                         f"购买商品赠送雨点 - 订单#{order_no}")
+                         f"购买商品赠送雨点 - 订单#{order_no}", order_id, REF_ORDER_REWARD)
                     )
 
                 if total_points > 0:
@@ -862,10 +889,11 @@ class FinanceService:
 
         cur.execute(
             """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after, 
-               flow_type, remark, created_at)
-               VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
+               flow_type, remark, related_order_id, ref_type, created_at)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
             ('platform_revenue_pool', PLATFORM_MERCHANT_ID, platform_revenue,
-             new_balance, 'income', f"会员订单#{order_id} 平台收入¥{platform_revenue:.2f}")
+             new_balance, 'income', f"会员订单#{order_id} 平台收入¥{platform_revenue:.2f}",
+             order_id, REF_ORDER_ALLOC)
         )
         logger.debug(f"平台收入池增加: {platform_revenue:.4f}（已写入流水）")
 
@@ -892,10 +920,10 @@ class FinanceService:
 
                 cur.execute(
                     """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after, 
-                       flow_type, remark, created_at)
-                       VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
+                       flow_type, remark, related_order_id, ref_type, created_at)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
                     (atype, PLATFORM_MERCHANT_ID, alloc_amount, new_balance, 'income',
-                     f"会员订单#{order_id} {atype}池¥{alloc_amount:.2f}")
+                     f"会员订单#{order_id} {atype}池¥{alloc_amount:.2f}", order_id, REF_ORDER_ALLOC)
                 )
                 logger.debug(f"池子 {atype} 增加: {alloc_amount:.4f}（已写入流水）")
             except Exception as e:
@@ -919,13 +947,22 @@ class FinanceService:
         logger.info(f"开始发放奖励: 订单#{order_id}, 购买者={buyer_id}({old_level}→{new_level}星)")
 
         # ==================== 防重复检查 ====================
-        cur.execute(
-            """SELECT id FROM account_flow 
-               WHERE account_type IN ('referral_points', 'team_reward_points') 
-               AND remark LIKE %s
-               LIMIT 1""",
-            (f"%订单#{order_id}%",)
-        )
+        if FlowRefService.refs_ready():
+            cur.execute(
+                """SELECT id FROM account_flow
+                   WHERE related_order_id = %s AND ref_type = %s
+                   AND account_type IN ('referral_points', 'team_reward_points')
+                   LIMIT 1""",
+                (order_id, REF_MEMBER_REWARD)
+            )
+        else:
+            cur.execute(
+                """SELECT id FROM account_flow 
+                   WHERE account_type IN ('referral_points', 'team_reward_points') 
+                   AND remark LIKE %s
+                   LIMIT 1""",
+                (f"%订单#{order_id}%",)
+            )
         if cur.fetchone():
             logger.warning(f"⚠️ 订单#{order_id}的奖励已发放过，跳过重复发放")
             return
@@ -973,10 +1010,10 @@ class FinanceService:
 
                     cur.execute(
                         """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after, 
-                           flow_type, remark, created_at)
-                           VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
+                           flow_type, remark, related_order_id, ref_type, created_at)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
                         ('referral_points', referrer['referrer_id'], reward_amount,
-                         new_balance, 'income', f"推荐奖励 - 订单#{order_id}")
+                         new_balance, 'income', f"推荐奖励 - 订单#{order_id}", order_id, REF_MEMBER_REWARD)
                     )
 
                     logger.info(f"推荐奖励发放: 用户{referrer['referrer_id']}({referrer_level}星) +{reward_amount:.2f}")
@@ -1107,10 +1144,11 @@ class FinanceService:
 
             cur.execute(
                 """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after, 
-                   flow_type, remark, created_at)
-                   VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
+                   flow_type, remark, related_order_id, ref_type, created_at)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
                 ('team_reward_points', recipient_id, reward_amount,
-                 new_balance, 'income', f"团队L{target_layer}奖励（来自第{actual_layer}层）- 订单#{order_id}")
+                 new_balance, 'income', f"团队L{target_layer}奖励（来自第{actual_layer}层）- 订单#{order_id}",
+                 order_id, REF_MEMBER_REWARD)
             )
 
             total_distributed += reward_amount
@@ -1272,35 +1310,39 @@ class FinanceService:
                 return result
 
     def _get_adjusted_points_value(self) -> Optional[Dict[str, Any]]:
-        """获取手动调整的积分值配置，返回包含 value 和 auto_clear 的字典"""
+        """获取手动调整的积分值配置，返回包含 value 和 auto_clear 的字典（经 FinanceConfigCache 缓存）"""
         try:
-            with get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "SELECT config_params FROM finance_accounts WHERE account_type = 'subsidy_pool'"
-                    )
-                    row = cur.fetchone()
-
-                    if row and row.get('config_params'):
-                        try:
-                            import json
-                            config = json.loads(row['config_params']) if isinstance(row['config_params'], str) else row[
-                                'config_params']
-
-                            if isinstance(config, dict) and 'points_value' in config:
-                                value = Decimal(str(config['points_value']))
-                                auto_clear = config.get('auto_clear', False)
-                                if 0 <= value <= MAX_POINTS_VALUE:
-                                    return {
-                                        'value': value,
-                                        'auto_clear': auto_clear
-                                    }
-                        except:
-                            pass
+            return FinanceConfigCache.get("subsidy_points_value", self._load_adjusted_points_value)
         except Exception as e:
             logger.error(f"获取积分值配置失败: {e}")
         return None
 
+    def _load_adjusted_points_value(self) -> Optional[Dict[str, Any]]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT config_params FROM finance_accounts WHERE account_type = 'subsidy_pool'"
+                )
+                row = cur.fetchone()
+
+                if row and row.get('config_params'):
+                    try:
+                        import json
+                        config = json.loads(row['config_params']) if isinstance(row['config_params'], str) else row[
+                            'config_params']
+
+                        if isinstance(config, dict) and 'points_value' in config:
+                            value = Decimal(str(config['points_value']))
+                            auto_clear = config.get('auto_clear', False)
+                            if 0 <= value <= MAX_POINTS_VALUE:
+                                return {
+                                    'value': value,
+                                    'auto_clear': auto_clear
+                                }
+                    except:
+                        pass
+        return None
+
     def adjust_subsidy_points_value(self, points_value: Optional[float] = None, auto_clear: bool = False) -> bool:
         """
         手动调整周补贴积分值
@@ -1334,6 +1376,7 @@ class FinanceService:
                         logger.info(f"已设置周补贴积分值手动调整: {value:.4f}，auto_clear={auto_clear}")
 
                     conn.commit()
+            FinanceConfigCache.bump()
             return True
         except Exception as e:
             logger.error(f"调整积分值失败: {e}")
@@ -1416,23 +1459,27 @@ class FinanceService:
         # ==================== 日补贴比例管理 ====================
 
     def get_daily_subsidy_ratio(self) -> Decimal:
-        """获取每日可发放的补贴池比例（默认0.05）"""
+        """获取每日可发放的补贴池比例（默认0.05，经 FinanceConfigCache 缓存）"""
         try:
-            with get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "SELECT config_params FROM finance_accounts WHERE account_type = 'subsidy_pool'"
-                    )
-                    row = cur.fetchone()
-                    if row and row.get('config_params'):
-                        import json
-                        config = json.loads(row['config_params'])
-                        ratio = config.get('daily_subsidy_ratio', 0.05)
-                        return Decimal(str(ratio))
+            return FinanceConfigCache.get("daily_subsidy_ratio", self._load_daily_subsidy_ratio)
         except Exception as e:
             logger.error(f"获取日补贴比例失败: {e}")
         return Decimal('0.05')
 
+    def _load_daily_subsidy_ratio(self) -> Decimal:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT config_params FROM finance_accounts WHERE account_type = 'subsidy_pool'"
+                )
+                row = cur.fetchone()
+                if row and row.get('config_params'):
+                    import json
+                    config = json.loads(row['config_params'])
+                    ratio = config.get('daily_subsidy_ratio', 0.05)
+                    return Decimal(str(ratio))
+        return Decimal('0.05')
+
     def set_daily_subsidy_ratio(self, ratio: float) -> bool:
         """手动调整日补贴比例"""
         try:
@@ -1452,8 +1499,9 @@ class FinanceService:
                         (json.dumps(config),)
                     )
                     conn.commit()
-                    logger.info(f"日补贴比例已调整为: {ratio}")
-                    return True
+            FinanceConfigCache.bump()
+            logger.info(f"日补贴比例已调整为: {ratio}")
+            return True
         except Exception as e:
             logger.error(f"设置日补贴比例失败: {e}")
             return False
@@ -2091,8 +2139,12 @@ class FinanceService:
 
     def _insert_account_flow(self, cur, account_type: str, related_user: Optional[int],
                              change_amount: Decimal, flow_type: str,
-                             remark: str, account_id: Optional[int] = None) -> None:
-        """插入流水记录（必须使用同一个cur）"""
+                             remark: str, account_id: Optional[int] = None,
+                             related_order_id: Optional[int] = None, ref_type: Optional[str] = None) -> None:
+        """插入流水记录（必须使用同一个cur）
+
+        related_order_id / ref_type: 订单相关流水的结构化关联（见 services.flow_ref_service）
+        """
         # 修复：移除多余的 cur 参数，直接从 cur 查询余额
         if related_user and account_type in ['promotion_balance', 'merchant_balance']:
             # 查询用户余额字段
@@ -2112,13 +2164,16 @@ class FinanceService:
             balance_after = Decimal(str(row['balance'] if row and row['balance'] is not None else 0))
 
         cur.execute(
-            """INSERT INTO account_flow (account_id, account_type, related_user, change_amount, balance_after, flow_type, remark, created_at)
-               VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())""",
-            (account_id, account_type, related_user, change_amount, balance_after, flow_type, remark)
+            """INSERT INTO account_flow (account_id, account_type, related_user, change_amount, balance_after, flow_type, remark,
+                                         related_order_id, ref_type, created_at)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
+            (account_id, account_type, related_user, change_amount, balance_after, flow_type, remark,
+             related_order_id, ref_type)
         )
 
     def _add_pool_balance(self, cur, account_type: str, amount: Decimal, remark: str,
-                          related_user: Optional[int] = None) -> Decimal:
+                          related_user: Optional[int] = None,
+                          related_order_id: Optional[int] = None, ref_type: Optional[str] = None) -> Decimal:
         # 使用同一个事务读写，避免跨连接导致未提交余额不可见
         cur.execute("SELECT balance FROM finance_accounts WHERE account_type = %s FOR UPDATE", (account_type,))
         row = cur.fetchone()
@@ -2155,7 +2210,8 @@ class FinanceService:
         # 记录流水
         flow_type = 'income' if amount >= 0 else 'expense'
         self._insert_account_flow(cur, account_type=account_type, related_user=related_user,
-                                  change_amount=amount, flow_type=flow_type, remark=remark)
+                                  change_amount=amount, flow_type=flow_type, remark=remark,
+                                  related_order_id=related_order_id, ref_type=ref_type)
 
         logger.debug(f"资金池 {account_type} 余额变更: {amount:.4f}，当前余额: {balance_after:.4f}")
         return balance_after
@@ -2239,7 +2295,11 @@ class FinanceService:
         - merchant_balance: Decimal (如 0.80)
         - 子池键: Decimal（占比，相对于总订单金额，如 0.01 表示 1%）
         如果数据库中没有配置，返回默认值（与项目原始占比一致）。
+        每笔支付分账都会调用，经 FinanceConfigCache 缓存，set_pool_allocations 写入后失效。
         """
+        return FinanceConfigCache.get("pool_allocations", self._load_pool_allocations)
+
+    def _load_pool_allocations(self) -> Dict[str, Decimal]:
         # 我们按行读取 finance_accounts 中每个子池的 config_params.allocation
         account_keys = [
             'merchant_balance', 'public_welfare', 'maintain_pool', 'subsidy_pool',
@@ -2388,6 +2448,7 @@ class FinanceService:
                     except Exception as e:
                         logger.error(f"更新 finance_accounts.account_type={atype} 的 config_params 失败: {e}")
                 conn.commit()
+        FinanceConfigCache.bump()
 
         # 返回最新的合并配置（读取每行）
         return self.get_pool_allocations()
@@ -2419,26 +2480,28 @@ class FinanceService:
                 return result
 
     def get_public_welfare_report(self, start_date: str, end_date: str) -> Dict[str, Any]:
-        with get_conn() as conn:
+        date_sql, date_params = build_date_range("created_at", start_date, end_date)
+        date_filter = f"AND {date_sql}" if date_sql else ""
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 汇总查询
                 cur.execute(
-                    """SELECT COUNT(*) as total_transactions,
+                    f"""SELECT COUNT(*) as total_transactions,
                               SUM(CASE WHEN flow_type = 'income' THEN change_amount ELSE 0 END) as total_income,
                               SUM(CASE WHEN flow_type = 'expense' THEN change_amount ELSE 0 END) as total_expense
                        FROM account_flow WHERE account_type = 'public_welfare'
-                       AND DATE(created_at) BETWEEN %s AND %s""",
-                    (start_date, end_date)
+                       {date_filter}""",
+                    tuple(date_params)
                 )
                 summary = cur.fetchone()
 
                 # 明细查询
                 cur.execute(
-                    """SELECT id, related_user, change_amount, balance_after, flow_type, remark, created_at
+                    f"""SELECT id, related_user, change_amount, balance_after, flow_type, remark, created_at
                        FROM account_flow WHERE account_type = 'public_welfare'
-                       AND DATE(created_at) BETWEEN %s AND %s
+                       {date_filter}
                        ORDER BY created_at DESC""",
-                    (start_date, end_date)
+                    tuple(date_params)
                 )
                 details = cur.fetchall()
 
@@ -2714,57 +2777,99 @@ class FinanceService:
         """
         已过期且未使用的优惠券：面额计入补贴池 subsidy_pool，并向持有人增加等额 member_points，
         券状态改为 expired。与发放时扣除的 true_total_points 无关（按产品规则仅补贴池+会员积分补偿）。
+
+        按 id 分批（每批 COUPON_SETTLE_CHUNK 张、单独提交）：批内一条 UPDATE 改状态，
+        补贴池入账与会员积分按用户汇总，每个用户一条资金流水和一条积分日志。
         """
         today = datetime.now().date()
         processed = 0
         total_amount = Decimal('0')
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT id, user_id, amount FROM coupons
-                    WHERE status = %s AND valid_to < %s
-                    ORDER BY id
-                    """,
-                    (CouponStatus.UNUSED, today),
-                )
-                rows = cur.fetchall() or []
-                for r in rows:
-                    cid = int(r['id'])
-                    uid = int(r['user_id'])
-                    amt = Decimal(str(r['amount'] or 0))
+        last_id = 0
+        while True:
+            with get_conn() as conn:
+                with conn.cursor() as cur:
                     cur.execute(
                         """
-                        UPDATE coupons SET status = %s
-                        WHERE id = %s AND status = %s AND valid_to < %s
+                        SELECT id, user_id, amount FROM coupons
+                        WHERE status = %s AND valid_to < %s AND id > %s
+                        ORDER BY id
+                        LIMIT %s
+                        FOR UPDATE
                         """,
-                        (CouponStatus.EXPIRED, cid, CouponStatus.UNUSED, today),
+                        (CouponStatus.UNUSED, today, last_id, COUPON_SETTLE_CHUNK),
                     )
-                    if cur.rowcount == 0:
-                        continue
-                    if amt > 0:
-                        self._add_pool_balance(
-                            cur,
-                            'subsidy_pool',
-                            amt,
-                            f"优惠券#{cid}过期未使用，面额归入补贴池",
-                            related_user=uid,
-                        )
+                    rows = cur.fetchall() or []
+                    if not rows:
+                        break
+                    last_id = int(rows[-1]['id'])
+
+                    placeholders, params = build_in_placeholders([int(r['id']) for r in rows])
+                    cur.execute(
+                        f"UPDATE coupons SET status = %s WHERE id IN ({placeholders}) AND status = %s",
+                        (CouponStatus.EXPIRED, *params.values(), CouponStatus.UNUSED),
+                    )
+
+                    # 按持有人汇总面额
+                    per_user: Dict[int, Dict[str, Any]] = {}
+                    for r in rows:
+                        amt = Decimal(str(r['amount'] or 0))
+                        if amt <= 0:
+                            continue
+                        entry = per_user.setdefault(int(r['user_id']), {'amount': Decimal('0'), 'ids': []})
+                        entry['amount'] += amt
+                        entry['ids'].append(int(r['id']))
+
+                    batch_amount = sum((e['amount'] for e in per_user.values()), Decimal('0'))
+                    if per_user:
+                        ledger = PoolLedger()
+                        for uid, entry in per_user.items():
+                            ledger.add(
+                                'subsidy_pool',
+                                entry['amount'],
+                                f"{_coupon_ids_label(entry['ids'])}过期未使用，面额归入补贴池",
+                                related_user=uid,
+                            )
+                        ledger.commit(cur)
+
+                        user_ids = sorted(per_user)
+                        case_sql = " ".join(["WHEN %s THEN %s"] * len(user_ids))
+                        case_params = [v for uid in user_ids for v in (uid, per_user[uid]['amount'])]
+                        placeholders, params = build_in_placeholders(user_ids)
                         cur.execute(
-                            "UPDATE users SET member_points = COALESCE(member_points, 0) + %s WHERE id = %s",
-                            (amt, uid),
+                            f"""UPDATE users
+                                SET member_points = COALESCE(member_points, 0) + CASE id {case_sql} ELSE 0 END
+                                WHERE id IN ({placeholders})""",
+                            (*case_params, *params.values()),
                         )
-                        cur.execute("SELECT member_points FROM users WHERE id = %s", (uid,))
-                        bal_row = cur.fetchone()
-                        new_bal = Decimal(str(bal_row['member_points'] or 0))
                         cur.execute(
-                            """INSERT INTO points_log (user_id, change_amount, balance_after, type, reason, related_order, created_at)
-                               VALUES (%s, %s, %s, 'member', %s, NULL, NOW())""",
-                            (uid, amt, new_bal, f"优惠券#{cid}过期补偿积分（面额¥{amt}）"),
+                            f"SELECT id, member_points FROM users WHERE id IN ({placeholders})",
+                            tuple(params.values()),
                         )
-                        total_amount += amt
-                    processed += 1
-                conn.commit()
+                        new_balances = {
+                            int(r['id']): Decimal(str(r['member_points'] or 0)) for r in cur.fetchall()
+                        }
+
+                        log_rows = []
+                        for uid in user_ids:
+                            if uid not in new_balances:
+                                continue
+                            entry = per_user[uid]
+                            label = "面额" if len(entry['ids']) == 1 else "面额合计"
+                            log_rows.append((
+                                uid, entry['amount'], new_balances[uid],
+                                f"{_coupon_ids_label(entry['ids'])}过期补偿积分（{label}¥{entry['amount']}）",
+                            ))
+                        if log_rows:
+                            values_sql = ", ".join(["(%s, %s, %s, 'member', %s, NULL, NOW())"] * len(log_rows))
+                            cur.execute(
+                                f"""INSERT INTO points_log (user_id, change_amount, balance_after, type, reason, related_order, created_at)
+                                    VALUES {values_sql}""",
+                                tuple(v for row in log_rows for v in row),
+                            )
+                    conn.commit()
+
+            processed += len(rows)
+            total_amount += batch_amount
         logger.info(
             "过期优惠券结算: %s 张, 合计面额 %s 已入补贴池并发放等额会员积分",
             processed,
@@ -2787,7 +2892,7 @@ class FinanceService:
 
     # ==================== 关键修改7：财务报告使用member_points ====================
     def get_finance_report(self) -> Dict[str, Any]:
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 用户资产
                 # 关键修改：SUM(member_points)替代SUM(points)
@@ -2871,7 +2976,7 @@ class FinanceService:
                 }
 
     def get_account_flow_report(self, limit: int = 50) -> List[Dict[str, Any]]:
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 获取表结构
                 cur.execute("SHOW COLUMNS FROM account_flow")
@@ -2924,27 +3029,31 @@ class FinanceService:
 
     # ========== 完整函数 1：获取手动调整配置（辅助函数） ==========
     def _get_adjusted_unilevel_amount(self) -> Optional[Decimal]:
-        """获取手动调整的联创分红金额配置"""
+        """获取手动调整的联创分红金额配置（经 FinanceConfigCache 缓存）"""
         try:
-            with get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "SELECT config_params FROM finance_accounts WHERE account_type = 'director_pool'"
-                    )
-                    row = cur.fetchone()
-
-                    if row and row.get('config_params'):
-                        try:
-                            import json
-                            config = json.loads(row['config_params'])
-                            if 'fixed_amount_per_weight' in config:
-                                return Decimal(str(config['fixed_amount_per_weight']))
-                        except (json.JSONDecodeError, KeyError, TypeError):
-                            pass
+            return FinanceConfigCache.get("unilevel_amount_per_weight", self._load_adjusted_unilevel_amount)
         except Exception as e:
             logger.error(f"获取调整配置失败: {e}")
         return None
 
+    def _load_adjusted_unilevel_amount(self) -> Optional[Decimal]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT config_params FROM finance_accounts WHERE account_type = 'director_pool'"
+                )
+                row = cur.fetchone()
+
+                if row and row.get('config_params'):
+                    try:
+                        import json
+                        config = json.loads(row['config_params'])
+                        if 'fixed_amount_per_weight' in config:
+                            return Decimal(str(config['fixed_amount_per_weight']))
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        pass
+        return None
+
     # ========== 完整函数 2：计算联创星级分红预览 ==========
     def calculate_unilevel_dividend_preview(self) -> Dict[str, Any]:
         """
@@ -2958,147 +3067,153 @@ class FinanceService:
         - 所有联创用户列表（包含理论金额和实际金额）
         - total_capped_users: 达到上限的用户数（新增）
         - capped_users_list: 被限制的用户列表（新增）
-        """
-        logger.info("计算联创星级分红预览（含单个用户上限1万）")
 
+        结果按 (月份, 分红池余额, 手动调整金额) 缓存 120 秒；发放分红后失效。
+        """
         # 1. 查询分红池余额（优先使用资金分配池 director_pool，与分配配置保持一致）
         pool_balance = self.get_account_balance('director_pool')
         if pool_balance is None or pool_balance == 0:
             # 兼容旧数据，回退到 honor_director 账户
             pool_balance = self.get_account_balance('honor_director')
 
-        total_member_points = Decimal('0')
-        total_merchant_points = Decimal('0')
-        company_points_balance = Decimal('0')
+        adjusted_amount = self._get_adjusted_unilevel_amount()
+        cache_key = (datetime.now().strftime('%Y-%m'), str(pool_balance), str(adjusted_amount))
+        cached = _unilevel_preview_cache.get(cache_key)
+        if cached is not None:
+            # 返回副本：调用方修改结果（如接口层补字段）不会污染缓存
+            return copy.deepcopy(cached)
+
+        logger.info("计算联创星级分红预览（含单个用户上限1万）")
 
         # 2. 查询所有联创用户及平台积分基数（含平台储备积分）
         with get_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute("SET time_zone = '+08:00'")
-
-                cur.execute("SELECT SUM(COALESCE(member_points,0)) AS total FROM users")
-                total_member_points = Decimal(str(cur.fetchone().get('total', 0) or 0))
-
-                cur.execute("SELECT SUM(COALESCE(merchant_points,0)) AS total FROM users")
-                total_merchant_points = Decimal(str(cur.fetchone().get('total', 0) or 0))
+                cur.execute(
+                    """SELECT COALESCE(SUM(member_points), 0) AS member_total,
+                              COALESCE(SUM(merchant_points), 0) AS merchant_total
+                       FROM users"""
+                )
+                totals = cur.fetchone() or {}
+                total_member_points = Decimal(str(totals.get('member_total', 0) or 0))
+                total_merchant_points = Decimal(str(totals.get('merchant_total', 0) or 0))
 
                 cur.execute("SELECT balance FROM finance_accounts WHERE account_type = 'company_points'")
                 cp_row = cur.fetchone() or {}
                 company_points_balance = Decimal(str(cp_row.get('balance', 0) or 0))
 
-                cur.execute("""
-                    SELECT uu.user_id, uu.level, u.name, u.member_level
-                    FROM user_unilevel uu
-                    JOIN users u ON uu.user_id = u.id
-                    INNER JOIN (
-                        SELECT DISTINCT o.user_id
-                        FROM orders o
-                        WHERE o.status IN ('pending_ship','pending_recv','completed')
-                          AND o.created_at >= DATE_FORMAT(CURDATE(), '%Y-%m-01')
-                          AND o.created_at < DATE_ADD(DATE_FORMAT(CURDATE(), '%Y-%m-01'), INTERVAL 1 MONTH)
-                    ) AS active_users ON uu.user_id = active_users.user_id
-                    WHERE uu.level IN (1, 2, 3)
-                """)
-                unilevel_users = cur.fetchall()
+                unilevel_users = self._load_unilevel_members(cur)
 
         weighted_merchant_points = total_merchant_points
         platform_total_points = total_member_points + weighted_merchant_points + company_points_balance
 
-        if not unilevel_users:
-            return {
-                "pool_balance": float(pool_balance),
-                "total_member_points": float(total_member_points),
-                "total_merchant_points": float(total_merchant_points),
-                "merchant_points_weighted": float(weighted_merchant_points),
-                "company_points_balance": float(company_points_balance),
-                "platform_total_points": float(platform_total_points),
-                "total_weight": 0,
-                "amount_per_weight_auto": 0.0,
-                "user_count": 0,
-                "adjustment_configured": False,
-                "adjusted_amount": None,
-                "will_use_adjusted": False,
-                "estimated_balance_after": float(pool_balance),
-                "total_required": 0.0,
-                "total_capped_users": 0,  # 新增
-                "capped_users_list": [],  # 新增
-                "users": []
-            }
-
-        # 3. 计算总权重
-        total_weight = sum(Decimal(str(user['level'])) for user in unilevel_users)
+        # 3~7. 权重、每权重金额、单人上限（与发放共用同一计算）
+        plan = self._compute_unilevel_dividend(unilevel_users, pool_balance, adjusted_amount)
 
-        # 4. 自动计算每个权重金额
-        amount_per_weight_auto = pool_balance / total_weight if total_weight > 0 else Decimal('0')
-
-        # 5. 检查是否有手动调整配置
-        adjusted_amount = self._get_adjusted_unilevel_amount()
-
-        # 6. 确定使用哪个金额
-        if adjusted_amount is not None:
-            amount_per_weight = adjusted_amount
-            will_use_adjusted = True
-        else:
-            amount_per_weight = amount_per_weight_auto
-            will_use_adjusted = False
-
-        # 7. 计算每个用户的金额并检查上限
-        MAX_PER_USER = Decimal('10000')
-        total_capped_users = 0
-        capped_users_list = []
-        users_data = []
-
-        for user in unilevel_users:
-            weight = Decimal(str(user['level']))
-            theoretical_dividend = amount_per_weight * weight
-            actual_dividend = min(theoretical_dividend, MAX_PER_USER)
-
-            # 检查是否被限制
-            is_capped = theoretical_dividend > actual_dividend
-            if is_capped:
-                total_capped_users += 1
-                capped_users_list.append({
-                    "user_id": user['user_id'],
-                    "user_name": user['name'],
-                    "weight": int(weight),
-                    "theoretical_dividend": float(theoretical_dividend),
-                    "actual_dividend": float(actual_dividend)
-                })
-
-            users_data.append({
-                "user_id": user['user_id'],
-                "user_name": user['name'],
-                "unilevel_level": user['level'],
-                "member_level": user['member_level'],
-                "weight": int(weight),
-                "theoretical_dividend": float(theoretical_dividend),  # 理论金额
-                "actual_dividend": float(actual_dividend),  # 实际金额（受上限影响）
-                "is_capped": is_capped  # 是否被限制
-            })
+        users_data = [
+            {
+                "user_id": u['user_id'],
+                "user_name": u['name'],
+                "unilevel_level": u['level'],
+                "member_level": u['member_level'],
+                "weight": u['weight'],
+                "theoretical_dividend": float(u['theoretical']),  # 理论金额
+                "actual_dividend": float(u['actual']),  # 实际金额（受上限影响）
+                "is_capped": u['is_capped']  # 是否被限制
+            }
+            for u in plan['users']
+        ]
+        capped_users_list = [
+            {
+                "user_id": u['user_id'],
+                "user_name": u['name'],
+                "weight": u['weight'],
+                "theoretical_dividend": float(u['theoretical']),
+                "actual_dividend": float(u['actual'])
+            }
+            for u in plan['users'] if u['is_capped']
+        ]
 
         # 8. 预估扣除后的余额（基于理论最大值）
-        total_theoretical_required = amount_per_weight * total_weight
+        total_theoretical_required = plan['total_theoretical']
         estimated_balance_after = pool_balance - total_theoretical_required
 
-        return {
+        result = {
             "pool_balance": float(pool_balance),
             "total_member_points": float(total_member_points),
             "total_merchant_points": float(total_merchant_points),
             "merchant_points_weighted": float(weighted_merchant_points),
             "company_points_balance": float(company_points_balance),
             "platform_total_points": float(platform_total_points),
-            "total_weight": int(total_weight),
-            "amount_per_weight_auto": float(amount_per_weight_auto),
+            "total_weight": int(plan['total_weight']),
+            "amount_per_weight_auto": float(plan['amount_per_weight_auto']),
             "user_count": len(unilevel_users),
             "adjustment_configured": adjusted_amount is not None,
             "adjusted_amount": float(adjusted_amount) if adjusted_amount else None,
-            "will_use_adjusted": will_use_adjusted,
+            "will_use_adjusted": plan['will_use_adjusted'],
             "estimated_balance_after": float(estimated_balance_after),
+            "total_required": float(plan['total_actual']),
             "total_theoretical_required": float(total_theoretical_required),
-            "total_capped_users": total_capped_users,  # 达到上限的用户数
+            "total_capped_users": len(capped_users_list),  # 达到上限的用户数
             "capped_users_list": capped_users_list,  # 被限制的用户详情
             "users": users_data
         }
+        _unilevel_preview_cache.set(cache_key, copy.deepcopy(result))
+        return result
+
+    @staticmethod
+    def _load_unilevel_members(cur) -> List[Dict[str, Any]]:
+        """本月有有效订单的联创用户（level 1~3），EXISTS 半连接走 orders(user_id, created_at) 索引"""
+        cur.execute("SET time_zone = '+08:00'")
+        cur.execute("""
+            SELECT uu.user_id, uu.level, u.name, u.member_level
+            FROM user_unilevel uu
+            JOIN users u ON uu.user_id = u.id
+            WHERE uu.level IN (1, 2, 3)
+              AND EXISTS (
+                  SELECT 1 FROM orders o
+                  WHERE o.user_id = uu.user_id
+                    AND o.status IN ('pending_ship','pending_recv','completed')
+                    AND o.created_at >= DATE_FORMAT(CURDATE(), '%Y-%m-01')
+                    AND o.created_at < DATE_ADD(DATE_FORMAT(CURDATE(), '%Y-%m-01'), INTERVAL 1 MONTH)
+              )
+        """)
+        return cur.fetchall()
+
+    @staticmethod
+    def _compute_unilevel_dividend(members: List[Dict[str, Any]], pool_balance: Decimal,
+                                   adjusted_amount: Optional[Decimal]) -> Dict[str, Any]:
+        """联创分红金额计算（预览与发放共用）
+
+        每权重金额：有手动调整用调整值，否则 = 分红池余额 / 总权重；
+        单人金额 = 每权重金额 × 权重，封顶 UNILEVEL_MAX_PER_USER。
+        """
+        total_weight = sum((Decimal(str(m['level'])) for m in members), Decimal('0'))
+        amount_per_weight_auto = pool_balance / total_weight if total_weight > 0 else Decimal('0')
+        will_use_adjusted = adjusted_amount is not None
+        amount_per_weight = adjusted_amount if will_use_adjusted else amount_per_weight_auto
+
+        users = []
+        for m in members:
+            weight = Decimal(str(m['level']))
+            theoretical = amount_per_weight * weight
+            actual = min(theoretical, UNILEVEL_MAX_PER_USER)
+            users.append({
+                **m,
+                "weight": int(weight),
+                "theoretical": theoretical,
+                "actual": actual,
+                "is_capped": theoretical > actual,
+            })
+
+        return {
+            "total_weight": total_weight,
+            "amount_per_weight_auto": amount_per_weight_auto,
+            "amount_per_weight": amount_per_weight,
+            "will_use_adjusted": will_use_adjusted,
+            "total_theoretical": amount_per_weight * total_weight,
+            "total_actual": sum((u['actual'] for u in users), Decimal('0')),
+            "users": users,
+        }
 
     # ========== 完整函数 3：手动调整联创分红金额 ==========
     def adjust_unilevel_dividend_amount(self, amount_per_weight: Optional[float] = None) -> Dict[str, Any]:
@@ -3134,35 +3249,19 @@ class FinanceService:
                             raise FinanceException("分红金额不能为负数")
 
                         # ==================== 新增：检查可能超限的用户 ====================
-                        MAX_PER_USER = Decimal('10000')
-                        cur.execute("""
-                            SELECT uu.user_id, u.name, uu.level as weight
-                            FROM user_unilevel uu
-                            JOIN users u ON uu.user_id = u.id
-                            INNER JOIN (
-                                SELECT DISTINCT o.user_id
-                                FROM orders o
-                                WHERE o.status IN ('pending_ship','pending_recv','completed')
-                                  AND o.created_at >= DATE_FORMAT(CURDATE(), '%Y-%m-01')
-                                  AND o.created_at < DATE_ADD(DATE_FORMAT(CURDATE(), '%Y-%m-01'), INTERVAL 1 MONTH)
-                            ) AS active_users ON uu.user_id = active_users.user_id
-                            WHERE uu.level IN (1, 2, 3)
-                        """)
-                        unilevel_users = cur.fetchall()
-
-                        capped_users = []
-                        for user in unilevel_users:
-                            weight = int(user['weight'])
-                            theoretical_amount = amount * Decimal(str(weight))
-
-                            if theoretical_amount > MAX_PER_USER:
-                                capped_users.append({
-                                    "user_id": user['user_id'],
-                                    "user_name": user['name'],
-                                    "weight": weight,
-                                    "theoretical_amount": float(theoretical_amount),
-                                    "actual_amount": float(MAX_PER_USER)
-                                })
+                        plan = self._compute_unilevel_dividend(
+                            self._load_unilevel_members(cur), Decimal('0'), amount
+                        )
+                        capped_users = [
+                            {
+                                "user_id": u['user_id'],
+                                "user_name": u['name'],
+                                "weight": u['weight'],
+                                "theoretical_amount": float(u['theoretical']),
+                                "actual_amount": float(u['actual'])
+                            }
+                            for u in plan['users'] if u['is_capped']
+                        ]
 
                         # 如果有用户超限，生成警告信息
                         if capped_users:
@@ -3190,6 +3289,7 @@ class FinanceService:
                         logger.info(f"已设置联创分红手动调整: ¥{amount:.4f}/权重")
 
                     conn.commit()
+            FinanceConfigCache.bump()
 
             return result
 
@@ -3205,36 +3305,20 @@ class FinanceService:
         1. 新增：每个用户发放金额上限10,000元
         2. 保留：余额检查、资金池扣减等保护逻辑
         3. 记录：超限情况日志，便于审计
+        4. 金额与预览共用 _compute_unilevel_dividend；按金额分组、每 UNILEVEL_PAYOUT_CHUNK 人一条
+           UPDATE / 一条多行流水 INSERT，分红池只做一笔汇总扣减
         """
         logger.info("联创星级分红发放开始（检测手动调整配置 + 用户上限1万）")
 
         # 查询所有联创用户
         with get_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute("SET time_zone = '+08:00'")
-
-                cur.execute("""
-                    SELECT uu.user_id, uu.level, u.name, u.member_level
-                    FROM user_unilevel uu
-                    JOIN users u ON uu.user_id = u.id
-                    INNER JOIN (
-                        SELECT DISTINCT o.user_id
-                        FROM orders o
-                        WHERE o.status IN ('pending_ship','pending_recv','completed')
-                          AND o.created_at >= DATE_FORMAT(CURDATE(), '%Y-%m-01')
-                          AND o.created_at < DATE_ADD(DATE_FORMAT(CURDATE(), '%Y-%m-01'), INTERVAL 1 MONTH)
-                    ) AS active_users ON uu.user_id = active_users.user_id
-                    WHERE uu.level IN (1, 2, 3)
-                """)
-                unilevel_users = cur.fetchall()
+                unilevel_users = self._load_unilevel_members(cur)
 
         if not unilevel_users:
             logger.warning("没有符合条件的联创用户")
             return False
 
-        # 计算总权重
-        total_weight = sum(Decimal(str(user['level'])) for user in unilevel_users)
-
         # 查询分红池余额
         pool_balance = self.get_account_balance('director_pool')
 
@@ -3244,10 +3328,11 @@ class FinanceService:
 
         # 检查手动调整配置
         adjusted_amount = self._get_adjusted_unilevel_amount()
+        plan = self._compute_unilevel_dividend(unilevel_users, pool_balance, adjusted_amount)
+        total_weight = plan['total_weight']
+        amount_per_weight = plan['amount_per_weight']
 
-        # 确定使用哪个金额
         if adjusted_amount is not None:
-            amount_per_weight = adjusted_amount
             total_required = amount_per_weight * total_weight
 
             # 关键：检查余额是否足够（在事务开始前检查）
@@ -3259,83 +3344,78 @@ class FinanceService:
 
             logger.info(f"使用手动调整金额: ¥{amount_per_weight:.4f}/权重")
         else:
-            amount_per_weight = pool_balance / total_weight
             logger.info(f"使用自动计算金额: ¥{amount_per_weight:.4f}/权重")
 
+        payouts = [u for u in plan['users'] if u['actual'] > 0]
+        capped = [u for u in payouts if u['is_capped']]
+        for u in capped:
+            logger.warning(
+                f"用户{u['user_id']}联创分红金额超限: {u['theoretical']:.4f} -> {u['actual']:.4f} "
+                f"(权重:{u['weight']}, 上限:{UNILEVEL_MAX_PER_USER})"
+            )
+        total_distributed = sum((u['actual'] for u in payouts), Decimal('0'))
+        if not payouts:
+            logger.warning("联创分红每权重金额为0，本次不发放")
+            return False
+
         # 执行分红发放
         try:
             with get_conn() as conn:
                 with conn.cursor() as cur:
-                    total_distributed = Decimal('0')
-                    total_limited = 0  # 记录被限制的用户数
-
-                    for user in unilevel_users:
-                        user_id = user['user_id']
-                        weight = Decimal(str(user['level']))
-
-                        # 计算理论发放金额
-                        theoretical_amount = amount_per_weight * weight
-
-                        # ==================== 新增：限制单个用户上限10,000元 ====================
-                        MAX_PER_USER = Decimal('10000.0000')
-                        actual_amount = min(theoretical_amount, MAX_PER_USER)
-
-                        if actual_amount != theoretical_amount:
-                            total_limited += 1
-                            logger.warning(
-                                f"用户{user_id}联创分红金额超限: {theoretical_amount:.4f} -> {actual_amount:.4f} "
-                                f"(权重:{weight}, 上限:{MAX_PER_USER})"
+                    # 先锁定并扣减分红池（余额保护），失败则整批不发
+                    ledger = PoolLedger()
+                    ledger.add(
+                        'director_pool', -total_distributed,
+                        f"联创星级分红发放 - {len(payouts)}人共{total_distributed:.4f}点数"
+                    )
+                    ledger.commit(cur)
+
+                    # 同一金额的用户一条 UPDATE（权重只有 1~3，加上封顶最多几种金额）
+                    by_amount: Dict[Decimal, List[int]] = {}
+                    for u in payouts:
+                        by_amount.setdefault(u['actual'], []).append(u['user_id'])
+                    for points_to_add, user_ids in by_amount.items():
+                        for i in range(0, len(user_ids), UNILEVEL_PAYOUT_CHUNK):
+                            chunk = user_ids[i:i + UNILEVEL_PAYOUT_CHUNK]
+                            placeholders, params = build_in_placeholders(chunk)
+                            cur.execute(
+                                f"""UPDATE users
+                                    SET points = COALESCE(points, 0) + %s,
+                                        true_total_points = true_total_points + %s
+                                    WHERE id IN ({placeholders})""",
+                                (points_to_add, points_to_add, *params.values())
                             )
-                        # ===================================================================
-
-                        points_to_add = actual_amount
-
-                        # 给用户发放点数
-                        cur.execute(
-                            "UPDATE users SET points = COALESCE(points, 0) + %s WHERE id = %s",
-                            (points_to_add, user_id)
-                        )
 
-                        # 同时更新真实总点数
+                    # 用户分红流水，每 UNILEVEL_PAYOUT_CHUNK 条一条多行 INSERT
+                    for i in range(0, len(payouts), UNILEVEL_PAYOUT_CHUNK):
+                        chunk = payouts[i:i + UNILEVEL_PAYOUT_CHUNK]
+                        values_sql = ", ".join(["(%s, %s, %s, %s, %s, %s, NOW())"] * len(chunk))
+                        flow_params = []
+                        for u in chunk:
+                            flow_params.extend([
+                                'director_pool', u['user_id'], u['actual'], 0, 'income',
+                                f"联创{u['weight']}星级分红（权重{u['weight']}/{total_weight}）"
+                            ])
                         cur.execute(
-                            "UPDATE users SET true_total_points = true_total_points + %s WHERE id = %s",
-                            (points_to_add, user_id)
+                            f"""INSERT INTO account_flow (account_type, related_user, change_amount, balance_after,
+                                                          flow_type, remark, created_at)
+                                VALUES {values_sql}""",
+                            tuple(flow_params)
                         )
 
-                        # 记录流水
-                        cur.execute("""
-                            INSERT INTO account_flow (account_type, related_user, change_amount, balance_after, 
-                            flow_type, remark, created_at)
-                            VALUES (%s, %s, %s, %s, %s, %s, NOW())
-                        """, ('director_pool', user_id, points_to_add, 0, 'income',
-                              f"联创{weight}星级分红（权重{weight}/{total_weight}）"))
-
-                        # 【关键修复】从 honor_director 池扣除发放的 points_to_add
-                        # 使用 _add_pool_balance（带余额保护）
-                        try:
-                            self._add_pool_balance(
-                                cur, 'director_pool', -points_to_add,
-                                f"联创星级分红发放 - 用户{user_id}获得{points_to_add:.4f}点数",
-                                related_user=None
-                            )
-                        except InsufficientBalanceException:
-                            logger.error(f"联创分红池余额不足，无法发放用户{user_id}的分红")
-                            raise FinanceException("联创分红池余额不足，发放失败")
-
-                        total_distributed += points_to_add
-                        logger.debug(f"用户{user_id}获得联创星级分红: {points_to_add:.4f}点数")
-
                     conn.commit()
 
+            _unilevel_preview_cache.clear()
+
             # 分红成功后，清除手动调整配置（避免下次误用）
             if adjusted_amount is not None:
                 logger.info("分红完成，清除手动调整配置")
                 self.adjust_unilevel_dividend_amount(None)
 
             # ==================== 新增：记录被限制的用户数 ====================
-            if total_limited > 0:
+            if capped:
                 logger.info(f"联创星级分红完成: 共{len(unilevel_users)}人，发放点数{total_distributed:.4f}，"
-                            f"其中{total_limited}人达到上限10,000元")
+                            f"其中{len(capped)}人达到上限10,000元")
             else:
                 logger.info(f"联创星级分红完成: 共{len(unilevel_users)}人，发放点数{total_distributed:.4f}")
             # ===================================================================
@@ -3351,7 +3431,7 @@ class FinanceService:
 
     # ==================== 关键修改8：积分流水报告使用member_points ====================
     def get_points_flow_report(self, user_id: Optional[int] = None, limit: int = 50) -> List[Dict[str, Any]]:
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 params = [limit]
                 sql = """SELECT id, user_id, change_amount, balance_after, type, reason, related_order, created_at
@@ -3443,40 +3523,42 @@ class FinanceService:
     # ==================== 关键修改9：积分抵扣报表使用member_points ====================
     def get_points_deduction_report(self, start_date: str, end_date: str, page: int = 1, page_size: int = 20) -> Dict[
         str, Any]:
-        with get_conn() as conn:
+        date_sql, date_params = build_date_range("o.created_at", start_date, end_date)
+        date_filter = f"AND {date_sql}" if date_sql else ""
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 offset = (page - 1) * page_size
 
                 # 总数查询
                 cur.execute(
-                    """SELECT COUNT(*) as total
+                    f"""SELECT COUNT(*) as total
                        FROM orders o JOIN points_log pl ON o.id = pl.related_order
                        WHERE o.points_discount > 0 AND pl.type = 'member' AND pl.reason = '积分抵扣支付'
-                       AND DATE(o.created_at) BETWEEN %s AND %s""",
-                    (start_date, end_date)
+                       {date_filter}""",
+                    tuple(date_params)
                 )
                 total_count = cur.fetchone()['total']
 
                 # 明细查询
                 cur.execute(
-                    """SELECT o.id as order_id, o.order_number, o.user_id, u.name as user_name, u.member_level,
+                    f"""SELECT o.id as order_id, o.order_number, o.user_id, u.name as user_name, u.member_level,
                               o.original_amount, o.points_discount, o.total_amount, ABS(pl.change_amount) as points_used, o.created_at
                        FROM orders o JOIN points_log pl ON o.id = pl.related_order JOIN users u ON o.user_id = u.id
                        WHERE o.points_discount > 0 AND pl.type = 'member' AND pl.reason = '积分抵扣支付'
-                       AND DATE(o.created_at) BETWEEN %s AND %s
+                       {date_filter}
                        ORDER BY o.created_at DESC LIMIT %s OFFSET %s""",
-                    (start_date, end_date, page_size, offset)
+                    (*date_params, page_size, offset)
                 )
                 records = cur.fetchall()
 
                 # 汇总查询
                 cur.execute(
-                    """SELECT COUNT(*) as total_orders, SUM(ABS(pl.change_amount)) as total_points,
+                    f"""SELECT COUNT(*) as total_orders, SUM(ABS(pl.change_amount)) as total_points,
                               SUM(o.points_discount) as total_discount_amount
                        FROM orders o JOIN points_log pl ON o.id = pl.related_order
                        WHERE o.points_discount > 0 AND pl.type = 'member' AND pl.reason = '积分抵扣支付'
-                       AND DATE(o.created_at) BETWEEN %s AND %s""",
-                    (start_date, end_date)
+                       {date_filter}""",
+                    tuple(date_params)
                 )
                 summary = cur.fetchone()
 
@@ -3510,7 +3592,7 @@ class FinanceService:
 
     # ==================== 关键修改10：交易链报表 ====================
     def get_transaction_chain_report(self, user_id: int, order_no: Optional[str] = None) -> Dict[str, Any]:
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 订单查询
                 if order_no:
@@ -3540,8 +3622,30 @@ class FinanceService:
                             "total_team_reward": 0.0,
                             "grand_total": 0.0
                         },
-                        "chain": []  # 空链
+                        "chain": [],  # 空链
+                        "fund_flows": []
                     }
+
+                # 本订单的团队奖励、推荐奖励各一次查询，按层号取用（替代逐层查询）
+                select_fields, existing_columns = _build_team_rewards_select(cur, ['reward_amount'])
+                # 确保包含 created_at 字段（如果不存在则使用 NULL）
+                if 'created_at' not in existing_columns:
+                    select_fields = select_fields + ", NULL AS created_at"
+                cur.execute(
+                    f"SELECT {select_fields} FROM team_rewards WHERE order_id = %s",
+                    (order['id'],)
+                )
+                team_rewards_by_layer = {}
+                for row in cur.fetchall():
+                    team_rewards_by_layer.setdefault(row['layer'], row)
+
+                cur.execute(
+                    """SELECT amount FROM pending_rewards
+                       WHERE order_id = %s AND reward_type = 'referral' AND status = 'approved'""",
+                    (order['id'],)
+                )
+                ref_reward = cur.fetchone()
+
                 # 构建推荐链
                 chain = []
                 current_id = user_id
@@ -3560,28 +3664,11 @@ class FinanceService:
 
                     level += 1
 
-                    # 动态构造 SELECT 语句
-                    select_fields, existing_columns = _build_team_rewards_select(cur, ['reward_amount'])
-                    # 确保包含 created_at 字段（如果不存在则使用 NULL）
-                    if 'created_at' not in existing_columns:
-                        select_fields = select_fields + ", NULL AS created_at"
-
-                    cur.execute(
-                        f"SELECT {select_fields} FROM team_rewards WHERE order_id = %s AND layer = %s",
-                        (order['id'], level)
-                    )
-                    team_reward = cur.fetchone()
+                    team_reward = team_rewards_by_layer.get(level)
 
                     referral_reward = None
-                    if level == 1:
-                        cur.execute(
-                            """SELECT amount FROM pending_rewards
-                               WHERE order_id = %s AND reward_type = 'referral' AND status = 'approved'""",
-                            (order['id'],)
-                        )
-                        ref_reward = cur.fetchone()
-                        if ref_reward:
-                            referral_reward = float(ref_reward['amount'])
+                    if level == 1 and ref_reward:
+                        referral_reward = float(ref_reward['amount'])
 
                     chain.append({
                         "layer": level,
@@ -3604,6 +3691,35 @@ class FinanceService:
                 total_referral = chain[0]['referral_reward'] if chain and chain[0]['referral_reward'] else 0.00
                 total_team = sum(item['team_reward']['amount'] for item in chain)
 
+                # 订单关联的资金流水（分账、资金池分配、奖励、退款回冲）
+                if FlowRefService.refs_ready():
+                    cur.execute(
+                        """SELECT id, account_type, related_user, change_amount, flow_type, ref_type, remark, created_at
+                           FROM account_flow WHERE related_order_id = %s
+                           ORDER BY id""",
+                        (order['id'],)
+                    )
+                else:
+                    cur.execute(
+                        """SELECT id, account_type, related_user, change_amount, flow_type, ref_type, remark, created_at
+                           FROM account_flow WHERE remark LIKE %s OR remark LIKE %s
+                           ORDER BY id""",
+                        (f"%{order['order_number']}%", f"%订单#{order['id']}%")
+                    )
+                fund_flows = [
+                    {
+                        "flow_id": row['id'],
+                        "account_type": row['account_type'],
+                        "related_user": row['related_user'],
+                        "change_amount": float(row['change_amount'] or 0),
+                        "flow_type": row['flow_type'],
+                        "ref_type": row['ref_type'],
+                        "remark": row['remark'],
+                        "created_at": row['created_at'].strftime("%Y-%m-%d %H:%M:%S") if row['created_at'] else None
+                    }
+                    for row in cur.fetchall()
+                ]
+
                 # 关键修改：将 order_no 改为 order_number
                 return {
                     "order_id": order['id'],
@@ -3616,68 +3732,142 @@ class FinanceService:
                         "total_team_reward": total_team,
                         "grand_total": total_referral + total_team
                     },
-                    "chain": chain
+                    "chain": chain,
+                    "fund_flows": fund_flows
                 }
 
     # ==================== 1. 优惠券直接发放 ====================
-    # ==================== 新增：内部发放方法（使用外部游标） ====================
-    def _distribute_coupon_internal(self, cur, user_id: int, amount: Decimal,
-                                    coupon_type: str = 'user',
-                                    applicable_product_type: str = 'all',
-                                    valid_days: int = COUPON_VALID_DAYS) -> int:
-        """
-        内部方法：在已有事务游标上发放单张优惠券。
-        """
-        from datetime import datetime, timedelta
-        from core.table_access import build_dynamic_select
-
-        # 1. 检查 true_total_points 余额
-        select_sql = build_dynamic_select(
-            cur,
-            "users",
-            where_clause="id=%s",
-            select_fields=["true_total_points"]
+    # ==================== 批量发放原语（使用外部游标） ====================
+    @staticmethod
+    def _lock_true_total_points(cur, user_ids: List[int]) -> Dict[int, Decimal]:
+        """按 id 顺序锁定用户行并读取 true_total_points，返回 {user_id: 余额}；不存在的用户不在结果中"""
+        if not user_ids:
+            return {}
+        placeholders, params = build_in_placeholders(sorted(set(user_ids)))
+        cur.execute(
+            f"""SELECT id, true_total_points FROM users
+                WHERE id IN ({placeholders})
+                ORDER BY id
+                FOR UPDATE""",
+            tuple(params.values())
         )
-        cur.execute(select_sql, (user_id,))
-        user_row = cur.fetchone()
-        if not user_row:
-            raise FinanceException(f"用户不存在: {user_id}")
+        return {int(r['id']): Decimal(str(r['true_total_points'] or 0)) for r in cur.fetchall()}
+
+    @staticmethod
+    def _coupon_shortfall_reason(user_id: int, balance: Decimal, need: Decimal) -> str:
+        return f"用户 {user_id} true_total_points 余额不足，当前余额: {balance:.4f}，需要 {need:.4f}"
 
-        current_balance = Decimal(str(user_row.get('true_total_points', 0) or 0))
-        if current_balance < amount:
-            raise FinanceException(
-                f"用户 {user_id} true_total_points 余额不足，当前余额: {current_balance:.4f}，需要 {amount:.4f}"
+    @staticmethod
+    def _issue_coupons_bulk(cur, grants: Dict[int, int], balances: Dict[int, Decimal], amount: Decimal,
+                            coupon_type: str = 'user',
+                            applicable_product_type: str = 'all',
+                            valid_days: int = COUPON_VALID_DAYS,
+                            flow_remark=None) -> Dict[int, List[int]]:
+        """
+        批量发放优惠券并扣除 true_total_points（调用方已用 _lock_true_total_points 锁定用户并确认余额充足）。
+
+        grants: {user_id: 张数}；balances: 锁定时读到的余额
+        flow_remark: 可选，(张数, 优惠券ID列表) -> 流水备注
+        1. 一条 UPDATE ... CASE 扣减所有用户余额，WHERE 带余额条件，命中行数不符时抛异常整体回滚
+        2. 多行 INSERT 写入优惠券（每条最多 COUPON_BULK_INSERT_CHUNK 行），券 ID 按每条 INSERT 的
+           lastrowid..lastrowid+rowcount-1 推出（见下方说明）
+        3. 每个用户一条汇总的 account_flow 扣除流水
+        返回 {user_id: [优惠券ID, ...]}
+        """
+        grants = {uid: n for uid, n in grants.items() if n > 0}
+        if not grants:
+            return {}
+        user_ids = sorted(grants)
+        costs = {uid: amount * grants[uid] for uid in user_ids}
+
+        # 1. 集合式扣减
+        charged = [uid for uid in user_ids if costs[uid] > 0]
+        if charged:
+            case_sql = " ".join(["WHEN %s THEN %s"] * len(charged))
+            case_params = [v for uid in charged for v in (uid, costs[uid])]
+            placeholders, params = build_in_placeholders(charged)
+            cur.execute(
+                f"""UPDATE users
+                    SET true_total_points = true_total_points - CASE id {case_sql} END
+                    WHERE id IN ({placeholders})
+                      AND true_total_points >= CASE id {case_sql} END""",
+                (*case_params, *params.values(), *case_params)
             )
+            if cur.rowcount != len(charged):
+                raise FinanceException(
+                    f"批量扣除 true_total_points 失败：应扣 {len(charged)} 个用户，实际 {cur.rowcount} 个"
+                )
 
-        # 2. 插入优惠券记录
+        # 2. 多行插入优惠券
         today = datetime.now().date()
         valid_to = today + timedelta(days=valid_days)
+        coupon_rows = [
+            (uid, coupon_type, amount, applicable_product_type, today, valid_to)
+            for uid in user_ids for _ in range(grants[uid])
+        ]
+        # 依赖 InnoDB 的自增分配规则：INSERT ... VALUES 多行属于 "simple insert"，行数事先已知，
+        # 在 innodb_autoinc_lock_mode 0/1/2 下都一次性分配连续 ID（只有 INSERT ... SELECT 等
+        # "bulk insert" 在模式 2 下可能不连续）；lastrowid 为该条语句第一行的 ID，步长取
+        # auto_increment_increment（默认 1）。不再按属性回查，避免把并发事务插入的同类券算进来
+        cur.execute("SELECT @@auto_increment_increment AS step")
+        step = int((cur.fetchone() or {}).get('step') or 1)
+        coupon_ids: Dict[int, List[int]] = {uid: [] for uid in user_ids}
+        for i in range(0, len(coupon_rows), COUPON_BULK_INSERT_CHUNK):
+            chunk = coupon_rows[i:i + COUPON_BULK_INSERT_CHUNK]
+            values_sql = ", ".join(["(%s, %s, %s, %s, %s, %s, 'unused')"] * len(chunk))
+            cur.execute(
+                f"""INSERT INTO coupons (user_id, coupon_type, amount, applicable_product_type, valid_from, valid_to, status)
+                    VALUES {values_sql}""",
+                tuple(v for row in chunk for v in row)
+            )
+            if cur.rowcount != len(chunk):
+                raise FinanceException(f"批量插入优惠券失败：应插入 {len(chunk)} 张，实际 {cur.rowcount} 张")
+            first_id = cur.lastrowid
+            for offset, row in enumerate(chunk):
+                coupon_ids[row[0]].append(first_id + offset * step)
+
+        # 3. 每个用户一条汇总流水
+        flow_rows = []
+        for uid in user_ids:
+            ids = coupon_ids[uid]
+            if flow_remark:
+                remark = flow_remark(grants[uid], ids)
+            elif grants[uid] == 1:
+                remark = f"发放优惠券扣除 - {_coupon_ids_label(ids)}，金额¥{amount:.2f}，类型:{applicable_product_type}"
+            else:
+                remark = (f"发放优惠券扣除 - {_coupon_ids_label(ids)}，每张¥{amount:.2f}，"
+                          f"合计¥{costs[uid]:.2f}，类型:{applicable_product_type}")
+            flow_rows.append(('true_total_points', uid, -costs[uid], balances[uid] - costs[uid], 'expense', remark))
+        values_sql = ", ".join(["(%s, %s, %s, %s, %s, %s, NOW())"] * len(flow_rows))
         cur.execute(
-            """INSERT INTO coupons (user_id, coupon_type, amount, applicable_product_type, valid_from, valid_to, status)
-               VALUES (%s, %s, %s, %s, %s, %s, 'unused')""",
-            (user_id, coupon_type, amount, applicable_product_type, today, valid_to)
+            f"""INSERT INTO account_flow (account_type, related_user, change_amount, balance_after,
+                                          flow_type, remark, created_at)
+                VALUES {values_sql}""",
+            tuple(v for row in flow_rows for v in row)
         )
-        coupon_id = cur.lastrowid
 
-        # 3. 扣除 true_total_points
-        new_balance = current_balance - amount
-        cur.execute(
-            "UPDATE users SET true_total_points = %s WHERE id = %s",
-            (new_balance, user_id)
+        logger.debug(
+            f"批量发放优惠券: {len(user_ids)}个用户，共{len(coupon_rows)}张，每张¥{amount:.2f}"
         )
+        return coupon_ids
 
-        # 4. 记录扣除流水
-        cur.execute(
-            """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after, 
-               flow_type, remark, created_at)
-               VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
-            ('true_total_points', user_id, -amount, new_balance, 'expense',
-             f"发放优惠券扣除 - 优惠券#{coupon_id}，金额¥{amount:.2f}，类型:{applicable_product_type}")
-        )
+    def _distribute_coupon_internal(self, cur, user_id: int, amount: Decimal,
+                                    coupon_type: str = 'user',
+                                    applicable_product_type: str = 'all',
+                                    valid_days: int = COUPON_VALID_DAYS) -> int:
+        """
+        内部方法：在已有事务游标上发放单张优惠券。
+        """
+        balances = self._lock_true_total_points(cur, [user_id])
+        if user_id not in balances:
+            raise FinanceException(f"用户不存在: {user_id}")
+        if balances[user_id] < amount:
+            raise FinanceException(self._coupon_shortfall_reason(user_id, balances[user_id], amount))
 
-        logger.debug(
-            f"发放优惠券给用户{user_id}: ID={coupon_id}, 金额¥{amount:.2f}, 扣除 true_total_points {amount:.4f}")
-        return coupon_id
+        coupon_ids = self._issue_coupons_bulk(
+            cur, {user_id: 1}, balances, amount, coupon_type, applicable_product_type, valid_days
+        )
+        return coupon_ids[user_id][0]
 
     # ===========================================================================
 
@@ -3703,18 +3893,21 @@ class FinanceService:
             applicable_product_type: str = 'all',
             valid_days: int = COUPON_VALID_DAYS,
     ) -> List[int]:
-        """为指定用户在同一事务内发放 count 张 1 元优惠券（每张等额扣除 true_total_points）。"""
+        """为指定用户在同一事务内发放 count 张 1 元优惠券（每张等额扣除 true_total_points，余额不足则一张都不发）。"""
         if count < 1:
             raise FinanceException("发放张数必须至少为 1")
         amount_per = Decimal('1')
         with get_conn() as conn:
             with conn.cursor() as cur:
-                coupon_ids: List[int] = []
-                for _ in range(count):
-                    cid = self._distribute_coupon_internal(
-                        cur, user_id, amount_per, coupon_type, applicable_product_type, valid_days
-                    )
-                    coupon_ids.append(cid)
+                balances = self._lock_true_total_points(cur, [user_id])
+                if user_id not in balances:
+                    raise FinanceException(f"用户不存在: {user_id}")
+                need = amount_per * count
+                if balances[user_id] < need:
+                    raise FinanceException(self._coupon_shortfall_reason(user_id, balances[user_id], need))
+                coupon_ids = self._issue_coupons_bulk(
+                    cur, {user_id: count}, balances, amount_per, coupon_type, applicable_product_type, valid_days
+                )[user_id]
                 conn.commit()
         return coupon_ids
 
@@ -3730,29 +3923,50 @@ class FinanceService:
             'failed_users': [{'user_id': 123, 'reason': '余额不足'}, ...],
             'coupon_ids': [优惠券ID列表]
         }
+        每 COUPON_BULK_USER_CHUNK 个用户一次加锁、一次扣减、一次插入；同一用户重复出现时按余额能覆盖的张数发放。
         """
         amount_dec = Decimal(str(amount))
-        coupon_ids = []
-        failed_users = []
+        requested: Dict[int, int] = {}
+        for uid in user_ids:
+            requested[uid] = requested.get(uid, 0) + 1
+        ordered = list(requested)
 
+        issued: Dict[int, List[int]] = {}
+        reasons: Dict[int, str] = {}
         with get_conn() as conn:
             with conn.cursor() as cur:
-                for uid in user_ids:
-                    try:
-                        cid = self._distribute_coupon_internal(
-                            cur, uid, amount_dec, coupon_type, applicable_product_type, valid_days
-                        )
-                        coupon_ids.append(cid)
-                    except FinanceException as e:
-                        # 余额不足或其他业务异常，跳过该用户，记录失败，继续下一个
-                        failed_users.append({
-                            'user_id': uid,
-                            'reason': str(e)
-                        })
-                        logger.warning(f"用户 {uid} 发放失败，已跳过：{e}")
+                for i in range(0, len(ordered), COUPON_BULK_USER_CHUNK):
+                    chunk = ordered[i:i + COUPON_BULK_USER_CHUNK]
+                    balances = self._lock_true_total_points(cur, chunk)
+                    grants: Dict[int, int] = {}
+                    for uid in chunk:
+                        if uid not in balances:
+                            reasons[uid] = f"用户不存在: {uid}"
+                            continue
+                        affordable = int(balances[uid] // amount_dec) if amount_dec > 0 else requested[uid]
+                        grants[uid] = min(requested[uid], affordable)
+                        if grants[uid] < requested[uid]:
+                            reasons[uid] = self._coupon_shortfall_reason(
+                                uid, balances[uid] - amount_dec * grants[uid], amount_dec
+                            )
+                    issued.update(self._issue_coupons_bulk(
+                        cur, grants, balances, amount_dec, coupon_type, applicable_product_type, valid_days
+                    ))
                 # 最后统一提交，成功的操作会持久化
                 conn.commit()
 
+        # 按请求顺序还原结果
+        coupon_ids = []
+        failed_users = []
+        for uid in user_ids:
+            ids = issued.get(uid)
+            if ids:
+                coupon_ids.append(ids.pop(0))
+            else:
+                reason = reasons.get(uid, f"用户 {uid} 发放失败")
+                failed_users.append({'user_id': uid, 'reason': reason})
+                logger.warning(f"用户 {uid} 发放失败，已跳过：{reason}")
+
         return {
             'success_count': len(coupon_ids),
             'failed_users': failed_users,
@@ -3852,12 +4066,10 @@ class FinanceService:
                 if user_id:
                     where.append("af.related_user = %s")
                     params.append(user_id)
-                if start_date:
-                    where.append("DATE(af.created_at) >= %s")
-                    params.append(start_date)
-                if end_date:
-                    where.append("DATE(af.created_at) <= %s")
-                    params.append(end_date)
+                date_sql, date_params = build_date_range("af.created_at", start_date, end_date)
+                if date_sql:
+                    where.append(date_sql)
+                    params.extend(date_params)
 
                 # 总数
                 count_sql = f"SELECT COUNT(*) as total FROM account_flow af WHERE {' AND '.join(where)}"
@@ -3966,7 +4178,7 @@ class FinanceService:
                                end_date: Optional[str] = None,
                                page: int = 1, page_size: int = 20) -> Dict[str, Any]:
         """查询奖励自动发放流水明细（从 account_flow 查询）"""
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 构建查询条件
                 where_conditions = [
@@ -3981,13 +4193,10 @@ class FinanceService:
                     where_conditions.append("af.account_type = %s")
                     params.append(f"{reward_type}_points")
 
-                if start_date:
-                    where_conditions.append("DATE(af.created_at) >= %s")
-                    params.append(start_date)
-
-                if end_date:
-                    where_conditions.append("DATE(af.created_at) <= %s")
-                    params.append(end_date)
+                date_sql, date_params = build_date_range("af.created_at", start_date, end_date)
+                if date_sql:
+                    where_conditions.append(date_sql)
+                    params.extend(date_params)
 
                 where_sql = " AND ".join(where_conditions)
 
@@ -4062,48 +4271,8 @@ class FinanceService:
         try:
             with get_conn() as conn:
                 with conn.cursor() as cur:
-                    # 1. 查询优惠券详情
-                    cur.execute(
-                        """SELECT c.*, u.name as user_name
-                           FROM coupons c JOIN users u ON c.user_id = u.id
-                           WHERE c.id = %s AND c.user_id = %s AND c.status = 'unused'""",
-                        (coupon_id, user_id)
-                    )
-                    coupon = cur.fetchone()
-
-                    if not coupon:
-                        raise FinanceException("优惠券不存在或已使用")
-
-                    # 2. 验证有效期
-                    today = datetime.now().date()
-                    if not (coupon['valid_from'] <= today <= coupon['valid_to']):
-                        raise FinanceException("优惠券不在有效期内")
-
-                    # 3. 验证商品类型匹配（如果提供了订单类型）
-                    if order_type:
-                        applicable_type = coupon['applicable_product_type']
-                        if applicable_type == 'normal_only' and order_type == 'member':
-                            raise FinanceException("该优惠券仅限普通商品使用")
-                        if applicable_type == 'member_only' and order_type == 'normal':
-                            raise FinanceException("该优惠券仅限会员商品使用")
-
-                    # 4. 标记为已使用
-                    cur.execute(
-                        "UPDATE coupons SET status = 'used', used_at = NOW() WHERE id = %s",
-                        (coupon_id,)
-                    )
-
-                    # 5. 记录使用流水
-                    cur.execute(
-                        """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after, 
-                           flow_type, remark, created_at)
-                           VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
-                        ('coupon', user_id, Decimal('0'), Decimal('0'), 'expense',
-                         f"用户使用优惠券 - 优惠券#{coupon_id}，金额¥{float(coupon['amount'])}, 类型:{coupon['applicable_product_type']}")
-                    )
-
+                    self._use_coupon_on_cursor(cur, coupon_id, user_id, order_type)
                     conn.commit()
-                    logger.debug(f"用户{user_id}使用优惠券{coupon_id}:¥{coupon['amount']:.2f}成功")
                     return True
 
         except FinanceException as e:
@@ -4112,6 +4281,50 @@ class FinanceService:
             logger.error(f"❌ 使用优惠券失败: {e}")
             raise
 
+    def _use_coupon_on_cursor(self, cur, coupon_id: int, user_id: int, order_type: str = None) -> None:
+        """在调用方事务内核销优惠券（校验有效期、商品类型并记录流水），不提交"""
+        # 1. 查询优惠券详情（锁定，避免并发重复核销）
+        cur.execute(
+            """SELECT c.*, u.name as user_name
+               FROM coupons c JOIN users u ON c.user_id = u.id
+               WHERE c.id = %s AND c.user_id = %s AND c.status = 'unused'
+               FOR UPDATE""",
+            (coupon_id, user_id)
+        )
+        coupon = cur.fetchone()
+
+        if not coupon:
+            raise FinanceException("优惠券不存在或已使用")
+
+        # 2. 验证有效期
+        today = datetime.now().date()
+        if not (coupon['valid_from'] <= today <= coupon['valid_to']):
+            raise FinanceException("优惠券不在有效期内")
+
+        # 3. 验证商品类型匹配（如果提供了订单类型）
+        if order_type:
+            applicable_type = coupon['applicable_product_type']
+            if applicable_type == 'normal_only' and order_type == 'member':
+                raise FinanceException("该优惠券仅限普通商品使用")
+            if applicable_type == 'member_only' and order_type == 'normal':
+                raise FinanceException("该优惠券仅限会员商品使用")
+
+        # 4. 标记为已使用
+        cur.execute(
+            "UPDATE coupons SET status = 'used', used_at = NOW() WHERE id = %s",
+            (coupon_id,)
+        )
+
+        # 5. 记录使用流水
+        cur.execute(
+            """INSERT INTO account_flow (account_type, related_user, change_amount, balance_after, 
+               flow_type, remark, created_at)
+               VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
+            ('coupon', user_id, Decimal('0'), Decimal('0'), 'expense',
+             f"用户使用优惠券 - 优惠券#{coupon_id}，金额¥{float(coupon['amount'])}, 类型:{coupon['applicable_product_type']}")
+        )
+        logger.debug(f"用户{user_id}使用优惠券{coupon_id}:¥{coupon['amount']:.2f}成功")
+
     # ==================== 提现申请处理报表（高优先级） ====================
     def get_withdrawal_report(self, start_date: str, end_date: str,
                               user_id: Optional[int] = None,
@@ -4124,11 +4337,14 @@ class FinanceService:
         """
         logger.info(f"生成提现申请报表: 日期范围={start_date}至{end_date}, 用户={user_id}, 状态={status}")
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 构建WHERE条件 - ✅ 使用表别名w.避免歧义
-                where_conditions = ["DATE(w.created_at) BETWEEN %s AND %s"]  # ✅ w.created_at
-                params = [start_date, end_date]
+                date_sql, date_params = build_date_range("w.created_at", start_date, end_date)
+                where_conditions = ["1=1"]
+                if date_sql:
+                    where_conditions.append(date_sql)  # ✅ w.created_at
+                params = list(date_params)
 
                 if user_id:
                     where_conditions.append("w.user_id = %s")  # ✅ w.user_id
@@ -4249,17 +4465,14 @@ class FinanceService:
             where_conditions.append("pl.user_id = %s")
             params.append(user_id)
 
-        if start_date:
-            where_conditions.append("DATE(pl.created_at) >= %s")
-            params.append(start_date)
-
-        if end_date:
-            where_conditions.append("DATE(pl.created_at) <= %s")
-            params.append(end_date)
+        date_sql, date_params = build_date_range("pl.created_at", start_date, end_date)
+        if date_sql:
+            where_conditions.append(date_sql)
+            params.extend(date_params)
 
         where_sql = " AND ".join(where_conditions)
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 1. 查询总记录数
                 count_sql = f"""
@@ -4276,7 +4489,7 @@ class FinanceService:
                     cur.execute("""
                         SELECT balance_after 
                         FROM points_log 
-                        WHERE user_id = %s AND type = 'member' AND DATE(created_at) < %s
+                        WHERE user_id = %s AND type = 'member' AND created_at < %s
                         ORDER BY created_at DESC 
                         LIMIT 1
                     """, (user_id, start_date))
@@ -4394,7 +4607,7 @@ class FinanceService:
                              page: int = 1, page_size: int = 20) -> Dict[str, Any]:
         logger.info(f"生成资金池流水报表: 账户={account_type}, 日期范围={start_date}至{end_date}")
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 查询平台余额
                 cur.execute("SELECT balance FROM finance_accounts WHERE account_type = %s", (account_type,))
@@ -4402,11 +4615,11 @@ class FinanceService:
                 actual_current_balance = Decimal(str(account_row['balance'] if account_row else 0))
 
                 # 智能过滤：只对 honor_director 强制过滤
-                where_conditions = [
-                    "account_type = %s",
-                    "DATE(created_at) BETWEEN %s AND %s"
-                ]
-                params = [account_type, start_date, end_date]
+                date_sql, date_params = build_date_range("created_at", start_date, end_date)
+                where_conditions = ["account_type = %s"]
+                if date_sql:
+                    where_conditions.append(date_sql)
+                params = [account_type, *date_params]
 
                 # 只有联创分红池才过滤 related_user=NULL
                 if account_type == 'honor_director':
@@ -4442,18 +4655,8 @@ class FinanceService:
                 """, tuple(params + [page_size, offset]))
                 records = cur.fetchall()
 
-                # 获取用户名称
-                def get_user_name(uid):
-                    if not uid:
-                        return "系统"
-                    if uid == 0:
-                        return "平台"
-                    try:
-                        cur.execute("SELECT name FROM users WHERE id = %s", (uid,))
-                        row = cur.fetchone()
-                        return row['name'] if row else f"未知用户:{uid}"
-                    except Exception:
-                        return f"查询失败:{uid}"
+                # 当页用户名称批量解析
+                user_names = UserDisplayService.get_names((r['related_user'] for r in records), cur)
 
                 # 计算净变动（保持Decimal类型）
                 total_income = Decimal(str(summary['total_income'] or 0))
@@ -4499,7 +4702,7 @@ class FinanceService:
                         {
                             "flow_id": r['id'],
                             "related_user": r['related_user'],
-                            "user_name": get_user_name(r['related_user']),
+                            "user_name": UserDisplayService.display_name(user_names, r['related_user']),
                             "change_amount": r['change_amount'],  # 保持原始Decimal类型
                             "balance_after": r['balance_after'],  # 保持原始Decimal类型
                             "flow_type": r['flow_type'],
@@ -4525,7 +4728,7 @@ class FinanceService:
         """
         logger.info(f"生成联创星级点数流水报表: 用户={user_id}, 星级={level}, 日期范围={start_date}至{end_date}")
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 构建WHERE条件（用于明细和汇总查询）
                 where_conditions = ["af.account_type = 'director_pool'", "af.flow_type = 'income'"]
@@ -4539,13 +4742,10 @@ class FinanceService:
                     where_conditions.append("uu.level = %s")
                     query_params.append(level)
 
-                if start_date:
-                    where_conditions.append("DATE(af.created_at) >= %s")
-                    query_params.append(start_date)
-
-                if end_date:
-                    where_conditions.append("DATE(af.created_at) <= %s")
-                    query_params.append(end_date)
+                date_sql, date_params = build_date_range("af.created_at", start_date, end_date)
+                if date_sql:
+                    where_conditions.append(date_sql)
+                    query_params.extend(date_params)
 
                 where_sql = " AND ".join(where_conditions)
 
@@ -4734,7 +4934,7 @@ class FinanceService:
         week_start = first_day + timedelta(weeks=week - 1)
         week_end = week_start + timedelta(days=6)
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 构建WHERE条件
                 where_conditions = ["wsr.week_start BETWEEN %s AND %s"]
@@ -4888,7 +5088,7 @@ class FinanceService:
         month_start = date(year, month, 1)
         month_end = date(year, month, last_day)
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 where_conditions = ["wsr.week_start BETWEEN %s AND %s"]
                 params = [month_start, month_end]
@@ -5018,11 +5218,16 @@ class FinanceService:
         week_start = first_day + timedelta(weeks=week - 1)
         week_end = week_start + timedelta(days=6)
 
-        with get_conn() as conn:
+        # 全量汇总读日汇总表，明细查询使用 [start, end+1) 半开区间
+        rollup = FinanceRollupService.get_points_summary('member', week_start, week_end)
+        range_start = datetime.combine(week_start, datetime.min.time())
+        range_end = datetime.combine(week_end, datetime.min.time()) + timedelta(days=1)
+
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 构建WHERE条件
-                where_conditions = ["DATE(pl.created_at) BETWEEN %s AND %s", "pl.type = 'member'"]
-                params = [week_start, week_end]
+                where_conditions = ["pl.created_at >= %s AND pl.created_at < %s", "pl.type = 'member'"]
+                params = [range_start, range_end]
 
                 if user_id:
                     where_conditions.append("pl.user_id = %s")
@@ -5030,14 +5235,17 @@ class FinanceService:
 
                 where_sql = " AND ".join(where_conditions)
 
-                # 总记录数查询
-                count_sql = f"""
-                    SELECT COUNT(*) as total 
-                    FROM points_log pl
-                    WHERE {where_sql}
-                """
-                cur.execute(count_sql, tuple(params))
-                total_count = cur.fetchone()['total'] or 0
+                # 总记录数（不限用户时直接取日汇总条数）
+                if user_id:
+                    count_sql = f"""
+                        SELECT COUNT(*) as total 
+                        FROM points_log pl
+                        WHERE {where_sql}
+                    """
+                    cur.execute(count_sql, tuple(params))
+                    total_count = cur.fetchone()['total'] or 0
+                else:
+                    total_count = rollup['log_count']
 
                 # 明细查询
                 offset = (page - 1) * page_size
@@ -5055,20 +5263,13 @@ class FinanceService:
                 cur.execute(detail_sql, tuple(params))
                 records = cur.fetchall()
 
-                # 汇总统计
-                summary_sql = f"""
-                    SELECT COUNT(DISTINCT pl.user_id) as total_users,
-                           SUM(CASE WHEN pl.change_amount > 0 THEN pl.change_amount ELSE 0 END) as total_income,
-                           SUM(CASE WHEN pl.change_amount < 0 THEN ABS(pl.change_amount) ELSE 0 END) as total_expense,
-                           SUM(pl.change_amount) as net_change
-                    FROM points_log pl
-                    WHERE {where_sql.replace(' AND pl.user_id = %s', '') if user_id else where_sql}
-                """
-                if user_id:
-                    cur.execute(summary_sql, (week_start, week_end))
-                else:
-                    cur.execute(summary_sql, tuple(params[:-2]))
-                summary = cur.fetchone()
+                # 汇总：金额取日汇总，仅活跃用户数需查原始流水
+                cur.execute(
+                    "SELECT COUNT(DISTINCT pl.user_id) AS total_users FROM points_log pl "
+                    "WHERE pl.created_at >= %s AND pl.created_at < %s AND pl.type = 'member'",
+                    (range_start, range_end)
+                )
+                total_users = cur.fetchone()['total_users'] or 0
 
                 return {
                     "summary": {
@@ -5076,10 +5277,10 @@ class FinanceService:
                         "query_week": f"{year}-W{week:02d}",
                         "week_start": week_start.strftime("%Y-%m-%d"),
                         "week_end": week_end.strftime("%Y-%m-%d"),
-                        "total_users": summary['total_users'] or 0,
-                        "total_income": float(summary['total_income'] or 0),
-                        "total_expense": float(summary['total_expense'] or 0),
-                        "net_change": float(summary['net_change'] or 0)
+                        "total_users": total_users,
+                        "total_income": float(rollup['income']),
+                        "total_expense": float(rollup['expense']),
+                        "net_change": float(rollup['net_change'])
                     },
                     "pagination": {
                         "page": page,
@@ -5128,11 +5329,16 @@ class FinanceService:
         month_start = date(year, month, 1)
         month_end = date(year, month, last_day)
 
-        with get_conn() as conn:
+        # 全量汇总读日汇总表，明细查询使用 [start, end+1) 半开区间
+        rollup = FinanceRollupService.get_points_summary('member', month_start, month_end)
+        range_start = datetime.combine(month_start, datetime.min.time())
+        range_end = datetime.combine(month_end, datetime.min.time()) + timedelta(days=1)
+
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 构建WHERE条件
-                where_conditions = ["DATE(pl.created_at) BETWEEN %s AND %s", "pl.type = 'member'"]
-                params = [month_start, month_end]
+                where_conditions = ["pl.created_at >= %s AND pl.created_at < %s", "pl.type = 'member'"]
+                params = [range_start, range_end]
 
                 if user_id:
                     where_conditions.append("pl.user_id = %s")
@@ -5140,14 +5346,17 @@ class FinanceService:
 
                 where_sql = " AND ".join(where_conditions)
 
-                # 总记录数查询
-                count_sql = f"""
-                    SELECT COUNT(*) as total 
-                    FROM points_log pl
-                    WHERE {where_sql}
-                """
-                cur.execute(count_sql, tuple(params))
-                total_count = cur.fetchone()['total'] or 0
+                # 总记录数（不限用户时直接取日汇总条数）
+                if user_id:
+                    count_sql = f"""
+                        SELECT COUNT(*) as total 
+                        FROM points_log pl
+                        WHERE {where_sql}
+                    """
+                    cur.execute(count_sql, tuple(params))
+                    total_count = cur.fetchone()['total'] or 0
+                else:
+                    total_count = rollup['log_count']
 
                 # 明细查询
                 offset = (page - 1) * page_size
@@ -5165,20 +5374,13 @@ class FinanceService:
                 cur.execute(detail_sql, tuple(params))
                 records = cur.fetchall()
 
-                # 汇总统计
-                summary_sql = f"""
-                    SELECT COUNT(DISTINCT pl.user_id) as total_users,
-                           SUM(CASE WHEN pl.change_amount > 0 THEN pl.change_amount ELSE 0 END) as total_income,
-                           SUM(CASE WHEN pl.change_amount < 0 THEN ABS(pl.change_amount) ELSE 0 END) as total_expense,
-                           SUM(pl.change_amount) as net_change
-                    FROM points_log pl
-                    WHERE {where_sql.replace(' AND pl.user_id = %s', '') if user_id else where_sql}
-                """
-                if user_id:
-                    cur.execute(summary_sql, (month_start, month_end))
-                else:
-                    cur.execute(summary_sql, tuple(params[:-2]))
-                summary = cur.fetchone()
+                # 汇总：金额取日汇总，仅活跃用户数需查原始流水
+                cur.execute(
+                    "SELECT COUNT(DISTINCT pl.user_id) AS total_users FROM points_log pl "
+                    "WHERE pl.created_at >= %s AND pl.created_at < %s AND pl.type = 'member'",
+                    (range_start, range_end)
+                )
+                total_users = cur.fetchone()['total_users'] or 0
 
                 return {
                     "summary": {
@@ -5186,10 +5388,10 @@ class FinanceService:
                         "query_month": f"{year}-{month:02d}",
                         "month_start": month_start.strftime("%Y-%m-%d"),
                         "month_end": month_end.strftime("%Y-%m-%d"),
-                        "total_users": summary['total_users'] or 0,
-                        "total_income": float(summary['total_income'] or 0),
-                        "total_expense": float(summary['total_expense'] or 0),
-                        "net_change": float(summary['net_change'] or 0)
+                        "total_users": total_users,
+                        "total_income": float(rollup['income']),
+                        "total_expense": float(rollup['expense']),
+                        "net_change": float(rollup['net_change'])
                     },
                     "pagination": {
                         "page": page,
@@ -5231,10 +5433,15 @@ class FinanceService:
         week_start = first_day + timedelta(weeks=week - 1)
         week_end = week_start + timedelta(days=6)
 
-        with get_conn() as conn:
+        # 全量汇总读日汇总表，明细查询使用 [start, end+1) 半开区间
+        rollup = FinanceRollupService.get_points_summary('merchant', week_start, week_end)
+        range_start = datetime.combine(week_start, datetime.min.time())
+        range_end = datetime.combine(week_end, datetime.min.time()) + timedelta(days=1)
+
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
-                where_conditions = ["DATE(pl.created_at) BETWEEN %s AND %s", "pl.type = 'merchant'"]
-                params = [week_start, week_end]
+                where_conditions = ["pl.created_at >= %s AND pl.created_at < %s", "pl.type = 'merchant'"]
+                params = [range_start, range_end]
 
                 if user_id:
                     where_conditions.append("pl.user_id = %s")
@@ -5242,10 +5449,13 @@ class FinanceService:
 
                 where_sql = " AND ".join(where_conditions)
 
-                # 总记录数
-                count_sql = f"SELECT COUNT(*) as total FROM points_log pl WHERE {where_sql}"
-                cur.execute(count_sql, tuple(params))
-                total_count = cur.fetchone()['total'] or 0
+                # 总记录数（不限用户时直接取日汇总条数）
+                if user_id:
+                    count_sql = f"SELECT COUNT(*) as total FROM points_log pl WHERE {where_sql}"
+                    cur.execute(count_sql, tuple(params))
+                    total_count = cur.fetchone()['total'] or 0
+                else:
+                    total_count = rollup['log_count']
 
                 # 明细
                 offset = (page - 1) * page_size
@@ -5263,20 +5473,13 @@ class FinanceService:
                 cur.execute(detail_sql, tuple(params))
                 records = cur.fetchall()
 
-                # 汇总
-                summary_sql = f"""
-                    SELECT COUNT(DISTINCT pl.user_id) as total_users,
-                           SUM(CASE WHEN pl.change_amount > 0 THEN pl.change_amount ELSE 0 END) as total_income,
-                           SUM(CASE WHEN pl.change_amount < 0 THEN ABS(pl.change_amount) ELSE 0 END) as total_expense,
-                           SUM(pl.change_amount) as net_change
-                    FROM points_log pl
-                    WHERE {where_sql.replace(' AND pl.user_id = %s', '') if user_id else where_sql}
-                """
-                if user_id:
-                    cur.execute(summary_sql, (week_start, week_end))
-                else:
-                    cur.execute(summary_sql, tuple(params[:-2]))
-                summary = cur.fetchone()
+                # 汇总：金额取日汇总，仅活跃用户数需查原始流水
+                cur.execute(
+                    "SELECT COUNT(DISTINCT pl.user_id) AS total_users FROM points_log pl "
+                    "WHERE pl.created_at >= %s AND pl.created_at < %s AND pl.type = 'merchant'",
+                    (range_start, range_end)
+                )
+                total_users = cur.fetchone()['total_users'] or 0
 
                 return {
                     "summary": {
@@ -5284,10 +5487,10 @@ class FinanceService:
                         "query_week": f"{year}-W{week:02d}",
                         "week_start": week_start.strftime("%Y-%m-%d"),
                         "week_end": week_end.strftime("%Y-%m-%d"),
-                        "total_users": summary['total_users'] or 0,
-                        "total_income": float(summary['total_income'] or 0),
-                        "total_expense": float(summary['total_expense'] or 0),
-                        "net_change": float(summary['net_change'] or 0)
+                        "total_users": total_users,
+                        "total_income": float(rollup['income']),
+                        "total_expense": float(rollup['expense']),
+                        "net_change": float(rollup['net_change'])
                     },
                     "pagination": {
                         "page": page,
@@ -5322,10 +5525,15 @@ class FinanceService:
         month_start = date(year, month, 1)
         month_end = date(year, month, last_day)
 
-        with get_conn() as conn:
+        # 全量汇总读日汇总表，明细查询使用 [start, end+1) 半开区间
+        rollup = FinanceRollupService.get_points_summary('merchant', month_start, month_end)
+        range_start = datetime.combine(month_start, datetime.min.time())
+        range_end = datetime.combine(month_end, datetime.min.time()) + timedelta(days=1)
+
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
-                where_conditions = ["DATE(pl.created_at) BETWEEN %s AND %s", "pl.type = 'merchant'"]
-                params = [month_start, month_end]
+                where_conditions = ["pl.created_at >= %s AND pl.created_at < %s", "pl.type = 'merchant'"]
+                params = [range_start, range_end]
 
                 if user_id:
                     where_conditions.append("pl.user_id = %s")
@@ -5333,10 +5541,13 @@ class FinanceService:
 
                 where_sql = " AND ".join(where_conditions)
 
-                # 总记录数
-                count_sql = f"SELECT COUNT(*) as total FROM points_log pl WHERE {where_sql}"
-                cur.execute(count_sql, tuple(params))
-                total_count = cur.fetchone()['total'] or 0
+                # 总记录数（不限用户时直接取日汇总条数）
+                if user_id:
+                    count_sql = f"SELECT COUNT(*) as total FROM points_log pl WHERE {where_sql}"
+                    cur.execute(count_sql, tuple(params))
+                    total_count = cur.fetchone()['total'] or 0
+                else:
+                    total_count = rollup['log_count']
 
                 # 明细
                 offset = (page - 1) * page_size
@@ -5354,20 +5565,13 @@ class FinanceService:
                 cur.execute(detail_sql, tuple(params))
                 records = cur.fetchall()
 
-                # 汇总
-                summary_sql = f"""
-                    SELECT COUNT(DISTINCT pl.user_id) as total_users,
-                           SUM(CASE WHEN pl.change_amount > 0 THEN pl.change_amount ELSE 0 END) as total_income,
-                           SUM(CASE WHEN pl.change_amount < 0 THEN ABS(pl.change_amount) ELSE 0 END) as total_expense,
-                           SUM(pl.change_amount) as net_change
-                    FROM points_log pl
-                    WHERE {where_sql.replace(' AND pl.user_id = %s', '') if user_id else where_sql}
-                """
-                if user_id:
-                    cur.execute(summary_sql, (month_start, month_end))
-                else:
-                    cur.execute(summary_sql, tuple(params[:-2]))
-                summary = cur.fetchone()
+                # 汇总：金额取日汇总，仅活跃用户数需查原始流水
+                cur.execute(
+                    "SELECT COUNT(DISTINCT pl.user_id) AS total_users FROM points_log pl "
+                    "WHERE pl.created_at >= %s AND pl.created_at < %s AND pl.type = 'merchant'",
+                    (range_start, range_end)
+                )
+                total_users = cur.fetchone()['total_users'] or 0
 
                 return {
                     "summary": {
@@ -5375,10 +5579,10 @@ class FinanceService:
                         "query_month": f"{year}-{month:02d}",
                         "month_start": month_start.strftime("%Y-%m-%d"),
                         "month_end": month_end.strftime("%Y-%m-%d"),
-                        "total_users": summary['total_users'] or 0,
-                        "total_income": float(summary['total_income'] or 0),
-                        "total_expense": float(summary['total_expense'] or 0),
-                        "net_change": float(summary['net_change'] or 0)
+                        "total_users": total_users,
+                        "total_income": float(rollup['income']),
+                        "total_expense": float(rollup['expense']),
+                        "net_change": float(rollup['net_change'])
                     },
                     "pagination": {
                         "page": page,
@@ -5417,7 +5621,7 @@ class FinanceService:
         week_start = first_day + timedelta(weeks=week - 1)
         week_end = week_start + timedelta(days=6)
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 1. 获取补贴池余额
                 pool_balance = self.get_account_balance('subsidy_pool')
@@ -5622,11 +5826,14 @@ class FinanceService:
         """
         logger.info(f"生成订单积分流水报告: 日期范围={start_date}至{end_date}, 用户={user_id}, 订单号={order_no}")
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 1. 构建WHERE条件
-                where_conditions = ["DATE(o.created_at) BETWEEN %s AND %s"]
-                params = [start_date, end_date]
+                date_sql, date_params = build_date_range("o.created_at", start_date, end_date)
+                where_conditions = ["1=1"]
+                if date_sql:
+                    where_conditions.append(date_sql)
+                params = list(date_params)
 
                 if user_id:
                     where_conditions.append("o.user_id = %s")
@@ -5839,7 +6046,7 @@ class FinanceService:
         """
         logger.info(f"生成纯点数流水报表: 用户={user_id or '所有用户'}")
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # 构建用户查询条件
                 user_where = "WHERE u.id = %s" if user_id else ""
@@ -6020,7 +6227,7 @@ class FinanceService:
         """查询周补贴点数明细报表"""
         logger.info(f"生成周补贴点数报表: 用户={user_id or '所有用户'}")
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 user_where = "WHERE u.id = %s" if user_id else ""
                 user_params = [user_id] if user_id else []
@@ -6084,7 +6291,7 @@ class FinanceService:
         """查询联创星级点数明细报表"""
         logger.info(f"生成联创星级点数报表: 用户={user_id or '所有用户'}")
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 user_where = "WHERE u.id = %s" if user_id else ""
                 user_params = [user_id] if user_id else []
@@ -6155,7 +6362,7 @@ class FinanceService:
         """
         logger.info(f"生成推荐+团队合并点数报表: 用户={user_id or '所有用户'}")
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 user_where = "WHERE u.id = %s" if user_id else ""
                 user_params = [user_id] if user_id else []
@@ -6268,7 +6475,7 @@ class FinanceService:
         """
         logger.info(f"生成综合点数流水报表: 用户={user_id or '所有用户'}, 日期={start_date}至{end_date}")
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # ==================== 1. 构建查询参数（统一处理） ====================
                 params_account_flow = []
@@ -6282,15 +6489,16 @@ class FinanceService:
                     where_wsr.append("wsr.user_id = %s")
                     params_wsr.append(user_id)
 
+                date_sql, date_params = build_date_range("af.created_at", start_date, end_date)
+                if date_sql:
+                    where_af.append(date_sql)
+                    params_account_flow.extend(date_params)
+
                 if start_date:
-                    where_af.append("DATE(af.created_at) >= %s")
-                    params_account_flow.append(start_date)
                     where_wsr.append("DATE(wsr.week_start) >= %s")
                     params_wsr.append(start_date)
 
                 if end_date:
-                    where_af.append("DATE(af.created_at) <= %s")
-                    params_account_flow.append(end_date)
                     where_wsr.append("DATE(wsr.week_start) <= %s")
                     params_wsr.append(end_date)
 
@@ -6624,6 +6832,48 @@ class FinanceService:
             logger.error(f"❌ 用户 {user_id} 捐赠失败: {e}")
             raise FinanceException(f"捐赠失败: {e}")
 
+    # 平台综合流水涉及的资金池及展示名称（顺序即报表展示顺序）
+    PLATFORM_FLOW_POOLS = {
+        "platform_revenue_pool": "平台收入池",  # 平台收入池（源头）
+        "public_welfare": "公益基金",
+        "subsidy_pool": "周补贴池",
+        "honor_director": "荣誉董事分红池",
+        "company_points": "公司积分池",
+        "maintain_pool": "平台维护池",
+        "director_pool": "荣誉董事池",
+        "shop_pool": "社区店池",
+        "city_pool": "城市运营中心池",
+        "branch_pool": "大区分公司池",
+        "fund_pool": "事业发展基金池",
+    }
+
+    @staticmethod
+    def _encode_flow_cursor(row: Dict[str, Any]) -> str:
+        return f"{row['created_at'].strftime('%Y-%m-%d %H:%M:%S')}|{row['src']}|{row['ref_id']}|{row['sub']}"
+
+    @staticmethod
+    def _decode_flow_cursor(cursor: str) -> tuple:
+        try:
+            ts, src, ref_id, sub = cursor.split("|")
+            return datetime.strptime(ts, "%Y-%m-%d %H:%M:%S"), int(src), int(ref_id), int(sub)
+        except (ValueError, AttributeError):
+            raise FinanceException("分页游标无效")
+
+    @staticmethod
+    def _flow_keyset_predicate(alias: str, src: int, sub: int, decoded: Optional[tuple]) -> tuple:
+        """把 (created_at, src, ref_id, sub) < 游标 改写为单个分支（src/sub 为常量）上的 (created_at, id) 条件"""
+        if decoded is None:
+            return "", []
+        ts, cur_src, cur_ref, cur_sub = decoded
+        if src < cur_src:
+            return f" AND {alias}.created_at <= %s", [ts]
+        if src > cur_src:
+            return f" AND {alias}.created_at < %s", [ts]
+        # 同一来源：子序号更小时同一 ref_id 也在游标之后
+        bound = cur_ref + 1 if sub < cur_sub else cur_ref
+        return (f" AND ({alias}.created_at < %s OR ({alias}.created_at = %s AND {alias}.id < %s))",
+                [ts, ts, bound])
+
     def get_platform_flow_summary(
             self,
             start_date: str,
@@ -6631,253 +6881,166 @@ class FinanceService:
             user_id: Optional[int] = None,
             include_detail: bool = True,
             page: int = 1,
-            page_size: int = 50
+            page_size: int = 50,
+            cursor: Optional[str] = None
     ) -> Dict[str, Any]:
         """
         平台综合流水报表（整合所有资金池、订单、积分流水）
 
-        整合逻辑：
-        1. 查询所有资金池的汇总和明细
-        2. 查询订单相关的积分和资金流动
-        3. 查询提现申请处理情况
-        4. 合并所有流水，按时间倒序排列
-        5. 计算总体统计和趋势分析
+        整合逻辑（单连接，内存占用与日期范围无关）：
+        1. 资金池汇总：account_flow 一次 GROUP BY account_type，期末余额一次查询
+        2. 明细：资金池流水与订单派生流水（平台收入/积分抵扣/用户获得积分）合并为一条 UNION ALL 查询，
+           按 (created_at, 来源, 关联ID, 子序号) 倒序，数据库端排序分页
+        3. 分页：传 cursor（上一页返回的 next_cursor）走键集分页；否则按 page 偏移分页。
+           游标条件与 LIMIT 下推到每个 UNION 分支，外层只归并各分支的前 N 行；总数只在首页计算
         """
         logger.info(
             f"生成平台综合流水报表: 日期范围={start_date}至{end_date}, "
             f"用户={user_id or '所有用户'}, 包含明细={include_detail}"
         )
 
-        from datetime import datetime, date
-        import itertools
-
-        # ==================== 1. 定义所有资金池类型 ====================
-        all_pool_types = [
-            'platform_revenue_pool',  # 平台收入池（源头）
-            'public_welfare',  # 公益基金
-            'subsidy_pool',  # 周补贴池
-            'honor_director',  # 荣誉董事分红池
-            'company_points',  # 公司积分池
-            'maintain_pool',  # 平台维护池
-            'director_pool',  # 荣誉董事池
-            'shop_pool',  # 社区店池
-            'city_pool',  # 城市运营中心池
-            'branch_pool',  # 大区分公司池
-            'fund_pool'  # 事业发展基金池
-        ]
-
-        # ==================== 2. 并行查询所有资金池数据 ====================
-        pools_summary = {}
-        all_raw_flows = []
-
-        for pool_type in all_pool_types:
-            try:
-                # 查询资金池汇总（不获取明细，只获取汇总）
-                with get_conn() as conn:
-                    with conn.cursor() as cur:
-                        # 构建WHERE条件
-                        where_conditions = [
-                            "account_type = %s",
-                            "DATE(created_at) BETWEEN %s AND %s"
-                        ]
-                        params = [pool_type, start_date, end_date]
-
-                        # 只有联创分红池过滤 related_user=NULL
-                        if pool_type == 'honor_director':
-                            where_conditions.append("related_user IS NULL")
-
-                        # 用户筛选（如果指定了user_id）
-                        if user_id:
-                            where_conditions.append("related_user = %s")
-                            params.append(user_id)
-
-                        where_sql = " AND ".join(where_conditions)
-
-                        # 查询汇总
-                        summary_sql = f"""
-                            SELECT 
-                                COUNT(*) as total_transactions,
-                                SUM(CASE WHEN flow_type = 'income' THEN change_amount ELSE 0 END) as total_income,
-                                SUM(CASE WHEN flow_type = 'expense' THEN change_amount ELSE 0 END) as total_expense,
-                                SUM(change_amount) as net_change
-                            FROM account_flow
-                            WHERE {where_sql}
-                        """
-                        cur.execute(summary_sql, tuple(params))
-                        summary = cur.fetchone()
-
-                        # 查询期末余额
-                        cur.execute(
-                            "SELECT balance FROM finance_accounts WHERE account_type = %s",
-                            (pool_type,)
-                        )
-                        balance_row = cur.fetchone()
-                        ending_balance = Decimal(str(balance_row['balance'] if balance_row else 0))
-
-                        # 添加到汇总
-                        account_name_map = {
-                            "platform_revenue_pool": "平台收入池",
-                            "public_welfare": "公益基金",
-                            "subsidy_pool": "周补贴池",
-                            "honor_director": "荣誉董事分红池",
-                            "company_points": "公司积分池",
-                            "maintain_pool": "平台维护池",
-                            "director_pool": "荣誉董事池",
-                            "shop_pool": "社区店池",
-                            "city_pool": "城市运营中心池",
-                            "branch_pool": "大区分公司池",
-                            "fund_pool": "事业发展基金池"
-                        }
-
-                        pools_summary[pool_type] = {
-                            "account_name": account_name_map.get(pool_type, pool_type),
-                            "total_transactions": summary['total_transactions'] or 0,
-                            "total_income": float(summary['total_income'] or 0),
-                            "total_expense": float(summary['total_expense'] or 0),
-                            "net_change": float(summary['net_change'] or 0),
-                            "ending_balance": float(ending_balance)
-                        }
-
-                        # 如果需要明细，查询原始流水
-                        if include_detail:
-                            # 查询所有流水（不分页，后续统一分页）
-                            detail_sql = f"""
-                                SELECT 
-                                    id as flow_id,
-                                    related_user,
-                                    change_amount,
-                                    balance_after,
-                                    flow_type,
-                                    remark,
-                                    created_at,
-                                    %s as account_type
-                                FROM account_flow
-                                WHERE {where_sql}
-                                ORDER BY created_at DESC
-                            """
-                            cur.execute(detail_sql, tuple([pool_type] + params))
-                            flows = cur.fetchall()
-                            all_raw_flows.extend(flows)
-
-            except Exception as e:
-                logger.warning(f"查询资金池 {pool_type} 数据失败: {e}")
-                continue
+        pool_types = list(self.PLATFORM_FLOW_POOLS)
+        pool_placeholders = ",".join(["%s"] * len(pool_types))
 
-        # ==================== 3. 查询订单相关流水（积分抵扣、用户支付） ====================
-        order_flows = []
-        if include_detail:
-            try:
-                # 使用已有的 get_order_points_flow_report 逻辑
-                order_data = self.get_order_points_flow_report(
-                    start_date=start_date,
-                    end_date=end_date,
-                    user_id=user_id,
-                    order_no=None,
-                    page=1,
-                    page_size=10000  # 获取所有记录用于合并
-                )
-
-                # 转换订单流水格式，与资金池流水统一
-                for record in order_data['records']:
-                    # 用户积分获得（收入）
-                    if record['user_points_earned'] > 0:
-                        order_flows.append({
-                            'flow_id': f"order_{record['order_id']}_user_points",
-                            'related_user': record['user_id'],
-                            'change_amount': Decimal(str(record['user_points_earned'])),
-                            'balance_after': None,  # 订单流水不记录余额
-                            'flow_type': 'income',
-                            'remark': f"订单#{record['order_no']} 用户获得积分{record['user_points_earned']:.4f}",
-                            'created_at': datetime.strptime(record['created_at'], "%Y-%m-%d %H:%M:%S"),
-                            'account_type': 'order_related'
-                        })
-
-                    # 积分抵扣（支出）
-                    if record['points_deduction'] > 0:
-                        order_flows.append({
-                            'flow_id': f"order_{record['order_id']}_points_deduction",
-                            'related_user': record['user_id'],
-                            'change_amount': -Decimal(str(record['points_deduction'])),
-                            'balance_after': None,
-                            'flow_type': 'expense',
-                            'remark': f"订单#{record['order_no']} 积分抵扣¥{record['points_deduction']:.2f}",
-                            'created_at': datetime.strptime(record['created_at'], "%Y-%m-%d %H:%M:%S"),
-                            'account_type': 'order_related'
-                        })
-
-                    # 平台收入（源头）
-                    order_flows.append({
-                        'flow_id': f"order_{record['order_id']}_platform_income",
-                        'related_user': record['user_id'],
-                        'change_amount': Decimal(str(record['net_sales'])),
-                        'balance_after': None,
-                        'flow_type': 'income',
-                        'remark': f"订单#{record['order_no']} 平台收入¥{record['net_sales']:.2f}（总销售额）",
-                        'created_at': datetime.strptime(record['created_at'], "%Y-%m-%d %H:%M:%S"),
-                        'account_type': 'order_related'
-                    })
+        # 资金池流水条件：联创分红池只统计 related_user 为空的池子流水
+        af_date_sql, af_date_params = build_date_range("af.created_at", start_date, end_date)
+        af_where = [
+            f"af.account_type IN ({pool_placeholders})",
+            "(af.account_type <> 'honor_director' OR af.related_user IS NULL)",
+        ]
+        if af_date_sql:
+            af_where.append(af_date_sql)
+        af_params: List[Any] = [*pool_types, *af_date_params]
+        if user_id:
+            af_where.append("af.related_user = %s")
+            af_params.append(user_id)
+        af_where_sql = " AND ".join(af_where)
+
+        # 订单派生流水条件（与 get_order_points_flow_report 一致）
+        o_date_sql, o_date_params = build_date_range("o.created_at", start_date, end_date)
+        o_where = ["1=1"]
+        if o_date_sql:
+            o_where.append(o_date_sql)
+        o_params: List[Any] = list(o_date_params)
+        if user_id:
+            o_where.append("o.user_id = %s")
+            o_params.append(user_id)
+        o_where_sql = " AND ".join(o_where)
 
-            except Exception as e:
-                logger.warning(f"查询订单相关流水失败: {e}")
+        pools_summary: Dict[str, Dict[str, Any]] = {}
+        paged_flows: List[Dict[str, Any]] = []
+        # 仅首页返回总数；翻页（游标或 page>1）时为 None，前端沿用首页的总数
+        total_records: Optional[int] = 0 if (not include_detail or (not cursor and page == 1)) else None
+        next_cursor = None
 
-        # ==================== 4. 合并所有流水并统一格式 ====================
-        all_flows = []
+        with get_conn(readonly=True) as conn:
+            with conn.cursor() as cur:
+                # ==================== 1. 资金池汇总（一次分组查询） ====================
+                cur.execute(f"""
+                    SELECT af.account_type,
+                           COUNT(*) AS total_transactions,
+                           SUM(CASE WHEN af.flow_type = 'income' THEN af.change_amount ELSE 0 END) AS total_income,
+                           SUM(CASE WHEN af.flow_type = 'expense' THEN af.change_amount ELSE 0 END) AS total_expense,
+                           SUM(af.change_amount) AS net_change
+                    FROM account_flow af
+                    WHERE {af_where_sql}
+                    GROUP BY af.account_type
+                """, tuple(af_params))
+                grouped = {row['account_type']: row for row in cur.fetchall()}
 
-        # 处理资金池流水
-        for flow in all_raw_flows:
-            try:
-                # 确保 created_at 是 datetime 对象
-                created_at = flow['created_at']
-                if isinstance(created_at, str):
-                    created_at = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")
-                elif isinstance(created_at, date) and not hasattr(created_at, 'hour'):
-                    created_at = datetime.combine(created_at, datetime.min.time())
-
-                # 智能识别资金流向类型
-                remark = flow['remark']
-                flow_category = self._classify_flow_type(
-                    account_type=flow['account_type'],
-                    flow_type=flow['flow_type'],
-                    remark=remark
+                cur.execute(
+                    f"SELECT account_type, balance FROM finance_accounts WHERE account_type IN ({pool_placeholders})",
+                    tuple(pool_types)
                 )
+                balances = {row['account_type']: row['balance'] for row in cur.fetchall()}
+
+                for pool_type, account_name in self.PLATFORM_FLOW_POOLS.items():
+                    summary = grouped.get(pool_type) or {}
+                    pools_summary[pool_type] = {
+                        "account_name": account_name,
+                        "total_transactions": summary.get('total_transactions') or 0,
+                        "total_income": float(summary.get('total_income') or 0),
+                        "total_expense": float(summary.get('total_expense') or 0),
+                        "net_change": float(summary.get('net_change') or 0),
+                        "ending_balance": float(Decimal(str(balances.get(pool_type) or 0)))
+                    }
 
-                all_flows.append({
-                    'flow_id': str(flow['flow_id']),
-                    'user_id': flow['related_user'],
-                    'user_name': self._get_user_name(flow['related_user']),
-                    'flow_type': flow_category['type'],
-                    'flow_category': flow_category['category'],
-                    'change_amount': float(flow['change_amount']),
-                    'balance_after': float(flow['balance_after']) if flow['balance_after'] is not None else None,
-                    'remark': remark,
-                    'created_at': created_at,
-                    'source': 'account_flow',
-                    'account_type': flow['account_type']
-                })
-            except Exception as e:
-                logger.debug(f"处理流水记录失败: {e}")
-                continue
-
-        # 添加订单流水
-        all_flows.extend(order_flows)
-
-        # 按时间倒序排序
-        all_flows.sort(key=lambda x: x['created_at'], reverse=True)
+                if include_detail:
+                    # ==================== 2. 明细：资金池 + 订单派生流水合并排序 ====================
+                    # src: 0=资金池流水 1=订单派生；sub: 订单派生流水的子序号（0平台收入 1积分抵扣 2用户积分）
+                    # 每个分支各自按 (created_at, id) 倒序走索引取前 N 条（游标条件也下推到分支内），
+                    # 外层只对最多 4×N 行归并排序，不再物化整个日期范围
+                    branches = [
+                        (0, 0, """SELECT af.created_at, 0 AS src, af.id AS ref_id, 0 AS sub,
+                                         af.related_user AS user_id, af.change_amount, af.balance_after,
+                                         af.flow_type, af.remark, af.account_type, NULL AS order_number
+                                  FROM account_flow af""",
+                         af_where_sql, af_params, "af", ""),
+                        (1, 0, """SELECT o.created_at, 1, o.id, 0,
+                                         o.user_id, o.total_amount, NULL,
+                                         'income', NULL, 'order_related', o.order_number
+                                  FROM orders o JOIN users u ON o.user_id = u.id""",
+                         o_where_sql, o_params, "o", ""),
+                        (1, 1, """SELECT o.created_at, 1, o.id, 1,
+                                         o.user_id, -o.points_discount, NULL,
+                                         'expense', NULL, 'order_related', o.order_number
+                                  FROM orders o JOIN users u ON o.user_id = u.id""",
+                         f"{o_where_sql} AND o.points_discount > 0", o_params, "o", ""),
+                        (1, 2, """SELECT o.created_at, 1, o.id, 2,
+                                         o.user_id, SUM(pl.change_amount), NULL,
+                                         'income', NULL, 'order_related', o.order_number
+                                  FROM orders o JOIN users u ON o.user_id = u.id
+                                  JOIN points_log pl ON pl.related_order = o.id AND pl.type = 'member'
+                                                    AND pl.change_amount > 0""",
+                         o_where_sql, o_params, "o", "GROUP BY o.id"),
+                    ]
 
-        # ==================== 5. 分页处理 ====================
-        total_records = len(all_flows)
-        total_pages = (total_records + page_size - 1) // page_size if total_records > 0 else 1
-        offset = (page - 1) * page_size
+                    # 总数只在首页计算（各分支分别计数再相加，不物化 UNION）
+                    if not cursor and page == 1:
+                        count_parts = []
+                        count_params: List[Any] = []
+                        for src, sub, select_sql, where_sql, params, alias, group_by in branches:
+                            from_sql = select_sql[select_sql.index("FROM"):]
+                            counted = f"DISTINCT {alias}.id" if group_by else "*"
+                            count_parts.append(f"(SELECT COUNT({counted}) {from_sql} WHERE {where_sql})")
+                            count_params.extend(params)
+                        cur.execute(f"SELECT {' + '.join(count_parts)} AS total", tuple(count_params))
+                        total_records = int(cur.fetchone()['total'] or 0)
+
+                    decoded = self._decode_flow_cursor(cursor) if cursor else None
+                    branch_limit = page_size if cursor else page * page_size
+                    parts = []
+                    page_params: List[Any] = []
+                    for src, sub, select_sql, where_sql, params, alias, group_by in branches:
+                        keyset_sql, keyset_params = self._flow_keyset_predicate(alias, src, sub, decoded)
+                        parts.append(
+                            f"({select_sql} WHERE {where_sql}{keyset_sql} {group_by} "
+                            f"ORDER BY {alias}.created_at DESC, {alias}.id DESC LIMIT %s)"
+                        )
+                        page_params.extend([*params, *keyset_params, branch_limit])
+                    page_sql = (f"SELECT * FROM ({' UNION ALL '.join(parts)}) AS flows "
+                                f"ORDER BY created_at DESC, src DESC, ref_id DESC, sub DESC LIMIT %s")
+                    page_params.append(page_size)
+                    if not cursor:
+                        page_sql += " OFFSET %s"
+                        page_params.append((page - 1) * page_size)
+
+                    cur.execute(page_sql, tuple(page_params))
+                    rows = cur.fetchall()
+                    if len(rows) == page_size:
+                        next_cursor = self._encode_flow_cursor(rows[-1])
 
-        paged_flows = all_flows[offset:offset + page_size]
+                    user_names = UserDisplayService.get_names((row['user_id'] for row in rows), cur)
+                    for row in rows:
+                        paged_flows.append(self._format_platform_flow(row, user_names))
 
-        # ==================== 6. 计算总体统计 ====================
-        grand_total_income = sum(
-            pool['total_income'] for pool in pools_summary.values()
-        )
-        grand_total_expense = sum(
-            pool['total_expense'] for pool in pools_summary.values()
-        )
+        # ==================== 3. 计算总体统计 ====================
+        if total_records is None:
+            total_pages = None
+        else:
+            total_pages = (total_records + page_size - 1) // page_size if total_records > 0 else 1
+        grand_total_income = sum(pool['total_income'] for pool in pools_summary.values())
+        grand_total_expense = sum(pool['total_expense'] for pool in pools_summary.values())
         grand_net_change = grand_total_income - grand_total_expense
 
         # 活跃资金池数量（有余额或有交易的）
@@ -6886,7 +7049,7 @@ class FinanceService:
             if pool['ending_balance'] > 0 or pool['total_transactions'] > 0
         )
 
-        # ==================== 7. 组装最终报表 ====================
+        # ==================== 4. 组装最终报表 ====================
         result = {
             "summary": {
                 "report_type": "platform_flow_summary",
@@ -6909,10 +7072,11 @@ class FinanceService:
                 "page_size": page_size,
                 "total": total_records,
                 "total_pages": total_pages,
-                "has_next": page < total_pages,
-                "has_prev": page > 1
+                "has_next": next_cursor is not None,
+                "has_prev": page > 1 or bool(cursor),
+                "next_cursor": next_cursor
             },
-            "flows": paged_flows if include_detail else [],
+            "flows": paged_flows,
             "data_sources": [
                 "account_flow（资金池流水）",
                 "orders + points_log（订单相关流水）"
@@ -6920,12 +7084,51 @@ class FinanceService:
         }
 
         logger.info(
-            f"平台综合流水报表生成完成: {total_records}笔交易, "
+            f"平台综合流水报表生成完成: 第{page}页{len(paged_flows)}笔, "
             f"净流量¥{grand_net_change:.2f}, {active_pools}个活跃资金池"
         )
 
         return result
 
+    def _format_platform_flow(self, row: Dict[str, Any], user_names: Dict[int, str]) -> Dict[str, Any]:
+        """把合并查询的一行转换为报表流水格式"""
+        change_amount = Decimal(str(row['change_amount'] or 0))
+        if row['src'] == 0:
+            flow_id = str(row['ref_id'])
+            remark = row['remark'] or ""
+            source = 'account_flow'
+        else:
+            order_no = row['order_number']
+            if row['sub'] == 0:
+                flow_id = f"order_{row['ref_id']}_platform_income"
+                remark = f"订单#{order_no} 平台收入¥{change_amount:.2f}（总销售额）"
+            elif row['sub'] == 1:
+                flow_id = f"order_{row['ref_id']}_points_deduction"
+                remark = f"订单#{order_no} 积分抵扣¥{-change_amount:.2f}"
+            else:
+                flow_id = f"order_{row['ref_id']}_user_points"
+                remark = f"订单#{order_no} 用户获得积分{change_amount:.4f}"
+            source = 'orders'
+
+        flow_category = self._classify_flow_type(
+            account_type=row['account_type'],
+            flow_type=row['flow_type'],
+            remark=remark
+        )
+        return {
+            'flow_id': flow_id,
+            'user_id': row['user_id'],
+            'user_name': UserDisplayService.display_name(user_names, row['user_id']),
+            'flow_type': flow_category['type'],
+            'flow_category': flow_category['category'],
+            'change_amount': float(change_amount),
+            'balance_after': float(row['balance_after']) if row['balance_after'] is not None else None,
+            'remark': remark,
+            'created_at': row['created_at'],
+            'source': source,
+            'account_type': row['account_type']
+        }
+
     def _classify_flow_type(self, account_type: str, flow_type: str, remark: str) -> Dict[str, str]:
         """
         智能识别流水类型和分类
@@ -7001,27 +7204,12 @@ class FinanceService:
         }
 
     def _get_user_name(self, user_id: Optional[int]) -> str:
-        """获取用户名称（缓存优化）"""
-        if not user_id:
-            return "系统"
-
-        # 使用简单的内存缓存（在同一次请求内）
-        if not hasattr(self, '_user_name_cache'):
-            self._user_name_cache = {}
-
-        if user_id in self._user_name_cache:
-            return self._user_name_cache[user_id]
-
+        """获取单个用户名称（多条记录请用 UserDisplayService.get_names 批量解析）"""
         try:
-            with get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT name FROM users WHERE id = %s", (user_id,))
-                    row = cur.fetchone()
-                    name = row['name'] if row else f"未知用户:{user_id}"
-                    self._user_name_cache[user_id] = name
-                    return name
+            names = UserDisplayService.get_names([user_id])
         except Exception:
             return f"查询失败:{user_id}"
+        return UserDisplayService.display_name(names, user_id)
 
     # ==================== 总积分明细报表（包含member/merchant/company三种积分） ====================
     def get_all_points_detail_report(self,
@@ -7037,7 +7225,7 @@ class FinanceService:
         """
         logger.info(f"生成总积分明细报表: 用户={user_id or '所有用户'}, 日期范围={start_date}至{end_date}")
 
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 # ==================== 1. 查询 member_points 流水 ====================
                 member_where = ["pl.type = 'member'"]
@@ -7046,12 +7234,10 @@ class FinanceService:
                 if user_id:
                     member_where.append("pl.user_id = %s")
                     member_params.append(user_id)
-                if start_date:
-                    member_where.append("DATE(pl.created_at) >= %s")
-                    member_params.append(start_date)
-                if end_date:
-                    member_where.append("DATE(pl.created_at) <= %s")
-                    member_params.append(end_date)
+                date_sql, date_params = build_date_range("pl.created_at", start_date, end_date)
+                if date_sql:
+                    member_where.append(date_sql)
+                    member_params.extend(date_params)
 
                 member_sql = f"""
                     SELECT 
@@ -7075,12 +7261,10 @@ class FinanceService:
                 if user_id:
                     merchant_where.append("pl.user_id = %s")
                     merchant_params.append(user_id)
-                if start_date:
-                    merchant_where.append("DATE(pl.created_at) >= %s")
-                    merchant_params.append(start_date)
-                if end_date:
-                    merchant_where.append("DATE(pl.created_at) <= %s")
-                    merchant_params.append(end_date)
+                date_sql, date_params = build_date_range("pl.created_at", start_date, end_date)
+                if date_sql:
+                    merchant_where.append(date_sql)
+                    merchant_params.extend(date_params)
 
                 merchant_sql = f"""
                     SELECT 
@@ -7104,12 +7288,10 @@ class FinanceService:
                 if user_id:
                     company_where.append("af.related_user = %s")
                     company_params.append(user_id)
-                if start_date:
-                    company_where.append("DATE(af.created_at) >= %s")
-                    company_params.append(start_date)
-                if end_date:
-                    company_where.append("DATE(af.created_at) <= %s")
-                    company_params.append(end_date)
+                date_sql, date_params = build_date_range("af.created_at", start_date, end_date)
+                if date_sql:
+                    company_where.append(date_sql)
+                    company_params.extend(date_params)
 
                 company_sql = f"""
                     SELECT 
@@ -7151,7 +7333,9 @@ class FinanceService:
 
                 # ==================== 5. 汇总统计（各类型分别统计）====================
                 # member 汇总
-                member_count_params = [p for p in [user_id, start_date, end_date] if p]
+                summary_date_sql, summary_date_params = build_date_range("created_at", start_date, end_date)
+                summary_date_sql = f"AND {summary_date_sql}" if summary_date_sql else ""
+                member_count_params = ([user_id] if user_id else []) + summary_date_params
                 cur.execute(f"""
                     SELECT 
                         COUNT(*) as count,
@@ -7160,8 +7344,7 @@ class FinanceService:
                         SUM(change_amount) as net_change
                     FROM points_log pl
                     WHERE type = 'member' {"AND user_id = %s" if user_id else ""} 
-                    {"AND DATE(created_at) >= %s" if start_date else ""}
-                    {"AND DATE(created_at) <= %s" if end_date else ""}
+                    {summary_date_sql}
                 """, tuple(member_count_params))
                 member_summary = cur.fetchone()
 
@@ -7174,13 +7357,12 @@ class FinanceService:
                         SUM(change_amount) as net_change
                     FROM points_log pl
                     WHERE type = 'merchant' {"AND user_id = %s" if user_id else ""}
-                    {"AND DATE(created_at) >= %s" if start_date else ""}
-                    {"AND DATE(created_at) <= %s" if end_date else ""}
+                    {summary_date_sql}
                 """, tuple(member_count_params))
                 merchant_summary = cur.fetchone()
 
                 # company_points 汇总
-                company_count_params = [p for p in [user_id, start_date, end_date] if p]
+                company_count_params = ([user_id] if user_id else []) + summary_date_params
                 cur.execute(f"""
                     SELECT 
                         COUNT(*) as count,
@@ -7189,8 +7371,7 @@ class FinanceService:
                         SUM(change_amount) as net_change
                     FROM account_flow
                     WHERE account_type = 'company_points' {"AND related_user = %s" if user_id else ""}
-                    {"AND DATE(created_at) >= %s" if start_date else ""}
-                    {"AND DATE(created_at) <= %s" if end_date else ""}
+                    {summary_date_sql}
                 """, tuple(company_count_params))
                 company_summary = cur.fetchone()
 
@@ -7488,12 +7669,10 @@ class FinanceService:
                 where_conditions = ["1=1"]
                 params = []
 
-                if start_date:
-                    where_conditions.append("DATE(created_at) >= %s")
-                    params.append(start_date)
-                if end_date:
-                    where_conditions.append("DATE(created_at) <= %s")
-                    params.append(end_date)
+                date_sql, date_params = build_date_range("created_at", start_date, end_date)
+                if date_sql:
+                    where_conditions.append(date_sql)
+                    params.extend(date_params)
                 if status:
                     where_conditions.append("status = %s")
                     params.append(status)
@@ -7607,7 +7786,7 @@ class FinanceService:
         daily_sheet.title = "日报表"
 
         # ==================== 2. 获取所有资金池类型 ====================
-        with get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT account_type FROM finance_accounts")
                 all_pools = [row['account_type'] for row in cur.fetchall()]
@@ -7636,102 +7815,57 @@ class FinanceService:
 
         self._write_excel_header(daily_sheet, daily_headers)
 
-        # ==================== 4. 逐日统计（复用同一个连接） ====================
+        # ==================== 4. 逐日统计（读取日汇总表） ====================
         row_idx = 2
         daily_data = []  # 用于后续月报表
 
-        # 使用一个连接，循环内不新建
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                current_date = start_dt
-                while current_date <= end_dt:
-                    date_str = current_date.strftime("%Y-%m-%d")
-                    try:
-                        # ---------- 订单数据 ----------
-                        cur.execute("""
-                            SELECT 
-                                COUNT(*) as total_orders,
-                                SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as completed_orders,
-                                COALESCE(SUM(original_amount), 0) as total_original,
-                                COALESCE(SUM(total_amount), 0) as total_actual,
-                                COALESCE(SUM(points_discount), 0) as total_points_discount,
-                                COALESCE(SUM(coupon_discount), 0) as total_coupon_discount
-                            FROM orders
-                            WHERE DATE(created_at) = %s
-                        """, (date_str,))
-                        order_stat = cur.fetchone() or {}
-
-                        # ---------- 优惠券使用统计 ----------
-                        cur.execute("""
-                            SELECT COUNT(*) as used_count, COALESCE(SUM(amount), 0) as total_amount
-                            FROM coupons
-                            WHERE DATE(used_at) = %s AND status = 'used'
-                        """, (date_str,))
-                        coupon_stat = cur.fetchone() or {}
-
-                        # ---------- 积分变动统计 ----------
-                        cur.execute("""
-                            SELECT 
-                                SUM(CASE WHEN type = 'member' AND change_amount > 0 THEN change_amount ELSE 0 END) as member_income,
-                                SUM(CASE WHEN type = 'member' AND change_amount < 0 THEN -change_amount ELSE 0 END) as member_expense,
-                                SUM(CASE WHEN type = 'merchant' AND change_amount > 0 THEN change_amount ELSE 0 END) as merchant_income,
-                                SUM(CASE WHEN type = 'merchant' AND change_amount < 0 THEN -change_amount ELSE 0 END) as merchant_expense,
-                                SUM(CASE WHEN type = 'company' THEN change_amount ELSE 0 END) as company_net
-                            FROM points_log
-                            WHERE DATE(created_at) = %s
-                        """, (date_str,))
-                        points_stat = cur.fetchone() or {}
-
-                        # ---------- 所有资金池净变动统计 ----------
-                        pool_changes = {}
-                        for pool in pool_types:
-                            cur.execute("""
-                                SELECT COALESCE(SUM(change_amount), 0) as net_change
-                                FROM account_flow
-                                WHERE account_type = %s AND DATE(created_at) = %s
-                            """, (pool, date_str))
-                            row = cur.fetchone() or {}
-                            pool_changes[pool] = float(row.get('net_change', 0))
-
-                        # 组装行数据（所有数值字段使用 or 0 防御）
-                        row_data = [
-                            date_str,
-                            order_stat.get('total_orders') or 0,
-                            order_stat.get('completed_orders') or 0,
-                            float(order_stat.get('total_original') or 0),
-                            float(order_stat.get('total_actual') or 0),
-                            float(order_stat.get('total_points_discount') or 0),
-                            float(order_stat.get('total_coupon_discount') or 0),
-                            coupon_stat.get('used_count') or 0,
-                            float(points_stat.get('member_income') or 0),
-                            float(points_stat.get('member_expense') or 0),
-                            float(points_stat.get('merchant_income') or 0),
-                            float(points_stat.get('merchant_expense') or 0),
-                        ]
-                        # 添加各资金池净变动
-                        for pool in pool_types:
-                            row_data.append(pool_changes.get(pool, 0))
+        daily_stats = FinanceRollupService.get_daily_stats(start_dt, end_dt)
+        pool_net_changes = FinanceRollupService.get_pool_net_changes(pool_types, start_dt, end_dt, daily=daily_stats)
+        for current_date in sorted(daily_stats):
+            date_str = current_date.strftime("%Y-%m-%d")
+            stats = daily_stats[current_date]
+            order_stat = stats["order"]
+            member_stat = stats["points"].get("member") or {}
+            merchant_stat = stats["points"].get("merchant") or {}
+
+            # 组装行数据（所有数值字段使用 or 0 防御）
+            row_data = [
+                date_str,
+                order_stat.get('total_orders') or 0,
+                order_stat.get('completed_orders') or 0,
+                float(order_stat.get('total_original') or 0),
+                float(order_stat.get('total_actual') or 0),
+                float(order_stat.get('total_points_discount') or 0),
+                float(order_stat.get('total_coupon_discount') or 0),
+                order_stat.get('coupon_used_count') or 0,
+                float(member_stat.get('income') or 0),
+                float(member_stat.get('expense') or 0),
+                float(merchant_stat.get('income') or 0),
+                float(merchant_stat.get('expense') or 0),
+            ]
+            # 添加各资金池净变动
+            for pool in pool_types:
+                row_data.append(pool_net_changes[current_date].get(pool, 0))
 
-                        daily_data.append(row_data)
+            daily_data.append(row_data)
 
-                        # 写入日报表
-                        for col_idx, value in enumerate(row_data, 1):
-                            cell = daily_sheet.cell(row=row_idx, column=col_idx, value=value)
-                            if isinstance(value, (int, float)):
-                                cell.number_format = '#,##0.00'
-                        row_idx += 1
+            # 写入日报表
+            for col_idx, value in enumerate(row_data, 1):
+                cell = daily_sheet.cell(row=row_idx, column=col_idx, value=value)
+                if isinstance(value, (int, float)):
+                    cell.number_format = '#,##0.00'
+            row_idx += 1
 
-                    except Exception as e:
-                        logger.error(f"生成日报表时 {date_str} 数据失败: {e}")
-                        # 继续处理下一天
-                    current_date += timedelta(days=1)
+        # 明细查询使用 [start, end+1) 半开区间，可走 created_at / used_at 索引
+        range_start = datetime.combine(start_dt, datetime.min.time())
+        range_end = range_start + timedelta(days=(end_dt - start_dt).days + 1)
 
         # ==================== 5. 优惠券使用明细（Sheet2） ====================
         if include_detail:
             coupon_sheet = wb.create_sheet(title="优惠券使用明细")
             coupon_headers = ["优惠券ID", "用户ID", "用户姓名", "金额(元)", "适用商品范围", "使用时间", "关联订单号"]
             self._write_excel_header(coupon_sheet, coupon_headers)
-            with get_conn() as conn:
+            with get_conn(readonly=True) as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
                         SELECT c.id, c.user_id, u.name as user_name, c.amount, c.applicable_product_type, 
@@ -7739,9 +7873,9 @@ class FinanceService:
                         FROM coupons c
                         LEFT JOIN users u ON c.user_id = u.id
                         LEFT JOIN orders o ON c.used_at = o.paid_at  -- 假设订单支付时间即使用时间
-                        WHERE c.status = 'used' AND DATE(c.used_at) BETWEEN %s AND %s
+                        WHERE c.status = 'used' AND c.used_at >= %s AND c.used_at < %s
                         ORDER BY c.used_at DESC
-                    """, (start_date, end_date))
+                    """, (range_start, range_end))
                     rows = cur.fetchall()
                     for row_idx, row in enumerate(rows, 2):
                         coupon_sheet.cell(row=row_idx, column=1, value=row['id'])
@@ -7759,7 +7893,7 @@ class FinanceService:
             points_headers = ["日志ID", "用户ID", "用户姓名", "积分类型", "变动金额(元)", "变动后余额(元)", "变动类型",
                               "原因", "关联订单", "创建时间"]
             self._write_excel_header(points_sheet, points_headers)
-            with get_conn() as conn:
+            with get_conn(readonly=True) as conn:
                 with conn.cursor() as cur:
                     # 合并 points_log 和 account_flow（company_points）
                     cur.execute("""
@@ -7769,7 +7903,7 @@ class FinanceService:
                                pl.reason, pl.related_order, pl.created_at
                         FROM points_log pl
                         JOIN users u ON pl.user_id = u.id
-                        WHERE DATE(pl.created_at) BETWEEN %s AND %s
+                        WHERE pl.created_at >= %s AND pl.created_at < %s
                         UNION ALL
                         SELECT af.id, af.related_user, u.name, 'company' as points_type,
                                af.change_amount, af.balance_after,
@@ -7777,9 +7911,9 @@ class FinanceService:
                                af.remark, NULL, af.created_at
                         FROM account_flow af
                         LEFT JOIN users u ON af.related_user = u.id
-                        WHERE af.account_type = 'company_points' AND DATE(af.created_at) BETWEEN %s AND %s
+                        WHERE af.account_type = 'company_points' AND af.created_at >= %s AND af.created_at < %s
                         ORDER BY created_at DESC
-                    """, (start_date, end_date, start_date, end_date))
+                    """, (range_start, range_end, range_start, range_end))
                     rows = cur.fetchall()
                     for row_idx, row in enumerate(rows, 2):
                         points_sheet.cell(row=row_idx, column=1, value=row['id'])
@@ -7905,17 +8039,20 @@ class FinanceService:
             sheet.column_dimensions[col_letter].width = min(max_len + 2, 25)
 
     def get_system_config(self, key: str, default: Any = None) -> Any:
-        """从 system_config 表中读取配置值"""
+        """从 system_config 表中读取配置值（经 FinanceConfigCache 缓存）"""
         try:
-            with get_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT config_value FROM system_config WHERE config_key = %s", (key,))
-                    row = cur.fetchone()
-                    if row:
-                        return row['config_value']
+            value = FinanceConfigCache.get(f"system_config:{key}", lambda: self._load_system_config(key))
         except Exception as e:
             logger.error(f"读取系统配置 {key} 失败: {e}")
-        return default
+            return default
+        return default if value is None else value
+
+    def _load_system_config(self, key: str) -> Optional[str]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT config_value FROM system_config WHERE config_key = %s", (key,))
+                row = cur.fetchone()
+                return row['config_value'] if row else None
 
     def get_user_true_total_points(self, user_id: int) -> Decimal:
         """获取用户的 true_total_points 余额"""
@@ -7940,7 +8077,6 @@ class FinanceService:
         if count <= 0:
             raise FinanceException("兑换数量必须大于0")
 
-        from datetime import datetime, timedelta
         from core.config import COUPON_VALID_DAYS
 
         with get_conn() as conn:
@@ -7963,40 +8099,26 @@ class FinanceService:
                         f"用户雨点余额不足，当前 {balance:.4f}，需要 {count:.4f}"
                     )
 
-                # 2. 扣除雨点余额
-                new_balance = balance - Decimal(count)
-                cur.execute(
-                    "UPDATE users SET true_total_points = %s WHERE id = %s",
-                    (new_balance, user_id)
-                )
-
-                # 3. 批量插入优惠券
-                today = datetime.now().date()
-                valid_to = today + timedelta(days=COUPON_VALID_DAYS)
-
-                coupon_records = []
-                for _ in range(count):
-                    coupon_records.append((user_id, 'user', 1.0, 'all', today, valid_to, 'unused'))
-
-                cur.executemany(
-                    """INSERT INTO coupons 
-                       (user_id, coupon_type, amount, applicable_product_type, valid_from, valid_to, status)
-                       VALUES (%s, %s, %s, %s, %s, %s, %s)""",
-                    coupon_records
-                )
-
-                # 4. 记录流水（汇总一条）
-                cur.execute(
-                    """INSERT INTO account_flow 
-                       (account_type, related_user, change_amount, balance_after, flow_type, remark, created_at)
-                       VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
-                    ('true_total_points', user_id, -count, new_balance, 'expense',
-                     f"兑换{count}张1元优惠券")
+                # 2. 扣除雨点余额、批量插入优惠券、记录流水（汇总一条）
+                self._issue_coupons_bulk(
+                    cur, {user_id: count}, {user_id: balance}, Decimal('1'),
+                    'user', 'all', COUPON_VALID_DAYS,
+                    flow_remark=lambda n, ids: f"兑换{n}张1元优惠券",
                 )
 
                 conn.commit()
                 return count
 
+    def _exchange_coupons_locked(self, cur, user_ids: List[int], limit: int,
+                                 valid_days: int) -> Dict[int, List[int]]:
+        """锁定用户并按 min(floor(雨点余额), 上限) 兑换1元优惠券（调用方负责提交/回滚）"""
+        balances = self._lock_true_total_points(cur, user_ids)
+        grants = {uid: min(int(balance), limit) for uid, balance in balances.items()}
+        return self._issue_coupons_bulk(
+            cur, grants, balances, Decimal('1'), 'user', 'all', valid_days,
+            flow_remark=lambda n, ids: f"兑换{n}张1元优惠券",
+        )
+
     def batch_exchange_coupons(self, max_per_user: Optional[int] = None) -> Dict[str, Any]:
         """
         批量将所有有雨点的用户雨点兑换为1元优惠券。
@@ -8011,87 +8133,90 @@ class FinanceService:
             统计结果字典
         """
         from core.config import COUPON_VALID_DAYS
-        from datetime import datetime, timedelta
-
-        # 获取所有 true_total_points > 0 的用户
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT id FROM users WHERE true_total_points > 0")
-                rows = cur.fetchall()
-                user_ids = [row['id'] for row in rows]
-
-        if not user_ids:
-            return {
-                'success_count': 0,
-                'total_users': 0,
-                'failed_users': [],
-                'total_coupons_issued': 0,
-                'message': '没有符合条件的用户'
-            }
-
-        success_count = 0
-        failed_users = []
-        total_coupons_issued = 0
 
         # 如果未指定 max_per_user，则使用系统上限
-        use_system_limit = max_per_user is None
-        if use_system_limit:
+        if max_per_user is None:
             max_count_str = self.get_system_config('coupon_exchange_max_count', default='10')
             try:
-                max_count = int(max_count_str)
+                limit = int(max_count_str)
             except (TypeError, ValueError):
-                max_count = 10
+                limit = 10
         else:
             # 防御：手动输入数量不能超过 1000（可根据需要调整）
-            if max_per_user > 1000:
-                max_per_user = 1000
-            if max_per_user <= 0:
+            limit = min(max_per_user, 1000)
+            if limit <= 0:
+                with get_conn() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT COUNT(*) AS cnt FROM users WHERE true_total_points > 0")
+                        total_users = int(cur.fetchone()['cnt'] or 0)
                 return {
                     'success_count': 0,
-                    'total_users': len(user_ids),
+                    'total_users': total_users,
                     'failed_users': [],
                     'total_coupons_issued': 0,
                     'message': '无效的兑换数量，必须大于0'
                 }
 
-        # 分批处理，避免单次事务过长
-        batch_size = 100
-        for i in range(0, len(user_ids), batch_size):
-            batch = user_ids[i:i + batch_size]
-            for user_id in batch:
-                try:
-                    # 获取用户雨点余额
-                    balance = self.get_user_true_total_points(user_id)
-                    if balance <= 0:
-                        continue
-
-                    # 计算应兑换张数
-                    if use_system_limit:
-                        count = int(balance)
-                        if count > max_count:
-                            count = max_count
-                    else:
-                        count = min(int(balance), max_per_user)
-
-                    if count <= 0:
-                        continue
+        success_count = 0
+        failed_users = []
+        total_coupons_issued = 0
+        total_users = 0
 
-                    # 调用已有兑换方法
-                    actual = self.exchange_coupons(user_id, count)
-                    success_count += 1
-                    total_coupons_issued += actual
+        # 按 id 分批，每批 COUPON_BULK_USER_CHUNK 个用户一个事务：一次加锁、一次扣减、一次插入
+        last_id = 0
+        while True:
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """SELECT id FROM users
+                           WHERE id > %s AND true_total_points > 0
+                           ORDER BY id LIMIT %s""",
+                        (last_id, COUPON_BULK_USER_CHUNK)
+                    )
+                    batch = [int(row['id']) for row in cur.fetchall()]
+                    if not batch:
+                        break
+                    last_id = batch[-1]
+                    total_users += len(batch)
 
-                except Exception as e:
-                    logger.error(f"批量兑换失败 - 用户{user_id}: {e}")
-                    failed_users.append({'user_id': user_id, 'reason': str(e)})
+                    try:
+                        issued = self._exchange_coupons_locked(cur, batch, limit, COUPON_VALID_DAYS)
+                        conn.commit()
+                    except Exception as e:
+                        conn.rollback()
+                        logger.warning(f"批量兑换失败，改为逐个用户处理 - 用户{batch[0]}~{batch[-1]}: {e}")
+                        issued = None
+
+            if issued is None:
+                # 整批回滚后逐个用户各自一个事务，单个用户出错不影响同批其他人
+                issued = {}
+                for uid in batch:
+                    try:
+                        with get_conn() as conn:
+                            with conn.cursor() as cur:
+                                issued.update(self._exchange_coupons_locked(cur, [uid], limit, COUPON_VALID_DAYS))
+                                conn.commit()
+                    except Exception as e:
+                        logger.error(f"批量兑换失败 - 用户{uid}: {e}")
+                        failed_users.append({'user_id': uid, 'reason': str(e)})
 
+            success_count += len(issued)
+            total_coupons_issued += sum(len(ids) for ids in issued.values())
             # 每批提交后休息一下，避免数据库压力
-            import time
             time.sleep(0.1)
 
+        if total_users == 0:
+            return {
+                'success_count': 0,
+                'total_users': 0,
+                'failed_users': [],
+                'total_coupons_issued': 0,
+                'message': '没有符合条件的用户'
+            }
+
         return {
             'success_count': success_count,
-            'total_users': len(user_ids),
+            'total_users': total_users,
             'failed_users': failed_users,
             'total_coupons_issued': total_coupons_issued,
             'message': f'批量兑换完成，成功{success_count}人，失败{len(failed_users)}人，共发放{total_coupons_issued}张优惠券'
@@ -8201,16 +8326,17 @@ def _execute_split(cur, order_number: str, total: Decimal):
         "UPDATE users SET merchant_balance=merchant_balance+%s WHERE id=1",
         (merchant,)
     )
-    # 记录完整支付链路（100% 收入 → 80% 商家 + 20% 各池）
-    svc = FinanceService()
+    # 分账流水统一关联订单，退款回冲按 related_order_id 汇总
+    order_id = FlowRefService.order_id_by_number(cur, order_number)
+
+    # 记录完整支付链路（100% 收入 → 80% 商家 + 20% 各池），资金池变动一次加锁批量落账
+    ledger = PoolLedger(related_order_id=order_id, ref_type=REF_ORDER_SPLIT)
 
     # ① 平台收入池 +100%
-    svc._add_pool_balance(cur, 'platform_revenue_pool', total,
-                          f"订单分账: {order_number} 用户支付¥{total:.2f}", None)
+    ledger.add('platform_revenue_pool', total, f"订单分账: {order_number} 用户支付¥{total:.2f}")
 
     # ② 平台收入池 -80%（商家部分）
-    svc._add_pool_balance(cur, 'platform_revenue_pool', -merchant,
-                          f"订单分账: {order_number} 商家结算¥{merchant:.2f}", None)
+    ledger.add('platform_revenue_pool', -merchant, f"订单分账: {order_number} 商家结算¥{merchant:.2f}")
 
     # ③ 各子池 20% 支出（已在下方 for 循环里记收入，保持不动）
     # 获取商家余额
@@ -8226,9 +8352,11 @@ def _execute_split(cur, order_number: str, total: Decimal):
 
     # 记录商家流水到 account_flow
     cur.execute(
-        """INSERT INTO account_flow (account_type, change_amount, balance_after, flow_type, remark, created_at)
-           VALUES (%s, %s, %s, %s, %s, NOW())""",
-        ("merchant_balance", merchant, merchant_balance_after, "income", f"订单分账: {order_number}")
+        """INSERT INTO account_flow (account_type, change_amount, balance_after, flow_type, remark,
+                                     related_order_id, ref_type, created_at)
+           VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())""",
+        ("merchant_balance", merchant, merchant_balance_after, "income", f"订单分账: {order_number}",
+         order_id, REF_ORDER_SPLIT)
     )
 
     # 按每个子池的配置分配（allocs 中的键是 account_type）
@@ -8250,64 +8378,61 @@ def _execute_split(cur, order_number: str, total: Decimal):
     for account_type, ratio in pools_to_assign.items():
         if account_type == 'public_welfare':
             continue  # ← 新增：不再重复写公益基金
-        try:
-            amt = total * ratio
-            # 单元级日志：准备分配到指定资金池的金额与比例
-            logger.debug(f"_execute_split allocating to {account_type}: ratio={ratio} amt={amt:.2f}")
-
-            # 确保 finance_accounts 中存在该账户类型
-            cur.execute(
-                "INSERT INTO finance_accounts (account_name, account_type, balance) VALUES (%s, %s, 0) ON DUPLICATE KEY "
-                "UPDATE account_name=VALUES(account_name)",
-                (account_type, account_type)
-            )
-
-            # 更新资金池余额
-            cur.execute(
-                "UPDATE finance_accounts SET balance = balance + %s WHERE account_type = %s",
-                (amt, account_type)
-            )
-
-            # 获取更新后的余额
-            select_sql = build_dynamic_select(
-                cur,
-                "finance_accounts",
-                where_clause="account_type = %s",
-                select_fields=["balance"]
-            )
-            cur.execute(select_sql, (account_type,))
-            balance_row = cur.fetchone()
-            balance_after = balance_row["balance"] if balance_row else amt
+        amt = total * ratio
+        # 单元级日志：准备分配到指定资金池的金额与比例
+        logger.debug(f"_execute_split allocating to {account_type}: ratio={ratio} amt={amt:.2f}")
+        ledger.add(account_type, amt, f"订单分账: {order_number}")
 
-            # 记录流水到 account_flow
-            cur.execute(
-                """INSERT INTO account_flow (account_type, change_amount, balance_after, flow_type, remark, created_at)
-                   VALUES (%s, %s, %s, %s, %s, NOW())""",
-                (account_type, amt, balance_after, "income", f"订单分账: {order_number}")
-            )
-            # 单元级日志：记录分配后余额
-            try:
-                logger.debug(f"_execute_split {account_type} balance_after={Decimal(str(balance_after)):.2f}")
-            except Exception:
-                logger.debug(f"_execute_split {account_type} balance_after (unserializable): {balance_after}")
-        except Exception as e:
-            logger.error(f"分配到池子 {account_type} 时出错: {e}")
+    balances = ledger.commit(cur)
+    # 单元级日志：记录分配后余额
+    logger.debug(f"_execute_split balances_after={ {k: f'{v:.2f}' for k, v in balances.items()} }")
 
 
 def reverse_split_on_refund(order_number: str):
-    """退款回冲：撤销订单分账"""
+    """退款回冲：撤销订单分账
+
+    回填完成后按 related_order_id 一次汇总该订单各账户的分账收入（idx_related_order），
+    否则沿用按 remark 前缀匹配的旧查询。
+    """
     from core.database import get_conn
     from decimal import Decimal
 
+    # 回冲各个资金池
+    pool_mapping = {
+        "public": "public_welfare",
+        "maintain": "maintain_pool",
+        "subsidy": "subsidy_pool",
+        "director": "director_pool",
+        "shop": "shop_pool",
+        "city": "city_pool",
+        "branch": "branch_pool",
+        "fund": "fund_pool"
+    }
+
     with get_conn() as conn:
         with conn.cursor() as cur:
+            order_id = FlowRefService.order_id_by_number(cur, order_number)
+
+            split_income = None
+            if order_id is not None and FlowRefService.refs_ready():
+                cur.execute(
+                    """SELECT account_type, SUM(change_amount) AS amt FROM account_flow
+                       WHERE related_order_id = %s AND ref_type = %s AND flow_type = 'income'
+                       GROUP BY account_type""",
+                    (order_id, REF_ORDER_SPLIT)
+                )
+                split_income = {row["account_type"]: row["amt"] or Decimal("0") for row in cur.fetchall()}
+
             # 从 account_flow 查询商家分得金额
-            cur.execute(
-                """SELECT SUM(change_amount) AS m FROM account_flow 
-                   WHERE account_type='merchant_balance' AND remark LIKE %s AND flow_type='income'""",
-                (f"订单分账: {order_number}%",)
-            )
-            m = cur.fetchone()["m"] or Decimal("0")
+            if split_income is not None:
+                m = split_income.get("merchant_balance", Decimal("0"))
+            else:
+                cur.execute(
+                    """SELECT SUM(change_amount) AS m FROM account_flow 
+                       WHERE account_type='merchant_balance' AND remark LIKE %s AND flow_type='income'""",
+                    (f"订单分账: {order_number}%",)
+                )
+                m = cur.fetchone()["m"] or Decimal("0")
 
             if m > 0:
                 # 回冲商家余额
@@ -8320,30 +8445,23 @@ def reverse_split_on_refund(order_number: str):
                 merchant_balance_after = cur.fetchone()["merchant_balance"]
                 # 记录回冲流水
                 cur.execute(
-                    """INSERT INTO account_flow (account_type, change_amount, balance_after, flow_type, remark, created_at)
-                       VALUES (%s, %s, %s, %s, %s, NOW())""",
-                    ("merchant_balance", -m, merchant_balance_after, "expense", f"退款回冲: {order_number}")
+                    """INSERT INTO account_flow (account_type, change_amount, balance_after, flow_type, remark,
+                                                 related_order_id, ref_type, created_at)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())""",
+                    ("merchant_balance", -m, merchant_balance_after, "expense", f"退款回冲: {order_number}",
+                     order_id, REF_REFUND_REVERSAL)
                 )
 
-            # 回冲各个资金池
-            pool_mapping = {
-                "public": "public_welfare",
-                "maintain": "maintain_pool",
-                "subsidy": "subsidy_pool",
-                "director": "director_pool",
-                "shop": "shop_pool",
-                "city": "city_pool",
-                "branch": "branch_pool",
-                "fund": "fund_pool"
-            }
-
             for pool_key, account_type in pool_mapping.items():
-                cur.execute(
-                    """SELECT SUM(change_amount) AS amt FROM account_flow 
-                       WHERE account_type=%s AND remark LIKE %s AND flow_type='income'""",
-                    (account_type, f"订单分账: {order_number}%")
-                )
-                pool_amt = cur.fetchone()["amt"] or Decimal("0")
+                if split_income is not None:
+                    pool_amt = split_income.get(account_type, Decimal("0"))
+                else:
+                    cur.execute(
+                        """SELECT SUM(change_amount) AS amt FROM account_flow 
+                           WHERE account_type=%s AND remark LIKE %s AND flow_type='income'""",
+                        (account_type, f"订单分账: {order_number}%")
+                    )
+                    pool_amt = cur.fetchone()["amt"] or Decimal("0")
                 if pool_amt > 0:
                     cur.execute(
                         "UPDATE finance_accounts SET balance = balance - %s WHERE account_type = %s",
@@ -8352,9 +8470,11 @@ def reverse_split_on_refund(order_number: str):
                     cur.execute("SELECT balance FROM finance_accounts WHERE account_type = %s", (account_type,))
                     balance_after = cur.fetchone()["balance"]
                     cur.execute(
-                        """INSERT INTO account_flow (account_type, change_amount, balance_after, flow_type, remark, created_at)
-                           VALUES (%s, %s, %s, %s, %s, NOW())""",
-                        (account_type, -pool_amt, balance_after, "expense", f"退款回冲: {order_number}")
+                        """INSERT INTO account_flow (account_type, change_amount, balance_after, flow_type, remark,
+                                                     related_order_id, ref_type, created_at)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())""",
+                        (account_type, -pool_amt, balance_after, "expense", f"退款回冲: {order_number}",
+                         order_id, REF_REFUND_REVERSAL)
                     )
             conn.commit()
 
@@ -8494,10 +8614,11 @@ def generate_statement():
                 "closing_balance") is not None else Decimal("0")
 
             # 获取当日收入（从 account_flow 表查询）
+            date_sql, date_params = build_date_range("created_at", yesterday, yesterday)
             cur.execute(
-                """SELECT SUM(change_amount) AS income FROM account_flow 
-                   WHERE account_type='merchant_balance' AND flow_type='income' AND DATE(created_at)=%s""",
-                (yesterday,)
+                f"""SELECT SUM(change_amount) AS income FROM account_flow 
+                   WHERE account_type='merchant_balance' AND flow_type='income' AND {date_sql}""",
+                tuple(date_params)
             )
             income = cur.fetchone()["income"] or Decimal("0")
 
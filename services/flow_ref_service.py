@@ -0,0 +1,172 @@
+# services/flow_ref_service.py
+"""
+account_flow 订单关联（related_order_id / ref_type）
+
+资金流水原先只在 remark 里写订单号/订单ID，交易链路、奖励防重、退款回冲都要 `remark LIKE '%...%'` 全表扫描。
+现在写入路径直接填结构化列，历史数据由 backfill() 解析 remark 回填，查询走 idx_related_order 索引。
+
+ref_type 取值：
+- order_split：订单分账（remark 以“订单分账: {订单号}”开头），退款回冲按它汇总
+- refund_reversal：退款回冲（“退款回冲: {订单号}”）
+- order_alloc：订单资金池分配 / 平台收入 / 公司积分池（“订单#{订单号}”、“会员订单#{订单ID}”、线下订单）
+- member_reward：会员订单推荐/团队奖励（“推荐奖励 - 订单#{ID}”、“团队L..- 订单#{ID}”），奖励防重按它判断
+- order_reward：普通商品推荐奖励、购物赠送雨点
+- none：回填时确认与订单无关
+
+切换策略：回填跑完（没有 ref_type IS NULL 的行）后在 system_config 写入 FLOW_REF_BACKFILL_KEY，
+refs_ready() 为 True 之前调用方继续走旧的 LIKE 查询，避免退款回冲漏掉尚未回填的历史流水。
+"""
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from core.cache import TTLCache
+from core.database import get_conn
+from core.db_adapter import build_in_placeholders
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+REF_ORDER_SPLIT = "order_split"
+REF_REFUND_REVERSAL = "refund_reversal"
+REF_ORDER_ALLOC = "order_alloc"
+REF_MEMBER_REWARD = "member_reward"
+REF_ORDER_REWARD = "order_reward"
+REF_NONE = "none"
+
+FLOW_REF_BACKFILL_KEY = "account_flow_ref_backfilled"
+
+# 按顺序匹配，先具体后通用
+_REMARK_PATTERNS: List[Tuple[re.Pattern, str]] = [
+    (re.compile(r"^订单分账: (\S+)"), REF_ORDER_SPLIT),
+    (re.compile(r"^退款回冲: (\S+)"), REF_REFUND_REVERSAL),
+    (re.compile(r"普通商品推荐奖励 - 订单#?(\S+)"), REF_ORDER_REWARD),
+    (re.compile(r"购买商品赠送雨点 - 订单#(\S+)"), REF_ORDER_REWARD),
+    (re.compile(r"^推荐奖励 - 订单#(\S+)"), REF_MEMBER_REWARD),
+    (re.compile(r"^团队L\d+奖励.*- 订单#(\S+)"), REF_MEMBER_REWARD),
+    (re.compile(r"^线下订单(?:收入|分配|平台积分|商家结算)?[:#] ?(\S+)"), REF_ORDER_ALLOC),
+    (re.compile(r"订单#(\S+)"), REF_ORDER_ALLOC),
+]
+
+# 回填完成标记：完成后缓存 1 小时，未完成时每分钟重查一次
+_ready_cache = TTLCache(maxsize=1, ttl=60, name="flow_ref_ready")
+_READY_TTL_SECONDS = 3600
+
+
+class FlowRefService:
+
+    @staticmethod
+    def parse_remark(remark: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+        """解析流水备注，返回 (订单号或订单ID文本, ref_type)；无关订单返回 (None, None)"""
+        if not remark:
+            return None, None
+        for pattern, ref_type in _REMARK_PATTERNS:
+            match = pattern.search(remark)
+            if match:
+                return match.group(1).rstrip("，,:："), ref_type
+        return None, None
+
+    @staticmethod
+    def resolve_order_ids(cur, tokens: Iterable[str]) -> Dict[str, int]:
+        """把备注中的订单号/订单ID批量解析为 orders.id：先按 order_number 匹配，剩余纯数字按 id 匹配"""
+        tokens = {t for t in tokens if t}
+        if not tokens:
+            return {}
+
+        resolved: Dict[str, int] = {}
+        placeholders, params = build_in_placeholders(tokens)
+        cur.execute(
+            f"SELECT id, order_number FROM orders WHERE order_number IN ({placeholders})",
+            tuple(params.values())
+        )
+        for row in cur.fetchall():
+            resolved[row['order_number']] = row['id']
+
+        numeric = [int(t) for t in tokens if t not in resolved and t.isdigit() and len(t) <= 18]
+        if numeric:
+            placeholders, params = build_in_placeholders(numeric)
+            cur.execute(f"SELECT id FROM orders WHERE id IN ({placeholders})", tuple(params.values()))
+            for row in cur.fetchall():
+                resolved[str(row['id'])] = row['id']
+        return resolved
+
+    @staticmethod
+    def order_id_by_number(cur, order_number: str) -> Optional[int]:
+        cur.execute("SELECT id FROM orders WHERE order_number = %s", (order_number,))
+        row = cur.fetchone()
+        return row['id'] if row else None
+
+    @staticmethod
+    def backfill(batch_size: int = 2000, max_batches: int = 50) -> int:
+        """回填 ref_type IS NULL 的历史流水，可重复执行（按 id 续扫，每批单独提交）
+
+        返回本次处理的行数；全部回填完成时写入 system_config 标记。
+        """
+        processed = 0
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                last_id = 0
+                for _ in range(max_batches):
+                    cur.execute(
+                        """SELECT id, remark FROM account_flow
+                           WHERE ref_type IS NULL AND id > %s
+                           ORDER BY id LIMIT %s""",
+                        (last_id, batch_size)
+                    )
+                    rows = cur.fetchall()
+                    if not rows:
+                        break
+
+                    parsed = {row['id']: FlowRefService.parse_remark(row['remark']) for row in rows}
+                    order_ids = FlowRefService.resolve_order_ids(
+                        cur, (token for token, _ in parsed.values() if token)
+                    )
+                    updates = [
+                        (order_ids.get(token) if token else None, ref_type or REF_NONE, flow_id)
+                        for flow_id, (token, ref_type) in parsed.items()
+                    ]
+                    cur.executemany(
+                        "UPDATE account_flow SET related_order_id = %s, ref_type = %s WHERE id = %s",
+                        updates
+                    )
+                    conn.commit()
+
+                    processed += len(rows)
+                    last_id = rows[-1]['id']
+                    if len(rows) < batch_size:
+                        break
+
+                cur.execute("SELECT 1 AS pending FROM account_flow WHERE ref_type IS NULL LIMIT 1")
+                if cur.fetchone() is None:
+                    cur.execute(
+                        """INSERT INTO system_config (config_key, config_value, description)
+                           VALUES (%s, '1', 'account_flow 订单关联回填已完成')
+                           ON DUPLICATE KEY UPDATE config_value = '1'""",
+                        (FLOW_REF_BACKFILL_KEY,)
+                    )
+                    conn.commit()
+                    _ready_cache.set(FLOW_REF_BACKFILL_KEY, True, ttl=_READY_TTL_SECONDS)
+
+        if processed:
+            logger.info(f"account_flow 订单关联回填 {processed} 行")
+        return processed
+
+    @staticmethod
+    def refs_ready() -> bool:
+        """历史流水是否已全部回填（为 True 时才允许用 related_order_id 替代 LIKE 查询）"""
+        cached = _ready_cache.get(FLOW_REF_BACKFILL_KEY)
+        if cached is not None:
+            return cached
+        ready = False
+        try:
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT config_value FROM system_config WHERE config_key = %s",
+                        (FLOW_REF_BACKFILL_KEY,)
+                    )
+                    row = cur.fetchone()
+                    ready = bool(row and str(row['config_value']) == '1')
+        except Exception as e:
+            logger.warning(f"读取 account_flow 回填标记失败，按未完成处理: {e}")
+        _ready_cache.set(FLOW_REF_BACKFILL_KEY, ready, ttl=_READY_TTL_SECONDS if ready else None)
+        return ready
@@ -3,6 +3,7 @@ from __future__ import annotations
 from decimal import Decimal
 from datetime import datetime, timedelta
 from typing import Optional, Union, TYPE_CHECKING, Any
+import asyncio
 import os
 import json
 
@@ -13,11 +14,14 @@ from core.database import get_conn
 from core.config import settings
 from core.logging import get_logger
 from services.finance_service import FinanceService
+from services.flow_ref_service import REF_ORDER_ALLOC
+from services.pool_ledger import PoolLedger
 from services.notify_service import notify_merchant
 from pathlib import Path
 import pymysql
 import xmltodict
 from services.wechat_api import get_wxacode_unlimit  # ✅ 新增导入
+from services.wxacode_cache import WxaCodeCache, composite_center_logo, file_fingerprint
 import base64
 from services.wechat_api import get_wxacode
 from cryptography import x509
@@ -347,7 +351,7 @@ class OfflineService:
         # 4. 调用微信统一下单（原有代码保持不变）
         try:
             # ========== 修改：优先使用核心微信支付客户端 ==========
-            from core.wx_pay_client import wxpay_client
+            from core.wx_pay_client import async_wxpay_client
 
             if settings.wx_mock_mode_bool:  # ✅ 使用布尔属性
                 # Mock 模式：生成模拟支付参数
@@ -375,7 +379,7 @@ class OfflineService:
 
                 # 使用核心微信支付客户端创建订单
                 store_name = row.get('store_name', '') if row else ''
-                wx_response = wxpay_client.create_jsapi_order(
+                wx_response = await async_wxpay_client.create_jsapi_order(
                     out_trade_no=order_no,
                     total_fee=amount_for_wx,
                     openid=openid,
@@ -390,7 +394,7 @@ class OfflineService:
                 logger.info(f"[WeChatPay] 获取 prepay_id 成功: {prepay_id}")
 
                 # 使用核心客户端生成前端支付参数（包含真实签名）
-                pay_params = wxpay_client.generate_jsapi_pay_params(prepay_id)
+                pay_params = await async_wxpay_client.generate_jsapi_pay_params(prepay_id)
                 logger.info(f"[WeChatPay] 生成支付参数成功")
 
             return {
@@ -503,10 +507,10 @@ class OfflineService:
                 
                 # 🔧 修改4：调用微信退款接口（关键修改）
                 try:
-                    from core.wx_pay_client import wxpay_client
+                    from core.wx_pay_client import async_wxpay_client
                     logger.info(f"[Offline] 调用微信退款: order_no={order_no}, transaction_id={transaction_id}, refund_fee={refund_fee}")
                     
-                    wx_result = wxpay_client.refund(
+                    wx_result = await async_wxpay_client.refund(
                         transaction_id=transaction_id,
                         out_refund_no=out_refund_no,
                         total_fee=total_fee,
@@ -596,129 +600,13 @@ class OfflineService:
         """
         with get_conn() as conn:
             with conn.cursor(pymysql.cursors.DictCursor) as cur:
-                # 查询订单信息
-                cur.execute(
-                    "SELECT merchant_id, user_id FROM offline_order WHERE order_no=%s",
-                    (order_no,)
-                )
-                order = cur.fetchone()
-                if not order:
-                    logger.error(f"[on_paid] 订单不存在: {order_no}")
+                split = OfflineService.split_paid_order(cur, order_no, amount, coupon_discount, transaction_id)
+                if split is None:
                     return None
-
-                merchant_id = order["merchant_id"]
-                user_id = order["user_id"]
-                wx_tid = (transaction_id or "").strip() or None
-
-                # 1. 插入平台订单表（用于对账）；须写入微信 transaction_id，否则统一退款审核读 orders 会缺号
-                cur.execute(
-                    """INSERT INTO orders (order_number, user_id, merchant_id, total_amount, status,
-                       offline_order_flag, pay_way, created_at, coupon_discount, transaction_id) 
-                       VALUES (%s, %s, %s, %s, 'completed', 1, 'wechat', NOW(), %s, %s)""",
-                    (order_no, user_id, merchant_id, amount, coupon_discount, wx_tid)
-                )
-                platform_order_id = cur.lastrowid
-
-                # 2. 资金分账
-                finance = FinanceService()
-                allocs = finance.get_pool_allocations()
-                merchant_ratio = allocs.get('merchant_balance', Decimal('0.80'))
-
-                # ✅ 统一基数 = 实付金额 + 优惠券金额
-                distribution_base = amount + coupon_discount
-
-                # 与线上 settle_order 一致：线下扫码无商品行，整笔基数视为「普通商品」分摊基数
-                normal_paid = distribution_base
-
-                has_referrer = False
-                referrer_id = None
-                if user_id is not None:
-                    cur.execute(
-                        "SELECT referrer_id FROM user_referrals WHERE user_id = %s",
-                        (user_id,),
-                    )
-                    ref_row = cur.fetchone()
-                    if ref_row and ref_row.get("referrer_id"):
-                        cur.execute(
-                            "SELECT status FROM users WHERE id = %s",
-                            (ref_row["referrer_id"],),
-                        )
-                        status_row = cur.fetchone()
-                        if status_row and status_row.get("status") == 0:
-                            has_referrer = True
-                            referrer_id = ref_row["referrer_id"]
-
-                merchant_amount = distribution_base * merchant_ratio  # 商家应得总额（含优惠券）
-
-                # 平台收入池记录完整收入
-                finance._add_pool_balance(
-                    cur, 'platform_revenue_pool', distribution_base,
-                    f"线下订单收入: {order_no}", merchant_id
-                )
-
-                # 从平台收入池分配各子池（公益基金、维护池、补贴池等）
-                for pool_type, ratio in allocs.items():
-                    if pool_type == 'merchant_balance' or ratio <= 0:
-                        continue
-                    alloc_amount = (distribution_base * ratio).quantize(Decimal("0.000001"))
-                    finance._add_pool_balance(
-                        cur, 'platform_revenue_pool', -alloc_amount,
-                        f"线下订单分配: {order_no} -> {pool_type}", merchant_id
-                    )
-                    if pool_type == 'fund_pool' and has_referrer and normal_paid > 0:
-                        referral_amount = (normal_paid * ratio).quantize(Decimal("0.000001"))
-                        finance._grant_referral_points(cur, referrer_id, referral_amount, order_no)
-                        fund_pool_amount = alloc_amount - referral_amount
-                        if fund_pool_amount > 0:
-                            finance._add_pool_balance(
-                                cur,
-                                pool_type,
-                                fund_pool_amount,
-                                f"线下订单#{order_no} fund_pool+{int(ratio * 100)}% (剩余部分)",
-                                user_id,
-                            )
-                    else:
-                        finance._add_pool_balance(
-                            cur, pool_type, alloc_amount,
-                            f"线下订单收入: {order_no}", merchant_id
-                        )
-
-                # 3. 用户积分发放（实付部分）
-                if amount > 0 and user_id is not None:
-                    cur.execute(
-                        "UPDATE users SET member_points = COALESCE(member_points, 0) + %s WHERE id = %s",
-                        (amount, user_id)
-                    )
-                    cur.execute("SELECT member_points FROM users WHERE id = %s", (user_id,))
-                    new_balance = cur.fetchone()["member_points"]
-                    cur.execute(
-                        """INSERT INTO points_log (user_id, change_amount, balance_after, type, reason, related_order, created_at)
-                           VALUES (%s, %s, %s, 'member', %s, %s, NOW())""",
-                        (
-                            user_id,
-                            amount,
-                            new_balance,
-                            f"线下订单支付获得积分: {order_no}",
-                            platform_order_id,
-                        ),
-                    )
-
-                # 4. 公司积分池增加（基于完整基数）
-                platform_points_amount = distribution_base * Decimal('0.20')
-                if platform_points_amount > 0:
-                    finance._add_pool_balance(
-                        cur, 'company_points', platform_points_amount,
-                        f"线下订单平台积分: {order_no}", None
-                    )
-
-                # ===== 新增：从平台收入池扣除商家应得金额 =====
-                finance._add_pool_balance(
-                    cur, 'platform_revenue_pool', -merchant_amount,
-                    f"线下订单商家结算: {order_no}", merchant_id
-                )
-
                 conn.commit()
 
+        merchant_id, merchant_amount = split["merchant_id"], split["merchant_amount"]
+
         # 5. 异步通知商家转账（转账金额基于完整基数）
         if merchant_amount > 0:
             try:
@@ -736,6 +624,134 @@ class OfflineService:
                 return msg
         return None
 
+    @staticmethod
+    def split_paid_order(
+        cur,
+        order_no: str,
+        amount: Decimal,
+        coupon_discount: Decimal = Decimal(0),
+        transaction_id: Optional[str] = None,
+    ) -> Optional[dict]:
+        """
+        线下订单资金分账（在调用方事务内执行，不提交）：写平台订单、各资金池分配、用户积分、公司积分池。
+        返回 {merchant_id, merchant_amount}（商家应得，元）；订单不存在返回 None
+        """
+        cur.execute(
+            "SELECT merchant_id, user_id FROM offline_order WHERE order_no=%s",
+            (order_no,)
+        )
+        order = cur.fetchone()
+        if not order:
+            logger.error(f"[on_paid] 订单不存在: {order_no}")
+            return None
+
+        merchant_id = order["merchant_id"]
+        user_id = order["user_id"]
+        wx_tid = (transaction_id or "").strip() or None
+
+        # 1. 插入平台订单表（用于对账）；须写入微信 transaction_id，否则统一退款审核读 orders 会缺号
+        cur.execute(
+            """INSERT INTO orders (order_number, user_id, merchant_id, total_amount, status,
+               offline_order_flag, pay_way, created_at, coupon_discount, transaction_id) 
+               VALUES (%s, %s, %s, %s, 'completed', 1, 'wechat', NOW(), %s, %s)""",
+            (order_no, user_id, merchant_id, amount, coupon_discount, wx_tid)
+        )
+        platform_order_id = cur.lastrowid
+
+        # 2. 资金分账
+        finance = FinanceService()
+        allocs = finance.get_pool_allocations()
+        merchant_ratio = allocs.get('merchant_balance', Decimal('0.80'))
+
+        # ✅ 统一基数 = 实付金额 + 优惠券金额
+        distribution_base = amount + coupon_discount
+
+        # 与线上 settle_order 一致：线下扫码无商品行，整笔基数视为「普通商品」分摊基数
+        normal_paid = distribution_base
+
+        has_referrer = False
+        referrer_id = None
+        if user_id is not None:
+            cur.execute(
+                "SELECT referrer_id FROM user_referrals WHERE user_id = %s",
+                (user_id,),
+            )
+            ref_row = cur.fetchone()
+            if ref_row and ref_row.get("referrer_id"):
+                cur.execute(
+                    "SELECT status FROM users WHERE id = %s",
+                    (ref_row["referrer_id"],),
+                )
+                status_row = cur.fetchone()
+                if status_row and status_row.get("status") == 0:
+                    has_referrer = True
+                    referrer_id = ref_row["referrer_id"]
+
+        merchant_amount = distribution_base * merchant_ratio  # 商家应得总额（含优惠券）
+
+        # 资金池变动统一登记，最后一次加锁批量落账
+        ledger = PoolLedger(related_order_id=platform_order_id, ref_type=REF_ORDER_ALLOC)
+
+        # 平台收入池记录完整收入
+        ledger.add('platform_revenue_pool', distribution_base, f"线下订单收入: {order_no}", merchant_id)
+
+        # 从平台收入池分配各子池（公益基金、维护池、补贴池等）
+        for pool_type, ratio in allocs.items():
+            if pool_type == 'merchant_balance' or ratio <= 0:
+                continue
+            alloc_amount = (distribution_base * ratio).quantize(Decimal("0.000001"))
+            ledger.add(
+                'platform_revenue_pool', -alloc_amount,
+                f"线下订单分配: {order_no} -> {pool_type}", merchant_id
+            )
+            if pool_type == 'fund_pool' and has_referrer and normal_paid > 0:
+                referral_amount = (normal_paid * ratio).quantize(Decimal("0.000001"))
+                finance._grant_referral_points(cur, referrer_id, referral_amount, order_no,
+                                               platform_order_id)
+                fund_pool_amount = alloc_amount - referral_amount
+                if fund_pool_amount > 0:
+                    ledger.add(
+                        pool_type,
+                        fund_pool_amount,
+                        f"线下订单#{order_no} fund_pool+{int(ratio * 100)}% (剩余部分)",
+                        user_id,
+                    )
+            else:
+                ledger.add(pool_type, alloc_amount, f"线下订单收入: {order_no}", merchant_id)
+
+        # 3. 用户积分发放（实付部分）
+        if amount > 0 and user_id is not None:
+            cur.execute(
+                "UPDATE users SET member_points = COALESCE(member_points, 0) + %s WHERE id = %s",
+                (amount, user_id)
+            )
+            cur.execute("SELECT member_points FROM users WHERE id = %s", (user_id,))
+            new_balance = cur.fetchone()["member_points"]
+            cur.execute(
+                """INSERT INTO points_log (user_id, change_amount, balance_after, type, reason, related_order, created_at)
+                   VALUES (%s, %s, %s, 'member', %s, %s, NOW())""",
+                (
+                    user_id,
+                    amount,
+                    new_balance,
+                    f"线下订单支付获得积分: {order_no}",
+                    platform_order_id,
+                ),
+            )
+
+        # 4. 公司积分池增加（基于完整基数）
+        platform_points_amount = distribution_base * Decimal('0.20')
+        if platform_points_amount > 0:
+            ledger.add('company_points', platform_points_amount, f"线下订单平台积分: {order_no}", None)
+
+        # ===== 新增：从平台收入池扣除商家应得金额 =====
+        ledger.add(
+            'platform_revenue_pool', -merchant_amount,
+            f"线下订单商家结算: {order_no}", merchant_id
+        )
+        ledger.commit(cur)
+        return {"merchant_id": merchant_id, "merchant_amount": merchant_amount}
+
     @staticmethod
     def is_valid_offline_permanent_pay_target(merchant_user_id: int) -> bool:
         """永久收款外链中的 id 须为已开通商户身份的用户（is_merchant>=1）。"""
@@ -747,12 +763,47 @@ class OfflineService:
                 )
                 return cur.fetchone() is not None
 
+    @staticmethod
+    def _merchant_avatar_file(merchant_id: int) -> Optional[Path]:
+        """商户头像的本地文件；avatar_path 可能是 URL 数组 JSON（/pic/avatars/xxx.jpg）或文件名"""
+        from core.config import AVATAR_UPLOAD_DIR
+
+        try:
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT avatar_path FROM users WHERE id=%s", (merchant_id,))
+                    row = cur.fetchone()
+        except Exception:
+            return None
+        avatar_path = (row or {}).get("avatar_path")
+        if not avatar_path:
+            return None
+        try:
+            paths = json.loads(avatar_path)
+        except ValueError:
+            paths = avatar_path
+        first = paths[0] if isinstance(paths, list) and paths else paths
+        if not isinstance(first, str) or not first:
+            return None
+        av_file = AVATAR_UPLOAD_DIR / Path(first).name
+        return av_file if av_file.exists() else None
+
+    @staticmethod
+    def _make_plain_qrcode(text: str) -> bytes:
+        import io
+        import qrcode
+
+        buf = io.BytesIO()
+        qrcode.make(text).save(buf, format="PNG")
+        return buf.getvalue()
+
     # ==================== 新增：生成永久收款码 ====================
     @staticmethod
     async def generate_permanent_qrcode(merchant_id: int) -> dict:
         """
         为指定商家生成永久有效的小程序码
-        返回 base64 图片数据及过期时间（长期有效，expire_at 返回 None）
+        返回 base64 图片数据、静态地址及过期时间（长期有效，expire_at 返回 None）
+        小程序码与普通二维码经 WxaCodeCache 缓存，重复请求不再调用微信、不再重新叠加头像
         """
         # 场景值编码（长度限制32字符）
         scene = f"m={merchant_id}"
@@ -760,69 +811,33 @@ class OfflineService:
         page = "pages/offline/permanentPay"
 
         try:
-            # 调用微信接口获取二维码图片二进制
-            qrcode_bytes = await get_wxacode_unlimit(scene, page)
-
-            # ====== 新增：如果商户有头像则把头像叠加到二维码中间 ======
-            avatar_path = None
-            try:
-                with get_conn() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("SELECT avatar_path FROM users WHERE id=%s", (merchant_id,))
-                        row = cur.fetchone()
-                        avatar_path = row.get("avatar_path") if row else None
-            except Exception:
-                avatar_path = None
-
-            if avatar_path:
-                try:
-                    from PIL import Image
-                    import io
-                    # 读取二维码图像
-                    qr_im = Image.open(io.BytesIO(qrcode_bytes)).convert("RGBA")
-                    # 尝试打开头像文件; avatar_path 可能是相对路径
-                    from core.config import AVATAR_UPLOAD_DIR
-                    av_file = AVATAR_UPLOAD_DIR / avatar_path
-                    if av_file.exists():
-                        av_im = Image.open(av_file).convert("RGBA")
-                        # 缩放头像到二维码中心尺寸 (约1/4 宽度)
-                        target_size = int(qr_im.width * 0.25)
-                        av_im = av_im.resize((target_size, target_size), Image.ANTIALIAS)
-                        # 计算位置并粘贴
-                        pos = ((qr_im.width - target_size) // 2, (qr_im.height - target_size) // 2)
-                        qr_im.paste(av_im, pos, av_im)
-                        # 写回 bytes
-                        buf = io.BytesIO()
-                        qr_im.save(buf, format="PNG")
-                        qrcode_bytes = buf.getvalue()
-                except Exception as e:
-                    logger.warning(f"叠加商户头像失败: {e}")
-            # ==========================================
-
+            # 商户有头像则叠加到小程序码中间；头像指纹参与缓存键，换头像自动生成新码
+            avatar_file = OfflineService._merchant_avatar_file(merchant_id)
+
+            async def _produce_wxacode() -> bytes:
+                code = await get_wxacode_unlimit(scene, page)
+                if avatar_file:
+                    code = await asyncio.to_thread(composite_center_logo, code, avatar_file)
+                return code
+
+            image = await WxaCodeCache.get_image(
+                "wxacode", scene=scene, page=page, width=280,
+                producer=_produce_wxacode, avatar_hash=file_fingerprint(avatar_file), owner_id=merchant_id,
+            )
+            qrcode_bytes = await asyncio.to_thread(image["path"].read_bytes)
             qrcode_base64 = base64.b64encode(qrcode_bytes).decode()
             qrcode_data_url = f"data:image/png;base64,{qrcode_base64}"
 
-            # 保存到数据库（幂等操作）
-            with get_conn() as conn:
-                with conn.cursor() as cur:
-                    # 检查是否已存在
-                    cur.execute(
-                        "SELECT id FROM merchant_qrcode WHERE merchant_id = %s",
-                        (merchant_id,)
-                    )
-                    if cur.fetchone():
-                        # 更新
-                        cur.execute(
-                            "UPDATE merchant_qrcode SET qrcode_data = %s, updated_at = NOW() WHERE merchant_id = %s",
-                            (qrcode_data_url, merchant_id)
-                        )
-                    else:
-                        # 插入
+            # 新生成时保存到数据库（幂等操作）；缓存命中说明库里已是同一张图
+            if image["created"]:
+                with get_conn() as conn:
+                    with conn.cursor() as cur:
                         cur.execute(
-                            "INSERT INTO merchant_qrcode (merchant_id, qrcode_data) VALUES (%s, %s)",
+                            "INSERT INTO merchant_qrcode (merchant_id, qrcode_data) VALUES (%s, %s) "
+                            "ON DUPLICATE KEY UPDATE qrcode_data=VALUES(qrcode_data), updated_at=NOW()",
                             (merchant_id, qrcode_data_url)
                         )
-                    conn.commit()
+                        conn.commit()
 
             # 普通可访问链接（HOST 或从 WECHAT_PAY_NOTIFY_URL 推断公开域名）
             base = settings.public_base_url
@@ -833,14 +848,16 @@ class OfflineService:
             # 与 universal 一致：普通二维码指向 /offline?id=（H5 拉起小程序）
             web_url = universal_url
 
-            # ===== 生成普通二维码图片 =====
+            # ===== 生成普通二维码图片（同样走缓存） =====
             normal_qrcode_data_url = None
+            plain_image = None
             try:
-                import qrcode, io
-                qr_img = qrcode.make(web_url)
-                buf = io.BytesIO()
-                qr_img.save(buf, format="PNG")
-                normal_qrcode_b64 = base64.b64encode(buf.getvalue()).decode()
+                plain_image = await WxaCodeCache.get_image(
+                    "qrcode", scene=web_url, page="", width=0,
+                    producer=lambda: asyncio.to_thread(OfflineService._make_plain_qrcode, web_url),
+                    owner_id=merchant_id,
+                )
+                normal_qrcode_b64 = base64.b64encode(await asyncio.to_thread(plain_image["path"].read_bytes)).decode()
                 normal_qrcode_data_url = f"data:image/png;base64,{normal_qrcode_b64}"
             except Exception as e:
                 logger.warning(f"生成普通二维码失败: {e}")
@@ -851,6 +868,8 @@ class OfflineService:
                 "url": web_url,                             # 传统二维码指向的页面
                 "universal_link": universal_url,           # 兼容旧客户端/描述
                 "plain_qrcode": normal_qrcode_data_url,    # base64 PNG 普通二维码
+                "qrcode_url": image["url"],                # 小程序码静态地址（可直接 <img>）
+                "plain_qrcode_url": plain_image["url"] if plain_image else None,
                 "expire_at": None,  # 永久有效
                 "merchant_id": merchant_id
             }
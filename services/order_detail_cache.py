@@ -0,0 +1,101 @@
+# services/order_detail_cache.py
+"""
+订单详情短缓存（供小程序轮询支付/发货状态）
+
+- 进程内 TTLCache 保存 (版本号, 详情, ETag)，TTL 很短，兜底任何漏掉的失效
+- Redis 可用时每个订单维护一个版本号，invalidate 时 INCR，多 worker 间读到新版本即视为失效；
+  Redis 不可用时只失效本进程，其它进程最多延迟 DETAIL_CACHE_TTL_SECONDS
+- 所有订单状态变更（update_status、支付回调、发货、退款、确认收货等）提交后需调用 OrderDetailCache.invalidate
+"""
+import hashlib
+import json
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from core.cache import TTLCache
+from core.logging import get_logger
+from core.redis_client import get_redis_client, mark_redis_failure, is_redis_error
+
+logger = get_logger(__name__)
+
+DETAIL_CACHE_TTL_SECONDS = 10
+_VERSION_KEY = "order:detail:ver:{}"
+_VERSION_KEY_TTL = 7 * 86400
+
+_detail_cache = TTLCache(maxsize=5000, ttl=DETAIL_CACHE_TTL_SECONDS, name="order_detail")
+
+
+def _remote_version(order_number: str) -> Optional[str]:
+    client = get_redis_client()
+    if client is None:
+        return None
+    try:
+        return client.get(_VERSION_KEY.format(order_number)) or "0"
+    except Exception as e:
+        if is_redis_error(e):
+            mark_redis_failure(e)
+            return None
+        raise
+
+
+def compute_etag(detail: Dict[str, Any]) -> str:
+    raw = json.dumps(detail, default=str, sort_keys=True, ensure_ascii=False)
+    return f'"{hashlib.md5(raw.encode("utf-8")).hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 可能是逗号分隔的多个值或 *，弱校验前缀 W/ 忽略"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class OrderDetailCache:
+
+    @staticmethod
+    def load(
+        order_number: str,
+        loader: Callable[[str], Optional[Dict[str, Any]]],
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """读取订单详情及 ETag；缓存未命中或版本变化时调用 loader 回源"""
+        # 版本号必须在回源前读取：回源期间发生的变更会推进版本，旧数据不会被当作新版本命中
+        version = _remote_version(order_number)
+        entry = _detail_cache.get(order_number)
+        if entry is not None and entry[0] == version:
+            return entry[1], entry[2]
+
+        detail = loader(order_number)
+        if detail is None:
+            return None, None
+        etag = compute_etag(detail)
+        _detail_cache.set(order_number, (version, detail, etag))
+        return detail, etag
+
+    @staticmethod
+    def invalidate(*order_numbers: Optional[str]) -> None:
+        OrderDetailCache.invalidate_many(order_numbers)
+
+    @staticmethod
+    def invalidate_many(order_numbers: Iterable[Optional[str]]) -> None:
+        """订单变更提交后调用；失败只记日志，不影响业务流程"""
+        numbers = [n for n in order_numbers if n]
+        if not numbers:
+            return
+        _detail_cache.delete_many(numbers)
+        client = get_redis_client()
+        if client is None:
+            return
+        try:
+            pipe = client.pipeline(transaction=False)
+            for n in numbers:
+                key = _VERSION_KEY.format(n)
+                pipe.incr(key)
+                pipe.expire(key, _VERSION_KEY_TTL)
+            pipe.execute()
+        except Exception as e:
+            if is_redis_error(e):
+                mark_redis_failure(e)
+            logger.warning(f"订单详情缓存版本推进失败 {numbers}: {e}")
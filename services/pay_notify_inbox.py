@@ -0,0 +1,326 @@
+# services/pay_notify_inbox.py
+"""
+支付成功回调收件箱（快速应答 + 分步结算）
+
+原先回调在应答微信前同步完成订单更新、优惠券核销、资金分账、商家转账……结算慢时超过微信 5 秒超时，
+微信判定失败反复重推，而每次重推又进入同一段长事务。现在：
+
+1. 回调入口验签解密后，PayNotifyInbox.enqueue 写入 pay_notify_inbox（transaction_id 唯一，重推只命中已有行）
+2. 落库成功立即应答 SUCCESS，kick() 在当前事件循环上异步处理该事件（WORKER_CONCURRENCY 个并发）；
+   异步入口 accept() 与 process() 中的数据库读写都在线程池执行，不阻塞事件循环
+3. 事件按步骤执行（见 services/pay_settlement_service.py）：settle 完成后登记后续步骤，
+   每个步骤在 pay_notify_steps 中单独记录状态、次数与下次执行时间，已完成的步骤重试时跳过
+4. 步骤失败按指数退避重试，超过 MAX_ATTEMPTS 次（或业务校验不通过）置 failed 等待人工处理；
+   事件 processing 超过 PROCESSING_STALE_MINUTES 视为 worker 中断，重新入队
+5. 定时任务 process_pending 兜底处理到期事件（进程重启、kick 丢失），stuck_events() 供管理端排查
+"""
+import asyncio
+import json
+import weakref
+from typing import Any, Dict, List, Optional, Set
+
+from core.database import get_conn
+from core.logging import get_logger
+from services.pay_settlement_service import PaySettlementService, SettlementRejected, STEP_SETTLE
+
+logger = get_logger(__name__)
+
+# 单个步骤最大执行次数与退避基数（秒）：30s, 60s, 120s ...
+MAX_ATTEMPTS = 8
+RETRY_BASE_SECONDS = 30
+# processing 超过该时长视为 worker 中断
+PROCESSING_STALE_MINUTES = 10
+# 每个事件循环上同时处理的事件数
+WORKER_CONCURRENCY = 4
+
+# 持有后台任务引用，避免被垃圾回收
+_tasks: Set[asyncio.Task] = set()
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def _notify_key(resource: Dict[str, Any]) -> str:
+    """去重键：微信支付订单号；测试回调缺失时退回商户订单号"""
+    tid = (resource.get("transaction_id") or "").strip()
+    return tid or f"out:{resource.get('out_trade_no') or ''}"
+
+
+def _worker_slots() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    sem = _semaphores.get(loop)
+    if sem is None:
+        sem = _semaphores[loop] = asyncio.Semaphore(WORKER_CONCURRENCY)
+    return sem
+
+
+class PayNotifyInbox:
+
+    # ------------- 入队 -------------
+    @staticmethod
+    def enqueue(resource: Dict[str, Any], event_type: str) -> Dict[str, Any]:
+        """记录已验签的支付成功通知，返回 {id, status}；同一 transaction_id 重复送达返回已有记录"""
+        out_trade_no = resource.get("out_trade_no")
+        if not out_trade_no:
+            raise ValueError("支付回调缺少 out_trade_no")
+        amount = (resource.get("amount") or {}).get("total")
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """INSERT INTO pay_notify_inbox
+                       (transaction_id, out_trade_no, event_type, amount_total, payload)
+                       VALUES (%s, %s, %s, %s, %s)
+                       ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)""",
+                    (_notify_key(resource), out_trade_no, event_type, amount,
+                     json.dumps(resource, ensure_ascii=False)),
+                )
+                event_id = cur.lastrowid
+                cur.execute(
+                    "INSERT IGNORE INTO pay_notify_steps (event_id, step, seq) VALUES (%s, %s, 0)",
+                    (event_id, STEP_SETTLE),
+                )
+                cur.execute("SELECT id, status FROM pay_notify_inbox WHERE id = %s", (event_id,))
+                row = cur.fetchone()
+                conn.commit()
+                return row
+
+    @staticmethod
+    async def accept(resource: Dict[str, Any], event_type: str) -> Dict[str, Any]:
+        """异步回调入口：入队写库放到线程池（不阻塞事件循环），待处理的事件随即 kick"""
+        event = await asyncio.to_thread(PayNotifyInbox.enqueue, resource, event_type)
+        if event["status"] == "pending":
+            PayNotifyInbox.kick(event["id"])
+        return event
+
+    @staticmethod
+    def kick(event_id: int) -> None:
+        """应答微信后在当前事件循环上处理；无运行中的事件循环时留给定时任务"""
+        try:
+            task = asyncio.get_running_loop().create_task(PayNotifyInbox._process_slot(event_id))
+        except RuntimeError:
+            return
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+    # ------------- 处理 -------------
+    @staticmethod
+    async def _process_slot(event_id: int) -> bool:
+        async with _worker_slots():
+            return await PayNotifyInbox.process(event_id)
+
+    @staticmethod
+    def _claim(event_id: int) -> Optional[Dict[str, Any]]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """UPDATE pay_notify_inbox SET status = 'processing', attempts = attempts + 1
+                       WHERE id = %s AND status = 'pending' AND next_run_at <= NOW()""",
+                    (event_id,),
+                )
+                if cur.rowcount != 1:
+                    conn.commit()
+                    return None
+                cur.execute("SELECT * FROM pay_notify_inbox WHERE id = %s", (event_id,))
+                event = cur.fetchone()
+                conn.commit()
+                return event
+
+    @staticmethod
+    def _due_step(event_id: int, tried: Set[int]) -> Optional[Dict[str, Any]]:
+        """按顺序取下一个到期的待执行步骤（本轮已执行过的跳过）"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT * FROM pay_notify_steps
+                       WHERE event_id = %s AND status = 'pending' AND next_run_at <= NOW()
+                       ORDER BY seq, id""",
+                    (event_id,),
+                )
+                return next((row for row in cur.fetchall() if row["id"] not in tried), None)
+
+    @staticmethod
+    def _record_step(event_id: int, step: Dict[str, Any], error: Optional[str],
+                     rejected: bool, follow_ups: List) -> None:
+        """写入步骤结果；成功时登记后续步骤"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                if error is None:
+                    cur.execute(
+                        """UPDATE pay_notify_steps
+                           SET status = 'done', attempts = attempts + 1, last_error = NULL, finished_at = NOW()
+                           WHERE id = %s""",
+                        (step["id"],),
+                    )
+                    if follow_ups:
+                        cur.executemany(
+                            """INSERT IGNORE INTO pay_notify_steps (event_id, step, seq, params)
+                               VALUES (%s, %s, %s, %s)""",
+                            [(event_id, name, step["seq"] + i + 1, json.dumps(params, ensure_ascii=False))
+                             for i, (name, params) in enumerate(follow_ups)],
+                        )
+                elif rejected or step["attempts"] + 1 >= MAX_ATTEMPTS:
+                    cur.execute(
+                        """UPDATE pay_notify_steps SET status = 'failed', attempts = attempts + 1, last_error = %s
+                           WHERE id = %s""",
+                        (error[:500], step["id"]),
+                    )
+                else:
+                    delay = RETRY_BASE_SECONDS * (2 ** step["attempts"])
+                    cur.execute(
+                        """UPDATE pay_notify_steps
+                           SET attempts = attempts + 1, last_error = %s, next_run_at = NOW() + INTERVAL %s SECOND
+                           WHERE id = %s""",
+                        (error[:500], delay, step["id"]),
+                    )
+                conn.commit()
+
+    @staticmethod
+    def _finish(event: Dict[str, Any]) -> str:
+        """根据步骤状态收尾事件：全部完成 done；有待重试步骤回到 pending；只剩失败步骤 failed"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT status, MIN(next_run_at) AS next_run_at, COUNT(*) AS n,
+                              MAX(last_error) AS last_error
+                       FROM pay_notify_steps WHERE event_id = %s GROUP BY status""",
+                    (event["id"],),
+                )
+                by_status = {row["status"]: row for row in cur.fetchall()}
+                if "pending" in by_status:
+                    status = "pending"
+                    cur.execute(
+                        """UPDATE pay_notify_inbox SET status = 'pending', next_run_at = %s, last_error = %s
+                           WHERE id = %s AND status = 'processing'""",
+                        (by_status["pending"]["next_run_at"], by_status["pending"]["last_error"], event["id"]),
+                    )
+                elif "failed" in by_status:
+                    status = "failed"
+                    cur.execute(
+                        """UPDATE pay_notify_inbox SET status = 'failed', last_error = %s
+                           WHERE id = %s AND status = 'processing'""",
+                        (by_status["failed"]["last_error"], event["id"]),
+                    )
+                    logger.error(
+                        f"[pay-inbox] 支付事件结算失败，需人工处理: id={event['id']}, "
+                        f"订单={event['out_trade_no']}, 错误={by_status['failed']['last_error']}"
+                    )
+                else:
+                    status = "done"
+                    cur.execute(
+                        """UPDATE pay_notify_inbox SET status = 'done', last_error = NULL, processed_at = NOW()
+                           WHERE id = %s AND status = 'processing'""",
+                        (event["id"],),
+                    )
+                conn.commit()
+                return status
+
+    @staticmethod
+    async def process(event_id: int) -> bool:
+        """执行事件中到期的步骤，返回事件是否全部完成"""
+        # 数据库读写均为同步 pymysql 调用，放到线程池执行，避免慢 SQL 卡住事件循环上的其它请求
+        event = await asyncio.to_thread(PayNotifyInbox._claim, event_id)
+        if event is None:
+            return False
+
+        payload = json.loads(event["payload"])
+        tried: Set[int] = set()
+        while True:
+            step = await asyncio.to_thread(PayNotifyInbox._due_step, event_id, tried)
+            if step is None:
+                break
+            tried.add(step["id"])
+            params = payload if step["step"] == STEP_SETTLE else json.loads(step["params"] or "{}")
+            error, rejected, follow_ups = None, False, []
+            try:
+                follow_ups = await PaySettlementService.run_step(step["step"], params) or []
+            except SettlementRejected as e:
+                error, rejected = str(e), True
+                logger.error(f"[pay-inbox] {step['step']} 校验不通过 订单={event['out_trade_no']}: {e}")
+            except Exception as e:
+                error = str(e) or e.__class__.__name__
+                logger.error(
+                    f"[pay-inbox] {step['step']} 第{step['attempts'] + 1}次执行失败 订单={event['out_trade_no']}: {e}",
+                    exc_info=True,
+                )
+            await asyncio.to_thread(PayNotifyInbox._record_step, event_id, step, error, rejected, follow_ups)
+            if error is not None and step["step"] == STEP_SETTLE:
+                # 结算未完成，后续步骤尚未登记
+                break
+
+        return await asyncio.to_thread(PayNotifyInbox._finish, event) == "done"
+
+    @staticmethod
+    def _due_ids(limit: int) -> List[int]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """UPDATE pay_notify_inbox SET status = 'pending'
+                       WHERE status = 'processing' AND updated_at < NOW() - INTERVAL %s MINUTE""",
+                    (PROCESSING_STALE_MINUTES,),
+                )
+                cur.execute(
+                    """SELECT id FROM pay_notify_inbox
+                       WHERE status = 'pending' AND next_run_at <= NOW()
+                       ORDER BY next_run_at, id LIMIT %s""",
+                    (limit,),
+                )
+                ids = [row["id"] for row in cur.fetchall()]
+                conn.commit()
+                return ids
+
+    @staticmethod
+    async def process_pending(limit: int = 50) -> int:
+        """处理到期事件（定时任务兜底），WORKER_CONCURRENCY 个并发，返回本轮全部完成的事件数"""
+        event_ids = await asyncio.to_thread(PayNotifyInbox._due_ids, limit)
+        results = await asyncio.gather(*(PayNotifyInbox._process_slot(event_id) for event_id in event_ids))
+        return sum(1 for ok in results if ok)
+
+    # ------------- 管理端 -------------
+    @staticmethod
+    def stuck_events(stale_minutes: int = 10, limit: int = 100) -> List[Dict[str, Any]]:
+        """未完成的事件：failed、等待重试中、或创建超过 stale_minutes 仍未完成的；附带各步骤状态"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT id, transaction_id, out_trade_no, amount_total, status, attempts,
+                              next_run_at, last_error, created_at, updated_at
+                       FROM pay_notify_inbox
+                       WHERE status = 'failed'
+                          OR (status <> 'done' AND (last_error IS NOT NULL
+                                                    OR created_at < NOW() - INTERVAL %s MINUTE))
+                       ORDER BY status = 'failed' DESC, created_at
+                       LIMIT %s""",
+                    (stale_minutes, limit),
+                )
+                events = cur.fetchall()
+                if events:
+                    placeholders = ",".join(["%s"] * len(events))
+                    cur.execute(
+                        f"""SELECT event_id, step, status, attempts, next_run_at, last_error, finished_at
+                            FROM pay_notify_steps WHERE event_id IN ({placeholders})
+                            ORDER BY event_id, seq, id""",
+                        tuple(e["id"] for e in events),
+                    )
+                    steps: Dict[int, List[Dict[str, Any]]] = {}
+                    for row in cur.fetchall():
+                        steps.setdefault(row.pop("event_id"), []).append(row)
+                    for e in events:
+                        e["steps"] = steps.get(e["id"], [])
+                return events
+
+    @staticmethod
+    def retry(event_id: int) -> bool:
+        """人工重试：失败步骤重置次数，事件立即重新入队（处理仍由 worker 完成，调用方随后 kick）"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """UPDATE pay_notify_steps SET status = 'pending', attempts = 0, next_run_at = NOW()
+                       WHERE event_id = %s AND status IN ('pending', 'failed')""",
+                    (event_id,),
+                )
+                cur.execute(
+                    """UPDATE pay_notify_inbox SET status = 'pending', next_run_at = NOW()
+                       WHERE id = %s AND status IN ('pending', 'failed')""",
+                    (event_id,),
+                )
+                requeued = cur.rowcount == 1
+                conn.commit()
+        return requeued
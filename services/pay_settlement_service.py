@@ -0,0 +1,304 @@
+# services/pay_settlement_service.py
+"""
+支付成功结算步骤
+
+原先回调里一口气完成订单更新、优惠券核销、split_order_funds、线下分账 + 商家转账、自提发货录入，
+其中线下分账在独立事务里先提交、订单状态后提交，中途失败重推会重复分账；商家转账、发货录入失败只能看日志。
+现在按步骤拆分，由 PayNotifyInbox 逐步执行并分别记录重试状态（pay_notify_steps）：
+
+- settle：订单结算（单个事务：锁订单 → 核销优惠券 → 金额核对 → 资金结算/线下分账 → 订单状态），
+  订单已不是待支付状态时视为已结算；完成后返回后续步骤
+- pickup_shipping：自提订单登记微信发货录入队列（services/shipping_sync_service.py）
+- merchant_transfer：线下订单商家应得转入微信零钱（按订单号幂等）
+- merchant_notice：商家到账模板消息
+
+业务校验不通过（金额不一致、优惠券失效等）抛出 SettlementRejected，不再重试，等待人工处理。
+"""
+import asyncio
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Dict, List, Tuple
+
+from core.config import POINTS_DISCOUNT_RATE
+from core.database import get_conn
+from core.exceptions import FinanceException
+from core.event_bus import order_event_bus
+from core.logging import get_logger
+from services.finance_service import (
+    FinanceService,
+    parse_pending_coupon_ids,
+    parse_offline_coupon_ids,
+    max_coupon_total_yuan,
+)
+from services.order_detail_cache import OrderDetailCache
+
+logger = get_logger(__name__)
+
+STEP_SETTLE = "settle"
+STEP_PICKUP_SHIPPING = "pickup_shipping"
+STEP_MERCHANT_TRANSFER = "merchant_transfer"
+STEP_MERCHANT_NOTICE = "merchant_notice"
+
+# 后续步骤：[(步骤名, 参数)]
+FollowUps = List[Tuple[str, Dict[str, Any]]]
+
+
+class SettlementRejected(Exception):
+    """业务校验不通过，重试无意义"""
+
+
+class PaySettlementService:
+
+    # ------------- settle -------------
+    @staticmethod
+    def settle(payload: Dict[str, Any]) -> FollowUps:
+        """结算一笔支付成功通知（payload 为解密后的回调 resource）"""
+        out_trade_no = payload.get("out_trade_no")
+        transaction_id = (payload.get("transaction_id") or "").strip()
+        amount = (payload.get("amount") or {}).get("total")
+        if not out_trade_no:
+            raise SettlementRejected("支付回调缺少 out_trade_no")
+
+        # 与小程序「发货管理」列表对齐：须与公众平台绑定的 appid、mchid 一致（便于排查搜不到单）
+        logger.info(
+            "支付成功结算: 订单号=%s, 微信流水号=%s, 金额=%s, appid=%s, mchid=%s, sub_mchid=%s",
+            out_trade_no, transaction_id, amount,
+            payload.get("appid"), payload.get("mchid"), payload.get("sub_mchid"),
+        )
+        try:
+            if out_trade_no.startswith("OFF"):
+                return PaySettlementService.settle_offline(out_trade_no, transaction_id, int(amount or 0))
+            return PaySettlementService.settle_online(out_trade_no, transaction_id, int(amount or 0))
+        finally:
+            # 支付结果已落库（或处理失败回滚），轮询中的订单详情需重新读取，并唤醒等待中的长轮询/SSE
+            OrderDetailCache.invalidate(out_trade_no)
+            order_event_bus.publish(out_trade_no, {"event": "pay_notify"})
+
+    @staticmethod
+    def settle_online(order_no: str, transaction_id: str, amount: int) -> FollowUps:
+        """线上商城订单：核销优惠券、资金结算、推进订单状态"""
+        from api.order.order import OrderManager
+
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, user_id, total_amount, status, delivery_way, "
+                    "pending_points, pending_coupon_id, pending_coupon_ids, original_amount, "
+                    "coupon_discount, points_discount "
+                    "FROM orders WHERE order_number=%s FOR UPDATE",
+                    (order_no,),
+                )
+                order = cur.fetchone()
+                if not order:
+                    # 可能是下单事务尚未提交，按退避重试
+                    raise LookupError(f"订单号不存在: {order_no}")
+                if order["status"] != "pending_pay":
+                    logger.info(f"订单 {order_no} 状态为 {order['status']}，已结算，忽略")
+                    return []
+
+                db_total = int((Decimal(str(order["total_amount"] or 0)) * 100).quantize(Decimal("1")))
+
+                # ====== 优惠券：多张叠加核销 ======
+                coupon_amt = Decimal("0")
+                coupon_id_list = parse_pending_coupon_ids(order)
+                if coupon_id_list:
+                    for cid in coupon_id_list:
+                        cur.execute(
+                            """SELECT id, amount, status, valid_to, user_id
+                               FROM coupons WHERE id = %s FOR UPDATE""",
+                            (cid,),
+                        )
+                        coupon_row = cur.fetchone()
+                        if (not coupon_row or coupon_row["status"] != "unused"
+                                or coupon_row["valid_to"] < datetime.now().date()):
+                            raise SettlementRejected(
+                                f"优惠券 {cid} 状态异常 "
+                                f"(status={coupon_row['status'] if coupon_row else 'not found'})"
+                            )
+                        if coupon_row["user_id"] != order["user_id"]:
+                            raise SettlementRejected(f"优惠券 {cid} 不属于当前订单用户")
+                        coupon_amt += Decimal(str(coupon_row["amount"]))
+
+                    orig = Decimal(str(order.get("original_amount") or 0))
+                    pd = min(Decimal(str(order.get("pending_points") or 0)) * POINTS_DISCOUNT_RATE, orig)
+                    max_c = max_coupon_total_yuan(orig, pd)
+                    if coupon_amt > max_c:
+                        raise SettlementRejected(
+                            f"优惠券叠加面额{coupon_amt}超过上限{max_c}元（原价扣积分后向上取整到元）"
+                        )
+
+                    placeholders = ",".join(["%s"] * len(coupon_id_list))
+                    cur.execute(
+                        f"UPDATE coupons SET status='used', used_at=NOW() "
+                        f"WHERE id IN ({placeholders}) AND status='unused'",
+                        tuple(coupon_id_list),
+                    )
+                    logger.info(f"订单 {order_no} 优惠券核销成功: IDs={coupon_id_list}, 合计金额={coupon_amt}")
+                else:
+                    coupon_amt = Decimal(str(order.get("coupon_discount") or 0))
+                    if coupon_amt > 0:
+                        logger.warning(
+                            "订单 %s 无 pending_coupon_ids 但存在 coupon_discount=%s，跳过核销，按落库券额结算",
+                            order_no, coupon_amt,
+                        )
+
+                # 微信支付金额与系统应付金额核对
+                if amount != db_total:
+                    raise SettlementRejected(f"金额不一致 微信{amount}≠系统{db_total}")
+
+                # 记录优惠券抵扣金额和交易流水号到订单表（发货接口需要 transaction_id）
+                cur.execute(
+                    """UPDATE orders
+                       SET coupon_discount = %s,
+                           original_amount = COALESCE(%s, total_amount),
+                           transaction_id = COALESCE(NULLIF(%s, ''), transaction_id)
+                       WHERE id = %s""",
+                    (coupon_amt, order.get("original_amount") or order["total_amount"], transaction_id, order["id"]),
+                )
+
+                # 资金结算（积分抵扣在 settle_order 内部处理）
+                FinanceService().settle_order(
+                    order_no=order_no,
+                    user_id=order["user_id"],
+                    order_id=order["id"],
+                    points_to_use=order.get("pending_points") or 0,
+                    coupon_discount=coupon_amt,
+                    external_conn=conn,
+                )
+
+                # 全部为虚拟商品的订单直接完成，否则按配送方式进入待收货/待发货
+                cur.execute(
+                    """SELECT COUNT(*) AS total,
+                              SUM(CASE WHEN p.is_virtual = 1 THEN 1 ELSE 0 END) AS virtual_count
+                       FROM order_items oi JOIN products p ON oi.product_id = p.id
+                       WHERE oi.order_id = %s""",
+                    (order["id"],),
+                )
+                counts = cur.fetchone()
+                total_items = counts["total"] or 0
+                if total_items > 0 and (counts["virtual_count"] or 0) == total_items:
+                    next_status = "completed"
+                    cur.execute("UPDATE orders SET completed_at = NOW() WHERE id = %s", (order["id"],))
+                else:
+                    next_status = "pending_recv" if order.get("delivery_way") == "pickup" else "pending_ship"
+                OrderManager.update_status(order_no, next_status, external_conn=conn)
+
+                conn.commit()
+
+        logger.info(f"线上订单支付成功: {order_no} -> {next_status}")
+        if next_status == "pending_recv":
+            return [(STEP_PICKUP_SHIPPING, {"order_no": order_no, "transaction_id": transaction_id})]
+        return []
+
+    @staticmethod
+    def settle_offline(order_no: str, transaction_id: str, amount: int) -> FollowUps:
+        """线下收银台订单：核销优惠券、更新订单、资金分账（与订单状态同一事务提交）"""
+        from services.offline_service import OfflineService
+
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, user_id, amount, paid_amount, status, coupon_id, coupon_ids, coupon_discount, "
+                    "merchant_id, store_name FROM offline_order WHERE order_no = %s FOR UPDATE",
+                    (order_no,),
+                )
+                order = cur.fetchone()
+                if not order:
+                    raise LookupError(f"线下订单不存在: {order_no}")
+                if order["status"] != 1:  # 1=待支付
+                    logger.info(f"[offline-pay] 订单已处理: {order_no}, 状态={order['status']}")
+                    return []
+
+                # 金额核对；paid_amount 缺失时按优惠券重新计算并修正
+                offline_cids = parse_offline_coupon_ids(order)
+                db_total = order.get("paid_amount")
+                if not db_total:
+                    logger.warning(f"[offline-pay] 订单 {order_no} paid_amount 为0或None，尝试从优惠券重新计算")
+                    coupon_discount = max(int(order.get("coupon_discount") or 0), 0)
+                    if coupon_discount == 0 and offline_cids:
+                        placeholders = ",".join(["%s"] * len(offline_cids))
+                        cur.execute(
+                            f"SELECT id, amount FROM coupons WHERE id IN ({placeholders})",
+                            tuple(offline_cids),
+                        )
+                        coupon_discount = sum(int(Decimal(r["amount"]) * 100) for r in cur.fetchall())
+                    expected_paid = max(order["amount"] - coupon_discount, 0)
+                    if amount != expected_paid:
+                        raise SettlementRejected(f"金额不一致: 微信{amount}≠预期{expected_paid}")
+                    db_total = expected_paid
+                    cur.execute("UPDATE offline_order SET paid_amount = %s WHERE id = %s", (db_total, order["id"]))
+                    logger.info(f"[offline-pay] 已修复订单 {order_no} paid_amount 为 {db_total}")
+                elif amount != db_total:
+                    raise SettlementRejected(f"金额不一致: 微信{amount}≠系统{db_total}")
+
+                # 核销优惠券：与订单状态、分账同一事务，结算失败回滚时券不会被单独核销；
+                # 券校验不通过（已使用/过期等）只记日志，不阻断结算
+                if offline_cids:
+                    fs = FinanceService()
+                    for cid in offline_cids:
+                        try:
+                            fs._use_coupon_on_cursor(cur, int(cid), order["user_id"], order_type="normal")
+                        except FinanceException as e:
+                            logger.error(f"[offline-pay] 优惠券核销失败（需人工处理）: 订单={order_no}, 券={cid}, 错误={e}")
+
+                cur.execute(
+                    """UPDATE offline_order
+                       SET status = 2, pay_time = NOW(), transaction_id = %s, updated_at = NOW()
+                       WHERE id = %s""",
+                    (transaction_id, order["id"]),
+                )
+
+                split = OfflineService.split_paid_order(
+                    cur,
+                    order_no=order_no,
+                    amount=Decimal(db_total) / 100,
+                    coupon_discount=Decimal(order["amount"] - db_total) / 100 if offline_cids else Decimal(0),
+                    transaction_id=transaction_id or None,
+                )
+                conn.commit()
+
+        logger.info(f"[offline-pay] 线下订单支付成功: {order_no}")
+        merchant_fen = int(split["merchant_amount"] * 100) if split else 0
+        if merchant_fen <= 0:
+            return []
+        return [(STEP_MERCHANT_TRANSFER, {
+            "order_no": order_no, "merchant_id": split["merchant_id"], "amount": merchant_fen,
+        })]
+
+    # ------------- 后续步骤 -------------
+    @staticmethod
+    def upload_pickup_shipping(params: Dict[str, Any]) -> FollowUps:
+        """自提订单登记微信发货录入（logistics_type=4），上传与重试由 ShippingSyncService 队列负责"""
+        from services.shipping_sync_service import ShippingSyncService
+
+        if not ShippingSyncService.enqueue_order(params["order_no"], logistics_type=4):
+            raise LookupError(f"订单不存在: {params['order_no']}")
+        return []
+
+    @staticmethod
+    async def merchant_transfer(params: Dict[str, Any]) -> FollowUps:
+        from services.notify_service import transfer_to_merchant
+
+        if not await transfer_to_merchant(params["merchant_id"], params["order_no"], params["amount"]):
+            return []
+        return [(STEP_MERCHANT_NOTICE, params)]
+
+    @staticmethod
+    async def merchant_notice(params: Dict[str, Any]) -> FollowUps:
+        from services.notify_service import send_merchant_income_notice
+
+        await send_merchant_income_notice(params["merchant_id"], params["order_no"], params["amount"])
+        return []
+
+    @staticmethod
+    async def run_step(step: str, params: Dict[str, Any]) -> FollowUps:
+        """执行一个步骤；同步步骤放到线程池，不阻塞事件循环"""
+        if step == STEP_SETTLE:
+            return await asyncio.to_thread(PaySettlementService.settle, params)
+        if step == STEP_PICKUP_SHIPPING:
+            return await asyncio.to_thread(PaySettlementService.upload_pickup_shipping, params)
+        if step == STEP_MERCHANT_TRANSFER:
+            return await PaySettlementService.merchant_transfer(params)
+        if step == STEP_MERCHANT_NOTICE:
+            return await PaySettlementService.merchant_notice(params)
+        raise SettlementRejected(f"未知的结算步骤: {step}")
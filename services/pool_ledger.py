@@ -0,0 +1,145 @@
+# services/pool_ledger.py
+"""
+资金池批量记账
+
+一次业务事件（订单分账、线下收款等）往往要改动多个资金池：平台收入池入账、商家部分扣回、各子池分配……
+逐笔调用 FinanceService._add_pool_balance 时，每笔都是 SELECT ... FOR UPDATE / UPDATE / 再 SELECT / INSERT 流水，
+同一支付在 finance_accounts 的几行热点数据上反复加锁。
+
+PoolLedger 把同一事件的变动先攒起来，commit 时：
+1. 按 account_type 排序一次性 SELECT ... FOR UPDATE 锁定涉及的资金池（固定加锁顺序，避免死锁）
+2. 按登记顺序逐笔计算余额并校验（与逐笔扣减时的余额不足判断一致）
+3. 一条 UPDATE ... CASE 写入所有资金池的净变动
+4. 一条多行 INSERT 写入全部 account_flow 流水（balance_after 为该笔之后的余额）
+
+使用示例:
+    ledger = PoolLedger(related_order_id=order_id, ref_type=REF_ORDER_SPLIT)
+    ledger.add('platform_revenue_pool', total, f"订单分账: {order_no} 用户支付¥{total:.2f}")
+    ledger.add('subsidy_pool', amt, f"订单分账: {order_no}")
+    balances = ledger.commit(cur)   # {account_type: 变动后余额}
+"""
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+from core.db_adapter import build_in_placeholders
+from core.exceptions import InsufficientBalanceException
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class PoolLedger:
+
+    def __init__(self, related_order_id: Optional[int] = None, ref_type: Optional[str] = None):
+        self.related_order_id = related_order_id
+        self.ref_type = ref_type
+        self._entries: List[Dict[str, Any]] = []
+
+    def add(self, account_type: str, amount: Decimal, remark: str,
+            related_user: Optional[int] = None, check_balance: bool = True,
+            ref_type: Optional[str] = None) -> "PoolLedger":
+        """登记一笔资金池变动（amount 为负表示扣减）
+
+        check_balance: 扣减时是否校验余额充足，与 _add_pool_balance 行为一致；
+                       原先直接 UPDATE、不做校验的路径传 False
+        ref_type: 覆盖本批次默认的 ref_type
+        """
+        self._entries.append({
+            "account_type": account_type,
+            "amount": Decimal(str(amount)),
+            "remark": remark,
+            "related_user": related_user,
+            "check_balance": check_balance,
+            "ref_type": ref_type or self.ref_type,
+        })
+        return self
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def commit(self, cur) -> Dict[str, Decimal]:
+        """在调用方事务内落账，返回各资金池变动后余额；不负责 conn.commit()"""
+        if not self._entries:
+            return {}
+
+        account_types = sorted({e["account_type"] for e in self._entries})
+        placeholders, params = build_in_placeholders(account_types)
+
+        cur.execute(
+            f"""SELECT account_type, balance FROM finance_accounts
+                WHERE account_type IN ({placeholders})
+                ORDER BY account_type
+                FOR UPDATE""",
+            tuple(params.values())
+        )
+        balances = {
+            row["account_type"]: Decimal(str(row["balance"] if row["balance"] is not None else 0))
+            for row in cur.fetchall()
+        }
+
+        # 不存在的资金池先建行（初始余额 0），插入即持有该行锁
+        missing = [t for t in account_types if t not in balances]
+        if missing:
+            cur.executemany(
+                """INSERT INTO finance_accounts (account_name, account_type, balance) VALUES (%s, %s, 0)
+                   ON DUPLICATE KEY UPDATE account_name = account_name""",
+                [(t, t) for t in missing]
+            )
+            # 并发建行时以库中实际余额为准
+            placeholders, params = build_in_placeholders(missing)
+            cur.execute(
+                f"""SELECT account_type, balance FROM finance_accounts
+                    WHERE account_type IN ({placeholders})
+                    FOR UPDATE""",
+                tuple(params.values())
+            )
+            for row in cur.fetchall():
+                balances[row["account_type"]] = Decimal(str(row["balance"] if row["balance"] is not None else 0))
+
+        # 按登记顺序推算每笔之后的余额
+        running = dict(balances)
+        flow_rows = []
+        for e in self._entries:
+            atype, amount = e["account_type"], e["amount"]
+            current = running[atype]
+            if e["check_balance"] and amount < 0 and current + amount < 0:
+                raise InsufficientBalanceException(
+                    f"finance_account:{atype}",
+                    abs(amount),
+                    current,
+                    message=f"资金池 {atype} 余额不足，当前: {current:.4f}，需要扣减: {abs(amount):.4f}"
+                )
+            running[atype] = current + amount
+            flow_rows.append((
+                atype, e["related_user"], amount, running[atype],
+                'income' if amount >= 0 else 'expense', e["remark"],
+                self.related_order_id, e["ref_type"],
+            ))
+
+        deltas = {t: running[t] - balances[t] for t in account_types}
+        changed = [t for t in account_types if deltas[t] != 0]
+        if changed:
+            case_sql = " ".join(["WHEN %s THEN %s"] * len(changed))
+            case_params = [v for t in changed for v in (t, deltas[t])]
+            in_placeholders, in_params = build_in_placeholders(changed)
+            cur.execute(
+                f"""UPDATE finance_accounts
+                    SET balance = balance + CASE account_type {case_sql} ELSE 0 END
+                    WHERE account_type IN ({in_placeholders})""",
+                (*case_params, *in_params.values())
+            )
+
+        values_sql = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, NOW())"] * len(flow_rows))
+        cur.execute(
+            f"""INSERT INTO account_flow (account_type, related_user, change_amount, balance_after,
+                                          flow_type, remark, related_order_id, ref_type, created_at)
+                VALUES {values_sql}""",
+            tuple(v for row in flow_rows for v in row)
+        )
+
+        logger.debug(
+            f"资金池批量记账: {len(flow_rows)}笔流水，"
+            f"{', '.join(f'{t}{deltas[t]:+.4f}' for t in account_types)}"
+        )
+        self._entries = []
+        return {t: running[t] for t in account_types}
@@ -0,0 +1,396 @@
+# services/refund_service.py
+"""
+微信退款任务队列
+
+流程：
+1. 审核通过时 RefundService.enqueue 在审核事务内写入 refund_tasks（pending），订单置为 refunding 后立即提交，
+   审核接口不再在持有订单行锁的事务里等待微信接口
+2. process_pending（定时任务 + 审核后唤醒）在任何事务之外调用 wxpay_client.refund，受 refund_rate_limiter 限流；
+   失败按指数退避重试，超过 MAX_SUBMIT_ATTEMPTS 次恢复订单原状态，退款申请退回 applied 等待重新审核
+3. 微信受理后任务进入 processing，并执行分账回冲 reverse_split_once（以 split_reversed 标记保证只回冲一次，
+   退款成功路径同样调用，回调/同步抢在受理落库之前到达时也不会漏掉回冲）
+4. sync_in_flight 定时批量查询 processing 任务的微信退款状态；终态处理与退款回调共用
+   apply_refund_success / apply_refund_closed，并写入回调幂等标记，先到的一方生效
+"""
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from core.config import settings
+from core.database import get_conn
+from core.idempotency import idempotency_store, REFUND_NOTIFY_NAMESPACE
+from core.logging import get_logger
+from core.rate_limiter import refund_rate_limiter
+from core.wx_pay_client import wxpay_client
+from services.order_detail_cache import OrderDetailCache
+from services.finance_service import FinanceService, reverse_split_on_refund
+
+logger = get_logger(__name__)
+
+# 提交退款的最大尝试次数与退避基数（秒）：30s, 60s, 120s, 240s ...
+MAX_SUBMIT_ATTEMPTS = 5
+SUBMIT_RETRY_BASE_SECONDS = 30
+# processing 任务两次查询间隔（秒）
+SYNC_INTERVAL_SECONDS = 300
+# submitting 状态超过该时长视为 worker 中断，重新入队（微信按 out_refund_no 幂等）
+SUBMITTING_STALE_MINUTES = 10
+
+_worker_lock = threading.Lock()
+
+
+@refund_rate_limiter
+def _wx_refund(task: Dict[str, Any], rate_key: str) -> Dict[str, Any]:
+    return wxpay_client.refund(
+        transaction_id=task["transaction_id"],
+        out_refund_no=task["out_refund_no"],
+        total_fee=task["total_fee"],
+        refund_fee=task["refund_fee"],
+        notify_url=f"{settings.public_base_url}/api/wechat-pay/refund-notify",
+        sub_mchid=task.get("sub_mchid"),
+    )
+
+
+@refund_rate_limiter
+def _wx_query_refund(task: Dict[str, Any], rate_key: str) -> Dict[str, Any]:
+    return wxpay_client.query_refund(task["out_refund_no"], sub_mchid=task.get("sub_mchid"))
+
+
+def _rate_key(task: Dict[str, Any]) -> str:
+    return task.get("sub_mchid") or "platform"
+
+
+class RefundService:
+
+    # ------------- 入队 -------------
+    @staticmethod
+    def enqueue(
+        cur,
+        order_number: str,
+        transaction_id: str,
+        total_fee: int,
+        refund_fee: int,
+        sub_mchid: Optional[str] = None,
+        prev_order_status: Optional[str] = None,
+    ) -> str:
+        """在调用方事务内登记退款任务，返回商户退款单号（由调用方提交事务）"""
+        out_refund_no = f"REF{order_number}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        cur.execute(
+            """INSERT INTO refund_tasks
+               (order_number, out_refund_no, transaction_id, total_fee, refund_fee, sub_mchid, prev_order_status)
+               VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+            (order_number, out_refund_no, transaction_id, total_fee, refund_fee, sub_mchid, prev_order_status),
+        )
+        return out_refund_no
+
+    @staticmethod
+    def kick() -> None:
+        """审核提交后唤醒 worker，不必等下一次定时任务"""
+        if _worker_lock.locked():
+            return
+        threading.Thread(target=RefundService.process_pending, daemon=True, name="refund-worker").start()
+
+    # ------------- 提交退款 -------------
+    @staticmethod
+    def _claim_pending(limit: int) -> List[Dict[str, Any]]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """UPDATE refund_tasks SET status='pending'
+                       WHERE status='submitting' AND updated_at < NOW() - INTERVAL %s MINUTE""",
+                    (SUBMITTING_STALE_MINUTES,),
+                )
+                cur.execute(
+                    """SELECT * FROM refund_tasks
+                       WHERE status='pending' AND next_run_at <= NOW()
+                       ORDER BY id LIMIT %s""",
+                    (limit,),
+                )
+                rows = cur.fetchall()
+                claimed = []
+                for row in rows:
+                    cur.execute(
+                        """UPDATE refund_tasks SET status='submitting', attempts=attempts+1
+                           WHERE id=%s AND status='pending'""",
+                        (row["id"],),
+                    )
+                    if cur.rowcount == 1:
+                        row["attempts"] += 1
+                        claimed.append(row)
+                conn.commit()
+                return claimed
+
+    @staticmethod
+    def process_pending(limit: int = 20) -> int:
+        """提交待处理退款，返回本轮受理成功的数量"""
+        if not _worker_lock.acquire(blocking=False):
+            return 0
+        accepted = 0
+        try:
+            for task in RefundService._claim_pending(limit):
+                try:
+                    result = _wx_refund(task, _rate_key(task))
+                except Exception as e:
+                    logger.error(f"【退款队列】提交失败 {task['out_refund_no']} 第{task['attempts']}次: {e}")
+                    RefundService._on_submit_error(task, str(e))
+                    continue
+                if RefundService._on_submit_accepted(task, result):
+                    accepted += 1
+        finally:
+            _worker_lock.release()
+        return accepted
+
+    @staticmethod
+    def _on_submit_accepted(task: Dict[str, Any], result: Dict[str, Any]) -> bool:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """UPDATE refund_tasks
+                       SET status='processing', wx_refund_id=%s, last_error=NULL,
+                           next_run_at=NOW() + INTERVAL %s SECOND
+                       WHERE id=%s AND status='submitting'""",
+                    (result.get("refund_id"), SYNC_INTERVAL_SECONDS, task["id"]),
+                )
+                moved = cur.rowcount == 1
+                conn.commit()
+        if moved:
+            logger.info(f"【退款队列】微信已受理: {task['out_refund_no']}, refund_id={result.get('refund_id')}")
+        # 回调/同步可能已抢先把任务推进到 success，回冲不依赖上面的状态迁移
+        RefundService.reverse_split_once(task["out_refund_no"], task["order_number"])
+        return moved
+
+    @staticmethod
+    def reverse_split_once(out_refund_no: str, order_number: str) -> bool:
+        """分账回冲（每个退款任务只执行一次）：先以 split_reversed=0 为条件抢占标记再回冲，
+        受理与退款成功两条路径都会调用，先到的一方执行；回冲失败则清除标记，下次到达时重试"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE refund_tasks SET split_reversed=1 WHERE out_refund_no=%s AND split_reversed=0",
+                    (out_refund_no,),
+                )
+                claimed = cur.rowcount == 1
+                conn.commit()
+        if not claimed:
+            return False
+        try:
+            reverse_split_on_refund(order_number)
+            return True
+        except Exception as e:
+            logger.error(f"【退款队列】分账回冲失败，需人工处理: {order_number}: {e}", exc_info=True)
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE refund_tasks SET split_reversed=0 WHERE out_refund_no=%s",
+                        (out_refund_no,),
+                    )
+                    conn.commit()
+            return False
+
+    @staticmethod
+    def _on_submit_error(task: Dict[str, Any], error: str) -> None:
+        error = error[:500]
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                if task["attempts"] < MAX_SUBMIT_ATTEMPTS:
+                    delay = SUBMIT_RETRY_BASE_SECONDS * (2 ** (task["attempts"] - 1))
+                    cur.execute(
+                        """UPDATE refund_tasks
+                           SET status='pending', last_error=%s, next_run_at=NOW() + INTERVAL %s SECOND
+                           WHERE id=%s AND status='submitting'""",
+                        (error, delay, task["id"]),
+                    )
+                else:
+                    cur.execute(
+                        "UPDATE refund_tasks SET status='failed', last_error=%s WHERE id=%s AND status='submitting'",
+                        (error, task["id"]),
+                    )
+                    if cur.rowcount == 1:
+                        cur.execute(
+                            """UPDATE orders SET status=%s, updated_at=NOW()
+                               WHERE order_number=%s AND refund_no=%s AND status='refunding'""",
+                            (task.get("prev_order_status") or "completed", task["order_number"], task["out_refund_no"]),
+                        )
+                        cur.execute(
+                            "UPDATE refunds SET status='applied' WHERE order_number=%s AND status='seller_ok'",
+                            (task["order_number"],),
+                        )
+                        logger.error(f"【退款队列】多次提交失败，订单已恢复原状态待重新审核: {task['order_number']}")
+                conn.commit()
+        OrderDetailCache.invalidate(task["order_number"])
+
+    # ------------- 终态处理（回调与批量同步共用） -------------
+    @staticmethod
+    def apply_refund_success(out_refund_no: str) -> bool:
+        """退款成功：订单置为 refunded 并回退积分/优惠券（同一事务），返回是否有订单被更新"""
+        order_number = None
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE orders SET status='refunded', updated_at=NOW() WHERE refund_no=%s AND status='refunding'",
+                    (out_refund_no,)
+                )
+                if cur.rowcount > 0:
+                    cur.execute("SELECT order_number FROM orders WHERE refund_no=%s", (out_refund_no,))
+                    row = cur.fetchone()
+                    order_number = row["order_number"] if row else None
+                else:
+                    # 兼容 refund_no 未回写的历史订单：从 REF{order_number}_{ts} 解析订单号
+                    parts = (out_refund_no or "").split('_')
+                    if len(parts) >= 2 and parts[0].startswith('REF'):
+                        cur.execute(
+                            "UPDATE orders SET status='refunded', updated_at=NOW() WHERE order_number=%s AND status='refunding'",
+                            (parts[0][3:],)
+                        )
+                        if cur.rowcount > 0:
+                            order_number = parts[0][3:]
+
+                if not order_number:
+                    logger.warning(f"【退款】未找到匹配的退款中订单: out_refund_no={out_refund_no}")
+                    cur.execute(
+                        "UPDATE refund_tasks SET status='success' WHERE out_refund_no=%s AND status='processing'",
+                        (out_refund_no,)
+                    )
+                    conn.commit()
+                    return False
+
+                # 出错时抛出异常，事务回滚，订单保持 refunding 等待下次回调/同步
+                FinanceService.revoke_order_discounts(order_number, external_cur=cur)
+                cur.execute(
+                    "UPDATE refund_tasks SET status='success' WHERE out_refund_no=%s",
+                    (out_refund_no,)
+                )
+                cur.execute(
+                    "UPDATE refunds SET status='refund_success' WHERE order_number=%s AND status='seller_ok'",
+                    (order_number,)
+                )
+                conn.commit()
+        OrderDetailCache.invalidate(order_number)
+        idempotency_store.mark_done(REFUND_NOTIFY_NAMESPACE, f"{out_refund_no}:SUCCESS")
+        RefundService.reverse_split_once(out_refund_no, order_number)
+        logger.info(f"【退款】✅ 退款成功并完成积分/优惠券回退: out_refund_no={out_refund_no}, order={order_number}")
+        return True
+
+    @staticmethod
+    def apply_refund_closed(out_refund_no: str) -> bool:
+        """退款关闭：订单恢复到发起退款前的状态（无记录时按 completed），退款申请落终态 rejected"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT order_number, prev_order_status FROM refund_tasks WHERE out_refund_no=%s",
+                    (out_refund_no,)
+                )
+                task = cur.fetchone()
+                prev_status = (task or {}).get("prev_order_status") or "completed"
+                cur.execute(
+                    """UPDATE orders SET status=%s, refund_status='rejected', updated_at=NOW()
+                       WHERE refund_no=%s AND status='refunding'""",
+                    (prev_status, out_refund_no)
+                )
+                updated = cur.rowcount > 0
+                # 与订单、任务同一事务落终态，避免分账已回冲而申请停留在 seller_ok
+                cur.execute(
+                    """UPDATE refunds r JOIN orders o ON o.order_number = r.order_number
+                       SET r.status='rejected', r.reject_reason='微信退款关闭'
+                       WHERE o.refund_no=%s AND r.status='seller_ok'""",
+                    (out_refund_no,)
+                )
+                cur.execute(
+                    "UPDATE refund_tasks SET status='closed' WHERE out_refund_no=%s",
+                    (out_refund_no,)
+                )
+                conn.commit()
+        if task:
+            OrderDetailCache.invalidate(task["order_number"])
+        idempotency_store.mark_done(REFUND_NOTIFY_NAMESPACE, f"{out_refund_no}:REFUNDCLOSE")
+        return updated
+
+    @staticmethod
+    def apply_query_result(task: Dict[str, Any], result: Dict[str, Any]) -> str:
+        """按微信查询结果推进任务，返回微信侧状态"""
+        status = result.get("status")
+        out_refund_no = task["out_refund_no"]
+        if status == "SUCCESS":
+            if not idempotency_store.is_done(REFUND_NOTIFY_NAMESPACE, f"{out_refund_no}:SUCCESS"):
+                RefundService.apply_refund_success(out_refund_no)
+        elif status == "CLOSED":
+            if not idempotency_store.is_done(REFUND_NOTIFY_NAMESPACE, f"{out_refund_no}:REFUNDCLOSE"):
+                RefundService.apply_refund_closed(out_refund_no)
+        elif status == "ABNORMAL":
+            logger.warning(f"【退款】退款异常，需要人工处理: out_refund_no={out_refund_no}, detail={result}")
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE refund_tasks SET status='abnormal', last_error=%s WHERE out_refund_no=%s",
+                        (str(result)[:500], out_refund_no)
+                    )
+                    conn.commit()
+        return status or "UNKNOWN"
+
+    # ------------- 批量同步 -------------
+    @staticmethod
+    def sync_in_flight(limit: int = 100) -> Dict[str, int]:
+        """批量查询 processing 中的退款并落终态；未到终态的统一顺延下次查询时间"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT id, order_number, out_refund_no, sub_mchid, prev_order_status
+                       FROM refund_tasks
+                       WHERE status='processing' AND next_run_at <= NOW()
+                       ORDER BY next_run_at LIMIT %s""",
+                    (limit,)
+                )
+                tasks = cur.fetchall()
+
+        stats: Dict[str, int] = {}
+        postponed: List[int] = []
+        for task in tasks:
+            try:
+                status = RefundService.apply_query_result(task, _wx_query_refund(task, _rate_key(task)))
+            except Exception as e:
+                logger.error(f"【退款同步】查询/处理失败 {task['out_refund_no']}: {e}")
+                status = "ERROR"
+            stats[status] = stats.get(status, 0) + 1
+            if status in ("PROCESSING", "ERROR", "UNKNOWN"):
+                postponed.append(task["id"])
+
+        if postponed:
+            placeholders = ",".join(["%s"] * len(postponed))
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        f"""UPDATE refund_tasks SET next_run_at = NOW() + INTERVAL %s SECOND
+                            WHERE id IN ({placeholders}) AND status='processing'""",
+                        (SYNC_INTERVAL_SECONDS, *postponed)
+                    )
+                    conn.commit()
+        return stats
+
+    @staticmethod
+    def sync_order(order_number: str) -> Optional[Dict[str, Any]]:
+        """同步单个订单的退款状态（手动接口用）；无退款任务时按 orders.refund_no 查询"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT id, order_number, out_refund_no, sub_mchid, prev_order_status, status
+                       FROM refund_tasks WHERE order_number=%s ORDER BY id DESC LIMIT 1""",
+                    (order_number,)
+                )
+                task = cur.fetchone()
+                if not task:
+                    cur.execute(
+                        """SELECT o.refund_no, u.wechat_sub_mchid FROM orders o
+                           LEFT JOIN users u ON o.merchant_id = u.id
+                           WHERE o.order_number=%s""",
+                        (order_number,)
+                    )
+                    row = cur.fetchone()
+                    if not row or not row.get("refund_no"):
+                        return None
+                    task = {"order_number": order_number, "out_refund_no": row["refund_no"],
+                            "sub_mchid": row.get("wechat_sub_mchid"), "status": "processing"}
+
+        if task["status"] in ("pending", "submitting"):
+            return {"out_refund_no": task["out_refund_no"], "wechat_status": None, "task_status": task["status"]}
+        result = _wx_query_refund(task, _rate_key(task))
+        wechat_status = RefundService.apply_query_result(task, result)
+        return {"out_refund_no": task["out_refund_no"], "wechat_status": wechat_status, "task_status": task["status"]}
@@ -0,0 +1,353 @@
+# services/shipping_sync_service.py
+"""
+微信小程序发货信息录入队列
+
+原先商家发货（/ship）与自提订单支付后各自在请求线程里逐单调用 upload_shipping_info，
+自提还要在线程里 sleep 等待「支付单不存在」重试，商家一次扫几百个包裹就串行等几百次微信接口。现在：
+
+1. 入队：发货/自提在本地事务内 ShippingSyncService.enqueue 写入 wechat_shipping_queue（每单一行），
+   orders.wechat_shipping_status 置 0（未上传），提交后 kick() 唤醒 worker，接口立即返回
+2. process_pending（定时任务 + 入队后唤醒）：一次认领一批到期任务，订单/openid/商品名各一次 IN 查询，
+   最多 UPLOAD_CONCURRENCY 个并发调用微信；结果（队列状态、orders 发货状态、wechat_shipping_logs 明细）
+   在一个事务里批量写入
+3. 重试：失败按指数退避（「支付单不存在」用较短的固定间隔，等待微信侧同步支付单），
+   每次尝试都记入 wechat_shipping_logs（首次 upload，之后 retry），超过 MAX_ATTEMPTS 置 failed
+4. 对账 reconcile：按支付时间窗口分页拉取微信 get_order_list，微信侧已发货/已收货的未完成任务直接置 done
+   （覆盖超时但实际成功、商家在微信后台手工录入等情况），不再逐单 get_order
+"""
+import json
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.config import settings
+from core.database import get_conn
+from core.db_adapter import build_in_placeholders
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+# 单轮认领数量与并发上传数
+BATCH_SIZE = 50
+UPLOAD_CONCURRENCY = 4
+# 最大尝试次数与退避基数（秒）：30s, 60s, 120s ...
+MAX_ATTEMPTS = 8
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+# 微信「支付单不存在」（支付成功瞬间录入时微信侧尚未同步）的重试间隔
+PAYMENT_NOT_FOUND_RETRY_SECONDS = 15
+# uploading 状态超过该时长视为 worker 中断，重新入队
+UPLOADING_STALE_MINUTES = 10
+# 对账时回看的支付时间窗口（天）
+RECONCILE_DAYS = 7
+
+# 本地数据缺失（无 openid / transaction_id），重试无意义，直接置 failed
+ERR_LOCAL_MISSING = -2
+
+# 微信 order_state：1待发货 2已发货 3确认收货 4交易完成
+WX_SHIPPED_STATES = (2, 3, 4)
+
+_worker_lock = threading.Lock()
+
+
+def _item_desc(names: List[str]) -> str:
+    clean_names = [re.sub(r"[\r\n\t]", "", n or "") for n in names]
+    joined = "、".join(n for n in clean_names if n)
+    if len(joined) > 120:
+        return joined[:117] + "…"
+    return joined or "商品"
+
+
+class ShippingSyncService:
+
+    # ------------- 入队 -------------
+    @staticmethod
+    def enqueue(cur, order_id: int, order_number: str, transaction_id: Optional[str],
+                logistics_type: int, tracking_no: Optional[str] = None,
+                express_company: Optional[str] = None) -> None:
+        """在调用方事务内登记（或重置）发货录入任务，由调用方提交事务后 kick()"""
+        cur.execute(
+            """INSERT INTO wechat_shipping_queue
+               (order_id, order_number, transaction_id, logistics_type, tracking_no, express_company)
+               VALUES (%s, %s, %s, %s, %s, %s)
+               ON DUPLICATE KEY UPDATE transaction_id=VALUES(transaction_id), logistics_type=VALUES(logistics_type),
+                   tracking_no=VALUES(tracking_no), express_company=VALUES(express_company),
+                   status='pending', attempts=0, next_run_at=NOW(), last_error=NULL""",
+            (order_id, order_number, transaction_id or None, logistics_type, tracking_no, express_company),
+        )
+        cur.execute(
+            """UPDATE orders SET wechat_shipping_status=0, wechat_shipping_msg=NULL, wechat_shipping_retry_count=0
+               WHERE id=%s""",
+            (order_id,),
+        )
+
+    @staticmethod
+    def enqueue_order(order_number: str, logistics_type: int) -> bool:
+        """按订单号入队（自提等无物流单号的场景），订单不存在返回 False"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, transaction_id FROM orders WHERE order_number=%s",
+                    (order_number,),
+                )
+                row = cur.fetchone()
+                if not row:
+                    return False
+                ShippingSyncService.enqueue(cur, row["id"], order_number, row.get("transaction_id"), logistics_type)
+                conn.commit()
+        ShippingSyncService.kick()
+        return True
+
+    @staticmethod
+    def kick() -> None:
+        """入队后唤醒 worker，不必等下一次定时任务"""
+        if _worker_lock.locked():
+            return
+        threading.Thread(target=ShippingSyncService.process_pending, daemon=True, name="shipping-worker").start()
+
+    # ------------- 认领 -------------
+    @staticmethod
+    def _claim(limit: int) -> List[Dict[str, Any]]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """UPDATE wechat_shipping_queue SET status='pending'
+                       WHERE status='uploading' AND updated_at < NOW() - INTERVAL %s MINUTE""",
+                    (UPLOADING_STALE_MINUTES,),
+                )
+                cur.execute(
+                    """SELECT id FROM wechat_shipping_queue
+                       WHERE status='pending' AND next_run_at <= NOW()
+                       ORDER BY next_run_at, id LIMIT %s""",
+                    (limit,),
+                )
+                ids = [r["id"] for r in cur.fetchall()]
+                if not ids:
+                    conn.commit()
+                    return []
+                # 认领令牌：多进程同时认领时只处理本进程实际置为 uploading 的行
+                token = uuid.uuid4().hex
+                placeholders, params = build_in_placeholders(ids)
+                cur.execute(
+                    f"""UPDATE wechat_shipping_queue SET status='uploading', attempts=attempts+1, claim_token=%s
+                        WHERE id IN ({placeholders}) AND status='pending'""",
+                    (token, *params.values()),
+                )
+                # 一次查出任务、订单与 openid
+                cur.execute(
+                    """SELECT q.*, u.openid
+                       FROM wechat_shipping_queue q
+                       JOIN orders o ON o.id = q.order_id
+                       LEFT JOIN users u ON u.id = o.user_id
+                       WHERE q.claim_token=%s AND q.status='uploading'""",
+                    (token,),
+                )
+                tasks = cur.fetchall()
+                if tasks:
+                    order_ids = [t["order_id"] for t in tasks]
+                    o_placeholders, o_params = build_in_placeholders(order_ids)
+                    cur.execute(
+                        f"""SELECT oi.order_id, p.name
+                            FROM order_items oi JOIN products p ON oi.product_id = p.id
+                            WHERE oi.order_id IN ({o_placeholders})
+                            ORDER BY oi.id""",
+                        tuple(o_params.values()),
+                    )
+                    names: Dict[int, List[str]] = {}
+                    for r in cur.fetchall():
+                        names.setdefault(r["order_id"], []).append(r["name"])
+                    for t in tasks:
+                        t["item_desc"] = _item_desc(names.get(t["order_id"], []))
+                conn.commit()
+                return tasks
+
+    # ------------- 上传 -------------
+    @staticmethod
+    def _upload(wx_service, task: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """调用微信录入一单，返回 (请求摘要, 微信返回)；不抛异常"""
+        openid = (task.get("openid") or "").strip()
+        tid = (task.get("transaction_id") or "").strip()
+        logistics_type = int(task["logistics_type"])
+        shipping_list: List[Dict[str, Any]] = [{"item_desc": task["item_desc"]}]
+        if logistics_type in (1, 2) and task.get("tracking_no"):  # 快递或同城配送需填写物流单号
+            shipping_list[0]["tracking_no"] = task["tracking_no"]
+            shipping_list[0]["express_company"] = task.get("express_company") or "YTO"
+        request = {"transaction_id": tid, "logistics_type": logistics_type, "shipping_list": shipping_list}
+        if not openid:
+            return request, {"errcode": ERR_LOCAL_MISSING, "errmsg": "用户无 openid"}
+
+        try:
+            # 自提在支付回调后立即入队，按商户单号录入更易命中；失败再按微信支付单号
+            mchid = (getattr(settings, "WECHAT_PAY_MCH_ID", None) or "").strip()
+            if logistics_type == 4 and mchid:
+                result = wx_service.upload_shipping_info(
+                    "", openid, logistics_type, shipping_list, mchid=mchid, out_trade_no=task["order_number"],
+                )
+                if result.get("errcode") == 0 or not tid:
+                    return {**request, "out_trade_no": task["order_number"]}, result
+            if not tid:
+                return request, {"errcode": ERR_LOCAL_MISSING, "errmsg": "缺少 transaction_id"}
+            return request, wx_service.upload_shipping_info(tid, openid, logistics_type, shipping_list, delivery_mode=1)
+        except Exception as e:
+            return request, {"errcode": -1, "errmsg": f"请求异常: {e}"[:500]}
+
+    @staticmethod
+    def _retry_delay(task: Dict[str, Any], result: Dict[str, Any]) -> int:
+        from services.wechat_shipping_v2_service import ERR_WX_SHIPPING_PAYMENT_NOT_FOUND
+
+        if result.get("errcode") == ERR_WX_SHIPPING_PAYMENT_NOT_FOUND:
+            return PAYMENT_NOT_FOUND_RETRY_SECONDS
+        return min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** (task["attempts"] - 1)))
+
+    @staticmethod
+    def _record(results: List[Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]]) -> None:
+        """批量写入队列状态、orders 发货状态与 wechat_shipping_logs"""
+        logs = []
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                for task, request, result in results:
+                    ok = result.get("errcode") == 0
+                    errmsg = None if ok else str(result.get("errmsg") or result)[:500]
+                    retry_count = min(task["attempts"] - 1, 127)
+                    if ok:
+                        cur.execute(
+                            "UPDATE wechat_shipping_queue SET status='done', last_error=NULL WHERE id=%s",
+                            (task["id"],),
+                        )
+                        cur.execute(
+                            """UPDATE orders SET wechat_shipping_status=%s, wechat_shipping_time=NOW(),
+                                   wechat_shipping_msg=NULL, wechat_shipping_retry_count=%s
+                               WHERE id=%s""",
+                            (1 if task["attempts"] == 1 else 3, retry_count, task["order_id"]),
+                        )
+                    else:
+                        if task["attempts"] < MAX_ATTEMPTS and result.get("errcode") != ERR_LOCAL_MISSING:
+                            cur.execute(
+                                """UPDATE wechat_shipping_queue
+                                   SET status='pending', last_error=%s, next_run_at=NOW() + INTERVAL %s SECOND
+                                   WHERE id=%s""",
+                                (errmsg, ShippingSyncService._retry_delay(task, result), task["id"]),
+                            )
+                        else:
+                            cur.execute(
+                                "UPDATE wechat_shipping_queue SET status='failed', last_error=%s WHERE id=%s",
+                                (errmsg, task["id"]),
+                            )
+                            logger.error(f"【发货录入】多次失败已放弃: {task['order_number']}: {errmsg}")
+                        cur.execute(
+                            """UPDATE orders SET wechat_shipping_status=2, wechat_shipping_msg=%s,
+                                   wechat_shipping_retry_count=%s
+                               WHERE id=%s""",
+                            (errmsg, retry_count, task["order_id"]),
+                        )
+                    shipping = request.get("shipping_list") or [{}]
+                    logs.append((
+                        task["order_id"], task["order_number"], request.get("transaction_id") or None,
+                        "upload" if task["attempts"] == 1 else "retry", request.get("logistics_type"),
+                        shipping[0].get("express_company"), shipping[0].get("tracking_no"),
+                        json.dumps(request, ensure_ascii=False), json.dumps(result, ensure_ascii=False, default=str),
+                        result.get("errcode"), errmsg, 1 if ok else 0,
+                    ))
+                cur.executemany(
+                    """INSERT INTO wechat_shipping_logs
+                       (order_id, order_number, transaction_id, action_type, logistics_type, express_company,
+                        tracking_no, request_data, response_data, errcode, errmsg, is_success)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                    logs,
+                )
+                conn.commit()
+
+    @staticmethod
+    def process_pending(limit: int = BATCH_SIZE) -> int:
+        """上传到期任务（一直处理到没有到期任务），返回本轮录入成功数量"""
+        if not _worker_lock.acquire(blocking=False):
+            return 0
+        uploaded = 0
+        try:
+            from services.wechat_shipping_v2_service import WechatShippingService
+
+            wx_service = WechatShippingService()
+            while True:
+                tasks = ShippingSyncService._claim(limit)
+                if not tasks:
+                    break
+                with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="wx-shipping") as pool:
+                    outcomes = list(pool.map(lambda t: ShippingSyncService._upload(wx_service, t), tasks))
+                results = [(t, req, res) for t, (req, res) in zip(tasks, outcomes)]
+                ShippingSyncService._record(results)
+                uploaded += sum(1 for _, _, res in results if res.get("errcode") == 0)
+                if len(tasks) < limit:
+                    break
+        finally:
+            _worker_lock.release()
+        if uploaded:
+            logger.info(f"【发货录入】本轮录入成功 {uploaded} 单")
+        return uploaded
+
+    # ------------- 对账 -------------
+    @staticmethod
+    def reconcile(days: int = RECONCILE_DAYS) -> int:
+        """拉取微信订单列表，把微信侧已发货的未完成任务置为 done，返回修正数量"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """SELECT id, order_id, transaction_id FROM wechat_shipping_queue
+                       WHERE status IN ('pending', 'failed') AND transaction_id IS NOT NULL
+                         AND created_at >= NOW() - INTERVAL %s DAY""",
+                    (days,),
+                )
+                outstanding = {r["transaction_id"]: r for r in cur.fetchall()}
+        if not outstanding:
+            return 0
+
+        from services.wechat_shipping_v2_service import WechatShippingService
+
+        wx_service = WechatShippingService()
+        begin = int(time.mktime((datetime.now() - timedelta(days=days + 1)).timetuple()))
+        end = int(time.time())
+        shipped: List[Dict[str, Any]] = []
+        last_index = ""
+        while True:
+            result = wx_service.get_order_list(begin_time=begin, end_time=end, last_index=last_index, page_size=100)
+            if result.get("errcode") != 0:
+                logger.error(f"【发货对账】查询微信订单列表失败: {result}")
+                break
+            for wx_order in result.get("order_list") or []:
+                task = outstanding.get(wx_order.get("transaction_id"))
+                if task and wx_order.get("order_state") in WX_SHIPPED_STATES:
+                    shipped.append(task)
+            if not result.get("has_more"):
+                break
+            last_index = result.get("last_index", "")
+
+        if not shipped:
+            return 0
+        placeholders, params = build_in_placeholders([t["id"] for t in shipped])
+        o_placeholders, o_params = build_in_placeholders([t["order_id"] for t in shipped])
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""UPDATE wechat_shipping_queue SET status='done', last_error=NULL
+                        WHERE id IN ({placeholders}) AND status IN ('pending', 'failed')""",
+                    tuple(params.values()),
+                )
+                cur.execute(
+                    f"""UPDATE orders SET wechat_shipping_status=1, wechat_shipping_msg=NULL,
+                            wechat_last_sync_time=NOW()
+                        WHERE id IN ({o_placeholders})""",
+                    tuple(o_params.values()),
+                )
+                cur.executemany(
+                    """INSERT INTO wechat_shipping_logs
+                       (order_id, order_number, transaction_id, action_type, remark, is_success)
+                       SELECT id, order_number, transaction_id, 'sync', '微信侧已发货，对账置为已上传', 1
+                       FROM orders WHERE id=%s""",
+                    [(t["order_id"],) for t in shipped],
+                )
+                conn.commit()
+        logger.info(f"【发货对账】微信侧已发货，修正 {len(shipped)} 单")
+        return len(shipped)
@@ -0,0 +1,74 @@
+# services/user_display_service.py
+"""
+用户展示信息（昵称）批量解析
+
+报表翻页后对当页记录批量解析 user_id -> 名称：先查进程内 TTL LRU 缓存，未命中的一次 IN 查询补齐，
+替代逐条 `SELECT name FROM users WHERE id = %s`。
+修改资料（/user/update-profile）后调用 UserDisplayService.invalidate 失效本进程缓存，
+其它 worker 最多延迟 USER_DISPLAY_TTL_SECONDS。
+
+使用示例:
+    rows = cur.fetchall()
+    names = UserDisplayService.get_names((r["related_user"] for r in rows), cur)
+    for r in rows:
+        r["user_name"] = UserDisplayService.display_name(names, r["related_user"])
+"""
+from typing import Dict, Iterable, List, Optional
+
+from core.cache import TTLCache
+from core.database import get_conn
+from core.db_adapter import build_in_placeholders
+
+USER_DISPLAY_TTL_SECONDS = 300
+
+_user_names = TTLCache(maxsize=20000, ttl=USER_DISPLAY_TTL_SECONDS, name="user_display")
+
+# 无关联用户（系统/平台流水）时的展示名
+SYSTEM_USER_NAME = "系统"
+
+
+class UserDisplayService:
+
+    @staticmethod
+    def get_names(user_ids: Iterable[Optional[int]], cur=None) -> Dict[int, str]:
+        """批量解析用户名称，返回 {user_id: name}；不存在的用户不在结果中
+
+        cur: 可复用调用方已有的游标，不传则自行取连接
+        """
+        ids = {int(uid) for uid in user_ids if uid}
+        if not ids:
+            return {}
+
+        names: Dict[int, str] = _user_names.get_many(ids)
+        missing = [uid for uid in ids if uid not in names]
+        if missing:
+            loaded = UserDisplayService._load(missing, cur)
+            _user_names.set_many(loaded)
+            names.update(loaded)
+        return names
+
+    @staticmethod
+    def _load(user_ids: List[int], cur=None) -> Dict[int, str]:
+        placeholders, params = build_in_placeholders(user_ids)
+        sql = f"SELECT id, name FROM users WHERE id IN ({placeholders})"
+        if cur is not None:
+            cur.execute(sql, tuple(params.values()))
+            rows = cur.fetchall()
+        else:
+            with get_conn() as conn:
+                with conn.cursor() as own_cur:
+                    own_cur.execute(sql, tuple(params.values()))
+                    rows = own_cur.fetchall()
+        return {row['id']: row['name'] or "" for row in rows}
+
+    @staticmethod
+    def display_name(names: Dict[int, str], user_id: Optional[int]) -> str:
+        if not user_id:
+            return SYSTEM_USER_NAME
+        name = names.get(int(user_id))
+        return name if name is not None else f"未知用户:{user_id}"
+
+    @staticmethod
+    def invalidate(*user_ids: Optional[int]) -> None:
+        """用户资料变更后调用"""
+        _user_names.delete_many(int(uid) for uid in user_ids if uid)
@@ -407,6 +407,7 @@ class UserService:
                 )
                 conn.commit()
 
+        UserService.invalidate_avatar_codes(user_id)
         return urls
 
     # ==================== 优惠券查询功能 ====================
@@ -1139,15 +1140,28 @@ class UserService:
                 return new_code
 
     @staticmethod
-    def generate_referral_qr(user_id: int) -> Optional[str]:
+    def invalidate_avatar_codes(user_id: int) -> None:
+        """头像变更后失效叠加了头像的小程序码缓存（失败只记日志，不影响头像更新）"""
+        try:
+            from .wxacode_cache import WxaCodeCache
+
+            WxaCodeCache.invalidate_owner(user_id)
+        except Exception as e:
+            logger.warning(f"失效用户 {user_id} 小程序码缓存失败: {e}")
+
+    @staticmethod
+    def generate_referral_qr(user_id: int, force: bool = False) -> Optional[str]:
         """
         生成用户的推荐码小程序码图片并返回访问URL
+        图片经 WxaCodeCache 按推荐码缓存（/pic/wxacode/...），force=True 时重新向微信生成
         :param user_id: 用户ID
+        :param force: 是否忽略缓存强制重新生成
         :return: 二维码图片URL路径或 None
         """
         try:
             # 延迟导入，避免循环依赖
             from .wechat_service import WechatService
+            from .wxacode_cache import WxaCodeCache
 
             # 1. 获取推荐码
             referral_code = UserService.get_user_referral_code(user_id)
@@ -1155,29 +1169,20 @@ class UserService:
                 logger.warning(f"用户 {user_id} 无法获取推荐码")
                 return None
 
-            # 2. 生成小程序码
-            qr_data = WechatService.generate_wxacode(referral_code)
-            if not qr_data:
+            # 2. 生成（或命中缓存）小程序码
+            image = WxaCodeCache.get_image_sync(
+                "wxacode", scene=referral_code, page="pages/index/index", width=280, extra="hyaline",
+                producer=lambda: WechatService.generate_wxacode(referral_code),
+                owner_id=user_id, force=force,
+            )
+            if not image:
                 logger.error(f"用户 {user_id} 生成小程序码失败")
                 return None
 
-            # 3. 保存图片
-            qr_dir = AVATAR_UPLOAD_DIR / "referral_qr"
-            qr_dir.mkdir(parents=True, exist_ok=True)
-
-            filename = f"qr_{user_id}_{referral_code}.jpg"
-            save_path = qr_dir / filename
-
-            # 如果文件已存在，先删除
-            if save_path.exists():
-                save_path.unlink()
-
-            # 保存图片
-            with open(save_path, "wb") as f:
-                f.write(qr_data)
+            # 3. 图片已落盘到缓存目录，直接使用其静态地址
+            qr_url = image["url"]
 
             # 4. 更新用户表的 qr_path 字段（如果字段存在）
-            qr_url = f"/pic/avatars/referral_qr/{filename}"
             with get_conn() as conn:
                 with conn.cursor() as cur:
                     # 检查字段是否存在
@@ -1,16 +1,14 @@
 # services/wechat_api.py
-import asyncio
 import json
-import time
-import threading
 import httpx
 from core.config import settings
+from core.http_client import async_request
 from core.logging import get_logger  # ✅ 新增：导入 logger
+from core.wechat_token import get_access_token as _shared_access_token, is_stale_token_error
+from services.wxacode_cache import WxaCodeCache
 
 logger = get_logger(__name__)        # ✅ 新增：初始化 logger
 
-_access_token_lock = asyncio.Lock()
-
 _WXA_ENV_ALLOWED = frozenset({"release", "trial", "develop"})
 
 
@@ -20,8 +18,7 @@ def _normalize_wxa_env_version() -> str:
 
 
 def _looks_like_stale_access_token(msg: str) -> bool:
-    t = msg.lower()
-    return "invalid credential" in t or "not latest" in t
+    return is_stale_token_error(errmsg=msg)
 
 
 def _wxacode_response_to_png(resp: httpx.Response, context: str) -> bytes:
@@ -48,66 +45,29 @@ def _wxacode_response_to_png(resp: httpx.Response, context: str) -> bytes:
     raise ValueError("微信返回非图片数据，请检查 access_token、路径与 env_version 配置")
 
 
-async def get_access_token(*, force_refresh: bool = False) -> str:
+async def get_access_token(*, force_refresh: bool = False, stale_token: str | None = None) -> str:
     """
-    稳定版小程序 access_token（POST cgi-bin/stable_token）。
-    与普通 token 接口相比，多实例并发刷新时不易出现 40001「not latest」。
+    稳定版小程序 access_token（POST cgi-bin/stable_token），由 core.wechat_token 统一缓存与刷新。
+    stale_token：刚被微信判定失效的 token，重试时传入以获取新 token。
     """
-    now = int(time.time())
-    cache = getattr(get_access_token, "_cache", None)
-    if (
-        not force_refresh
-        and cache
-        and now - cache[1] < cache[2]
-    ):
-        return cache[0]
-
-    async with _access_token_lock:
-        now = int(time.time())
-        cache = getattr(get_access_token, "_cache", None)
-        if (
-            not force_refresh
-            and cache
-            and now - cache[1] < cache[2]
-        ):
-            return cache[0]
-
-        url = "https://api.weixin.qq.com/cgi-bin/stable_token"
-        body = {
-            "grant_type": "client_credential",
-            "appid": settings.WECHAT_APP_ID,
-            "secret": settings.WECHAT_APP_SECRET,
-            "force_refresh": bool(force_refresh),
-        }
-        async with httpx.AsyncClient() as cli:
-            ret = await cli.post(url, json=body, timeout=15)
-            ret.raise_for_status()
-            data = ret.json()
-        if data.get("errcode"):
-            logger.error("stable_token 失败: %s", data)
-            raise ValueError(data.get("errmsg") or str(data))
-        token = data["access_token"]
-        expires_in = int(data.get("expires_in") or 7200)
-        ttl = max(120, min(7000, expires_in - 300))
-        get_access_token._cache = (token, now, ttl)
-        return token
+    return await _shared_access_token(force_refresh=force_refresh, stale_token=stale_token)
 
 async def get_wxacode(path: str, scene: str = "", width: int = 280) -> bytes:
     """获取临时小程序码二进制"""
     last_err: BaseException | None = None
+    token: str | None = None
     for attempt in range(2):
-        token = await get_access_token(force_refresh=(attempt > 0))
+        token = await get_access_token(stale_token=token)
         url = f"https://api.weixin.qq.com/wxa/getwxacode?access_token={token}"
         body = {"path": path, "scene": scene, "width": width}
         try:
-            async with httpx.AsyncClient() as cli:
-                r = await cli.post(url, json=body)
-                r.raise_for_status()
-                return _wxacode_response_to_png(r, "getwxacode")
+            r = await async_request("POST", url, endpoint="wxa.getwxacode", idempotent=True, json=body)
+            r.raise_for_status()
+            return _wxacode_response_to_png(r, "getwxacode")
         except ValueError as e:
             last_err = e
             if attempt == 0 and _looks_like_stale_access_token(str(e)):
-                logger.warning("getwxacode token 失效，将强制刷新后重试: %s", e)
+                logger.warning("getwxacode token 失效，将刷新 access_token 后重试: %s", e)
                 continue
             raise
     assert last_err is not None
@@ -138,18 +98,18 @@ async def get_wxacode_unlimit(scene: str, page: str, width: int = 280) -> bytes:
         "env_version": env_ver,
     }
     last_err: BaseException | None = None
+    token: str | None = None
     for attempt in range(2):
-        token = await get_access_token(force_refresh=(attempt > 0))
+        token = await get_access_token(stale_token=token)
         url = f"https://api.weixin.qq.com/wxa/getwxacodeunlimit?access_token={token}"
         try:
-            async with httpx.AsyncClient() as client:
-                resp = await client.post(url, json=payload, timeout=10)
-                resp.raise_for_status()
-                return _wxacode_response_to_png(resp, "getwxacodeunlimit")
+            resp = await async_request("POST", url, endpoint="wxa.getwxacodeunlimit", idempotent=True, json=payload)
+            resp.raise_for_status()
+            return _wxacode_response_to_png(resp, "getwxacodeunlimit")
         except ValueError as e:
             last_err = e
             if attempt == 0 and _looks_like_stale_access_token(str(e)):
-                logger.warning("getwxacodeunlimit token 失效，将强制刷新后重试: %s", e)
+                logger.warning("getwxacodeunlimit token 失效，将刷新 access_token 后重试: %s", e)
                 continue
             raise
     assert last_err is not None
@@ -157,11 +117,6 @@ async def get_wxacode_unlimit(scene: str, page: str, width: int = 280) -> bytes:
 
 
 # ---------- URL Link（网页拉起小程序） ----------
-_urllink_memo: dict[str, tuple[str, float]] = {}
-_urllink_memo_lock = threading.Lock()
-URLLINK_MEMO_TTL_SEC = 86400
-
-
 async def generate_miniprogram_urllink(*, path: str, query: str = "") -> str:
     """
     调用 wxa/generate_urllink，返回 https 的 url_link。
@@ -175,18 +130,18 @@ async def generate_miniprogram_urllink(*, path: str, query: str = "") -> str:
     }
     if query:
         body["query"] = query
+    token: str | None = None
     for attempt in range(2):
-        token = await get_access_token(force_refresh=(attempt > 0))
+        token = await get_access_token(stale_token=token)
         api_url = f"https://api.weixin.qq.com/wxa/generate_urllink?access_token={token}"
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(api_url, json=body, timeout=15)
-            resp.raise_for_status()
+        resp = await async_request("POST", api_url, endpoint="wxa.generate_urllink", json=body)
+        resp.raise_for_status()
         data = resp.json()
         errcode = int(data.get("errcode") or 0)
         if errcode:
             logger.error("generate_urllink 失败: %s", data)
-            if attempt == 0 and errcode == 40001:
-                logger.warning("generate_urllink 40001，将强制刷新 stable_token 后重试")
+            if attempt == 0 and is_stale_token_error(errcode, data.get("errmsg")):
+                logger.warning("generate_urllink token 失效(%s)，刷新 access_token 后重试", errcode)
                 continue
             raise ValueError(data.get("errmsg") or str(data))
         link = data.get("url_link")
@@ -198,29 +153,18 @@ async def generate_miniprogram_urllink(*, path: str, query: str = "") -> str:
 
 
 async def get_or_create_permanent_pay_urllink(merchant_user_id: int) -> str:
-    """线下永久收款页 URL Link，带 query id=商户用户ID；带进程内缓存减轻微信配额压力。"""
+    """线下永久收款页 URL Link，带 query id=商户用户ID；经 WxaCodeCache 持久缓存、临近过期后台刷新。"""
     query = f"id={merchant_user_id}"
-    cache_key = f"pages/offline/permanentPay|{query}"
-    now = time.time()
-    with _urllink_memo_lock:
-        hit = _urllink_memo.get(cache_key)
-        if hit and now - hit[1] < URLLINK_MEMO_TTL_SEC:
-            return hit[0]
-    link = await generate_miniprogram_urllink(
+    return await WxaCodeCache.get_link(
+        "urllink",
         path="pages/offline/permanentPay",
         query=query,
+        producer=lambda: generate_miniprogram_urllink(path="pages/offline/permanentPay", query=query),
+        owner_id=merchant_user_id,
     )
-    with _urllink_memo_lock:
-        _urllink_memo[cache_key] = (link, now)
-    return link
 
 
 # ---------- URL Scheme（微信内 H5 立即跳转，减少 URL Link 中间确认页） ----------
-_scheme_memo: dict[str, tuple[str, float]] = {}
-_scheme_memo_lock = threading.Lock()
-SCHEME_MEMO_TTL_SEC = 86400
-
-
 async def generate_miniprogram_openlink(*, path: str, query: str = "") -> str:
     """
     调用 wxa/generatescheme，返回 weixin://dl/business/?t=... 的 openlink。
@@ -231,18 +175,18 @@ async def generate_miniprogram_openlink(*, path: str, query: str = "") -> str:
     if query:
         jump_wxa["query"] = query
     body: dict = {"jump_wxa": jump_wxa, "is_expire": False}
+    token: str | None = None
     for attempt in range(2):
-        token = await get_access_token(force_refresh=(attempt > 0))
+        token = await get_access_token(stale_token=token)
         api_url = f"https://api.weixin.qq.com/wxa/generatescheme?access_token={token}"
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(api_url, json=body, timeout=15)
-            resp.raise_for_status()
+        resp = await async_request("POST", api_url, endpoint="wxa.generatescheme", json=body)
+        resp.raise_for_status()
         data = resp.json()
         errcode = int(data.get("errcode") or 0)
         if errcode:
             logger.error("generatescheme 失败: %s", data)
-            if attempt == 0 and errcode == 40001:
-                logger.warning("generatescheme 40001，将强制刷新 stable_token 后重试")
+            if attempt == 0 and is_stale_token_error(errcode, data.get("errmsg")):
+                logger.warning("generatescheme token 失效(%s)，刷新 access_token 后重试", errcode)
                 continue
             raise ValueError(data.get("errmsg") or str(data))
         openlink = data.get("openlink")
@@ -254,18 +198,12 @@ async def generate_miniprogram_openlink(*, path: str, query: str = "") -> str:
 
 
 async def get_or_create_permanent_pay_openlink(merchant_user_id: int) -> str:
-    """与永久收款 URL Link 同 path/query；进程内缓存减轻微信生成配额压力。"""
+    """与永久收款 URL Link 同 path/query；经 WxaCodeCache 持久缓存减轻微信生成配额压力。"""
     query = f"id={merchant_user_id}"
-    cache_key = f"pages/offline/permanentPay|{query}"
-    now = time.time()
-    with _scheme_memo_lock:
-        hit = _scheme_memo.get(cache_key)
-        if hit and now - hit[1] < SCHEME_MEMO_TTL_SEC:
-            return hit[0]
-    link = await generate_miniprogram_openlink(
+    return await WxaCodeCache.get_link(
+        "openlink",
         path="pages/offline/permanentPay",
         query=query,
+        producer=lambda: generate_miniprogram_openlink(path="pages/offline/permanentPay", query=query),
+        owner_id=merchant_user_id,
     )
-    with _scheme_memo_lock:
-        _scheme_memo[cache_key] = (link, now)
-    return link
\ No newline at end of file
@@ -10,7 +10,7 @@ from typing import Dict, List, Optional, Any
 from fastapi import HTTPException, UploadFile
 from core.database import get_conn
 from core.config import WECHAT_PAY_MCH_ID, WECHAT_PAY_API_V3_KEY, DRAFT_EXPIRE_DAYS, MAX_FILE_SIZE_MB
-from core.wx_pay_client import WeChatPayClient  # ✅ 修复：WechatPayClient → WeChatPayClient
+from core.wx_pay_client import WeChatPayClient, AsyncWeChatPayClient  # ✅ 修复：WechatPayClient → WeChatPayClient
 from core.push_service import push_service
 from core.table_access import build_dynamic_select, build_dynamic_insert, build_dynamic_update
 import logging
@@ -21,6 +21,7 @@ logger = logging.getLogger(__name__)
 class WechatApplymentService:
     def __init__(self):
         self.pay_client = WeChatPayClient()  # ✅ 修复：WechatPayClient → WeChatPayClient
+        self.async_pay_client = AsyncWeChatPayClient(self.pay_client)
         self.max_file_size = MAX_FILE_SIZE_MB * 1024 * 1024
 
     def _extract_id_card_periods(self, subject_info: Any) -> tuple[Optional[str], Optional[str]]:
@@ -413,7 +414,7 @@ class WechatApplymentService:
                     }
 
                     # ✅ 强制使用服务商模式（is_sub_merchant=True）
-                    response = self.pay_client.submit_applyment(payload, is_sub_merchant=True)
+                    response = await self.async_pay_client.submit_applyment(payload, is_sub_merchant=True)
                     applyment_id = response.get("applyment_id")
 
                     card_period_begin = id_card_info.get("card_period_begin")
@@ -425,6 +426,9 @@ class WechatApplymentService:
                         "applyment_state": "APPLYMENT_STATE_AUDITING",
                         "is_draft": 0,
                         "submitted_at": datetime.datetime.now(),
+                        # 进入审核：重新开始按状态时长退避轮询
+                        "state_changed_at": datetime.datetime.now(),
+                        "next_check_at": None,
                         "card_period_begin": card_period_begin,
                         "card_period_end": card_period_end,
                         "updated_at": datetime.datetime.now(),
@@ -502,7 +506,7 @@ class WechatApplymentService:
             f.write(content)
 
         # 上传到微信支付获取media_id
-        media_id = self.pay_client.upload_image(content, file.content_type)
+        media_id = await self.async_pay_client.upload_image(content, file.content_type)
 
         # 保存到数据库
         with get_conn() as conn:
@@ -708,8 +712,8 @@ class WechatApplymentService:
                 logger.info(f"用户 {user_id} 修改核心信息，重新进件: {cur.lastrowid}")
                 return {"new_applyment_id": cur.lastrowid, "business_code": new_business_code}
 
-    def resubmit_applyment(self, user_id: int, applyment_id: int) -> dict:
-        """重新提交被驳回的进件"""
+    async def resubmit_applyment(self, user_id: int, applyment_id: int) -> dict:
+        """重新提交被驳回的进件（调用微信期间不持有数据库连接）"""
         with get_conn() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
@@ -744,10 +748,12 @@ class WechatApplymentService:
                     "business_info": business_info
                 }
 
-                # 调用微信支付API重新提交
-                response = self.pay_client.submit_applyment(submit_data, is_sub_merchant=True)
-                wx_applyment_id = response.get("applyment_id")
+        # 调用微信支付API重新提交（异步客户端，限流排队不阻塞事件循环）
+        response = await self.async_pay_client.submit_applyment(submit_data, is_sub_merchant=True)
+        wx_applyment_id = response.get("applyment_id")
 
+        with get_conn() as conn:
+            with conn.cursor() as cur:
                 # ✅ 修复：更新更多字段
                 update_data = {
                     "applyment_id": wx_applyment_id,  # 微信申请单号
@@ -755,6 +761,8 @@ class WechatApplymentService:
                     "applyment_state_msg": response.get("state_msg"),  # 新状态消息
                     "audit_detail": None,  # 清空驳回详情
                     "submitted_at": datetime.datetime.now(),  # 提交时间
+                    "state_changed_at": datetime.datetime.now(),
+                    "next_check_at": None,  # 尽快轮询
                     "updated_at": datetime.datetime.now()
                 }
                 update_sql = build_dynamic_update(cur, "wx_applyment", update_data, "id = %s")
@@ -964,19 +972,17 @@ class WechatApplymentService:
                 old_state = result['applyment_state']
 
                 # 更新状态
-                update_sql = build_dynamic_update(
-                    cur,
-                    "wx_applyment",
-                    {
-                        "applyment_state": new_state,
-                        "applyment_state_msg": status_info.get("state_msg"),
-                        "sub_mchid": status_info.get("sub_mchid"),
-                        "finished_at": datetime.datetime.now() if new_state == "APPLYMENT_STATE_FINISHED" else None,
-                        "updated_at": datetime.datetime.now()
-                    },
-                    "applyment_id = %s"
-                )
-                cur.execute(update_sql, (applyment_id,))
+                update_data = {
+                    "applyment_state": new_state,
+                    "applyment_state_msg": status_info.get("state_msg"),
+                    "sub_mchid": status_info.get("sub_mchid"),
+                    "finished_at": datetime.datetime.now() if new_state == "APPLYMENT_STATE_FINISHED" else None,
+                    "updated_at": datetime.datetime.now()
+                }
+                if new_state != old_state:
+                    update_data["state_changed_at"] = datetime.datetime.now()
+                update_sql = build_dynamic_update(cur, "wx_applyment", update_data, "applyment_id = %s")
+                cur.execute(update_sql, tuple(update_data.values()) + (applyment_id,))
 
                 # 如果审核通过，绑定商户号并同步结算账户
                 if new_state == "APPLYMENT_STATE_FINISHED":
@@ -0,0 +1,423 @@
+# services/wechat_reconcile_service.py
+"""
+微信支付每日对账
+
+原先凌晨同步任务只对齐发货/收货状态，且逐单 SELECT；支付是否真正落库全靠回调，漏回调/结算失败的单
+要等用户投诉才发现。现在按日对账，耗时与差异单数量成正比，而不是与订单总量成正比：
+
+1. 下载账单：一次 download_trade_bill 拉取当天全部支付成功流水（SUCCESS 账单），解析为
+   {transaction_id, out_trade_no, amount(分), trade_time}
+2. 批量比对：账单流水按 transaction_id 分批 IN 查询 orders / offline_order（均有 idx_trans），
+   未命中的再按商户订单号（唯一索引）查一次；本地当天已支付（orders.paid_at / offline_order.pay_time）
+   但不在账单里的单通过一次范围查询取出做差集
+3. 处理差异：
+   - unpaid_local：微信已支付、本地仍待支付 → 补投 pay_notify_inbox，走与回调相同的结算流程（修复）
+   - tx_mismatch：本地已支付但流水号为空 → 批量回填（修复）；流水号不一致 → 标记
+   - amount_mismatch / missing_local：金额不一致、本地无此订单 → 标记
+   - local_only：本地已支付但账单无记录 → 最多 VERIFY_CONCURRENCY 个并发按单查询微信核实，
+     跨日（回调晚于零点）等确认已支付的不算差异，其余标记
+   比对只占用一次只读连接；补投与向微信核实在释放连接后进行，不会为几百次外部调用占着连接池
+4. 报表：每个账单日一行 wechat_reconcile_runs（汇总），回填与差异明细在一个短事务里批量写入
+   wechat_reconcile_items；重跑同一日期覆盖上一次的明细
+"""
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.database import get_conn
+from core.db_adapter import build_in_placeholders
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+# 单次 IN 查询的流水号数量
+LOOKUP_CHUNK = 500
+# 向微信核实 local_only 的并发数与单次对账核实上限（超出部分直接标记未核实）
+VERIFY_CONCURRENCY = 4
+MAX_VERIFY = 500
+# 同一账单日对账在运行中视为有效的时长（分钟），超时认为上次运行已中断
+RUNNING_STALE_MINUTES = 30
+
+KIND_MISSING_LOCAL = "missing_local"
+KIND_UNPAID_LOCAL = "unpaid_local"
+KIND_TX_MISMATCH = "tx_mismatch"
+KIND_AMOUNT_MISMATCH = "amount_mismatch"
+KIND_LOCAL_ONLY = "local_only"
+
+ACTION_FIXED = "fixed"
+ACTION_FLAGGED = "flagged"
+
+# 账单中的终止行：之后为汇总区
+_BILL_SUMMARY_PREFIX = "总交易单数"
+
+
+def _to_fen(value: Any) -> int:
+    return int((Decimal(str(value or 0)) * 100).quantize(Decimal("1")))
+
+
+class ReconcileBusy(Exception):
+    """同一账单日的对账正在运行"""
+
+
+class WechatReconcileService:
+
+    # ------------- 账单 -------------
+    @staticmethod
+    def parse_bill(text: str) -> List[Dict[str, Any]]:
+        """解析交易账单 CSV：字段值带反引号前缀，汇总区（总交易单数…）之后忽略，只保留 SUCCESS 行"""
+        rows: List[Dict[str, Any]] = []
+        if not text:
+            return rows
+        reader = csv.reader(io.StringIO(text))
+        header: Optional[List[str]] = None
+        for line in reader:
+            if not line:
+                continue
+            if header is None:
+                header = [h.strip() for h in line]
+                continue
+            if line[0].startswith(_BILL_SUMMARY_PREFIX):
+                break
+            rec = dict(zip(header, (v.strip().lstrip("`") for v in line)))
+            if rec.get("交易状态", "SUCCESS") != "SUCCESS" or not rec.get("微信订单号"):
+                continue
+            rows.append({
+                "transaction_id": rec["微信订单号"],
+                "out_trade_no": rec.get("商户订单号", ""),
+                "amount": _to_fen(rec.get("订单金额") or rec.get("应结订单金额")),
+                "trade_time": rec.get("交易时间", ""),
+            })
+        return rows
+
+    # ------------- 本地订单 -------------
+    @staticmethod
+    def _fetch(cur, column: str, values: List[str], source: str) -> List[Dict[str, Any]]:
+        """按 transaction_id 或订单号分批 IN 查询，统一为 {source, order_no, status, paid, amount, transaction_id}"""
+        result: List[Dict[str, Any]] = []
+        for i in range(0, len(values), LOOKUP_CHUNK):
+            placeholders, params = build_in_placeholders(values[i:i + LOOKUP_CHUNK])
+            if source == "online":
+                col = "order_number" if column == "order_no" else column
+                cur.execute(
+                    f"""SELECT order_number AS order_no, status, total_amount, transaction_id
+                        FROM orders WHERE {col} IN ({placeholders})""",
+                    tuple(params.values()),
+                )
+                for r in cur.fetchall():
+                    result.append({
+                        "source": "online", "order_no": r["order_no"], "status": r["status"],
+                        "paid": r["status"] not in ("pending_pay", "cancelled"),
+                        "amount": _to_fen(r["total_amount"]), "transaction_id": r["transaction_id"] or "",
+                    })
+            else:
+                cur.execute(
+                    f"""SELECT order_no, status, amount, paid_amount, transaction_id
+                        FROM offline_order WHERE {column} IN ({placeholders})""",
+                    tuple(params.values()),
+                )
+                for r in cur.fetchall():
+                    result.append({
+                        "source": "offline", "order_no": r["order_no"], "status": str(r["status"]),
+                        "paid": r["status"] != 1,
+                        "amount": int(r["paid_amount"] or r["amount"] or 0),
+                        "transaction_id": r["transaction_id"] or "",
+                    })
+        return result
+
+    @staticmethod
+    def _match_local(cur, bill: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """返回 {transaction_id: 本地订单}；先按流水号，未命中再按商户订单号"""
+        tx_ids = [b["transaction_id"] for b in bill]
+        matched: Dict[str, Dict[str, Any]] = {}
+        for source in ("online", "offline"):
+            for row in WechatReconcileService._fetch(cur, "transaction_id", tx_ids, source):
+                matched[row["transaction_id"]] = row
+
+        rest = [b for b in bill if b["transaction_id"] not in matched and b["out_trade_no"]]
+        if rest:
+            by_no: Dict[str, Dict[str, Any]] = {}
+            online = [b["out_trade_no"] for b in rest if not b["out_trade_no"].startswith("OFF")]
+            offline = [b["out_trade_no"] for b in rest if b["out_trade_no"].startswith("OFF")]
+            for row in WechatReconcileService._fetch(cur, "order_no", online, "online"):
+                by_no[row["order_no"]] = row
+            for row in WechatReconcileService._fetch(cur, "order_no", offline, "offline"):
+                by_no[row["order_no"]] = row
+            for b in rest:
+                if b["out_trade_no"] in by_no:
+                    matched[b["transaction_id"]] = by_no[b["out_trade_no"]]
+        return matched
+
+    @staticmethod
+    def _local_paid_on(cur, bill_date: date) -> List[Dict[str, Any]]:
+        """本地当天已支付且有流水号的订单（orders.idx_paid_at / offline_order.idx_pay_time 范围扫描）"""
+        start = datetime.combine(bill_date, datetime.min.time())
+        end = start + timedelta(days=1)
+        cur.execute(
+            """SELECT order_number AS order_no, status, total_amount, transaction_id
+               FROM orders
+               WHERE paid_at >= %s AND paid_at < %s AND transaction_id IS NOT NULL AND transaction_id <> ''""",
+            (start, end),
+        )
+        rows = [{
+            "source": "online", "order_no": r["order_no"], "status": r["status"], "paid": True,
+            "amount": _to_fen(r["total_amount"]), "transaction_id": r["transaction_id"],
+        } for r in cur.fetchall()]
+        cur.execute(
+            """SELECT order_no, status, amount, paid_amount, transaction_id
+               FROM offline_order
+               WHERE pay_time >= %s AND pay_time < %s AND transaction_id IS NOT NULL AND transaction_id <> ''""",
+            (start, end),
+        )
+        rows.extend({
+            "source": "offline", "order_no": r["order_no"], "status": str(r["status"]), "paid": True,
+            "amount": int(r["paid_amount"] or r["amount"] or 0), "transaction_id": r["transaction_id"],
+        } for r in cur.fetchall())
+        return rows
+
+    # ------------- 差异处理 -------------
+    @staticmethod
+    def _item(kind: str, action: str, bill: Optional[Dict[str, Any]], local: Optional[Dict[str, Any]],
+              detail: str = "") -> Dict[str, Any]:
+        return {
+            "kind": kind,
+            "action": action,
+            "order_source": local["source"] if local else ("offline" if (bill or {}).get("out_trade_no", "").startswith("OFF") else "online"),
+            "order_no": local["order_no"] if local else (bill or {}).get("out_trade_no", ""),
+            "transaction_id": (bill or {}).get("transaction_id") or (local or {}).get("transaction_id", ""),
+            "wechat_amount": bill["amount"] if bill else None,
+            "local_amount": local["amount"] if local else None,
+            "local_status": local["status"] if local else None,
+            "detail": detail[:500],
+        }
+
+    @staticmethod
+    def _replay_notify(bill: Dict[str, Any]) -> str:
+        """补投支付成功事件到收件箱，由 process_pay_notify_inbox 按回调同样的流程结算"""
+        from services.pay_notify_inbox import PayNotifyInbox
+
+        event = PayNotifyInbox.enqueue({
+            "transaction_id": bill["transaction_id"],
+            "out_trade_no": bill["out_trade_no"],
+            "trade_state": "SUCCESS",
+            "success_time": bill["trade_time"],
+            "amount": {"total": bill["amount"]},
+        }, "RECONCILE.SUCCESS")
+        return f"已补投收件箱 event_id={event['id']} status={event['status']}"
+
+    @staticmethod
+    def _verify(local: Dict[str, Any]) -> Optional[str]:
+        """向微信核实本地已支付的单；确认已支付返回 None，否则返回差异说明"""
+        from core.wx_pay_client import wxpay_client
+
+        try:
+            resp = wxpay_client.query_transaction_by_out_trade_no(local["order_no"])
+        except Exception as e:
+            return f"查单失败: {e}"
+        state = resp.get("trade_state")
+        if state in ("SUCCESS", "REFUND") and resp.get("transaction_id") == local["transaction_id"]:
+            return None
+        return f"微信 trade_state={state} transaction_id={resp.get('transaction_id')}"
+
+    @staticmethod
+    def _diff(cur, bill: List[Dict[str, Any]], bill_date: date) -> Dict[str, Any]:
+        """比对账单与本地订单（只读），返回
+        {items: 已定性的差异, backfill: 待回填流水号, replay: 待补投的 (账单行, 本地单),
+         ok: 匹配数, candidates: 待向微信核实的本地单}"""
+        S = WechatReconcileService
+        matched = S._match_local(cur, bill)
+        items: List[Dict[str, Any]] = []
+        backfill: List[Tuple[str, str, str]] = []
+        replay: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+        ok = 0
+
+        for b in bill:
+            local = matched.get(b["transaction_id"])
+            if not local:
+                items.append(S._item(KIND_MISSING_LOCAL, ACTION_FLAGGED, b, None, "微信有支付成功流水，本地无此订单"))
+                continue
+            if not local["paid"]:
+                if local["status"] in ("pending_pay", "1"):
+                    replay.append((b, local))
+                else:
+                    items.append(S._item(KIND_UNPAID_LOCAL, ACTION_FLAGGED, b, local, "微信已支付，本地订单已取消"))
+                continue
+            if local["amount"] != b["amount"]:
+                items.append(S._item(KIND_AMOUNT_MISMATCH, ACTION_FLAGGED, b, local))
+                continue
+            if not local["transaction_id"]:
+                backfill.append((local["source"], b["transaction_id"], local["order_no"]))
+                items.append(S._item(KIND_TX_MISMATCH, ACTION_FIXED, b, local, "本地流水号为空，已回填"))
+                continue
+            if local["transaction_id"] != b["transaction_id"]:
+                items.append(S._item(KIND_TX_MISMATCH, ACTION_FLAGGED, b, local,
+                                     f"本地流水号 {local['transaction_id']}"))
+                continue
+            ok += 1
+
+        bill_tx = {b["transaction_id"] for b in bill}
+        candidates = [r for r in S._local_paid_on(cur, bill_date) if r["transaction_id"] not in bill_tx]
+        return {"items": items, "backfill": backfill, "replay": replay, "ok": ok, "candidates": candidates}
+
+    @staticmethod
+    def _replay_all(replay: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """补投收件箱（每条 enqueue 各自一个短事务）"""
+        S = WechatReconcileService
+        items: List[Dict[str, Any]] = []
+        for b, local in replay:
+            try:
+                items.append(S._item(KIND_UNPAID_LOCAL, ACTION_FIXED, b, local, S._replay_notify(b)))
+            except Exception as e:
+                items.append(S._item(KIND_UNPAID_LOCAL, ACTION_FLAGGED, b, local, f"补投失败: {e}"))
+        return items
+
+    @staticmethod
+    def _verify_all(candidates: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+        """本地已支付但账单中没有的单：并发向微信核实，跨日支付等确认无误的不计入差异；返回 (差异, 核实调用数)"""
+        S = WechatReconcileService
+        items: List[Dict[str, Any]] = []
+        to_verify, overflow = candidates[:MAX_VERIFY], candidates[MAX_VERIFY:]
+        if to_verify:
+            with ThreadPoolExecutor(max_workers=VERIFY_CONCURRENCY, thread_name_prefix="wx-reconcile") as pool:
+                for local, problem in zip(to_verify, pool.map(S._verify, to_verify)):
+                    if problem:
+                        items.append(S._item(KIND_LOCAL_ONLY, ACTION_FLAGGED, None, local, problem))
+        for local in overflow:
+            items.append(S._item(KIND_LOCAL_ONLY, ACTION_FLAGGED, None, local, "超出单次核实上限，未核实"))
+        return items, len(to_verify)
+
+    @staticmethod
+    def _write(run_id: int, bill_date: date, items: List[Dict[str, Any]],
+               backfill: List[Tuple[str, str, str]]) -> None:
+        """回填流水号并覆盖写入本次差异明细（一个短事务）"""
+        online = [(tx, no) for src, tx, no in backfill if src == "online"]
+        offline = [(tx, no) for src, tx, no in backfill if src == "offline"]
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                if online:
+                    cur.executemany(
+                        "UPDATE orders SET transaction_id=%s WHERE order_number=%s AND (transaction_id IS NULL OR transaction_id='')",
+                        online,
+                    )
+                if offline:
+                    cur.executemany(
+                        "UPDATE offline_order SET transaction_id=%s WHERE order_no=%s AND (transaction_id IS NULL OR transaction_id='')",
+                        offline,
+                    )
+                cur.execute("DELETE FROM wechat_reconcile_items WHERE run_id=%s", (run_id,))
+                if items:
+                    cur.executemany(
+                        """INSERT INTO wechat_reconcile_items
+                           (run_id, bill_date, kind, action, order_source, order_no, transaction_id,
+                            wechat_amount, local_amount, local_status, detail)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                        [(run_id, bill_date, i["kind"], i["action"], i["order_source"], i["order_no"],
+                          i["transaction_id"], i["wechat_amount"], i["local_amount"], i["local_status"],
+                          i["detail"]) for i in items],
+                    )
+                conn.commit()
+
+    # ------------- 运行与报表 -------------
+    @staticmethod
+    def _start_run(bill_date: date) -> int:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, status, started_at FROM wechat_reconcile_runs WHERE bill_date=%s FOR UPDATE",
+                    (bill_date,),
+                )
+                row = cur.fetchone()
+                if (row and row["status"] == "running" and row["started_at"]
+                        and row["started_at"] > datetime.now() - timedelta(minutes=RUNNING_STALE_MINUTES)):
+                    raise ReconcileBusy(f"{bill_date} 对账正在运行")
+                cur.execute(
+                    """INSERT INTO wechat_reconcile_runs (bill_date, status, started_at)
+                       VALUES (%s, 'running', NOW())
+                       ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id), status='running', started_at=NOW(),
+                                               finished_at=NULL, error=NULL""",
+                    (bill_date,),
+                )
+                run_id = cur.lastrowid
+                conn.commit()
+                return run_id
+
+    @staticmethod
+    def _finish_run(run_id: int, status: str, summary: Dict[str, Any], error: Optional[str] = None) -> None:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """UPDATE wechat_reconcile_runs
+                       SET status=%s, bill_count=%s, bill_amount=%s, matched_count=%s, fixed_count=%s,
+                           flagged_count=%s, verified_count=%s, error=%s, finished_at=NOW()
+                       WHERE id=%s""",
+                    (status, summary.get("bill_count", 0), summary.get("bill_amount", 0),
+                     summary.get("matched_count", 0), summary.get("fixed_count", 0),
+                     summary.get("flagged_count", 0), summary.get("verified_count", 0),
+                     (error or "")[:500] or None, run_id),
+                )
+                conn.commit()
+
+    @staticmethod
+    def run(bill_date: Optional[date] = None) -> Dict[str, Any]:
+        """对账指定日期（默认昨天），返回汇总；差异明细见 wechat_reconcile_items"""
+        from core.wx_pay_client import wxpay_client
+
+        bill_date = bill_date or (date.today() - timedelta(days=1))
+        run_id = WechatReconcileService._start_run(bill_date)
+        summary: Dict[str, Any] = {"run_id": run_id, "bill_date": str(bill_date)}
+        try:
+            bill = WechatReconcileService.parse_bill(wxpay_client.download_trade_bill(bill_date.isoformat()))
+            summary["bill_count"] = len(bill)
+            summary["bill_amount"] = sum(b["amount"] for b in bill)
+
+            # 比对只读、用完即释放连接；补投、向微信核实都在连接之外进行，最后一个短事务写入结果
+            with get_conn() as conn:
+                with conn.cursor() as cur:
+                    diff = WechatReconcileService._diff(cur, bill, bill_date)
+            items = diff["items"] + WechatReconcileService._replay_all(diff["replay"])
+            unverified, verified = WechatReconcileService._verify_all(diff["candidates"])
+            items.extend(unverified)
+            WechatReconcileService._write(run_id, bill_date, items, diff["backfill"])
+
+            summary.update(
+                matched_count=diff["ok"],
+                fixed_count=sum(1 for i in items if i["action"] == ACTION_FIXED),
+                flagged_count=sum(1 for i in items if i["action"] == ACTION_FLAGGED),
+                verified_count=verified,
+            )
+            WechatReconcileService._finish_run(run_id, "done", summary)
+        except Exception as e:
+            WechatReconcileService._finish_run(run_id, "failed", summary, error=str(e))
+            raise
+        logger.info(f"【微信对账】{summary}")
+        return summary
+
+    @staticmethod
+    def list_runs(limit: int = 30) -> List[Dict[str, Any]]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT * FROM wechat_reconcile_runs ORDER BY bill_date DESC LIMIT %s",
+                    (limit,),
+                )
+                return cur.fetchall()
+
+    @staticmethod
+    def list_items(bill_date: date, kind: Optional[str] = None, action: Optional[str] = None,
+                   limit: int = 200) -> List[Dict[str, Any]]:
+        sql = "SELECT * FROM wechat_reconcile_items WHERE bill_date=%s"
+        params: List[Any] = [bill_date]
+        if kind:
+            sql += " AND kind=%s"
+            params.append(kind)
+        if action:
+            sql += " AND action=%s"
+            params.append(action)
+        sql += " ORDER BY id LIMIT %s"
+        params.append(limit)
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, tuple(params))
+                return cur.fetchall()
@@ -3,7 +3,6 @@ import uuid
 import pymysql
 import jwt
 import datetime
-import requests
 import base64
 import json
 from Crypto.Cipher import AES
@@ -12,8 +11,10 @@ from fastapi import HTTPException
 
 from core.logging import get_logger
 from core.database import get_conn
+from core.http_client import sync_request
 from core.config import WECHAT_APP_ID, WECHAT_APP_SECRET
 from core.table_access import build_dynamic_select, _quote_identifier
+from core.wechat_token import get_access_token_sync, is_stale_token_error
 from services.user_service import hash_pwd, UserStatus, _generate_code
 
 logger = get_logger(__name__)
@@ -148,14 +149,11 @@ class WechatService:
     @staticmethod
     def get_openid_by_code(code: str) -> tuple[str, str]:
         """通过code换取openid和session_key"""
-        # 延迟导入 requests，避免 Windows multiprocessing 导入问题
-        import requests
-        
         if not WECHAT_APP_ID or not WECHAT_APP_SECRET:
             raise HTTPException(status_code=500, detail="未配置微信小程序 AppId/Secret，请在 .env 中设置 WECHAT_APP_ID 与 WECHAT_APP_SECRET")
 
         url = f"https://api.weixin.qq.com/sns/jscode2session?appid={WECHAT_APP_ID}&secret={WECHAT_APP_SECRET}&js_code={code}&grant_type=authorization_code"
-        response = requests.get(url)
+        response = sync_request("GET", url, endpoint="sns.jscode2session")
         if response.status_code != 200:
             raise HTTPException(status_code=500, detail="微信接口调用失败")
 
@@ -192,21 +190,6 @@ class WechatService:
         :return: 图片二进制数据或 None
         """
         try:
-            # 获取 access_token
-            token_url = (
-                f"https://api.weixin.qq.com/cgi-bin/token?"
-                f"grant_type=client_credential&appid={WECHAT_APP_ID}&secret={WECHAT_APP_SECRET}"
-            )
-            resp = requests.get(token_url, timeout=10).json()
-
-            access_token = resp.get("access_token")
-            if not access_token:
-                logger.error(f"获取 access_token 失败: {resp}")
-                return None
-
-            # 调用微信生成小程序码接口
-            qr_url = f"https://api.weixin.qq.com/wxa/getwxacodeunlimit?access_token={access_token}"
-
             data = {
                 "scene": scene,
                 "page": page,
@@ -215,15 +198,28 @@ class WechatService:
                 "check_path": False  # 不校验页面路径（适用于未发布页面）
             }
 
-            resp = requests.post(qr_url, json=data, timeout=10)
-
-            # 微信返回的是图片字节流或 JSON 错误信息
-            content_type = resp.headers.get("Content-Type", "")
-            if "image" in content_type:
-                return resp.content
-            else:
+            # 调用微信生成小程序码接口（token 失效时刷新后重试一次）
+            access_token = None
+            for attempt in range(2):
+                access_token = get_access_token_sync(stale_token=access_token)
+                qr_url = f"https://api.weixin.qq.com/wxa/getwxacodeunlimit?access_token={access_token}"
+                resp = sync_request("POST", qr_url, endpoint="wxa.getwxacodeunlimit", idempotent=True, json=data)
+
+                # 微信返回的是图片字节流或 JSON 错误信息
+                content_type = resp.headers.get("Content-Type", "")
+                if "image" in content_type:
+                    return resp.content
+
+                try:
+                    err = resp.json()
+                except ValueError:
+                    err = {}
+                if attempt == 0 and is_stale_token_error(err.get("errcode"), err.get("errmsg")):
+                    logger.warning(f"生成小程序码 token 失效，刷新后重试: {err}")
+                    continue
                 logger.error(f"生成小程序码失败: {resp.text}")
                 return None
+            return None
 
         except Exception as e:
             logger.exception(f"生成小程序码异常: {e}")
@@ -233,7 +229,7 @@ class WechatService:
     def get_openid_by_code(code: str) -> Tuple[str, str]:
         """code 换 openid 和 session_key"""
         url = f"https://api.weixin.qq.com/sns/jscode2session?appid={WECHAT_APP_ID}&secret={WECHAT_APP_SECRET}&js_code={code}&grant_type=authorization_code"
-        resp = requests.get(url, timeout=10).json()
+        resp = sync_request("GET", url, endpoint="sns.jscode2session").json()
 
         if "errcode" in resp and resp["errcode"] != 0:
             raise ValueError(f"微信接口错误: {resp.get('errmsg')}")
@@ -271,12 +267,15 @@ class WechatService:
     def get_phone_number(phone_code: str) -> str:
         """微信手机号快速验证 - 核心方法"""
         try:
-            # 获取 access_token
-            access_token = WechatService.get_access_token()
-
-            # 调用微信接口
-            url = f"https://api.weixin.qq.com/wxa/business/getuserphonenumber?access_token={access_token}"
-            resp = requests.post(url, json={"code": phone_code}, timeout=10).json()
+            # 调用微信接口（token 失效时刷新后重试一次）
+            access_token = None
+            for attempt in range(2):
+                access_token = get_access_token_sync(stale_token=access_token)
+                url = f"https://api.weixin.qq.com/wxa/business/getuserphonenumber?access_token={access_token}"
+                resp = sync_request("POST", url, endpoint="wxa.getuserphonenumber", json={"code": phone_code}).json()
+                if attempt == 0 and is_stale_token_error(resp.get("errcode"), resp.get("errmsg")):
+                    continue
+                break
 
             if resp.get("errcode") != 0:
                 raise ValueError(f"微信接口错误: {resp.get('errmsg')}")
@@ -289,11 +288,5 @@ class WechatService:
 
     @staticmethod
     def get_access_token() -> str:
-        """获取微信 access_token（生产环境需缓存）"""
-        url = f"https://api.weixin.qq.com/cgi-bin/token?grant_type=client_credential&appid={WECHAT_APP_ID}&secret={WECHAT_APP_SECRET}"
-        resp = requests.get(url, timeout=10).json()
-
-        if "access_token" not in resp:
-            raise ValueError(f"获取access_token失败: {resp}")
-
-        return resp["access_token"]
\ No newline at end of file
+        """获取微信 access_token（统一由 core.wechat_token 缓存与刷新）"""
+        return get_access_token_sync()
\ No newline at end of file
@@ -1,23 +1,20 @@
 # services/wechat_shipping_v2.py
 import json
-import re
-import time
 import logging
 from datetime import datetime
 from typing import Optional, Dict, Any, List
 from zoneinfo import ZoneInfo
 
-import requests
-from core.config import settings
-from core.database import get_conn
+import httpx
+from core.http_client import sync_request
 from core.logging import get_logger
+from core.wechat_token import get_access_token_sync, is_stale_token_error
 
 logger = get_logger(__name__)
 
 # 支付成功瞬间调用发货录入时，微信侧常尚未同步，返回「支付单不存在」，需延迟重试（见开放社区）
+# 重试由 services/shipping_sync_service.py 队列按 PAYMENT_NOT_FOUND_RETRY_SECONDS 间隔处理
 ERR_WX_SHIPPING_PAYMENT_NOT_FOUND = 10060001
-# 第 1 次立即请求，之后每次请求前的等待（秒）
-PICKUP_UPLOAD_RETRY_DELAYS_SEC = (2, 4, 8, 16, 24)
 
 # 物流类型映射：将你系统中的 delivery_way 映射为微信要求的枚举值
 # 1: 实体物流, 2: 同城配送, 3: 虚拟商品, 4: 用户自提
@@ -30,162 +27,17 @@ LOGISTICS_TYPE_MAP = {
 }
 
 
-def upload_pickup_shipping_to_wechat(order_number: str, transaction_id: str) -> None:
-    """
-    自提订单支付成功后向微信录入发货（logistics_type=4）。
-    微信「小程序订单」需先发货录入才会从「待发货」进入待收货流程；本地已直接 pending_recv，
-    商家端 ship 仅处理 pending_ship，故在此处补录。
-    """
-    tid = (transaction_id or "").strip()
-    if not tid:
-        logger.warning("自提同步微信发货跳过: 无 transaction_id, order=%s", order_number)
-        return
-    try:
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """SELECT o.id, o.delivery_way, u.openid
-                       FROM orders o JOIN users u ON o.user_id = u.id
-                       WHERE o.order_number=%s""",
-                    (order_number,),
-                )
-                row = cur.fetchone()
-                if not row:
-                    logger.warning("自提同步微信发货跳过: 订单不存在 %s", order_number)
-                    return
-                if row.get("delivery_way") != "pickup":
-                    return
-                openid = (row.get("openid") or "").strip()
-                if not openid:
-                    logger.warning("自提同步微信发货跳过: 无 openid, order=%s", order_number)
-                    return
-                cur.execute(
-                    """
-                    SELECT p.name
-                    FROM order_items oi
-                    JOIN products p ON oi.product_id = p.id
-                    WHERE oi.order_id = %s
-                    """,
-                    (row["id"],),
-                )
-                products = cur.fetchall() or []
-    except Exception as e:
-        logger.error("自提同步微信发货查询失败 order=%s: %s", order_number, e, exc_info=True)
-        return
-
-    clean_names = [re.sub(r"[\r\n\t]", "", p["name"]) for p in products]
-    joined = "、".join(clean_names)
-    if len(joined) > 120:
-        item_desc = joined[:117] + "…"
-    else:
-        item_desc = joined or "商品"
-
-    mchid = (
-        (getattr(settings, "WECHAT_PAY_MCH_ID", None) or getattr(settings, "WX_MCHID", None) or "")
-        .strip()
-    )
-    shipping_list = [{"item_desc": item_desc}]
-
-    try:
-        wx_service = WechatShippingService()
-
-        if mchid:
-            wx_mch = wx_service.upload_shipping_info(
-                "",
-                openid,
-                4,
-                shipping_list,
-                mchid=mchid,
-                out_trade_no=order_number,
-            )
-            if wx_mch.get("errcode") == 0:
-                logger.info("自提订单微信发货录入成功(商户单号): order=%s", order_number)
-                return
-            logger.info(
-                "自提订单按商户单号录入未成功，将按微信支付单号重试: order=%s err=%s",
-                order_number,
-                wx_mch,
-            )
-
-        max_tx_attempts = 1 + len(PICKUP_UPLOAD_RETRY_DELAYS_SEC)
-        last: Dict[str, Any] = {}
-        for attempt in range(max_tx_attempts):
-            if attempt > 0:
-                wait_sec = PICKUP_UPLOAD_RETRY_DELAYS_SEC[attempt - 1]
-                logger.info(
-                    "自提发货录入遇支付单未同步，%ss 后进行第 %s/%s 次请求: order=%s",
-                    wait_sec,
-                    attempt + 1,
-                    max_tx_attempts,
-                    order_number,
-                )
-                time.sleep(wait_sec)
-            last = wx_service.upload_shipping_info(
-                tid,
-                openid,
-                4,
-                shipping_list,
-                delivery_mode=1,
-            )
-            code = last.get("errcode")
-            if code == 0:
-                logger.info(
-                    "自提订单微信发货录入成功: order=%s tx=%s 第%s次请求",
-                    order_number,
-                    tid,
-                    attempt + 1,
-                )
-                return
-            if code != ERR_WX_SHIPPING_PAYMENT_NOT_FOUND:
-                logger.error(
-                    "自提订单微信发货录入失败: order=%s tx=%s err=%s",
-                    order_number,
-                    tid,
-                    last,
-                )
-                return
-
-        logger.error(
-            "自提订单微信发货录入失败(多次重试仍支付单不存在): order=%s tx=%s err=%s",
-            order_number,
-            tid,
-            last,
-        )
-    except Exception as e:
-        logger.error("自提订单微信发货录入异常 order=%s: %s", order_number, e, exc_info=True)
-
-
 class WechatShippingService:
     """微信小程序发货信息管理服务 V2"""
 
     BASE_URL = "https://api.weixin.qq.com/wxa/sec/order"
 
-    def __init__(self):
-        self.access_token = None
-        self.token_expires_at = 0
-
-    def _get_access_token(self) -> str:
-        """获取并缓存 access_token"""
-        if self.access_token and time.time() < self.token_expires_at:
-            return self.access_token
-
-        url = f"https://api.weixin.qq.com/cgi-bin/token?grant_type=client_credential&appid={settings.WECHAT_APP_ID}&secret={settings.WECHAT_APP_SECRET}"
-        try:
-            resp = requests.get(url, timeout=10)
-            resp.raise_for_status()
-            data = resp.json()
-            self.access_token = data.get("access_token")
-            expires_in = data.get("expires_in", 7200)
-            self.token_expires_at = time.time() + expires_in - 200
-            logger.info("成功获取微信 access_token")
-            return self.access_token
-        except Exception as e:
-            logger.error(f"获取微信 access_token 失败: {e}")
-            raise
+    def _get_access_token(self, stale_token: Optional[str] = None) -> str:
+        """获取 access_token（core.wechat_token 统一缓存，多 worker 共享）"""
+        return get_access_token_sync(stale_token=stale_token)
 
     def _request(self, endpoint: str, payload: dict) -> dict:
         """通用的微信API请求方法，处理 token 和错误"""
-        url = f"{self.BASE_URL}{endpoint}?access_token={self._get_access_token()}"
         try:
             # 微信对请求体 UTF-8 校验较严；显式 charset 与 bytes 可避免 47007(not UTF8)
             body = json.dumps(
@@ -196,13 +48,21 @@ class WechatShippingService:
             )
             body_bytes = body.encode("utf-8")
             headers = {"Content-Type": "application/json; charset=utf-8"}
-            resp = requests.post(url, data=body_bytes, headers=headers, timeout=15)
-            resp.raise_for_status()
-            result = resp.json()
+            token = None
+            for attempt in range(2):
+                token = self._get_access_token(stale_token=token)
+                url = f"{self.BASE_URL}{endpoint}?access_token={token}"
+                resp = sync_request("POST", url, endpoint="wxa.sec.order", content=body_bytes, headers=headers)
+                resp.raise_for_status()
+                result = resp.json()
+                if attempt == 0 and is_stale_token_error(result.get("errcode"), result.get("errmsg")):
+                    logger.warning(f"微信发货API token 失效，刷新后重试: endpoint={endpoint}")
+                    continue
+                break
             if result.get("errcode") != 0:
                 logger.error(f"微信发货API调用失败: endpoint={endpoint}, errcode={result.get('errcode')}, errmsg={result.get('errmsg')}")
             return result
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"微信发货API请求异常: {e}")
             raise
 
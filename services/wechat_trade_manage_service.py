@@ -10,6 +10,7 @@ from typing import Any, Dict
 
 from core.database import get_conn
 from core.logging import get_logger
+from services.order_detail_cache import OrderDetailCache
 
 logger = get_logger(__name__)
 
@@ -72,6 +73,7 @@ def process_trade_manage_order_settlement(data: Dict[str, Any]) -> None:
                         (order["id"],),
                     )
                     conn.commit()
+                    OrderDetailCache.invalidate(order["order_number"])
                     logger.info("订单 %s 已根据微信结算/确认收货事件更新为已完成", order["order_number"])
     except Exception as e:
         logger.error("处理 trade_manage_order_settlement 失败: %s", e, exc_info=True)
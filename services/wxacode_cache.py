@@ -0,0 +1,304 @@
+# services/wxacode_cache.py
+"""
+小程序码 / 普通二维码 / URL Link 持久缓存
+
+永久收款码、推荐码每次展示都要调微信生成（永久收款码还要用 Pillow 叠加商户头像），
+URL Link / URL Scheme 只有进程内 24 小时缓存，多 worker 各自生成。现在统一走这里：
+
+1. 缓存键：sha256(kind | scene | page | width | env_version | avatar_hash | extra)，
+   头像参与键计算，换头像自然生成新码；索引存 wxa_code_cache 表，进程内 TTLCache 兜一层
+2. 图片按内容 sha256 存放在 pic_data/wxacode/<前两位>/<sha256>.png，经 /pic 静态目录直接访问，
+   相同图片只存一份；写文件先写临时文件再 os.replace，并发生成不会读到半张图
+3. URL Link / Scheme 微信侧最长 30 天有效：按 LINK_TTL_DAYS 记过期时间，
+   剩余不足 LINK_REFRESH_BEFORE_DAYS 时先返回旧链接、后台重新生成（同一键同时只生成一次）
+4. 失效：头像变更调用 invalidate_owner(user_id)，删除该用户带头像的缓存行；
+   不再被引用的图片文件由定时任务 purge_orphan_files 清理
+
+使用示例:
+    image = await WxaCodeCache.get_image(
+        "wxacode", scene="m=1", page="pages/offline/permanentPay", width=280,
+        producer=lambda: get_wxacode_unlimit("m=1", "pages/offline/permanentPay"), owner_id=1,
+    )
+    image["url"]   # /pic/wxacode/ab/ab12....png
+"""
+import asyncio
+import hashlib
+import io
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from core.cache import TTLCache
+from core.config import WXACODE_CACHE_DIR
+from core.database import get_conn
+from core.logging import get_logger
+
+logger = get_logger(__name__)
+
+STATIC_URL_PREFIX = "/pic/wxacode"
+# URL Link / URL Scheme 记录的有效期（微信侧最长 30 天），以及提前后台刷新的天数
+LINK_TTL_DAYS = 25
+LINK_REFRESH_BEFORE_DAYS = 3
+# 未被引用的图片文件保留时长（小时），避免删除刚写入、尚未落库的文件
+ORPHAN_FILE_GRACE_HOURS = 24
+
+_entries = TTLCache(maxsize=4096, ttl=300, name="wxa_code_cache")
+# 生成中的任务 {cache_key: Task}：同一键并发未命中/后台刷新只调用一次微信
+_inflight: Dict[str, "asyncio.Task"] = {}
+
+
+def _env_version() -> str:
+    from services.wechat_api import _normalize_wxa_env_version
+
+    return _normalize_wxa_env_version()
+
+
+def file_fingerprint(path: Optional[Path]) -> str:
+    """头像等本地文件的指纹（路径 + 大小 + 修改时间），文件不存在返回空串"""
+    if not path:
+        return ""
+    try:
+        st = path.stat()
+    except OSError:
+        return ""
+    raw = f"{path.name}|{st.st_size}|{st.st_mtime_ns}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def composite_center_logo(code_bytes: bytes, logo_file: Path, ratio: float = 0.25) -> bytes:
+    """把头像/LOGO 缩放到码宽的 ratio 后贴到中心，返回 PNG；失败返回原图"""
+    try:
+        from PIL import Image
+
+        code_im = Image.open(io.BytesIO(code_bytes)).convert("RGBA")
+        logo_im = Image.open(logo_file).convert("RGBA")
+        size = int(code_im.width * ratio)
+        logo_im = logo_im.resize((size, size), Image.LANCZOS)
+        code_im.paste(logo_im, ((code_im.width - size) // 2, (code_im.height - size) // 2), logo_im)
+        buf = io.BytesIO()
+        code_im.save(buf, format="PNG")
+        return buf.getvalue()
+    except Exception as e:
+        logger.warning(f"叠加头像失败 {logo_file}: {e}")
+        return code_bytes
+
+
+class WxaCodeCache:
+
+    # ---------- 键 / 存储 ----------
+    @staticmethod
+    def cache_key(kind: str, *, scene: str = "", page: str = "", width: int = 0,
+                  env_version: str = "", avatar_hash: str = "", extra: str = "") -> str:
+        raw = "|".join([kind, scene, page, str(width), env_version, avatar_hash, extra])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _url(file_path: str) -> str:
+        return f"{STATIC_URL_PREFIX}/{file_path}"
+
+    @staticmethod
+    def _write_file(content: bytes) -> tuple:
+        """按内容寻址写文件，返回 (content_hash, 相对路径)"""
+        content_hash = hashlib.sha256(content).hexdigest()
+        ext = ".jpg" if content[:3] == b"\xff\xd8\xff" else ".png"
+        rel = f"{content_hash[:2]}/{content_hash}{ext}"
+        path = WXACODE_CACHE_DIR / rel
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f".{uuid.uuid4().hex}.tmp")
+            tmp.write_bytes(content)
+            os.replace(tmp, path)
+        return content_hash, rel
+
+    @staticmethod
+    def _load(key: str) -> Optional[Dict[str, Any]]:
+        row = _entries.get(key)
+        if row is not None:
+            return row
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT cache_key, kind, content_hash, file_path, link, expires_at "
+                    "FROM wxa_code_cache WHERE cache_key=%s",
+                    (key,)
+                )
+                row = cur.fetchone()
+        if row:
+            _entries.set(key, row)
+        return row
+
+    @staticmethod
+    def _save(key: str, kind: str, *, scene: str, page: str, width: int, env_version: str,
+              avatar_hash: str, owner_id: Optional[int], content_hash: Optional[str] = None,
+              file_path: Optional[str] = None, link: Optional[str] = None,
+              expires_at: Optional[datetime] = None) -> Dict[str, Any]:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """INSERT INTO wxa_code_cache
+                       (cache_key, kind, owner_id, scene, page, width, env_version, avatar_hash,
+                        content_hash, file_path, link, expires_at)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                       ON DUPLICATE KEY UPDATE owner_id=VALUES(owner_id), content_hash=VALUES(content_hash),
+                           file_path=VALUES(file_path), link=VALUES(link), expires_at=VALUES(expires_at)""",
+                    (key, kind, owner_id, scene[:255], page[:255], width, env_version, avatar_hash,
+                     content_hash, file_path, link, expires_at)
+                )
+                conn.commit()
+        row = {"cache_key": key, "kind": kind, "content_hash": content_hash,
+               "file_path": file_path, "link": link, "expires_at": expires_at}
+        _entries.set(key, row)
+        return row
+
+    @staticmethod
+    def _image_result(row: Dict[str, Any], created: bool) -> Dict[str, Any]:
+        return {
+            "url": WxaCodeCache._url(row["file_path"]),
+            "path": WXACODE_CACHE_DIR / row["file_path"],
+            "content_hash": row["content_hash"],
+            "created": created,
+        }
+
+    @staticmethod
+    def _image_hit(row: Optional[Dict[str, Any]]) -> bool:
+        return bool(row and row.get("file_path") and (WXACODE_CACHE_DIR / row["file_path"]).exists())
+
+    @staticmethod
+    def _start(key: str, factory: Callable[[], Awaitable[Any]]) -> "asyncio.Task":
+        task = _inflight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(factory())
+            _inflight[key] = task
+
+            def _done(t, k=key):
+                if _inflight.get(k) is t:
+                    _inflight.pop(k, None)
+                if not t.cancelled() and t.exception() is not None:
+                    logger.warning(f"小程序码/链接生成失败 {k[:12]}: {t.exception()}")
+
+            task.add_done_callback(_done)
+        return task
+
+    @staticmethod
+    async def _single_flight(key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        return await asyncio.shield(WxaCodeCache._start(key, factory))
+
+    # ---------- 图片 ----------
+    @staticmethod
+    async def get_image(kind: str, *, scene: str, page: str, width: int = 280,
+                        producer: Callable[[], Awaitable[bytes]], avatar_hash: str = "",
+                        extra: str = "", owner_id: Optional[int] = None,
+                        force: bool = False) -> Dict[str, Any]:
+        """命中直接返回静态地址；未命中（或 force）调用 producer 生成并落盘
+
+        :return: {"url", "path", "content_hash", "created"}，created=True 表示本次新生成
+        """
+        env_version = _env_version()
+        key = WxaCodeCache.cache_key(kind, scene=scene, page=page, width=width, env_version=env_version,
+                                     avatar_hash=avatar_hash, extra=extra)
+        if not force:
+            # 查库/写库是同步 pymysql 调用，放到线程池，避免阻塞事件循环
+            row = await asyncio.to_thread(WxaCodeCache._load, key)
+            if WxaCodeCache._image_hit(row):
+                return WxaCodeCache._image_result(row, created=False)
+
+        async def _generate():
+            content = await producer()
+            content_hash, rel = await asyncio.to_thread(WxaCodeCache._write_file, content)
+            return await asyncio.to_thread(
+                WxaCodeCache._save, key, kind, scene=scene, page=page, width=width, env_version=env_version,
+                avatar_hash=avatar_hash, owner_id=owner_id, content_hash=content_hash, file_path=rel,
+            )
+
+        row = await WxaCodeCache._single_flight(key, _generate)
+        return WxaCodeCache._image_result(row, created=True)
+
+    @staticmethod
+    def get_image_sync(kind: str, *, scene: str, page: str, width: int = 280,
+                       producer: Callable[[], Optional[bytes]], avatar_hash: str = "",
+                       extra: str = "", owner_id: Optional[int] = None,
+                       force: bool = False) -> Optional[Dict[str, Any]]:
+        """同步版 get_image（供同步路由/服务使用）；producer 返回 None 时不缓存并返回 None"""
+        env_version = _env_version()
+        key = WxaCodeCache.cache_key(kind, scene=scene, page=page, width=width, env_version=env_version,
+                                     avatar_hash=avatar_hash, extra=extra)
+        if not force:
+            row = WxaCodeCache._load(key)
+            if WxaCodeCache._image_hit(row):
+                return WxaCodeCache._image_result(row, created=False)
+        content = producer()
+        if not content:
+            return None
+        content_hash, rel = WxaCodeCache._write_file(content)
+        row = WxaCodeCache._save(key, kind, scene=scene, page=page, width=width, env_version=env_version,
+                                 avatar_hash=avatar_hash, owner_id=owner_id,
+                                 content_hash=content_hash, file_path=rel)
+        return WxaCodeCache._image_result(row, created=True)
+
+    # ---------- URL Link / Scheme ----------
+    @staticmethod
+    async def get_link(kind: str, *, path: str, query: str = "",
+                       producer: Callable[[], Awaitable[str]], owner_id: Optional[int] = None) -> str:
+        """未过期直接返回；临近过期返回旧链接并后台刷新；已过期/未命中同步生成"""
+        env_version = _env_version()
+        key = WxaCodeCache.cache_key(kind, scene=query, page=path, env_version=env_version)
+
+        async def _generate():
+            link = await producer()
+            return await asyncio.to_thread(
+                WxaCodeCache._save, key, kind, scene=query, page=path, width=0, env_version=env_version,
+                avatar_hash="", owner_id=owner_id, link=link,
+                expires_at=datetime.now() + timedelta(days=LINK_TTL_DAYS),
+            )
+
+        row = await asyncio.to_thread(WxaCodeCache._load, key)
+        now = datetime.now()
+        if row and row.get("link") and row.get("expires_at") and row["expires_at"] > now:
+            if row["expires_at"] - now < timedelta(days=LINK_REFRESH_BEFORE_DAYS) and key not in _inflight:
+                logger.info(f"{kind} 临近过期，后台刷新: {path}?{query}")
+                WxaCodeCache._start(key, _generate)
+            return row["link"]
+
+        row = await WxaCodeCache._single_flight(key, _generate)
+        return row["link"]
+
+    # ---------- 失效 / 清理 ----------
+    @staticmethod
+    def invalidate_owner(owner_id: int) -> int:
+        """头像变更后调用：删除该用户叠加了头像的缓存行（下次展示按新头像重新生成）"""
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM wxa_code_cache WHERE owner_id=%s AND avatar_hash<>''",
+                    (owner_id,)
+                )
+                deleted = cur.rowcount
+                conn.commit()
+        if deleted:
+            _entries.clear()
+            logger.info(f"用户 {owner_id} 头像变更，失效小程序码缓存 {deleted} 条")
+        return deleted
+
+    @staticmethod
+    def purge_orphan_files() -> int:
+        """删除不再被 wxa_code_cache 引用、且超过保留时长的图片文件"""
+        if not WXACODE_CACHE_DIR.exists():
+            return 0
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT DISTINCT file_path FROM wxa_code_cache WHERE file_path IS NOT NULL")
+                referenced = {r["file_path"] for r in cur.fetchall()}
+        cutoff = time.time() - ORPHAN_FILE_GRACE_HOURS * 3600
+        removed = 0
+        for f in WXACODE_CACHE_DIR.glob("*/*"):
+            rel = f"{f.parent.name}/{f.name}"
+            try:
+                if rel not in referenced and f.stat().st_mtime < cutoff:
+                    f.unlink()
+                    removed += 1
+            except OSError as e:
+                logger.warning(f"清理小程序码文件失败 {f}: {e}")
+        return removed
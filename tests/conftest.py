@@ -0,0 +1,78 @@
+# tests/conftest.py
+"""测试环境：补齐必需配置（不连接真实 MySQL/Redis），微信接口走 Mock"""
+import os
+import sys
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret")
+os.environ.setdefault("MYSQL_USER", "test")
+os.environ.setdefault("MYSQL_PASSWORD", "test")
+os.environ.setdefault("MYSQL_DATABASE", "test")
+os.environ.setdefault("REDIS_HOST", "")
+os.environ.setdefault("WX_MOCK_MODE", "true")
+os.environ.setdefault("ENVIRONMENT", "test")
+
+
+class FakeCursor:
+    """按 SQL 片段分派到 handler 的游标：handler(sql, params) 返回 (rowcount, rows) 或 (rowcount, rows, lastrowid)"""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.rowcount = 0
+        self.lastrowid = None
+        self._rows = []
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+        result = self.handler(sql, params)
+        self.rowcount, self._rows = result[0], result[1]
+        if len(result) > 2:
+            self.lastrowid = result[2]
+        return self.rowcount
+
+    def executemany(self, sql, seq):
+        total = 0
+        for params in seq:
+            total += self.execute(sql, params)
+        self.rowcount = total
+        return total
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConn:
+    def __init__(self, handler):
+        self.handler = handler
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self.handler)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+def fake_get_conn(handler):
+    """生成可替换 get_conn 的上下文管理器工厂"""
+    @contextmanager
+    def _get_conn(*args, **kwargs):
+        yield FakeConn(handler)
+    return _get_conn
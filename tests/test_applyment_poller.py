@@ -0,0 +1,29 @@
+# tests/test_applyment_poller.py
+"""进件轮询排期：间隔为状态时长的 1/AGE_DIVISOR，夹在上下限之间，失败有最小退避"""
+from datetime import datetime, timedelta
+
+from services.applyment_poller import (
+    AGE_DIVISOR, ERROR_INTERVAL, MAX_INTERVAL, MIN_INTERVAL, next_check_time,
+)
+
+NOW = datetime(2026, 10, 19, 12, 0, 0)
+
+
+def test_fresh_state_uses_min_interval():
+    assert next_check_time(NOW, NOW) == NOW + MIN_INTERVAL
+    assert next_check_time(None, NOW) == NOW + MIN_INTERVAL
+
+
+def test_interval_grows_with_state_age():
+    age = timedelta(minutes=40)
+    assert next_check_time(NOW - age, NOW) == NOW + age / AGE_DIVISOR
+
+
+def test_interval_is_capped():
+    assert next_check_time(NOW - timedelta(days=3), NOW) == NOW + MAX_INTERVAL
+
+
+def test_failure_waits_at_least_error_interval():
+    assert next_check_time(NOW, NOW, failed=True) == NOW + ERROR_INTERVAL
+    # 间隔本身已超过 ERROR_INTERVAL 时不缩短
+    assert next_check_time(NOW - timedelta(days=3), NOW, failed=True) == NOW + MAX_INTERVAL
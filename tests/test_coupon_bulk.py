@@ -0,0 +1,81 @@
+# tests/test_coupon_bulk.py
+"""批量发券：券 ID 按每条 INSERT 推出；批量兑换整批失败时逐个用户重试"""
+from decimal import Decimal
+
+import pytest
+
+from conftest import FakeCursor, fake_get_conn
+import services.finance_service as finance_module
+from core.exceptions import FinanceException
+from services.finance_service import FinanceService
+
+
+class CouponDb:
+    """只模拟发券用到的 users / coupons / account_flow 语句"""
+
+    def __init__(self, balances, next_id=100, step=1, broken_user=None):
+        self.balances = dict(balances)
+        self.next_id = next_id
+        self.step = step
+        self.broken_user = broken_user
+        self.coupons = []
+
+    def __call__(self, sql, params):
+        sql = " ".join(sql.split())
+        if sql.startswith("SELECT id FROM users WHERE id >"):
+            last_id, limit = params
+            ids = sorted(uid for uid, b in self.balances.items() if uid > last_id and b > 0)[:limit]
+            return len(ids), [{"id": uid} for uid in ids]
+        if sql.startswith("SELECT id, true_total_points FROM users"):
+            rows = [{"id": uid, "true_total_points": self.balances[uid]} for uid in params if uid in self.balances]
+            return len(rows), rows
+        if sql.startswith("UPDATE users SET true_total_points"):
+            charged = {p for p in params if isinstance(p, int) and p in self.balances}
+            return len(charged), []
+        if sql.startswith("SELECT @@auto_increment_increment"):
+            return 1, [{"step": self.step}]
+        if sql.startswith("INSERT INTO coupons"):
+            rows = [params[i:i + 6] for i in range(0, len(params), 6)]
+            first_id = self.next_id
+            self.next_id += len(rows) * self.step
+            self.coupons.extend(rows)
+            return len(rows), [], first_id
+        if sql.startswith("INSERT INTO account_flow"):
+            if self.broken_user in params[1::6]:
+                raise RuntimeError(f"flow insert failed for {self.broken_user}")
+            return len(params) // 6, []
+        raise AssertionError(f"unexpected sql: {sql}")
+
+
+def test_issue_ids_follow_each_insert(monkeypatch):
+    monkeypatch.setattr(finance_module, "COUPON_BULK_INSERT_CHUNK", 2)
+    db = CouponDb({1: Decimal("5"), 2: Decimal("5")}, next_id=100, step=2)
+    issued = FinanceService._issue_coupons_bulk(
+        FakeCursor(db), {1: 2, 2: 1}, db.balances, Decimal("1")
+    )
+    # 第一条 INSERT 两张（100, 102），第二条 INSERT 一张（104）
+    assert issued == {1: [100, 102], 2: [104]}
+
+
+def test_issue_rejects_short_insert():
+    db = CouponDb({1: Decimal("5")})
+
+    def short_insert(sql, params):
+        if "INSERT INTO coupons" in sql:
+            return 0, [], None
+        return db(sql, params)
+
+    with pytest.raises(FinanceException):
+        FinanceService._issue_coupons_bulk(FakeCursor(short_insert), {1: 1}, db.balances, Decimal("1"))
+
+
+def test_batch_exchange_isolates_failing_user(monkeypatch):
+    db = CouponDb({1: Decimal("3"), 2: Decimal("2"), 3: Decimal("1")}, broken_user=2)
+    monkeypatch.setattr(finance_module, "get_conn", fake_get_conn(db))
+    monkeypatch.setattr(finance_module.time, "sleep", lambda s: None)
+    # 成功后余额不会真正扣减，第二轮查询从 last_id 之后开始，不会重复处理
+    result = FinanceService(session=object()).batch_exchange_coupons(max_per_user=10)
+    assert result["total_users"] == 3
+    assert result["success_count"] == 2
+    assert [f["user_id"] for f in result["failed_users"]] == [2]
+    assert result["total_coupons_issued"] == 4
@@ -0,0 +1,37 @@
+# tests/test_db_adapter.py
+"""build_date_range：含首尾两天的日期过滤改写为半开区间"""
+from datetime import date, datetime
+
+import pytest
+
+from core.db_adapter import build_date_range
+
+
+def test_both_ends_become_half_open_range():
+    sql, params = build_date_range("af.created_at", "2025-01-01", "2025-01-31")
+    assert sql == "af.created_at >= %s AND af.created_at < %s"
+    assert params == [datetime(2025, 1, 1), datetime(2025, 2, 1)]
+
+
+def test_single_end():
+    assert build_date_range("created_at", start_date="2025-03-01") == (
+        "created_at >= %s", [datetime(2025, 3, 1)]
+    )
+    assert build_date_range("created_at", end_date=date(2025, 12, 31)) == (
+        "created_at < %s", [datetime(2026, 1, 1)]
+    )
+
+
+def test_datetime_and_long_strings_truncate_to_day():
+    sql, params = build_date_range("o.created_at", datetime(2025, 5, 6, 13, 45), "2025-05-07 23:59:59")
+    assert params == [datetime(2025, 5, 6), datetime(2025, 5, 8)]
+
+
+def test_no_dates_returns_empty_predicate():
+    assert build_date_range("created_at") == ("", [])
+    assert build_date_range("created_at", "", None) == ("", [])
+
+
+def test_bad_format_raises():
+    with pytest.raises(ValueError):
+        build_date_range("created_at", "2025/01/01")
@@ -0,0 +1,87 @@
+# tests/test_pool_ledger.py
+"""PoolLedger：按登记顺序校验余额，一次 UPDATE 写净变动、一条 INSERT 写流水"""
+from decimal import Decimal
+
+import pytest
+
+from conftest import FakeCursor
+from core.exceptions import InsufficientBalanceException
+from services.pool_ledger import PoolLedger
+
+
+class FinanceAccounts:
+    """只模拟 finance_accounts / account_flow 上 PoolLedger 用到的语句"""
+
+    def __init__(self, balances):
+        self.balances = {k: Decimal(v) for k, v in balances.items()}
+        self.flows = []
+        self.updates = 0
+
+    def __call__(self, sql, params):
+        sql = " ".join(sql.split())
+        if sql.startswith("SELECT account_type, balance FROM finance_accounts"):
+            rows = [{"account_type": t, "balance": self.balances[t]} for t in sorted(params) if t in self.balances]
+            return len(rows), rows
+        if sql.startswith("INSERT INTO finance_accounts"):
+            self.balances.setdefault(params[1], Decimal("0"))
+            return 1, []
+        if sql.startswith("UPDATE finance_accounts"):
+            self.updates += 1
+            n = sql.count("WHEN %s THEN %s")
+            for i in range(n):
+                self.balances[params[2 * i]] += params[2 * i + 1]
+            return n, []
+        if sql.startswith("INSERT INTO account_flow"):
+            self.flows.extend(params[i:i + 8] for i in range(0, len(params), 8))
+            return len(params) // 8, []
+        raise AssertionError(f"unexpected sql: {sql}")
+
+
+def test_commit_applies_net_deltas_and_running_balances():
+    db = FinanceAccounts({"platform_revenue_pool": "100", "subsidy_pool": "5"})
+    ledger = PoolLedger(related_order_id=9, ref_type="order_split")
+    ledger.add("platform_revenue_pool", Decimal("50"), "入账")
+    ledger.add("subsidy_pool", Decimal("-5"), "扣减")
+    ledger.add("platform_revenue_pool", Decimal("-30"), "扣回")
+
+    result = ledger.commit(FakeCursor(db))
+
+    assert result == {"platform_revenue_pool": Decimal("120"), "subsidy_pool": Decimal("0")}
+    assert db.balances == result
+    assert db.updates == 1
+    # balance_after 是每笔之后的余额，按登记顺序推算
+    assert [(f[0], f[3], f[4]) for f in db.flows] == [
+        ("platform_revenue_pool", Decimal("150"), "income"),
+        ("subsidy_pool", Decimal("0"), "expense"),
+        ("platform_revenue_pool", Decimal("120"), "expense"),
+    ]
+    assert len(ledger) == 0
+
+
+def test_insufficient_balance_raises_before_any_write():
+    db = FinanceAccounts({"subsidy_pool": "10"})
+    ledger = PoolLedger().add("subsidy_pool", Decimal("-5"), "a").add("subsidy_pool", Decimal("-6"), "b")
+
+    with pytest.raises(InsufficientBalanceException):
+        ledger.commit(FakeCursor(db))
+    assert db.balances == {"subsidy_pool": Decimal("10")}
+    assert db.flows == [] and db.updates == 0
+
+
+def test_unchecked_entry_may_go_negative():
+    db = FinanceAccounts({"subsidy_pool": "1"})
+    result = PoolLedger().add("subsidy_pool", Decimal("-3"), "兜底扣减", check_balance=False).commit(FakeCursor(db))
+    assert result == {"subsidy_pool": Decimal("-2")}
+
+
+def test_missing_pool_is_created_with_zero_balance():
+    db = FinanceAccounts({})
+    result = PoolLedger().add("new_pool", Decimal("8"), "首笔").commit(FakeCursor(db))
+    assert result == {"new_pool": Decimal("8")}
+    assert db.balances == {"new_pool": Decimal("8")}
+
+
+def test_empty_ledger_commits_nothing():
+    db = FinanceAccounts({})
+    assert PoolLedger().commit(FakeCursor(db)) == {}
+    assert db.flows == []
@@ -0,0 +1,110 @@
+# tests/test_rate_limiter.py
+"""限流器：令牌桶计算与共享后端逐级降级（Redis → MySQL → 进程内）"""
+import pytest
+
+import core.rate_limiter as rate_module
+from core.rate_limiter import RateLimiter, RateLimitExceeded, _take
+
+
+class _RedisDown(Exception):
+    pass
+
+
+class _BrokenRedis:
+    def eval(self, *args):
+        raise _RedisDown("connection reset")
+
+
+def test_take_refills_and_caps_at_capacity():
+    granted, wait, tokens = _take(tokens=0.0, ts=0.0, now=100.0, rate=5.0, capacity=5.0, max_wait=1.0)
+    assert (granted, wait, tokens) == (True, 0.0, 4.0)
+
+
+def test_take_reserves_into_debt_and_reports_wait():
+    granted, wait, tokens = _take(tokens=0.5, ts=10.0, now=10.0, rate=2.0, capacity=2.0, max_wait=1.0)
+    assert granted is True
+    assert wait == pytest.approx(0.25)
+    assert tokens == pytest.approx(-0.5)
+
+
+def test_take_rejects_beyond_max_wait_without_spending():
+    granted, wait, tokens = _take(tokens=-3.0, ts=0.0, now=0.0, rate=1.0, capacity=1.0, max_wait=2.0)
+    assert granted is False
+    assert wait == pytest.approx(4.0)
+    assert tokens == -3.0
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    failures = []
+    monkeypatch.setattr(rate_module, "is_redis_configured", lambda: True)
+    monkeypatch.setattr(rate_module, "get_redis_client", lambda: _BrokenRedis())
+    monkeypatch.setattr(rate_module, "is_redis_error", lambda e: isinstance(e, _RedisDown))
+    monkeypatch.setattr(rate_module, "mark_redis_failure", failures.append)
+    lim = RateLimiter(max_calls=2, period=1, name="t", backend="auto")
+    lim.redis_failures = failures
+    return lim
+
+
+def test_redis_error_falls_back_to_mysql(limiter, monkeypatch):
+    monkeypatch.setattr(limiter._mysql, "take", lambda *a: (True, 0.0))
+    assert limiter._take("k") == (True, 0.0, "mysql")
+    assert len(limiter.redis_failures) == 1
+
+
+def test_mysql_error_falls_back_to_memory(limiter, monkeypatch):
+    def mysql_down(*a):
+        raise RuntimeError("too many connections")
+
+    monkeypatch.setattr(limiter._mysql, "take", mysql_down)
+    assert limiter._take("k") == (True, 0.0, "memory")
+    assert limiter._take("k") == (True, 0.0, "memory")
+    # 进程内桶容量 2 用完后开始排队
+    granted, wait, backend = limiter._take("k")
+    assert granted is True and wait > 0 and backend == "memory"
+
+
+def test_memory_mode_errors_propagate(monkeypatch):
+    lim = RateLimiter(max_calls=1, period=1, name="m", backend="memory")
+
+    def broken(*a):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(lim._memory, "take", broken)
+    with pytest.raises(RuntimeError):
+        lim._take("k")
+
+
+def test_reserve_raises_when_queue_too_long():
+    lim = RateLimiter(max_calls=1, period=10, name="q", backend="memory", max_wait=1.0)
+    assert lim._reserve("k") == 0.0
+    with pytest.raises(RateLimitExceeded):
+        lim._reserve("k")
+    assert lim.get_stats("k")["rejected"] == 1
+
+
+def test_auto_without_redis_configured_uses_memory(monkeypatch):
+    monkeypatch.setattr(rate_module, "is_redis_configured", lambda: False)
+    lim = RateLimiter(max_calls=1, period=1, name="nr", backend="auto")
+    assert lim._backend() is lim._memory
+
+
+def _with_sub_mchid(self, sub_mchid, account_info=None):
+    pass
+
+
+def _without_sub_mchid(self, applyment_id):
+    pass
+
+
+def test_extract_key_uses_sub_mchid_by_name():
+    key = RateLimiter._extract_key
+    assert key(_with_sub_mchid, (object(), "1900001"), {}) == "_with_sub_mchid_1900001"
+    assert key(_with_sub_mchid, (object(),), {"sub_mchid": "1900002"}) == "_with_sub_mchid_1900002"
+
+
+def test_extract_key_without_sub_mchid_shares_interface_bucket():
+    key = RateLimiter._extract_key
+    # applyment_id 不是子商户号，不参与计数键
+    assert key(_without_sub_mchid, (object(), 123), {}) == "_without_sub_mchid"
+    assert key(_with_sub_mchid, (object(), ""), {}) == "_with_sub_mchid"
@@ -0,0 +1,106 @@
+# tests/test_refund_service.py
+"""退款任务：分账回冲只执行一次，且不依赖 submitting→processing 迁移"""
+import pytest
+
+from conftest import fake_get_conn
+import services.refund_service as refund_module
+from services.refund_service import RefundService
+
+
+class RefundTasksTable:
+    """只模拟 refund_tasks 上 RefundService 用到的几条 UPDATE"""
+
+    def __init__(self, status="submitting", split_reversed=0):
+        self.row = {"id": 1, "out_refund_no": "REF1_1", "order_number": "ORD1",
+                    "status": status, "split_reversed": split_reversed}
+
+    def __call__(self, sql, params):
+        sql = " ".join(sql.split())
+        if "SET status='processing'" in sql:
+            if self.row["status"] == "submitting":
+                self.row["status"] = "processing"
+                return 1, []
+            return 0, []
+        if "SET split_reversed=1" in sql:
+            if self.row["split_reversed"] == 0:
+                self.row["split_reversed"] = 1
+                return 1, []
+            return 0, []
+        if "SET split_reversed=0" in sql:
+            self.row["split_reversed"] = 0
+            return 1, []
+        raise AssertionError(f"unexpected sql: {sql}")
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = RefundTasksTable()
+    monkeypatch.setattr(refund_module, "get_conn", fake_get_conn(table))
+    return table
+
+
+@pytest.fixture
+def reversals(monkeypatch):
+    calls = []
+    monkeypatch.setattr(refund_module, "reverse_split_on_refund", calls.append)
+    return calls
+
+
+def _task():
+    return {"id": 1, "out_refund_no": "REF1_1", "order_number": "ORD1"}
+
+
+def test_accepted_moves_to_processing_and_reverses(table, reversals):
+    assert RefundService._on_submit_accepted(_task(), {"refund_id": "wx1"}) is True
+    assert table.row["status"] == "processing"
+    assert reversals == ["ORD1"]
+
+
+def test_reverse_split_runs_once_across_paths(table, reversals):
+    assert RefundService.reverse_split_once("REF1_1", "ORD1") is True
+    assert RefundService.reverse_split_once("REF1_1", "ORD1") is False
+    RefundService._on_submit_accepted(_task(), {"refund_id": "wx1"})
+    assert reversals == ["ORD1"]
+
+
+def test_success_before_accept_still_reverses(table, reversals):
+    # 回调/同步抢先置为 success：受理落库迁移 0 行，但回冲仍要执行
+    table.row["status"] = "success"
+    assert RefundService._on_submit_accepted(_task(), {"refund_id": "wx1"}) is False
+    assert reversals == ["ORD1"]
+    assert table.row["split_reversed"] == 1
+
+
+def test_failed_reversal_releases_flag_for_retry(table, monkeypatch):
+    attempts = []
+
+    def flaky(order_number):
+        attempts.append(order_number)
+        if len(attempts) == 1:
+            raise RuntimeError("db down")
+
+    monkeypatch.setattr(refund_module, "reverse_split_on_refund", flaky)
+    assert RefundService.reverse_split_once("REF1_1", "ORD1") is False
+    assert table.row["split_reversed"] == 0
+    assert RefundService.reverse_split_once("REF1_1", "ORD1") is True
+    assert table.row["split_reversed"] == 1
+    assert attempts == ["ORD1", "ORD1"]
+
+
+def test_closed_refund_moves_application_to_terminal_status(monkeypatch):
+    executed = []
+
+    def handler(sql, params):
+        sql = " ".join(sql.split())
+        executed.append(sql)
+        if sql.startswith("SELECT order_number, prev_order_status"):
+            return 1, [{"order_number": "ORD1", "prev_order_status": "pending_recv"}]
+        return 1, []
+
+    monkeypatch.setattr(refund_module, "get_conn", fake_get_conn(handler))
+    monkeypatch.setattr(refund_module.OrderDetailCache, "invalidate", lambda *a: None)
+    monkeypatch.setattr(refund_module.idempotency_store, "mark_done", lambda *a: None)
+
+    assert RefundService.apply_refund_closed("REF1_1") is True
+    assert any("UPDATE refunds" in sql and "r.status='rejected'" in sql and "r.status='seller_ok'" in sql
+               for sql in executed)
@@ -0,0 +1,56 @@
+# tests/test_unilevel_dividend.py
+"""联创分红：每权重金额、单人封顶、预览缓存返回副本"""
+from decimal import Decimal
+
+import services.finance_service as finance_module
+from services.finance_service import FinanceService, UNILEVEL_MAX_PER_USER
+
+
+def _member(user_id, level):
+    return {"user_id": user_id, "level": level, "name": f"u{user_id}", "member_level": 1}
+
+
+def test_auto_amount_splits_pool_by_weight():
+    plan = FinanceService._compute_unilevel_dividend(
+        [_member(1, 1), _member(2, 3)], Decimal("400"), None
+    )
+    assert plan["total_weight"] == Decimal("4")
+    assert plan["amount_per_weight"] == Decimal("100")
+    assert plan["will_use_adjusted"] is False
+    assert [u["actual"] for u in plan["users"]] == [Decimal("100"), Decimal("300")]
+    assert plan["total_actual"] == Decimal("400")
+
+
+def test_adjusted_amount_is_capped_per_user():
+    plan = FinanceService._compute_unilevel_dividend(
+        [_member(1, 1), _member(2, 3)], Decimal("100"), Decimal("5000")
+    )
+    capped = plan["users"][1]
+    assert plan["will_use_adjusted"] is True
+    assert capped["theoretical"] == Decimal("15000")
+    assert capped["actual"] == UNILEVEL_MAX_PER_USER
+    assert capped["is_capped"] is True
+    assert plan["users"][0]["is_capped"] is False
+    assert plan["total_theoretical"] == Decimal("20000")
+    assert plan["total_actual"] == Decimal("5000") + UNILEVEL_MAX_PER_USER
+
+
+def test_empty_members_have_zero_weight():
+    plan = FinanceService._compute_unilevel_dividend([], Decimal("400"), None)
+    assert plan["total_weight"] == 0
+    assert plan["amount_per_weight_auto"] == Decimal("0")
+    assert plan["users"] == []
+
+
+def test_cached_preview_is_a_copy(monkeypatch):
+    service = FinanceService(session=object())
+    monkeypatch.setattr(service, "get_account_balance", lambda account_type: Decimal("100"))
+    monkeypatch.setattr(service, "_get_adjusted_unilevel_amount", lambda: None)
+    finance_module._unilevel_preview_cache.clear()
+    key = (finance_module.datetime.now().strftime("%Y-%m"), "100", "None")
+    finance_module._unilevel_preview_cache.set(key, {"users": [{"user_id": 1}]})
+
+    first = service.calculate_unilevel_dividend_preview()
+    first["users"].append({"user_id": 2})
+    assert service.calculate_unilevel_dividend_preview() == {"users": [{"user_id": 1}]}
+    finance_module._unilevel_preview_cache.clear()
@@ -0,0 +1,71 @@
+# tests/test_wechat_reconcile.py
+"""微信对账：交易账单解析与“核实期间不占连接”"""
+from services import wechat_reconcile_service as reconcile_module
+from services.wechat_reconcile_service import (
+    KIND_LOCAL_ONLY, WechatReconcileService,
+)
+
+BILL = (
+    "交易时间,公众账号ID,商户号,微信订单号,商户订单号,交易状态,应结订单金额,订单金额\n"
+    "`2026-10-18 10:00:01,`wx1,`1900,`4200000001,`ORD1,`SUCCESS,`12.50,`12.50\n"
+    "`2026-10-18 11:00:00,`wx1,`1900,`4200000002,`OFF2,`REFUND,`3.00,`3.00\n"
+    "`2026-10-18 12:30:00,`wx1,`1900,,`ORD3,`SUCCESS,`1.00,`1.00\n"
+    "`2026-10-18 13:00:00,`wx1,`1900,`4200000004,`OFF4,`SUCCESS,`0.99,\n"
+    "总交易单数,应结订单总金额,退款总金额\n"
+    "`3,`14.49,`3.00\n"
+)
+
+
+def test_parse_bill_keeps_success_rows_with_transaction_id():
+    rows = WechatReconcileService.parse_bill(BILL)
+    assert rows == [
+        {"transaction_id": "4200000001", "out_trade_no": "ORD1", "amount": 1250,
+         "trade_time": "2026-10-18 10:00:01"},
+        # 订单金额为空时回落到应结订单金额
+        {"transaction_id": "4200000004", "out_trade_no": "OFF4", "amount": 99,
+         "trade_time": "2026-10-18 13:00:00"},
+    ]
+
+
+def test_parse_bill_empty_text():
+    assert WechatReconcileService.parse_bill("") == []
+
+
+def test_verify_runs_without_holding_a_connection(monkeypatch):
+    open_conns = []
+
+    class _Conn:
+        def __enter__(self):
+            open_conns.append(self)
+            return self
+
+        def __exit__(self, *exc):
+            open_conns.remove(self)
+            return False
+
+        def cursor(self):
+            return self
+
+    local = {"source": "online", "order_no": "ORD9", "status": "completed", "paid": True,
+             "amount": 100, "transaction_id": "4200000009"}
+    writes = []
+
+    def verify(row):
+        assert open_conns == []
+        return "微信 trade_state=NOT_EXIST transaction_id=None"
+
+    monkeypatch.setattr(reconcile_module, "get_conn", _Conn)
+    monkeypatch.setattr(WechatReconcileService, "_start_run", staticmethod(lambda bill_date: 7))
+    monkeypatch.setattr(WechatReconcileService, "_finish_run", staticmethod(lambda *a, **k: None))
+    monkeypatch.setattr(WechatReconcileService, "_diff", staticmethod(
+        lambda cur, bill, bill_date: {"items": [], "backfill": [], "replay": [], "ok": 0, "candidates": [local]}
+    ))
+    monkeypatch.setattr(WechatReconcileService, "_verify", staticmethod(verify))
+    monkeypatch.setattr(WechatReconcileService, "_write", staticmethod(
+        lambda run_id, bill_date, items, backfill: writes.append(items)
+    ))
+
+    summary = WechatReconcileService.run()
+    assert summary["verified_count"] == 1
+    assert summary["flagged_count"] == 1
+    assert [i["kind"] for i in writes[0]] == [KIND_LOCAL_ONLY]